@@ -786,6 +786,11 @@ class TileAcqPlugin(Plugin):
 
         # For stitching only
         da_list = []  # for each position, a list of DataArrays
+        if self.stitch.value:
+            # Register the tiles in the background, while the acquisition goes on
+            reg_pipeline = stitching.RegistrationPipeline()
+        else:
+            reg_pipeline = None
         i = 0
         prev_idx = [0, 0]
         try:
@@ -815,7 +820,10 @@ class TileAcqPlugin(Plugin):
 
                 if self.stitch.value:
                     # Sort tiles (largest sem on first position)
-                    da_list.append(self.sort_das(das, stitch_ss))
+                    das_stitch = self.sort_das(das, stitch_ss)
+                    da_list.append(das_stitch)
+                    if da_list[0]:
+                        reg_pipeline.addTile(das_stitch)
 
                 # Check the FoV is correct using the data, and if not update
                 if i == 0:
@@ -835,7 +843,7 @@ class TileAcqPlugin(Plugin):
                 ft.set_progress(end=self.estimate_time(0) + time.time())
 
                 logging.info("Computing big image out of %d images", len(da_list))
-                das_registered = stitching.register(da_list)
+                das_registered = reg_pipeline.getRegisteredTiles(ft)
 
                 # Select weaving method
                 # On a Sparc system the mean weaver gives the best result since it
@@ -897,6 +905,8 @@ class TileAcqPlugin(Plugin):
             self._dlg.setAcquisitionInfo("Acquisition failed: %s" % (ex,),
                                          lvl=logging.ERROR)
         finally:
+            if reg_pipeline:
+                reg_pipeline.cancel()
             logging.info("Tiled acquisition ended")
             main_data.stage.moveAbs(orig_pos)
 
@@ -32,6 +32,7 @@ from odemis import model
 from odemis.model import InstantaneousFuture
 from odemis.util import executeAsyncTask, almost_equal
 from odemis.util.img import Subtract
+import Queue
 from scipy import ndimage
 import threading
 import time
@@ -39,10 +40,16 @@ import time
 
 MTD_BINARY = 0
 MTD_EXHAUSTIVE = 1
+MTD_SWEEP = 2
 
 MAX_STEPS_NUMBER = 100  # Max steps to perform autofocus
 MAX_BS_NUMBER = 1  # Maximum number of applying binary search with a smaller max_step
 
+# Number of images acquired during the focus sweep (if the focus speed can be set)
+MIN_SWEEP_FRAMES = 20
+MAX_SWEEP_FRAMES = 200
+SWEEP_BINNING = 2  # binning (or scale increase) of the images during the sweep
+
 
 def _convertRBGToGrayscale(image):
     """
@@ -179,6 +186,52 @@ def _discard_data(df, data):
     pass
 
 
+def _getDepthOfField(detector, emt):
+    """
+    Find the depth of field, to use as reference for the focus steps
+    detector: model.DigitalCamera or model.Detector
+    emt (None or model.Emitter): In case of a SED this is the scanner used
+    return (0<float): depth of field (m)
+    """
+    # use the .depthOfField on detector or emitter
+    avail_depths = (detector, emt)
+    if model.hasVA(emt, "dwellTime"):
+        # Hack in case of using the e-beam with a DigitalCamera detector.
+        # All the digital cameras have a depthOfField, which is updated based
+        # on the optical lens properties... but the depthOfField in this
+        # case depends on the e-beam lens.
+        # TODO: or better rely on which component the focuser affects? If it
+        # affects (also) the emitter, use this one first? (but in the
+        # current models the focusers affects nothing)
+        avail_depths = (emt, detector)
+    for c in avail_depths:
+        if model.hasVA(c, "depthOfField"):
+            dof = c.depthOfField.value
+            break
+    else:
+        logging.debug("No depth of field info found")
+        dof = 1e-6  # m, not too bad value
+    logging.debug("Depth of field is %f", dof)
+    return dof
+
+
+def _getFocusMeasure(detector):
+    """
+    Pick measurement method based on the heuristics that SEM detectors
+    are typically just a point (ie, shape == data depth).
+    detector: model.DigitalCamera or model.Detector
+    return (callable): MeasureOpticalFocus or MeasureSEMFocus
+    """
+    # TODO: is this working as expected? Alternatively, we could check
+    # MD_DET_TYPE.
+    if len(detector.shape) > 1:
+        logging.debug("Using Optical method to estimate focus")
+        return MeasureOpticalFocus
+    else:
+        logging.debug("Using SEM method to estimate focus")
+        return MeasureSEMFocus
+
+
 def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
     """
     Iteratively acquires an optical image, measures its focus level and adjusts
@@ -224,24 +277,7 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
         timeout = 3 + 2 * estimateAcquisitionTime(detector, emt)
 
         # use the .depthOfField on detector or emitter as maximum stepsize
-        avail_depths = (detector, emt)
-        if model.hasVA(emt, "dwellTime"):
-            # Hack in case of using the e-beam with a DigitalCamera detector.
-            # All the digital cameras have a depthOfField, which is updated based
-            # on the optical lens properties... but the depthOfField in this
-            # case depends on the e-beam lens.
-            # TODO: or better rely on which component the focuser affects? If it
-            # affects (also) the emitter, use this one first? (but in the
-            # current models the focusers affects nothing)
-            avail_depths = (emt, detector)
-        for c in avail_depths:
-            if model.hasVA(c, "depthOfField"):
-                dof = c.depthOfField.value
-                break
-        else:
-            logging.debug("No depth of field info found")
-            dof = 1e-6  # m, not too bad value
-        logging.debug("Depth of field is %f", dof)
+        dof = _getDepthOfField(detector, emt)
         min_step = dof / 2
 
         # adjust to rng_focus if provided
@@ -263,16 +299,7 @@ def _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
         best_fm = 0
         last_pos = None
 
-        # Pick measurement method based on the heuristics that SEM detectors
-        # are typically just a point (ie, shape == data depth).
-        # TODO: is this working as expected? Alternatively, we could check
-        # MD_DET_TYPE.
-        if len(detector.shape) > 1:
-            logging.debug("Using Optical method to estimate focus")
-            Measure = MeasureOpticalFocus
-        else:
-            logging.debug("Using SEM method to estimate focus")
-            Measure = MeasureSEMFocus
+        Measure = _getFocusMeasure(detector)
 
         step_factor = 2 ** 7
         if good_focus is not None:
@@ -447,32 +474,9 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
         timeout = 3 + 2 * estimateAcquisitionTime(detector, emt)
 
         # use the .depthOfField on detector or emitter as maximum stepsize
-        avail_depths = (detector, emt)
-        if model.hasVA(emt, "dwellTime"):
-            # Hack in case of using the e-beam with a DigitalCamera detector.
-            # All the digital cameras have a depthOfField, which is updated based
-            # on the optical lens properties... but the depthOfField in this
-            # case depends on the e-beam lens.
-            avail_depths = (emt, detector)
-        for c in avail_depths:
-            if model.hasVA(c, "depthOfField"):
-                dof = c.depthOfField.value
-                break
-        else:
-            logging.debug("No depth of field info found")
-            dof = 1e-6  # m, not too bad value
-        logging.debug("Depth of field is %f", dof)
-
-        # Pick measurement method based on the heuristics that SEM detectors
-        # are typically just a point (ie, shape == data depth).
-        # TODO: is this working as expected? Alternatively, we could check
-        # MD_DET_TYPE.
-        if len(detector.shape) > 1:
-            logging.debug("Using Optical method to estimate focus")
-            Measure = MeasureOpticalFocus
-        else:
-            logging.debug("Using SEM method to estimate focus")
-            Measure = MeasureSEMFocus
+        dof = _getDepthOfField(detector, emt)
+
+        Measure = _getFocusMeasure(detector)
 
         # adjust to rng_focus if provided
         rng = focus.axes["z"].range
@@ -552,6 +556,314 @@ def _DoExhaustiveFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focu
             future._autofocus_state = FINISHED
 
 
+def _reduceFrameSize(detector, emt):
+    """
+    Bin the images (or increase the scale of the scanner), so that they are
+    acquired and measured faster.
+    detector: model.DigitalCamera or model.Detector
+    emt (None or model.Emitter): In case of a SED this is the scanner used
+    return (list of (VigilantAttribute, value)): the settings to restore
+      afterwards, in the reverse order
+    """
+    prev_settings = []
+    if model.hasVA(emt, "dwellTime") and model.hasVA(emt, "scale"):
+        comp, va_name = emt, "scale"
+    elif model.hasVA(detector, "binning"):
+        comp, va_name = detector, "binning"
+    else:
+        return prev_settings
+
+    # Changing the binning also changes the resolution
+    if model.hasVA(comp, "resolution"):
+        prev_settings.append((comp.resolution, comp.resolution.value))
+    va = getattr(comp, va_name)
+    prev_settings.append((va, va.value))
+    b = va.value
+    va.value = va.clip((b[0] * SWEEP_BINNING, b[1] * SWEEP_BINNING))
+    logging.debug("Using %s %s during the focus sweep", va_name, va.value)
+    return prev_settings
+
+
+def _restoreSettings(settings):
+    """
+    settings (list of (VigilantAttribute, value)): as returned by _reduceFrameSize()
+    """
+    for va, v in reversed(settings):
+        try:
+            va.value = v
+        except Exception:
+            logging.exception("Failed to restore setting to %s", v)
+
+
+def _getMidAcquisitionTime(data, arrival, dur):
+    """
+    Find when the middle of the acquisition of an image happened
+    data (model.DataArray): the image
+    arrival (float): time when the image was received
+    dur (float): estimated duration of the acquisition, if the metadata
+      doesn't provide it
+    return (float): time in s since epoch
+    """
+    md = data.metadata
+    if model.MD_EXP_TIME in md:
+        dur = md[model.MD_EXP_TIME]
+    elif model.MD_DWELL_TIME in md:
+        dur = md[model.MD_DWELL_TIME] * numpy.prod(data.shape[:2])
+    start = md.get(model.MD_ACQ_DATE, arrival - dur)
+    return start + dur / 2
+
+
+def _fitFocusPeak(positions, levels):
+    """
+    Find the position of the maximum focus level, by fitting a parabola on the
+    highest level and its neighbours.
+    positions (list of floats): focus position of each measurement
+    levels (list of floats): focus level of each measurement
+    return (float): the estimated best focus position
+    """
+    positions = numpy.asarray(positions, dtype=float)
+    levels = numpy.asarray(levels, dtype=float)
+    order = numpy.argsort(positions)
+    positions, levels = positions[order], levels[order]
+
+    i_max = numpy.argmax(levels)
+    best_pos = positions[i_max]
+    pos_fit = positions[max(0, i_max - 2):i_max + 3]
+    lvl_fit = levels[max(0, i_max - 2):i_max + 3]
+    if len(pos_fit) >= 3 and pos_fit[-1] > pos_fit[0]:
+        # Centred on the maximum, for numerical stability
+        a, b, _ = numpy.polyfit(pos_fit - best_pos, lvl_fit, 2)
+        if a < 0:
+            peak = best_pos - b / (2 * a)
+            if pos_fit[0] <= peak <= pos_fit[-1]:
+                return peak
+
+    return best_pos
+
+
+def _sweepFocus(future, detector, emt, focus, dfbkg, rng, travel, timeout, Measure):
+    """
+    Moves the focus from one end of the range to the other, while continuously
+    acquiring images.
+    future (model.ProgressiveFuture): Progressive future provided by the wrapper
+    detector: model.DigitalCamera or model.Detector
+    emt (None or model.Emitter): In case of a SED this is the scanner used
+    focus (model.Actuator): The focus actuator (with a "z" axis)
+    dfbkg (model.DataFlow or None): dataflow of se- or bs- detector, to
+      activate the emitter during the whole sweep
+    rng (float, float): range of focus positions to sweep
+    travel (0<float): focus distance to travel during one image acquisition
+    timeout (0<float): maximum time to wait for an image
+    Measure (callable): function to compute the focus level of an image
+    returns:
+        (list of float): focus position at the middle of each image acquisition
+        (list of float): focus level of each image
+    raises:
+            CancelledError if cancelled
+            IOError if no image was received
+    """
+    frames = Queue.Queue()  # (float, DataArray): time of arrival, image
+
+    def on_data(df, data):
+        frames.put((time.time(), data))
+
+    pos_samples = []  # (float, float): time, focus position
+
+    def on_position(pos):
+        pos_samples.append((time.time(), pos["z"]))
+
+    et = estimateAcquisitionTime(detector, emt)
+    times = []  # time of the middle of each acquisition
+    levels = []
+    detector.data.subscribe(on_data)
+    if dfbkg is not None:
+        # No background subtraction: the emitter is active during the whole sweep
+        dfbkg.subscribe(_discard_data)
+    try:
+        # Start from the end closest to the current position
+        pos = focus.position.value["z"]
+        if abs(pos - rng[0]) <= abs(pos - rng[1]):
+            sweep_start, sweep_end = rng
+        else:
+            sweep_end, sweep_start = rng
+        focus.moveAbsSync({"z": sweep_start})
+
+        # Measure the actual frame rate, which can be much slower than the
+        # exposure time, and set the speed so that the focus moves by "travel"
+        # during each image.
+        arrivals = []
+        while len(arrivals) < 3:
+            try:
+                arrival, data = frames.get(timeout=timeout)
+            except Queue.Empty:
+                raise IOError("No data received after %g s" % (timeout,))
+            arrivals.append(arrival)
+        period = max(et, (arrivals[-1] - arrivals[0]) / (len(arrivals) - 1))
+
+        prev_speed = None
+        if model.hasVA(focus, "speed") and "z" in focus.speed.value:
+            prev_speed = focus.speed.value
+            speed_rng = focus.speed.range
+            speed = max(speed_rng[0], min(travel / period, speed_rng[1]))
+            focus.speed.value = dict(prev_speed, z=speed)
+            logging.debug("Sweeping focus from %g to %g m at %g m/s, with an image every %g s",
+                          sweep_start, sweep_end, speed, period)
+            future.set_progress(end=time.time() + abs(sweep_end - sweep_start) / speed +
+                                estimateAutoFocusTime(detector, emt, 10))
+        else:
+            logging.debug("Sweeping focus from %g to %g m at the default speed",
+                          sweep_start, sweep_end)
+
+        fmove = None
+        focus.position.subscribe(on_position)
+        try:
+            pos_samples.append((time.time(), focus.position.value["z"]))
+            t_start = time.time()
+            fmove = focus.moveAbs({"z": sweep_end})
+            t_end = None
+            stopped = False
+            while True:
+                if future._autofocus_state == CANCELLED:
+                    focus.stop({"z"})
+                    raise CancelledError()
+
+                if t_end is None and fmove.done():
+                    t_end = time.time()
+                    pos_samples.append((t_end, focus.position.value["z"]))
+
+                try:
+                    arrival, data = frames.get(timeout=0.1)
+                except Queue.Empty:
+                    if t_end is not None and time.time() > t_end + timeout:
+                        break  # The detector doesn't send new images anymore
+                    continue
+
+                t = _getMidAcquisitionTime(data, arrival, et)
+                if t < t_start:
+                    continue  # Acquired before the sweep
+                if t_end is not None and t > t_end:
+                    break  # Acquired after the sweep
+
+                times.append(t)
+                levels.append(Measure(data))
+
+                # Stop early if the focus peak has clearly been passed
+                if (not stopped and len(levels) >= 10 and
+                    numpy.argmax(levels) < len(levels) - 3 and
+                    levels[-1] < 0.5 * max(levels) and AssessFocus(levels)):
+                    logging.debug("Focus peak passed, stopping the sweep")
+                    focus.stop({"z"})
+                    stopped = True
+        finally:
+            focus.position.unsubscribe(on_position)
+            if prev_speed is not None:
+                # Only once the move is over, so that the speed is not changed during it
+                if fmove is not None:
+                    try:
+                        fmove.result()
+                    except Exception:
+                        logging.debug("Focus sweep move ended with an error", exc_info=True)
+                focus.speed.value = prev_speed
+    finally:
+        detector.data.unsubscribe(on_data)
+        if dfbkg is not None:
+            dfbkg.unsubscribe(_discard_data)
+
+    if not times:
+        return [], []
+
+    # Associate each image to the focus position at the time of its acquisition,
+    # assuming the focus moves linearly between two known positions.
+    sample_t, sample_pos = zip(*sorted(pos_samples))
+    positions = numpy.interp(times, sample_t, sample_pos)
+    for p, l in zip(positions, levels):
+        logging.debug("Focus level at %f is %f", p, l)
+    return list(positions), levels
+
+
+def _DoSweepFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus):
+    """
+    Moves the focus at constant speed through the whole range, while the detector
+    continuously acquires (binned) images. Each image is associated to the focus
+    position at the middle of its acquisition, and the best focus position is
+    estimated by fitting a peak on the focus levels. It finishes by a short
+    binary search around this position.
+    future (model.ProgressiveFuture): Progressive future provided by the wrapper
+    detector: model.DigitalCamera or model.Detector
+    emt (None or model.Emitter): In case of a SED this is the scanner used
+    focus (model.Actuator): The focus actuator (with a "z" axis)
+    dfbkg (model.DataFlow): dataflow of se- or bs- detector. Note that during
+      the sweep, no background subtraction is done.
+    good_focus (float): if provided, an already known good focus position,
+      used if no significant focus level is found during the sweep
+    rng_focus (tuple of floats): if provided, the search of the best focus position is limited
+      within this range
+    returns:
+        (float): Focus position (m)
+        (float): Focus level
+    raises:
+            CancelledError if cancelled
+            IOError if procedure failed
+    """
+    logging.debug("Starting sweep autofocus on detector %s...", detector.name)
+
+    best_pos = focus.position.value['z']
+    try:
+        # Big timeout, most important being that it's shorter than eternity
+        timeout = 3 + 2 * estimateAcquisitionTime(detector, emt)
+        dof = _getDepthOfField(detector, emt)
+        Measure = _getFocusMeasure(detector)
+
+        # adjust to rng_focus if provided
+        rng = focus.axes["z"].range
+        if rng_focus:
+            rng = (max(rng[0], rng_focus[0]), min(rng[1], rng_focus[1]))
+        length = rng[1] - rng[0]
+        if length <= 0:
+            raise ValueError("Unexpected focus range %s" % (rng,))
+
+        # Same order of magnitude as the steps of the exhaustive search, but
+        # always with a reasonable number of images
+        travel = min(max(4 * dof, length / MAX_SWEEP_FRAMES), length / MIN_SWEEP_FRAMES)
+
+        prev_settings = _reduceFrameSize(detector, emt)
+        try:
+            positions, levels = _sweepFocus(future, detector, emt, focus, dfbkg,
+                                            rng, travel, timeout, Measure)
+        finally:
+            _restoreSettings(prev_settings)
+
+        if future._autofocus_state == CANCELLED:
+            raise CancelledError()
+
+        if len(levels) < 5:
+            # Typically, because the focus speed cannot be controlled
+            logging.info("Only %d images acquired during the focus sweep, using binary search",
+                         len(levels))
+            return _DoBinaryFocus(future, detector, emt, focus, dfbkg, good_focus, rng_focus)
+
+        if good_focus is not None and not AssessFocus(levels):
+            logging.debug("No significant focus level found, refining around %g", good_focus)
+            peak = good_focus
+        else:
+            peak = _fitFocusPeak(positions, levels)
+            logging.debug("Focus peak estimated at %g", peak)
+        peak = max(rng[0], min(peak, rng[1]))
+
+        return _DoBinaryFocus(future, detector, emt, focus, dfbkg, peak,
+                              (peak - 2 * travel, peak + 2 * travel))
+
+    except CancelledError:
+        # Go to the best position known so far
+        focus.moveAbsSync({"z": best_pos})
+    finally:
+        # Only used if for some reason the binary focus is not called (e.g. cancellation)
+        with future._autofocus_lock:
+            if future._autofocus_state == CANCELLED:
+                raise CancelledError()
+            future._autofocus_state = FINISHED
+
+
 def _CancelAutoFocus(future):
     """
     Canceller of AutoFocus task.
@@ -617,7 +929,9 @@ def AutoFocus(detector, emt, focus, dfbkg=None, good_focus=None, rng_focus=None,
     rng_focus (tuple): if provided, the search of the best focus position is limited
       within this range
     method (MTD_*): focusing method, if BINARY we follow a dichotomic method while in
-      case of EXHAUSTIVE we iterate through the whole provided range
+      case of EXHAUSTIVE we iterate through the whole provided range. In case
+      of SWEEP, the focus moves continuously through the range while images
+      are acquired, which is faster but requires a focus with a "speed".
     returns (model.ProgressiveFuture):  Progress of DoAutoFocus, whose result() will return:
             Focus position (m)
             Focus level
@@ -635,6 +949,8 @@ def AutoFocus(detector, emt, focus, dfbkg=None, good_focus=None, rng_focus=None,
         autofocus_fn = _DoExhaustiveFocus
     elif method == MTD_BINARY:
         autofocus_fn = _DoBinaryFocus
+    elif method == MTD_SWEEP:
+        autofocus_fn = _DoSweepFocus
     else:
         raise ValueError("Unknown autofocus method")
 
@@ -29,6 +29,11 @@ import math
 from numpy import arange
 from numpy import fft
 
+# Maximum precision for which the computation in single precision floating
+# points is sufficiently accurate
+MAX_SINGLE_PRECISION = 10
+
+
 def MeasureShift(previous_img, current_img, precision=1):
     """
     Given two images, it calculates the shift in x and y axis. It first computes
@@ -38,6 +43,7 @@ def MeasureShift(previous_img, current_img, precision=1):
     cross-correlation" by Manuel Guizar, for the corresponding matlab code see
     http://www.mathworks.com/matlabcentral/fileexchange/
     18401-efficient-subpixel-image-registration-by-cross-correlation.
+    To compare many images to the same image, it's faster to use a PhaseCorrelator.
 
     previous_img (numpy.array): 2d array with the previous frame
     current_img (numpy.array): 2d array with the last frame, must be of same
@@ -49,114 +55,204 @@ def MeasureShift(previous_img, current_img, precision=1):
         raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
     assert previous_img.shape == current_img.shape, "Prev shape %s != new shape %s" % (previous_img.shape, current_img.shape)
 
-    previous_fft = fft.fft2(previous_img)
-    current_fft = fft.fft2(current_img)
-    m, n = previous_fft.shape
-
-    if precision == 1:
-        # Cross-correlation computation
-        CC = fft.ifft2(previous_fft * current_fft.conj())
+    return PhaseCorrelator(previous_img, precision).measure(current_img)
 
-        # Locate the peak
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
 
-        rloc = loc1[loc2]
-        cloc = loc2
-
-        # Calculate shift from the peak
-        md2 = m // 2
-        nd2 = n // 2
-        if rloc > md2:
-            row_shift = rloc - m
-        else:
-            row_shift = rloc
+class PhaseCorrelator(object):
+    """
+    Measures the shift between a reference image and other images, with the
+    same algorithm as MeasureShift(). The Fourier transform of the reference
+    is computed only once, so each measurement only needs the transform of
+    the new image.
+    As the images are real, only half of their spectrum is computed (rfft).
+    """
 
-        if cloc > nd2:
-            col_shift = cloc - n
+    def __init__(self, ref_img, precision=1, window=None, ref_spectrum=None):
+        """
+        ref_img (numpy.array): 2d array with the reference image (eg, the
+          previous frame)
+        precision (1<=int): Calculate drift within 1/precision of a pixel
+        window (None or numpy.array): 2d array of the same shape as ref_img, by
+          which all the images are multiplied before computing their transform
+          (eg, a Hann window, to reduce the effect of the borders).
+        ref_spectrum (None or numpy.array): the transform of ref_img, as
+          returned by .transform() of a PhaseCorrelator with the same settings.
+          If provided, it's used instead of computing it again.
+        """
+        if precision < 1:
+            raise ValueError("Precision cannot be less than 1, got %s." % (precision,))
+        if window is not None and window.shape != ref_img.shape:
+            raise ValueError("Window shape %s != image shape %s" % (window.shape, ref_img.shape))
+
+        self.shape = ref_img.shape
+        self.precision = precision
+        self._window = window
+        # Computing in single precision is faster, and sufficient for the
+        # most usual (low) precisions
+        if precision <= MAX_SINGLE_PRECISION:
+            self._dtype = numpy.complex64
         else:
-            col_shift = cloc
-
-    else:
-        mlarge, nlarge = m * 2, n * 2
-
-        # Upsample by factor of 2 to obtain initial estimation and
-        # embed Fourier data in a 2x larger array
-        CC = numpy.zeros((mlarge, nlarge), dtype=numpy.complex)
-        CC[m - m // 2:m + 1 + (m - 1) // 2,
-           n - n // 2:n + 1 + (n - 1) // 2] = (fft.fftshift(previous_fft) *
-                                               fft.fftshift(current_fft).conj()
-                                              )
-
-        # Cross-correlation computation
-        CC = fft.ifft2(fft.ifftshift(CC))
-
-        # Locate the peak
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
-
-        rloc = loc1[loc2]
-        cloc = loc2
-
-        # Calculate shift in previous pixel grid from the position of the peak
-        (m, n) = CC.shape
-        md2 = m // 2
-        nd2 = n // 2
-
-        if rloc > md2:
-            row_shift = rloc - m
-        else:
-            row_shift = rloc
+            self._dtype = numpy.complex128
+
+        if ref_spectrum is None:
+            ref_spectrum = self.transform(ref_img)
+        self._ref_fft = ref_spectrum
+
+    def transform(self, img):
+        """
+        Compute the (half) spectrum of an image, as used to measure the shift.
+        img (numpy.array): 2d array of the same shape as the reference image.
+          If it's complex, only the real part is used.
+        returns (numpy.array of complex): the real FFT of the (windowed) image
+        """
+        if img.shape != self.shape:
+            raise ValueError("Image shape %s != reference shape %s" % (img.shape, self.shape))
+        if numpy.iscomplexobj(img):
+            img = img.real
+        if self._window is not None:
+            img = img * self._window
+        return fft.rfft2(img).astype(self._dtype, copy=False)
+
+    def measure(self, img, spectrum=None):
+        """
+        Calculates the shift between the reference image and the given image.
+        img (numpy.array): 2d array with the last frame, must be of same shape
+          as the reference image
+        spectrum (None or numpy.array): the transform of img, as returned by
+          .transform(). If provided, it's used instead of computing it again.
+        returns (tuple of floats): Drift in pixels, same as
+          MeasureShift(ref_img, img, precision)
+        """
+        if spectrum is None:
+            spectrum = self.transform(img)
+
+        m, n = self.shape
+        # Cross-power spectrum (of the non-negative frequencies along X)
+        xps = self._ref_fft * spectrum.conj()
+
+        if self.precision == 1:
+            # Cross-correlation computation
+            CC = fft.irfft2(xps, s=(m, n))
+
+            # Locate the peak
+            rloc, cloc = _LocatePeak(CC)
+
+            # Calculate shift from the peak
+            md2 = m // 2
+            nd2 = n // 2
+            if rloc > md2:
+                row_shift = rloc - m
+            else:
+                row_shift = rloc
+
+            if cloc > nd2:
+                col_shift = cloc - n
+            else:
+                col_shift = cloc
 
-        if cloc > nd2:
-            col_shift = cloc - n
         else:
-            col_shift = cloc
-
-        row_shift /= 2
-        col_shift /= 2
-
-        # DFT computation
-        # Initial shift estimation in upsampled grid
-        row_shift = round(row_shift * precision) / precision
-        col_shift = round(col_shift * precision) / precision
-        dft_shift = math.ceil(precision * 1.5) // 2  # Center of output at dft_shift+1
-
-        # Matrix multiply DFT around the current shift estimation
-        CC = (_UpsampledDFT(current_fft * previous_fft.conj(),
-                            math.ceil(precision * 1.5),
-                            math.ceil(precision * 1.5),
-                            precision,
-                            dft_shift - row_shift * precision,
-                            dft_shift - col_shift * precision)
-              ) / (md2 * nd2 * (precision ** 2))
-        # was .conj(), but as we just need the abs(), it's not needed
-
-        # Locate maximum and map back to original pixel grid
-        ACC = abs(CC)
-        loc1 = ACC.argmax(0)
-        max1 = ACC[(loc1, range(ACC.shape[1]))]
-        loc2 = max1.argmax(0)
-
-        rloc = loc1[loc2]
-        cloc = loc2
-
-        rloc -= dft_shift
-        cloc -= dft_shift
+            precision = self.precision
+            mlarge, nlarge = m * 2, n * 2
+
+            # Upsample by factor of 2 to obtain initial estimation and
+            # embed Fourier data in a 2x larger array
+            CC = numpy.zeros((mlarge, nlarge // 2 + 1), dtype=xps.dtype)
+            mpos = (m - 1) // 2 + 1  # number of non-negative frequencies
+            CC[:mpos, :n // 2 + 1] = xps[:mpos]
+            CC[mlarge - m // 2:, :n // 2 + 1] = xps[mpos:]
+            if n % 2 == 0:
+                # The Nyquist frequency is not anymore the last one, so it'd
+                # be counted twice (as positive and negative frequency)
+                CC[:, n // 2] *= 0.5
+
+            # Cross-correlation computation
+            CC = fft.irfft2(CC, s=(mlarge, nlarge))
+
+            # Locate the peak
+            rloc, cloc = _LocatePeak(CC)
+
+            # Calculate shift in previous pixel grid from the position of the peak
+            (m, n) = CC.shape
+            md2 = m // 2
+            nd2 = n // 2
+
+            if rloc > md2:
+                row_shift = rloc - m
+            else:
+                row_shift = rloc
+
+            if cloc > nd2:
+                col_shift = cloc - n
+            else:
+                col_shift = cloc
+
+            row_shift /= 2
+            col_shift /= 2
+
+            # DFT computation
+            # Initial shift estimation in upsampled grid
+            row_shift = round(row_shift * precision) / precision
+            col_shift = round(col_shift * precision) / precision
+            dft_shift = math.ceil(precision * 1.5) // 2  # Center of output at dft_shift+1
+
+            # Matrix multiply DFT around the current shift estimation
+            CC = (_UpsampledDFT(_HalfToFullSpectrum(xps, self.shape[1]).conj(),
+                                math.ceil(precision * 1.5),
+                                math.ceil(precision * 1.5),
+                                precision,
+                                dft_shift - row_shift * precision,
+                                dft_shift - col_shift * precision)
+                  ) / (md2 * nd2 * (precision ** 2))
+            # was .conj(), but as we just need the abs(), it's not needed
+
+            # Locate maximum and map back to original pixel grid
+            rloc, cloc = _LocatePeak(CC)
+
+            rloc -= dft_shift
+            cloc -= dft_shift
+
+            row_shift += rloc / precision
+            col_shift += cloc / precision
+
+            if md2 == 1:
+                row_shift = 0
+            if nd2 == 1:
+                col_shift = 0
+
+        return col_shift, row_shift
+
+
+def _LocatePeak(CC):
+    """
+    Find the position of the maximum (absolute) value
+    CC (numpy.array): 2d array
+    returns (int, int): row and column of the peak
+    """
+    ACC = abs(CC)
+    loc1 = ACC.argmax(0)
+    max1 = ACC[(loc1, range(ACC.shape[1]))]
+    loc2 = max1.argmax(0)
 
-        row_shift += rloc / precision
-        col_shift += cloc / precision
+    return loc1[loc2], loc2
 
-        if md2 == 1:
-            row_shift = 0
-        if nd2 == 1:
-            col_shift = 0
 
-    return col_shift, row_shift
+def _HalfToFullSpectrum(data, n):
+    """
+    Reconstruct the complete spectrum of a real signal from its half spectrum
+    (as computed by rfft2), using the Hermitian symmetry.
+    data (numpy.array of shape m, n // 2 + 1): the non-negative frequencies
+      along the last dimension
+    n (int): the size of the last dimension of the signal
+    returns (numpy.array of shape m, n): the spectrum, as computed by fft2
+    """
+    m, nh = data.shape
+    full = numpy.empty((m, n), dtype=data.dtype)
+    full[:, :nh] = data
+    # X[k, j] = conj(X[-k, -j])
+    rows = (-numpy.arange(m)) % m
+    cols = n - numpy.arange(nh, n)
+    full[:, nh:] = data[rows][:, cols].conj()
+    return full
 
 
 def _UpsampledDFT(data, nor, noc, precision=1, roff=0, coff=0):
@@ -172,16 +268,18 @@ def _UpsampledDFT(data, nor, noc, precision=1, roff=0, coff=0):
     """
     z = 1j  # imaginary unit
     nr, nc = data.shape
+    dtype = numpy.result_type(data.dtype, numpy.complex64)
 
     # Compute kernels and obtain DFT by matrix products
-    kernc = numpy.power(math.e, (-z * 2 * math.pi / (nc * precision)) *
-                                ((fft.ifftshift(arange(0, nc))[:, None]).T - nc // 2) *
-                                (arange(0, noc) - coff)[:, None]
-                       )
-
-    kernr = numpy.power(math.e, (-z * 2 * math.pi / (nr * precision)) *
-                                (fft.ifftshift(arange(0, nr))[:, None] - nr // 2) *
-                                ((arange(0, nor)[:, None]).T - roff)
-                       )
+    # (in the same precision as the data)
+    kernc = numpy.exp((-z * 2 * math.pi / (nc * precision)) *
+                      ((fft.ifftshift(arange(0, nc))[:, None]).T - nc // 2) *
+                      (arange(0, noc) - coff)[:, None]
+                     ).astype(dtype, copy=False)
+
+    kernr = numpy.exp((-z * 2 * math.pi / (nr * precision)) *
+                      (fft.ifftshift(arange(0, nr))[:, None] - nr // 2) *
+                      ((arange(0, nor)[:, None]).T - roff)
+                     ).astype(dtype, copy=False)
 
     return numpy.dot(numpy.dot((kernr.transpose()), data), kernc.transpose())
@@ -26,6 +26,7 @@ import odemis
 from odemis.acq import align
 from odemis.acq.align import autofocus
 from odemis.dataio import hdf5
+from odemis.driver import simcam, simulated
 from odemis.util import test, timeout
 import os
 from scipy import ndimage
@@ -145,6 +146,66 @@ class TestAutofocus(unittest.TestCase):
         self.assertGreater(foc_lev, 0)
 
 
+class TestSweepFocus(unittest.TestCase):
+    """
+    Test the sweep autofocus, with a simulated camera and focus
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.focus = simulated.Stage(name="focus", role="focus", axes=["z"],
+                                    ranges={"z": [0, 0.012]})
+        cls.ccd = simcam.Camera(name="camera", role="ccd", image="simcam-fake-overview.h5",
+                                children={"focus": cls.focus})
+        # The good focus position is the start up position
+        cls._good_focus = cls.focus.position.value["z"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ccd.terminate()
+        cls.focus.terminate()
+
+    def test_fit_peak(self):
+        pos = [i * 1e-6 for i in range(20)]
+        levels = [100 - (p - 7.3e-6) ** 2 * 1e12 for p in pos]
+        peak = autofocus._fitFocusPeak(pos, levels)
+        self.assertAlmostEqual(peak, 7.3e-6, 9)
+
+        # Maximum on the border => no fit possible
+        peak = autofocus._fitFocusPeak(pos[:5], levels[:5])
+        self.assertEqual(peak, pos[4])
+
+    @timeout(1000)
+    def test_autofocus_sweep(self):
+        self.focus.moveAbs({"z": self._good_focus - 800e-6}).result()
+        self.ccd.exposureTime.value = 0.01  # s
+        prev_binning = self.ccd.binning.value
+        prev_speed = self.focus.speed.value
+        rng = (self._good_focus - 1.5e-3, self._good_focus + 1.5e-3)
+        future_focus = align.AutoFocus(self.ccd, None, self.focus, rng_focus=rng,
+                                       method=autofocus.MTD_SWEEP)
+        foc_pos, foc_lev = future_focus.result(timeout=900)
+        self.assertAlmostEqual(foc_pos, self._good_focus, 4)
+        self.assertGreater(foc_lev, 0)
+
+        # The settings are restored
+        self.assertEqual(self.ccd.binning.value, prev_binning)
+        self.assertEqual(self.focus.speed.value, prev_speed)
+
+    @timeout(1000)
+    def test_cancel(self):
+        self.focus.moveAbs({"z": self._good_focus - 800e-6}).result()
+        start = self.focus.position.value["z"]
+        rng = (self._good_focus - 1.5e-3, self._good_focus + 1.5e-3)
+        future_focus = align.AutoFocus(self.ccd, None, self.focus, rng_focus=rng,
+                                       method=autofocus.MTD_SWEEP)
+        time.sleep(2)
+        future_focus.cancel()
+        with self.assertRaises(CancelledError):
+            future_focus.result(timeout=900)
+        self.assertAlmostEqual(self.focus.position.value["z"], start)
+
+
 class TestAutofocusSpectrometer(unittest.TestCase):
     """
     Test autofocus spectrometer function
@@ -179,6 +179,201 @@ def get_spectrum_efficiency(das):
     return ret
 
 
+# Maximum size of the data computed at once (in bytes) when the whole
+# compensated spectrum is needed
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class CompensatedSpectrum(object):
+    """
+    Lazy view of spectrum data compensated for the background and/or efficiency.
+    The compensation is only applied on the part of the data requested, so
+    that accessing a pixel spectrum, a band or a line doesn't need to compute
+    (and store) the whole cube.
+    It has the .shape, .ndim, .dtype and .metadata of the compensated data.
+    Use the slicing syntax (eg, view[:, 0, 0, y, x]) to get a DataArray with
+    the compensated values, or getData() to get all the data.
+    """
+
+    def __init__(self, data, bckg=None, coef=None):
+        """
+        Same arguments as compensate_spectrum_efficiency()
+        raise ValueError: if the calibration data is not compatible
+        """
+        # Need to get the calibration data for each wavelength of the data
+        wl_data = spectrum.get_wavelength_per_pixel(data)
+
+        # TODO: use MD_BASELINE as a fallback?
+        if bckg is not None:
+            if bckg.shape[1:] != (1, 1, 1, 1):
+                raise ValueError("bckg should have shape C1111")
+            # It must be fitting the data
+            # TODO: support if the data is binned?
+            if data.shape[0] != bckg.shape[0]:
+                raise ValueError("Background should have same length as the data, but got %d != %d" %
+                                 (bckg.shape[0], data.shape[0]))
+
+            wl_bckg = spectrum.get_wavelength_per_pixel(bckg)
+            # Warn if not the same wavelength
+            if not numpy.allclose(wl_bckg, wl_data):
+                logging.warning("Spectrum background is between %g->%g nm, "
+                                "while the spectrum is between %g->%g nm.",
+                                wl_bckg[0] * 1e9, wl_bckg[-1] * 1e9,
+                                wl_data[0] * 1e9, wl_data[-1] * 1e9)
+
+            # One value per wavelength is all what is needed
+            bckg = numpy.asarray(bckg[:, 0, 0, 0, 0])
+
+        # We could be more clever if calib has a MD_WL_POLYNOMIAL, but it's very
+        # unlikely the calibration is in this form anyway.
+        if coef is not None:
+            if coef.shape[1:] != (1, 1, 1, 1):
+                raise ValueError("coef should have shape C1111")
+            wl_coef = spectrum.get_wavelength_per_pixel(coef)
+
+            # Warn if the calibration is not enough for the data
+            if wl_coef[0] > wl_data[0] or wl_coef[-1] < wl_data[-1]:
+                logging.warning("Spectrum efficiency compensation is only between "
+                                "%g->%g nm, while the spectrum is between %g->%g nm.",
+                                wl_coef[0] * 1e9, wl_coef[-1] * 1e9,
+                                wl_data[0] * 1e9, wl_data[-1] * 1e9)
+
+            # Interpolate the calibration data for each wl_data
+            coef = numpy.interp(wl_data, wl_coef, coef[:, 0, 0, 0, 0])
+
+        self._data = data
+        self._bckg = bckg  # None or array of shape C
+        self._coef = coef  # None or array of float of shape C
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.metadata = data.metadata
+        # The type is the one numpy picks when computing the compensation
+        self.dtype = self[(slice(0, 1),) * self.ndim].dtype
+
+    def _normalize_key(self, key):
+        """
+        Convert a key to one int or slice per dimension
+        key (anything accepted by numpy.ndarray.__getitem__)
+        return (tuple of int/slice or None): one element per dimension of the
+          data, or None if the key uses advanced indexing.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        nkey = []
+        for k in key:
+            if k is Ellipsis:
+                if Ellipsis in nkey:
+                    return None
+                nkey.append(k)
+            elif isinstance(k, (int, long, numpy.integer)):
+                nkey.append(int(k))
+            elif isinstance(k, slice):
+                nkey.append(k)
+            else:  # None, list, array...
+                return None
+
+        if len(nkey) > self.ndim + (Ellipsis in nkey):
+            raise IndexError("Too many indices for data of %d dimensions" % (self.ndim,))
+        if Ellipsis in nkey:
+            i = nkey.index(Ellipsis)
+            nkey[i:i + 1] = [slice(None)] * (self.ndim - len(nkey) + 1)
+        nkey += [slice(None)] * (self.ndim - len(nkey))
+        return tuple(nkey)
+
+    def _compensate(self, data, ckey):
+        """
+        Apply the compensation on (a part of) the data
+        data (DataArray): part of the original data, with all the dimensions
+        ckey (slice): the indices of C from which the data comes
+        return (DataArray): the compensated data
+        """
+        shape = (-1,) + (1,) * (data.ndim - 1)
+
+        if self._bckg is not None:
+            data = img.Subtract(data, self._bckg[ckey].reshape(shape))
+
+        if self._coef is not None:
+            data = data * self._coef[ckey].reshape(shape)  # will keep metadata from data
+
+        return data
+
+    def __getitem__(self, key):
+        """
+        return (DataArray): the compensated data at the given position
+        """
+        nkey = self._normalize_key(key)
+        if nkey is None:
+            # Advanced indexing: not worthy to be clever
+            logging.debug("Compensating all the data to access %s", key)
+            return self._compensate(self._data, slice(None))[key]
+
+        # Integer indices are converted to slices of one element, so that the
+        # data always keeps all its dimensions (and is never a scalar) while
+        # compensated. They are removed afterwards.
+        skey = []
+        squeeze = []
+        for k, l in zip(nkey, self.shape):
+            if isinstance(k, int):
+                if not -l <= k < l:
+                    raise IndexError("Index %d is out of bounds for size %d" % (k, l))
+                k %= l
+                skey.append(slice(k, k + 1))
+                squeeze.append(0)
+            else:
+                skey.append(k)
+                squeeze.append(slice(None))
+
+        data = self._compensate(self._data[tuple(skey)], skey[0])
+        if 0 in squeeze:
+            data = data[tuple(squeeze)]
+        return data
+
+    def get_chunk_length(self):
+        """
+        return (int > 0): number of wavelengths to compensate at once to fit
+          within CHUNK_SIZE
+        """
+        # Count as float64, for the temporary arrays
+        c_size = int(numpy.prod(self.shape[1:])) * 8
+        return max(1, CHUNK_SIZE // max(1, c_size))
+
+    def getData(self, dtype=numpy.float32):
+        """
+        Compute the whole compensated data. The data is compensated by chunks,
+        to limit the extra memory used.
+        dtype (None or numpy.dtype): type of the output. If None, the type of
+          the view is used (typically float64). The default, float32, is
+          precise enough for display, and uses half the memory.
+        return (DataArray): all the compensated data
+        """
+        if dtype is None:
+            dtype = self.dtype
+        out = model.DataArray(numpy.empty(self.shape, dtype=dtype),
+                              self.metadata.copy())
+        n = self.get_chunk_length()
+        for c in range(0, self.shape[0], n):
+            out[c:c + n] = self[c:c + n]
+        return out
+
+    def getMinMax(self):
+        """
+        Compute the minimum and maximum of the whole compensated data. The data
+        is compensated by chunks, so the whole data is never stored.
+        return (2 numbers of type .dtype): the minimum and maximum values
+        """
+        mn, mx = None, None
+        n = self.get_chunk_length()
+        for c in range(0, self.shape[0], n):
+            chunk = self[c:c + n].view(numpy.ndarray)
+            cmn, cmx = chunk.min(), chunk.max()
+            if mn is None:
+                mn, mx = cmn, cmx
+            else:
+                mn, mx = min(mn, cmn), max(mx, cmx)
+        return mn, mx
+
+
 def compensate_spectrum_efficiency(data, bckg=None, coef=None):
     """
     Apply the efficiency compensation factors to the given data.
@@ -192,51 +387,9 @@ def compensate_spectrum_efficiency(data, bckg=None, coef=None):
       Need MD_WL_* metadata.
     returns (DataArray): same shape as original data. Can have dtype=float
     """
-    # Need to get the calibration data for each wavelength of the data
-    wl_data = spectrum.get_wavelength_per_pixel(data)
-
-    # TODO: use MD_BASELINE as a fallback?
-    if bckg is not None:
-        if bckg.shape[1:] != (1, 1, 1, 1):
-            raise ValueError("bckg should have shape C1111")
-        # It must be fitting the data
-        # TODO: support if the data is binned?
-        if data.shape[0] != bckg.shape[0]:
-            raise ValueError("Background should have same length as the data, but got %d != %d" %
-                             (bckg.shape[0], data.shape[0]))
-
-        wl_bckg = spectrum.get_wavelength_per_pixel(bckg)
-        # Warn if not the same wavelength
-        if not numpy.allclose(wl_bckg, wl_data):
-            logging.warning("Spectrum background is between %g->%g nm, "
-                            "while the spectrum is between %g->%g nm.",
-                            wl_bckg[0] * 1e9, wl_bckg[-1] * 1e9,
-                            wl_data[0] * 1e9, wl_data[-1] * 1e9)
-
-        data = img.Subtract(data, bckg)
-
-    # We could be more clever if calib has a MD_WL_POLYNOMIAL, but it's very
-    # unlikely the calibration is in this form anyway.
-    if coef is not None:
-        if coef.shape[1:] != (1, 1, 1, 1):
-            raise ValueError("coef should have shape C1111")
-        wl_coef = spectrum.get_wavelength_per_pixel(coef)
-
-        # Warn if the calibration is not enough for the data
-        if wl_coef[0] > wl_data[0] or wl_coef[-1] < wl_data[-1]:
-            logging.warning("Spectrum efficiency compensation is only between "
-                            "%g->%g nm, while the spectrum is between %g->%g nm.",
-                            wl_coef[0] * 1e9, wl_coef[-1] * 1e9,
-                            wl_data[0] * 1e9, wl_data[-1] * 1e9)
-
-        # Interpolate the calibration data for each wl_data
-        calib_fitted = numpy.interp(wl_data, wl_coef, coef[:, 0, 0, 0, 0])
-        calib_fitted.shape += (1, 1, 1, 1) # put TZYX dims
-
-        # Compensate the data
-        data = data * calib_fitted # will keep metadata from data
-
-    return data
+    if bckg is None and coef is None:
+        return data
+    return CompensatedSpectrum(data, bckg, coef).getData(dtype=None)
 
 
 def get_time_range_to_trigger_delay(data, timeRange_choices, triggerDelay_range):
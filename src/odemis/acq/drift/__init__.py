@@ -30,7 +30,7 @@ from scipy import misc
 import threading
 import cv2
 
-from odemis.acq.align.shift import MeasureShift
+from odemis.acq.align.shift import MeasureShift, PhaseCorrelator
 
 MIN_RESOLUTION = (20, 20) # seems 10x10 sometimes work, but let's not tent it
 MAX_PIXELS = 128 ** 2  # px
@@ -65,6 +65,11 @@ class AnchoredEstimator(object):
         self.max_drift = (0, 0) # in sem px
 
         self.raw = []  # first 2 and last 2 anchor areas acquired (in order)
+        # To compare to the first and previous anchor areas, without computing
+        # again their spectrum
+        self._orig_corr = None  # PhaseCorrelator for raw[0]
+        self._prev_corr = None  # PhaseCorrelator for the latest anchor area estimated
+        self._prev_img = None  # the latest anchor area estimated
         self._acq_sem_complete = threading.Event()
 
         # Calculate initial translation for anchor region acquisition
@@ -166,11 +171,22 @@ class AnchoredEstimator(object):
             # include also the drift of the previous image.
             # Also, MeasureShift return the shift in image pixels, which is
             # different (usually bigger) from the SEM px.
-            prev_drift = MeasureShift(self.raw[-2], self.raw[-1], 10)
+            if self._orig_corr is None:
+                self._orig_corr = PhaseCorrelator(self.raw[0], 10)
+            if self._prev_img is not self.raw[-2]:
+                self._prev_corr = PhaseCorrelator(self.raw[-2], 10)
+            # The spectrum of the latest image is computed only once
+            img = self.raw[-1]
+            spectrum = self._orig_corr.transform(img)
+
+            prev_drift = self._prev_corr.measure(img, spectrum)
             prev_drift = (prev_drift[0] * self._scale[0] + self.drift[0],
                           prev_drift[1] * self._scale[1] + self.drift[1])
 
-            orig_drift = MeasureShift(self.raw[0], self.raw[-1], 10)
+            orig_drift = self._orig_corr.measure(img, spectrum)
+            # The latest image will be the previous one at the next estimation
+            self._prev_corr = PhaseCorrelator(img, 10, ref_spectrum=spectrum)
+            self._prev_img = img
             self.drift = (orig_drift[0] * self._scale[0],
                           orig_drift[1] * self._scale[1])
 
@@ -26,7 +26,7 @@ import unittest
 import math
 
 from odemis.dataio import hdf5
-from odemis.acq.align.shift import MeasureShift
+from odemis.acq.align.shift import MeasureShift, PhaseCorrelator, MAX_SINGLE_PRECISION
 from numpy import fft
 from numpy import random
 
@@ -202,5 +202,87 @@ class TestShiftCalculation(unittest.TestCase):
         drift = MeasureShift(self.small_data, self.small_data_random_drifted_noisy, 10)
         numpy.testing.assert_almost_equal(drift, (self.small_deltac, self.small_deltar), 0)
 
+class TestPhaseCorrelator(unittest.TestCase):
+    """
+    Test PhaseCorrelator
+    """
+    def setUp(self):
+        numpy.random.seed(25)
+        self.data = hdf5.read_data("example_input.h5")
+        C, T, Z, Y, X = self.data[0].shape
+        self.data[0].shape = Y, X
+
+        self.data_drifted = hdf5.read_data("example_drifted.h5")
+        C, T, Z, Y, X = self.data_drifted[0].shape
+        self.data_drifted[0].shape = Y, X
+
+    def _shift(self, data, deltar, deltac):
+        """
+        return (ndarray of float): data shifted by subpixel value
+        """
+        nr, nc = data.shape
+        Nr = fft.ifftshift(numpy.arange(-numpy.fix(nr / 2), numpy.ceil(nr / 2)))
+        Nc = fft.ifftshift(numpy.arange(-numpy.fix(nc / 2), numpy.ceil(nc / 2)))
+        [Nc, Nr] = numpy.meshgrid(Nc, Nr)
+        shifted = fft.ifft2(fft.fft2(data) * numpy.exp(2j * math.pi *
+                                                       (deltar * Nr / nr + deltac * Nc / nc)))
+        return shifted.real
+
+    def test_known_shifts(self):
+        """
+        Tests the correlator finds known shifts, for several images, within
+        the requested precision
+        """
+        # Also with a precision too high for computing in single precision
+        for precision in (1, 10, MAX_SINGLE_PRECISION * 10):
+            corr = PhaseCorrelator(self.data[0], precision)
+
+            # Integer shifts are found exactly, whatever the precision
+            for deltar, deltac in ((0, 0), (5, -12), (-31, 2)):
+                shifted = self._shift(self.data[0], deltar, deltac)
+                drift = corr.measure(shifted)
+                numpy.testing.assert_allclose(drift, (deltac, deltar), atol=1e-6)
+
+            # Subpixel shifts are found within 1/precision
+            for i in range(3):
+                deltar, deltac = numpy.random.uniform(-20, 20, 2)
+                shifted = self._shift(self.data[0], deltar, deltac)
+                drift = corr.measure(shifted)
+                numpy.testing.assert_allclose(drift, (deltac, deltar), atol=1 / precision)
+
+        corr = PhaseCorrelator(self.data[0], 1)
+        drift = corr.measure(self.data_drifted[0])
+        numpy.testing.assert_almost_equal(drift, (-3, 5), 1)
+
+    def test_spectrum_reuse(self):
+        """
+        Tests the spectrum of an image can be reused as reference
+        """
+        shifted = self._shift(self.data[0], 3.3, -7.6)
+        corr = PhaseCorrelator(self.data[0], 10)
+        spectrum = corr.transform(shifted)
+        drift = corr.measure(shifted, spectrum)
+        numpy.testing.assert_almost_equal(drift, (-7.6, 3.3), 1)
+
+        # Same image, as reference
+        corr2 = PhaseCorrelator(shifted, 10, ref_spectrum=spectrum)
+        drift = corr2.measure(shifted)
+        numpy.testing.assert_almost_equal(drift, (0, 0), 1)
+
+    def test_window(self):
+        """
+        Tests the shift is still found with a window
+        """
+        window = numpy.outer(numpy.hanning(self.data[0].shape[0]),
+                             numpy.hanning(self.data[0].shape[1]))
+        corr = PhaseCorrelator(self.data[0], 10, window=window)
+        shifted = self._shift(self.data[0], 2.5, 4.2)
+        drift = corr.measure(shifted)
+        numpy.testing.assert_almost_equal(drift, (4.2, 2.5), 0)
+
+        with self.assertRaises(ValueError):
+            PhaseCorrelator(self.data[0], 10, window=window[1:])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -19,8 +19,12 @@ from __future__ import division
 from odemis.acq.stitching._registrar import *
 from odemis.acq.stitching._weaver import *
 
+from concurrent import futures
 import copy
+import logging
+import multiprocessing
 import random
+import time
 
 REGISTER_IDENTITY = 0
 REGISTER_SHIFT = 1
@@ -30,39 +34,35 @@ WEAVER_COLLAGE = 1
 WEAVER_COLLAGE_REVERSE = 2
 
 
-def register(tiles, method=REGISTER_GLOBAL_SHIFT):
+def _create_registrar(method, executor=None):
     """
-    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles to compute the registration. 
-    If it's tuples, the first tile of each tuple is the “main tile”, and the following ones are 
-    dependent tiles.
-    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar
-    returns:
-        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated 
-        MD_POS metadata
+    method (REGISTER_*): the registration method
+    executor (None or Executor): to compute the shifts asynchronously, if the
+      registrar supports it.
+    returns (Registrar): a new registrar
     """
-
     if method == REGISTER_SHIFT:
-        registrar = ShiftRegistrar()
+        return ShiftRegistrar()
     elif method == REGISTER_IDENTITY:
-        registrar = IdentityRegistrar()
+        return IdentityRegistrar()
     elif method == REGISTER_GLOBAL_SHIFT:
-        registrar = GlobalShiftRegistrar()
+        return GlobalShiftRegistrar(executor)
     else:
         raise ValueError("Invalid registrar %s" % (method,))
 
-    # Register tiles
-    updatedTiles = []
-    for ts in tiles:
-        # Separate tile and dependent_tiles
-        if isinstance(ts, tuple):
-            tile = ts[0]
-            dep_tiles = ts[1:]
-        else:
-            tile = ts
-            dep_tiles = None
-        registrar.addTile(tile, dep_tiles)
 
-    # Update positions
+def _update_positions(tiles, registrar):
+    """
+    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles
+      which have been added to the registrar.
+    registrar (Registrar): the registrar
+    returns:
+        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
+        MD_POS metadata
+    """
+    tile_pos, dep_tile_pos = registrar.getPositions()
+
+    updatedTiles = []
     for i, ts in enumerate(tiles):
         # Return tuple of positions if dependent tiles are present
         if isinstance(ts, tuple):
@@ -71,22 +71,20 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
 
             # Update main tile
             md = copy.deepcopy(tile.metadata)
-            md[model.MD_POS] = registrar.getPositions()[0][i]
+            md[model.MD_POS] = tile_pos[i]
             tileUpd = model.DataArray(tile, md)
 
             # Update dependent tiles
             tilesNew = [tileUpd]
             for j, dt in enumerate(dep_tiles):
                 md = copy.deepcopy(dt.metadata)
-                md[model.MD_POS] = registrar.getPositions()[1][i][j]
+                md[model.MD_POS] = dep_tile_pos[i][j]
                 tilesNew.append(model.DataArray(dt, md))
             tileUpd = tuple(tilesNew)
 
         else:
-            dep_tiles = None
-
             md = copy.deepcopy(ts.metadata)
-            md[model.MD_POS] = registrar.getPositions()[0][i]
+            md[model.MD_POS] = tile_pos[i]
             tileUpd = model.DataArray(ts, md)
 
         updatedTiles.append(tileUpd)
@@ -94,6 +92,118 @@ def register(tiles, method=REGISTER_GLOBAL_SHIFT):
     return updatedTiles
 
 
+def _add_tile(registrar, ts):
+    """
+    Add a tile (and its dependent tiles) to the registrar
+    ts (DataArray of shape YX or tuple of DataArrays)
+    """
+    # Separate tile and dependent_tiles
+    if isinstance(ts, tuple):
+        tile = ts[0]
+        dep_tiles = ts[1:]
+    else:
+        tile = ts
+        dep_tiles = None
+    registrar.addTile(tile, dep_tiles)
+
+
+def register(tiles, method=REGISTER_GLOBAL_SHIFT):
+    """
+    tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles to compute the registration. 
+    If it's tuples, the first tile of each tuple is the “main tile”, and the following ones are 
+    dependent tiles.
+    method (REGISTER_*): REGISTER_SHIFT → ShiftRegistrar, REGISTER_IDENTITY → IdentityRegistrar
+    returns:
+        tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated 
+        MD_POS metadata
+    """
+    registrar = _create_registrar(method)
+
+    # Register tiles
+    for ts in tiles:
+        _add_tile(registrar, ts)
+
+    # Update positions
+    return _update_positions(tiles, registrar)
+
+
+class RegistrationPipeline(object):
+    """
+    Registers the tiles while they are acquired. The shifts between each new tile
+    and its neighbours are computed by a pool of threads, in the background. So,
+    once the last tile is added, only the global positioning is left.
+    Only REGISTER_GLOBAL_SHIFT computes the shifts in the background. The other
+    methods register each tile when it's added.
+    """
+
+    def __init__(self, method=REGISTER_GLOBAL_SHIFT, max_workers=None):
+        """
+        method (REGISTER_*): the registration method, as for register()
+        max_workers (None or 0 < int): number of threads computing the shifts.
+          If None, it's the number of CPUs.
+        """
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._registrar = _create_registrar(method, self._executor)
+        self._tiles = []
+
+    def addTile(self, ts):
+        """
+        Add a tile, and start its registration. It returns immediately.
+        ts (DataArray of shape YX or tuple of DataArrays): the tile, or the
+          main tile followed by its dependent tiles, as for register().
+        """
+        _add_tile(self._registrar, ts)
+        self._tiles.append(ts)
+
+    def _getPendingShifts(self):
+        if isinstance(self._registrar, GlobalShiftRegistrar):
+            return [f for f in self._registrar.getPendingShifts() if not f.done()]
+        return []
+
+    def getRegisteredTiles(self, future=None):
+        """
+        Wait for the registration of all the tiles to be finished. No tile can
+        be added afterwards.
+        future (None or ProgressiveFuture): if provided, its expected end time
+          is updated while waiting, and the waiting stops if it's cancelled.
+        returns:
+            tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles as passed, but with updated
+            MD_POS metadata
+        raises:
+            CancelledError: if the future was cancelled while waiting
+        """
+        pending = self._getPendingShifts()
+        if future is not None and pending:
+            logging.debug("Waiting for %d tile shifts to be computed", len(pending))
+            tstart = time.time()
+            npending = len(pending)
+            while pending:
+                if future.cancelled():
+                    self.cancel()
+                    raise futures.CancelledError()
+                _, pending = futures.wait(pending, timeout=1)
+                ndone = npending - len(pending)
+                if ndone:
+                    # Assume the remaining shifts take as long as the previous ones
+                    dur = time.time() - tstart
+                    future.set_progress(end=time.time() + dur * len(pending) / ndone)
+
+        try:
+            return _update_positions(self._tiles, self._registrar)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    def cancel(self):
+        """
+        Stop all the computations not yet started. No tile can be added afterwards.
+        """
+        for f in self._getPendingShifts():
+            f.cancel()
+        self._executor.shutdown(wait=False)
+
+
 def weave(tiles, method=WEAVER_MEAN):
     """
     tiles (list of DataArray of shape YX or tuples of DataArrays): The tiles to compute the registration. 
@@ -119,3 +229,28 @@ def weave(tiles, method=WEAVER_MEAN):
     return stitched_image
 
 
+def weave_to_file(tiles, filename, method=WEAVER_MEAN, compressed=True):
+    """
+    Same as weave(), but the stitched image is directly written into a pyramidal
+    TIFF file, without ever holding the complete image in memory.
+    tiles (list of DataArray or DataArrayShadow of shape YX): The tiles to weave,
+      with their final MD_POS. Only one DataArrayShadow is loaded at a time.
+    filename (unicode): the TIFF file to create
+    method (WEAVER_*): WEAVER_MEAN → MeanWeaver, WEAVER_COLLAGE → CollageWeaver
+    compressed (bool): whether the file is LZW compressed or not.
+    """
+    if method == WEAVER_MEAN:
+        weaver_cls = MeanWeaver
+    elif method == WEAVER_COLLAGE:
+        weaver_cls = CollageWeaver
+    elif method == WEAVER_COLLAGE_REVERSE:
+        weaver_cls = CollageWeaverReverse
+    else:
+        raise ValueError("Invalid weaver %s" % (method,))
+
+    weaver = PyramidalFileWeaver(filename, tiles, weaver_cls, compressed)
+    try:
+        for t in tiles:
+            weaver.addTile(t)
+    finally:
+        weaver.close()
@@ -446,26 +446,51 @@ class GlobalShiftRegistrar(object):
     neighbours and performs a global optimization to find the best path connecting the tiles.
     """
 
-    def __init__(self):
+    def __init__(self, executor=None):
+        """
+        executor (None or concurrent.futures.Executor): if provided, the shifts
+          between a new tile and its neighbours are computed asynchronously, with
+          this executor. The positions are then updated only when all the shifts
+          of the tile are known (and at the latest when calling getPositions()).
+        """
         # Store all the tiles. Each cell contains either None or a DataArray
         self.tiles = [[None]]
 
-        # Store the shifts in a data structure with shape num_rows x (num_cols - 1) x 2 for the
-        # horizontal shifts and (num_cols - 1) x num_rows x 2 for the vertical shifts. The data
-        # structure contains the shift on all edges in the tile grid from top left to bottom right.
-        # Each cell contains a tuple (x, y shift) and a float (error value).
-        # The main advantage of using this data structure over an adjacency matrix is
-        # that it can be extended in the same way as the self.tiles attribute is extended
-        # when a new tile is added.
-        self.shifts_hor = [[None]]
-        self.shifts_ver = [[None]]
+        # Store the shifts between neighbouring tiles as a sparse list of edges.
+        # The key is the pair of grid positions ((row, col), (row, col)), with
+        # the top (or left) tile first. The value is the (x, y) shift from the
+        # first tile to the second one, and the error value (lower is better).
+        self._shifts = {}
+
+        # Minimum spanning tree (forest, actually, if some tiles are not
+        # connected) of the tiles, with the first tile as root.
+        # (row, col) -> parent (row, col), or None for a root
+        self._parent = {}
+        # (row, col) -> set of children (row, col)
+        self._children = {}
+        # (row, col) -> number of edges to the root
+        self._depth = {}
+
+        # Registered position (x, y, in px) of each tile, relative to the first tile.
+        # It's updated every time a tile is added. Tiles not connected to the
+        # first tile are not present.
+        self._positions = {}
 
         # List of 2D indices for grid positions in order of acquisition
         self.acq_order = []
+        # Metadata position of the tiles, in order of acquisition (only the
+        # first len(acq_order) rows are used)
+        self._md_pos = numpy.empty((16, 2))
 
         # Shift between main tile and dependent tiles, shape: number of tiles x number of dep_tiles.
         self.offsets_dep_tiles = []
 
+        self._executor = executor
+        # Tiles whose shifts are not yet integrated in the tree, in order of
+        # acquisition: (row, col, list of (edge, Future))
+        self._pending = deque()
+        self._pending_edges = set()
+
     def addTile(self, tile, dependent_tiles=None):
         """
         Extends grid by one tile. The first tile is added at the top left position. Any following
@@ -477,7 +502,18 @@ class GlobalShiftRegistrar(object):
         relative to main tile. Their content and metadata are not used for the computation of the final position.
         """
         row, col = self._insert_tile_to_grid(tile)
-        self._compute_registration(row, col)
+        if self._executor is None:
+            edges = self._compute_registration(row, col)
+            self._update_tree(row, col, edges)
+        else:
+            fshifts = []
+            for edge, t1, t2 in self._get_new_edges(row, col):
+                f = self._executor.submit(self._get_shift, t1, t2)
+                fshifts.append((edge, f))
+                self._pending_edges.add(edge)
+            self._pending.append((row, col, fshifts))
+            # Integrate the shifts already computed
+            self._process_pending(wait=False)
 
         if dependent_tiles is not None:
             offsets = []
@@ -494,14 +530,22 @@ class GlobalShiftRegistrar(object):
         :returns dep_tile_positions: (list of N tuples of K tuples of 2 floats) for each tile, it returns
         the adjusted position of all dependent tile (in the order they were passed)
         """
+        # Wait for all the shifts to be computed
+        self._process_pending(wait=True)
+
         px_size = self.tiles[0][0].metadata[model.MD_PIXEL_SIZE]
         firstPosition = numpy.divide(self.tiles[0][0].metadata[model.MD_POS], px_size)
         tile_positions = []
         dep_tile_positions = []
 
-        registered_positions = self._assemble_mosaic()
         for ti in self.acq_order:
-            shift = registered_positions[ti[0]][ti[1]]
+            shift = self._positions.get(tuple(ti))
+            if shift is None:
+                # Not connected to the first tile => cannot be registered
+                tile = self.tiles[ti[0]][ti[1]]
+                logging.warning("Tile at %s couldn't be registered, using its original position", ti)
+                tile_positions.append(tuple(tile.metadata[model.MD_POS]))
+                continue
             tile_positions.append(((shift[0] + firstPosition[0]) * px_size[0],
                                    (firstPosition[1] - shift[1]) * px_size[1]))
 
@@ -521,11 +565,12 @@ class GlobalShiftRegistrar(object):
 
         :param tile: (DataArray) tile to be inserted
         :returns: (int, int) row, col grid position of the tile
-        :updates self.tiles, self.shifts, self.acq_order:
+        :updates self.tiles, self.acq_order:
         """
+        pos = tile.metadata[model.MD_POS]
         if self.tiles[0][0] is None:
             self.tiles[0][0] = tile
-            self.acq_order.append([0, 0])
+            self._add_to_acq_order(0, 0, pos)
             return 0, 0
 
         if tile.shape != self.tiles[0][0].shape:
@@ -535,20 +580,16 @@ class GlobalShiftRegistrar(object):
         num_cols = len(self.tiles[0])
         num_rows = len(self.tiles)
 
-        # Find the registered tile that is closest to the new tile.
-        minDist = float("inf")
-        for i in range(num_rows):
-            for j in range(num_cols):
-                if self.tiles[i][j] is not None:
-                    dist = math.hypot(*numpy.subtract(tile.metadata[model.MD_POS],
-                                                     self.tiles[i][j].metadata[model.MD_POS]))
-                    if dist < minDist:
-                        minDist = dist
-                        prev_row, prev_col = (i, j)
+        # Find the registered tile that is closest to the new tile (the first
+        # one in the grid, if several are at the same distance).
+        md_pos = self._md_pos[:len(self.acq_order)]
+        dist = numpy.hypot(md_pos[:, 0] - pos[0], md_pos[:, 1] - pos[1])
+        closest = numpy.flatnonzero(dist == dist.min())
+        prev_row, prev_col = min(tuple(self.acq_order[i]) for i in closest)
 
         # Insert new tile either to the right or to the bottom of the closest tile.
-        ver_diff = tile.metadata[model.MD_POS][1] - self.tiles[prev_row][prev_col].metadata[model.MD_POS][1]
-        hor_diff = tile.metadata[model.MD_POS][0] - self.tiles[prev_row][prev_col].metadata[model.MD_POS][0]
+        ver_diff = pos[1] - self.tiles[prev_row][prev_col].metadata[model.MD_POS][1]
+        hor_diff = pos[0] - self.tiles[prev_row][prev_col].metadata[model.MD_POS][0]
         if abs(ver_diff) > abs(hor_diff) and ver_diff < 0:
             # new tile below previous tile
             row = prev_row + 1
@@ -556,8 +597,6 @@ class GlobalShiftRegistrar(object):
             # extend grid in y direction if necessary
             if num_rows <= row:
                 self.tiles.append([None] * num_cols)
-                self.shifts_hor.append([None] * (num_cols - 1))
-                self.shifts_ver.append([None] * (num_cols))
         elif abs(ver_diff) > abs(hor_diff) and ver_diff > 0:
             # new tile on top of previous tile
             row = prev_row - 1
@@ -574,15 +613,24 @@ class GlobalShiftRegistrar(object):
             if num_cols <= col:
                 for i in range(len(self.tiles)):
                     self.tiles[i].append(None)
-                    self.shifts_hor[i].append(None)
-                    self.shifts_ver[i].append(None)
         else:
             raise ValueError("Cannot insert multiple tiles at the same position.")
 
         self.tiles[row][col] = tile
-        self.acq_order.append([row, col])
+        self._add_to_acq_order(row, col, pos)
         return row, col
 
+    def _add_to_acq_order(self, row, col, pos):
+        """
+        :updates self.acq_order, self._md_pos:
+        """
+        n = len(self.acq_order)
+        if n >= self._md_pos.shape[0]:
+            # Double the size, to keep the amortized cost constant
+            self._md_pos = numpy.concatenate([self._md_pos, numpy.empty_like(self._md_pos)])
+        self._md_pos[n] = pos
+        self.acq_order.append([row, col])
+
     def _get_shift(self, prev_tile, tile):
         """
         Calculates the shift  between the two tiles. It also returns an error metric based on the
@@ -641,109 +689,249 @@ class GlobalShiftRegistrar(object):
 
         return shift_total, ncc
 
-    def _compute_registration(self, row, col):
+    def getPendingShifts(self):
         """
-        Performs registration of the tile at grid position row, col with respect to every
-        available neighbour. The computed shifts and the respective cross-correlation values
-        are stored in self.shifts.
+        :returns: (list of Futures) the shift computations not yet integrated in
+          the registration. Empty if the registrar has no executor.
+        """
+        return [f for _, _, fshifts in self._pending for _, f in fshifts]
+
+    def _process_pending(self, wait):
+        """
+        Integrates the shifts computed asynchronously, in the order the tiles were
+        added, so that the result is the same as if they were computed synchronously.
+
+        :param wait: (bool) if True, wait for all the shifts to be computed.
+          Otherwise, stop at the first tile with shifts not yet computed.
+        :updates self._shifts, and the tree:
+        """
+        while self._pending:
+            row, col, fshifts = self._pending[0]
+            if not wait and not all(f.done() for _, f in fshifts):
+                break
+            self._pending.popleft()
+            edges = []
+            for edge, f in fshifts:
+                shift, ncc = f.result()
+                self._pending_edges.discard(edge)
+                self._store_shift(edge, shift, ncc)
+                edges.append(edge)
+            self._update_tree(row, col, edges)
+
+    def _get_new_edges(self, row, col):
+        """
+        Lists the neighbours of the tile at grid position row, col whose shift
+        hasn't been computed yet.
 
         :param row: (int) row index
         :param col: (int) col index
-        :updates self.shifts:
+        :returns: (list of (edge, DataArray, DataArray)) each edge (key of
+          self._shifts) with its first and second tile
         """
         tile = self.tiles[row][col]
         num_cols = len(self.tiles[0])
         num_rows = len(self.tiles)
 
-        # Neighbouring tiles and shifts
-        nbr_left = self.tiles[row][col - 1] if col > 0 else None
-        nbr_right = self.tiles[row][col + 1] if col < num_cols - 2 else None
-        nbr_top = self.tiles[row - 1][col] if row > 0 else None
-        nbr_bottom = self.tiles[row + 1][col] if row < num_rows - 2 else None
+        # Neighbouring tiles, as (edge, first tile, second tile)
+        nbrs = []
+        if col > 0:
+            nbrs.append((((row, col - 1), (row, col)), self.tiles[row][col - 1], tile))
+        if col < num_cols - 2:
+            nbrs.append((((row, col), (row, col + 1)), tile, self.tiles[row][col + 1]))
+        if row > 0:
+            nbrs.append((((row - 1, col), (row, col)), self.tiles[row - 1][col], tile))
+        if row < num_rows - 2:
+            nbrs.append((((row, col), (row + 1, col)), tile, self.tiles[row + 1][col]))
+
+        # All adjacent tiles that have not been calculated yet
+        return [(edge, t1, t2) for edge, t1, t2 in nbrs
+                if t1 is not None and t2 is not None and
+                edge not in self._shifts and edge not in self._pending_edges]
+
+    def _store_shift(self, edge, shift, ncc):
+        """
+        :param edge: (edge) key of self._shifts
+        :param shift: (float, float) the shift from the first tile to the second one
+        :param ncc: (-1 <= float <= 1) normalized cross correlation of the shift
+        :updates self._shifts:
+        """
+        # The normalized cross correlation value needs to be transformed, so it can be
+        # used in the minimum spanning tree. Lower values are better and the value should
+        # never be 0 --> convert to error between [100, 200]
+        self._shifts[edge] = (shift, 200 - (ncc + 1) * 50)
 
-        shift_left = self.shifts_hor[row][col - 1] if col > 0 else None
-        shift_right = self.shifts_hor[row][col] if col < num_cols - 2 else None
-        shift_top = self.shifts_ver[row - 1][col] if row > 0 else None
-        shift_bottom = self.shifts_ver[row][col] if row < num_rows - 2 else None
+    def _compute_registration(self, row, col):
+        """
+        Performs registration of the tile at grid position row, col with respect to every
+        available neighbour. The computed shifts and the respective error values
+        are stored in self._shifts.
 
+        :param row: (int) row index
+        :param col: (int) col index
+        :returns: (list of edges) the edges (keys of self._shifts) newly computed
+        :updates self._shifts:
+        """
         # Calculate the shifts to all adjacent tiles that have not been calculated yet
-        if nbr_left is not None and not shift_left:
-            self.shifts_hor[row][col - 1] = self._get_shift(nbr_left, tile)
-        if nbr_right is not None and not shift_right:
-            self.shifts_hor[row][col] = self._get_shift(tile, nbr_right)
-        if nbr_top is not None and not shift_top:
-            self.shifts_ver[row - 1][col] = self._get_shift(nbr_top, tile)
-        if nbr_bottom is not None and not shift_bottom:
-            self.shifts_ver[row][col] = self._get_shift(tile, nbr_bottom)
-            
-    def _assemble_mosaic(self):
+        edges = []
+        for edge, t1, t2 in self._get_new_edges(row, col):
+            shift, ncc = self._get_shift(t1, t2)
+            self._store_shift(edge, shift, ncc)
+            edges.append(edge)
+
+        return edges
+
+    def _update_tree(self, row, col, edges):
+        """
+        Updates the minimum spanning tree and the registered positions after
+        adding the tile at the given grid position.
+        As the graph is only extended by the new tile, the new minimum spanning
+        tree is obtained from the previous one by adding the new edges one at a
+        time, and each time a cycle is closed, by removing its heaviest edge
+        (cycle property). So only the positions of the tiles whose path to the
+        first tile changed need to be updated.
+
+        :param row: (int) row index of the new tile
+        :param col: (int) col index of the new tile
+        :param edges: (list of edges) the edges to the new tile
+        :updates self._parent, self._children, self._depth, self._positions:
+        """
+        node = (row, col)
+        self._parent[node] = None
+        self._children[node] = set()
+        self._depth[node] = 0
+        if node == tuple(self.acq_order[0]):
+            # First tile: reference for all the other positions
+            self._positions[node] = numpy.zeros(2)
+
+        for edge in sorted(edges, key=lambda e: self._shifts[e][1]):
+            nbr = edge[0] if edge[1] == node else edge[1]
+            paths = self._get_path(node, nbr)
+            if paths is None:
+                # Different trees => just connect them, from the tree not
+                # containing the first tile (which has no position).
+                if nbr in self._positions:
+                    self._attach(node, nbr)
+                else:
+                    self._attach(nbr, node)
+                continue
+
+            # Same tree => replace the heaviest edge on the cycle, if it's worse
+            path_node, path_nbr = paths
+            worst = max(path_node + path_nbr, key=lambda e: self._shifts[e][1])
+            if self._shifts[worst][1] <= self._shifts[edge][1]:
+                continue
+            self._detach(worst)
+            # The side of the cycle which is not connected to the root anymore
+            # gets reconnected via the new edge.
+            if worst in path_node:
+                self._attach(node, nbr)
+            else:
+                self._attach(nbr, node)
+
+    def _get_path(self, n1, n2):
         """
-        Performs a global optimization to find the best path through the tile grid using 
-        a minimum spanning tree.
+        Finds the path between two tiles in the tree.
 
-        :returns: (DataArray with shape num_rows x num_cols x 2) registered positions
+        :returns: (list of edges, list of edges) the edges from n1 to the closest
+          common ancestor, and from n2 to the closest common ancestor, or None
+          if the tiles are not in the same tree.
         """
-        # Transform shifts and errors to adjacency matrices
-        # The normalized cross correlation value needs to be transformed, so it can be
-        # used in the minimum spanning tree. Lower values are better and the value should
-        # never be 0 --> convert to error between [100, 200]
-        num_cols = len(self.tiles[0])
-        num_rows = len(self.tiles)
-        errors = numpy.zeros((num_rows * num_cols, num_rows * num_cols))
-        shifts = numpy.zeros((num_rows * num_cols, num_rows * num_cols, 2))
-        for row in range(num_rows):
-            for col in range(num_cols - 1):
-                idx = row * num_cols + col
-                if self.shifts_hor[row][col]:
-                    ncc = self.shifts_hor[row][col][1]
-                    errors[idx, idx + 1] = 200 - (ncc + 1) * 50
-                    shifts[idx, idx + 1] = self.shifts_hor[row][col][0]
-
-        for row in range(num_rows - 1):
-            for col in range(num_cols):
-                idx = row * num_cols + col
-                if self.shifts_ver[row][col]:
-                    ncc = self.shifts_ver[row][col][1]
-                    errors[idx, idx + num_cols] = 200 - (ncc + 1) * 50
-                    shifts[idx, idx + num_cols] = self.shifts_ver[row][col][0]
+        path1, path2 = [], []
+        while n1 != n2:
+            if self._depth[n1] >= self._depth[n2]:
+                p = self._parent[n1]
+                if p is None:
+                    return None
+                path1.append((min(n1, p), max(n1, p)))
+                n1 = p
+            else:
+                p = self._parent[n2]
+                path2.append((min(n2, p), max(n2, p)))
+                n2 = p
+
+        return path1, path2
+
+    def _detach(self, edge):
+        """
+        Removes an edge from the tree. The child becomes the root of its own tree.
+        """
+        n1, n2 = edge
+        child, parent = (n1, n2) if self._parent[n1] == n2 else (n2, n1)
+        self._children[parent].discard(child)
+        self._parent[child] = None
+        # Depth of the subtree is updated when it's attached again
+
+    def _attach(self, node, parent):
+        """
+        Connects the tree containing node to parent. The tree is re-rooted at
+        node, and the positions of all its tiles are updated.
+        """
+        # Reverse the path from the node to the root
+        prev, n = parent, node
+        while n is not None:
+            p = self._parent[n]
+            if p is not None:
+                self._children[p].discard(n)
+            self._parent[n] = prev
+            self._children[prev].add(n)
+            prev, n = n, p
+
+        # Update the depth and positions of the whole (sub)tree
+        queue = deque([node])
+        while queue:
+            n = queue.popleft()
+            p = self._parent[n]
+            self._depth[n] = self._depth[p] + 1
+            if p in self._positions:
+                if n > p:
+                    self._positions[n] = numpy.add(self._positions[p], self._shifts[(p, n)][0])
+                else:
+                    self._positions[n] = numpy.subtract(self._positions[p], self._shifts[(n, p)][0])
+            else:
+                self._positions.pop(n, None)
+            queue.extend(self._children[n])
+
+    def _assemble_mosaic(self):
+        """
+        Performs a global optimization to find the best path through the tile grid using
+        a minimum spanning tree, computed on the whole graph of the tiles.
+        It's normally not needed, as the positions are updated each time a tile is added,
+        but it's useful as reference.
+
+        :returns: (dict (int, int) -> numpy.array of 2 floats) registered position of each
+          tile (in px), relative to the first tile. Tiles not connected to the first tile
+          are not present.
+        """
+        # Convert the edge list to a sparse adjacency matrix. As the nodes are
+        # sorted in the grid order, the first tile of an edge always has the
+        # lowest index.
+        nodes = sorted(self._parent.keys())
+        node_idx = {n: i for i, n in enumerate(nodes)}
+        edges = list(self._shifts.keys())
+        errors = [self._shifts[e][1] for e in edges]
+        rows = [node_idx[e[0]] for e in edges]
+        cols = [node_idx[e[1]] for e in edges]
+        graph = csr_matrix((errors, (rows, cols)), shape=(len(nodes), len(nodes)))
 
         # Build the minimum spanning tree
-        tree = minimum_spanning_tree(csr_matrix(errors))
-        tree = tree.toarray().astype(int)
+        tree = minimum_spanning_tree(graph).tocoo()
 
         # Follow the path through the tree and update positions with the corresponding shifts.
-        # The minimum spanning tree is converted to an adjacency list that contains for every
-        # tile a list of all tiles that should be updated based on the current tile.
-        # The children of the newly updated tile will be placed in a queue waiting to be
-        # updated themselves.
         adj_list = {}
-        for i in range(len(tree)):
-            adj = []
-            for j in range(len(tree[0])):
-                if tree[i][j] != 0:
-                    adj.append([j, shifts[i][j]])
-                if tree[j][i] != 0:
-                    adj.append([j, shifts[j][i]])
-            adj_list[i] = adj
-
-        positions = {0: (0, 0)}
-        idx_queue = deque([0])  # start with index 0
-        while idx_queue:
-            key = idx_queue.popleft()
-            for next_idx, shift in adj_list[key]:
-                if not next_idx in positions.keys():
-                    if next_idx > key:
-                        positions[next_idx] = numpy.add(positions[key], shift)
-                    else:
-                        positions[next_idx] = numpy.subtract(positions[key], shift)
-
-                    if next_idx not in idx_queue:
-                        idx_queue.append(next_idx)
-
-        # If there are any tiles missing in the grid, add position None, so we can still
-        # reshape the array and get an output
-        for i in range(num_rows * num_cols):
-            if i not in positions:
-                positions[i] = [None, None]
-
-        return numpy.array(positions.values()).reshape([num_rows, num_cols, 2])
+        for i, j in zip(tree.row, tree.col):
+            src, dst = nodes[min(i, j)], nodes[max(i, j)]
+            shift = self._shifts[(src, dst)][0]
+            adj_list.setdefault(src, []).append((dst, shift, numpy.add))
+            adj_list.setdefault(dst, []).append((src, shift, numpy.subtract))
+
+        start = tuple(self.acq_order[0])
+        positions = {start: numpy.zeros(2)}
+        queue = deque([start])
+        while queue:
+            key = queue.popleft()
+            for nxt, shift, op in adj_list.get(key, []):
+                if nxt not in positions:
+                    positions[nxt] = op(positions[key], shift)
+                    queue.append(nxt)
+
+        return positions
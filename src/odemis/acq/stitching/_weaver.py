@@ -19,6 +19,7 @@ from __future__ import division
 import logging
 import numpy
 from odemis import model, util
+from odemis.dataio import tiff
 from odemis.util import img
 
 
@@ -30,6 +31,84 @@ from odemis.util import img
 # directly copy the image already transformed.
 # TODO: handle higher dimensions by just copying them as-is
 
+def _get_gradient_weights(shape):
+    """
+    Computes the weights of the pixels of a tile, for blending it with the
+    previous tiles. The weight is 0 at the center and increases towards the
+    borders, along a maximum-norm.
+    shape (int, int): shape of the tile
+    return (numpy.array of float): weights of same shape
+    """
+    hh, hw = numpy.divide(shape, 2)  # half-height, half-width
+    # Deal with even/odd tile sizes
+    if shape[1] % 2 == 0:
+        x = numpy.arange(-hw, hw, 1)
+    else:
+        x = numpy.arange(-hw, hw + 1, 1)
+
+    if shape[0] % 2 == 0:
+        y = numpy.arange(-hh, hh, 1)
+    else:
+        y = numpy.arange(-hh, hh + 1, 1)
+
+    xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
+    return numpy.maximum(xx, yy)
+
+
+def _get_bounding_boxes(tiles_info):
+    """
+    Computes the position of the tiles in the global image.
+    tiles_info (list of (shape, metadata)): shape and metadata (with the correction
+      metadata already merged) of each tile
+    return:
+      tbbx_px (list of 4 ints): bounding-box (ltrb) in px of each tile in the global image
+      gbbx_px (4 ints): bounding-box (ltrb) in px of the global image
+      gbbx_phy (4 floats): bounding-box (ltrb) in physical coordinates of the global image
+    """
+    # Get a fixed pixel size by using the first one
+    # TODO: use the mean, in case they are all slightly different due to
+    # correction?
+    pxs = tiles_info[0][1][model.MD_PIXEL_SIZE]
+
+    tbbx_phy = []  # tuples of ltrb in physical coordinates
+    for shape, md in tiles_info:
+        c = md[model.MD_POS]
+        w = shape[-1], shape[-2]
+        if not util.almost_equal(pxs[0], md[model.MD_PIXEL_SIZE][0], rtol=0.01):
+            logging.warning("Tile @ %s has a unexpected pixel size (%g vs %g)",
+                            c, md[model.MD_PIXEL_SIZE][0], pxs[0])
+        bbx = (c[0] - (w[0] * pxs[0] / 2), c[1] - (w[1] * pxs[1] / 2),
+               c[0] + (w[0] * pxs[0] / 2), c[1] + (w[1] * pxs[1] / 2))
+
+        tbbx_phy.append(bbx)
+
+    gbbx_phy = (min(b[0] for b in tbbx_phy), min(b[1] for b in tbbx_phy),
+                max(b[2] for b in tbbx_phy), max(b[3] for b in tbbx_phy))
+
+    # Compute the bounding-boxes in pixel coordinates
+    tbbx_px = []
+
+    # that's the origin (Y is max as Y is inverted)
+    glt = gbbx_phy[0], gbbx_phy[3]
+    for bp, (shape, md) in zip(tbbx_phy, tiles_info):
+        lt = (int(round((bp[0] - glt[0]) / pxs[0])),
+              int(round(-(bp[3] - glt[1]) / pxs[1])))
+        w = shape[-1], shape[-2]
+        bbx = (lt[0], lt[1],
+               lt[0] + w[0], lt[1] + w[1])
+        tbbx_px.append(bbx)
+
+    gbbx_px = (min(b[0] for b in tbbx_px), min(b[1] for b in tbbx_px),
+               max(b[2] for b in tbbx_px), max(b[3] for b in tbbx_px))
+
+    assert gbbx_px[0] == gbbx_px[1] == 0
+    if numpy.greater(gbbx_px[-2:], 4 * numpy.sum(tbbx_px[-2:])).any():
+        # Overlap > 50% or missing tiles
+        logging.warning("Global area much bigger than sum of tile areas")
+
+    return tbbx_px, gbbx_px, gbbx_phy
+
+
 class CollageWeaver(object):
     """
     Very straight-forward version, which just paste the images where their center
@@ -65,48 +144,7 @@ class CollageWeaver(object):
         tiles = self.tiles
 
         # Compute the bounding box of each tile and the global bounding box
-
-        # Get a fixed pixel size by using the first one
-        # TODO: use the mean, in case they are all slightly different due to
-        # correction?
-        pxs = tiles[0].metadata[model.MD_PIXEL_SIZE]
-
-        tbbx_phy = []  # tuples of ltrb in physical coordinates
-        for t in tiles:
-            c = t.metadata[model.MD_POS]
-            w = t.shape[-1], t.shape[-2]
-            if not util.almost_equal(pxs[0], t.metadata[model.MD_PIXEL_SIZE][0], rtol=0.01):
-                logging.warning("Tile @ %s has a unexpected pixel size (%g vs %g)",
-                                c, t.metadata[model.MD_PIXEL_SIZE][0], pxs[0])
-            bbx = (c[0] - (w[0] * pxs[0] / 2), c[1] - (w[1] * pxs[1] / 2),
-                   c[0] + (w[0] * pxs[0] / 2), c[1] + (w[1] * pxs[1] / 2))
-
-            tbbx_phy.append(bbx)
-
-        gbbx_phy = (min(b[0] for b in tbbx_phy), min(b[1] for b in tbbx_phy),
-                    max(b[2] for b in tbbx_phy), max(b[3] for b in tbbx_phy))
-
-        # Compute the bounding-boxes in pixel coordinates
-        tbbx_px = []
-
-        # that's the origin (Y is max as Y is inverted)
-        glt = gbbx_phy[0], gbbx_phy[3]
-        for bp, t in zip(tbbx_phy, tiles):
-            lt = (int(round((bp[0] - glt[0]) / pxs[0])),
-                  int(round(-(bp[3] - glt[1]) / pxs[1])))
-            w = t.shape[-1], t.shape[-2]
-            bbx = (lt[0], lt[1],
-                   lt[0] + w[0], lt[1] + w[1])
-            tbbx_px.append(bbx)
-
-        gbbx_px = (min(b[0] for b in tbbx_px), min(b[1] for b in tbbx_px),
-                   max(b[2] for b in tbbx_px), max(b[3] for b in tbbx_px))
-
-        assert gbbx_px[0] == gbbx_px[1] == 0
-
-        if numpy.greater(gbbx_px[-2:], 4 * numpy.sum(tbbx_px[-2:])).any():
-            # Overlap > 50% or missing tiles
-            logging.warning("Global area much bigger than sum of tile areas")
+        tbbx_px, gbbx_px, gbbx_phy = _get_bounding_boxes([(t.shape, t.metadata) for t in tiles])
 
         # Paste each tile
         logging.debug("Generating global image of size %dx%d px",
@@ -153,47 +191,7 @@ class CollageWeaverReverse(object):
         tiles = self.tiles
 
         # Compute the bounding box of each tile and the global bounding box
-
-        # Get a fixed pixel size by using the first one
-        # TODO: use the mean, in case they are all slightly different due to
-        # correction?
-        pxs = tiles[0].metadata[model.MD_PIXEL_SIZE]
-
-        tbbx_phy = []  # tuples of ltrb in physical coordinates
-        for t in tiles:
-            c = t.metadata[model.MD_POS]
-            w = t.shape[-1], t.shape[-2]
-            if not util.almost_equal(pxs[0], t.metadata[model.MD_PIXEL_SIZE][0], rtol=0.01):
-                logging.warning("Tile @ %s has a unexpected pixel size (%g vs %g)",
-                                c, t.metadata[model.MD_PIXEL_SIZE][0], pxs[0])
-            bbx = (c[0] - (w[0] * pxs[0] / 2), c[1] - (w[1] * pxs[1] / 2),
-                   c[0] + (w[0] * pxs[0] / 2), c[1] + (w[1] * pxs[1] / 2))
-
-            tbbx_phy.append(bbx)
-
-        gbbx_phy = (min(b[0] for b in tbbx_phy), min(b[1] for b in tbbx_phy),
-                    max(b[2] for b in tbbx_phy), max(b[3] for b in tbbx_phy))
-
-        # Compute the bounding-boxes in pixel coordinates
-        tbbx_px = []
-
-        # that's the origin (Y is max as Y is inverted)
-        glt = gbbx_phy[0], gbbx_phy[3]
-        for bp, t in zip(tbbx_phy, tiles):
-            lt = (int(round((bp[0] - glt[0]) / pxs[0])),
-                  int(round(-(bp[3] - glt[1]) / pxs[1])))
-            w = t.shape[-1], t.shape[-2]
-            bbx = (lt[0], lt[1],
-                   lt[0] + w[0], lt[1] + w[1])
-            tbbx_px.append(bbx)
-
-        gbbx_px = (min(b[0] for b in tbbx_px), min(b[1] for b in tbbx_px),
-                   max(b[2] for b in tbbx_px), max(b[3] for b in tbbx_px))
-
-        assert gbbx_px[0] == gbbx_px[1] == 0
-        if numpy.greater(gbbx_px[-2:], 4 * numpy.sum(tbbx_px[-2:])).any():
-            # Overlap > 50% or missing tiles
-            logging.warning("Global area much bigger than sum of tile areas")
+        tbbx_px, gbbx_px, gbbx_phy = _get_bounding_boxes([(t.shape, t.metadata) for t in tiles])
 
         # Paste each tile
         logging.debug("Generating global image of size %dx%d px",
@@ -249,47 +247,7 @@ class MeanWeaver(object):
         tiles = self.tiles
 
         # Compute the bounding box of each tile and the global bounding box
-
-        # Get a fixed pixel size by using the first one
-        # TODO: use the mean, in case they are all slightly different due to
-        # correction?
-        pxs = tiles[0].metadata[model.MD_PIXEL_SIZE]
-
-        tbbx_phy = []  # tuples of ltrb in physical coordinates
-        for t in tiles:
-            c = t.metadata[model.MD_POS]
-            w = t.shape[-1], t.shape[-2]
-            if not util.almost_equal(pxs[0], t.metadata[model.MD_PIXEL_SIZE][0], rtol=0.01):
-                logging.warning("Tile @ %s has a unexpected pixel size (%g vs %g)",
-                                c, t.metadata[model.MD_PIXEL_SIZE][0], pxs[0])
-            bbx = (c[0] - (w[0] * pxs[0] / 2), c[1] - (w[1] * pxs[1] / 2),
-                   c[0] + (w[0] * pxs[0] / 2), c[1] + (w[1] * pxs[1] / 2))
-
-            tbbx_phy.append(bbx)
-
-        gbbx_phy = (min(b[0] for b in tbbx_phy), min(b[1] for b in tbbx_phy),
-                    max(b[2] for b in tbbx_phy), max(b[3] for b in tbbx_phy))
-
-        # Compute the bounding-boxes in pixel coordinates
-        tbbx_px = []
-
-        # that's the origin (Y is max as Y is inverted)
-        glt = gbbx_phy[0], gbbx_phy[3]
-        for bp, t in zip(tbbx_phy, tiles):
-            lt = (int(round((bp[0] - glt[0]) / pxs[0])),
-                  int(round(-(bp[3] - glt[1]) / pxs[1])))
-            w = t.shape[-1], t.shape[-2]
-            bbx = (lt[0], lt[1],
-                   lt[0] + w[0], lt[1] + w[1])
-            tbbx_px.append(bbx)
-
-        gbbx_px = (min(b[0] for b in tbbx_px), min(b[1] for b in tbbx_px),
-                   max(b[2] for b in tbbx_px), max(b[3] for b in tbbx_px))
-
-        assert gbbx_px[0] == gbbx_px[1] == 0
-        if numpy.greater(gbbx_px[-2:], 4 * numpy.sum(tbbx_px[-2:])).any():
-            # Overlap > 50% or missing tiles
-            logging.warning("Global area much bigger than sum of tile areas")
+        tbbx_px, gbbx_px, gbbx_phy = _get_bounding_boxes([(t.shape, t.metadata) for t in tiles])
 
         # Weave tiles by using a smooth gradient. The part of the tile that does not overlap
         # with any previous tiles is inserted into the part of the
@@ -331,21 +289,7 @@ class MeanWeaver(object):
 
             # Create weight matrix with decreasing values from its center that
             # has the same size as the tile.
-            hh, hw = numpy.divide(roi.shape, 2)  # half-height, half-width
-            # Deal with even/odd tile sizes
-            sz = roi.shape
-            if sz[1] % 2 == 0:
-                x = numpy.arange(-hw, hw, 1)
-            else:
-                x = numpy.arange(-hw, hw + 1, 1)
-
-            if sz[0] % 2 == 0:
-                y = numpy.arange(-hh, hh, 1)
-            else:
-                y = numpy.arange(-hh, hh + 1, 1)
-
-            xx, yy = numpy.meshgrid((x / hw) ** 6, (y / hh) ** 6)
-            w = numpy.maximum(xx, yy)
+            w = _get_gradient_weights(roi.shape)
             # Hardcoding a weight function is quite arbitrary and might result in
             # suboptimal solutions in some cases.
             # Alternatively, different weights might be used. One option would be to select
@@ -369,3 +313,164 @@ class MeanWeaver(object):
         md[model.MD_POS] = c_phy
 
         return model.DataArray(im, md)
+
+
+def _paste_collage(roi, moi, tile, w):
+    roi[...] = tile
+
+
+def _paste_collage_reverse(roi, moi, tile, w):
+    roi[~moi] = tile[~moi]
+
+
+def _paste_mean(roi, moi, tile, w):
+    roi[~moi] = tile[~moi]
+    roi[moi] = (tile * (1 - w))[moi] + (roi * w)[moi]
+
+
+class PyramidalFileWeaver(object):
+    """
+    Weaves the tiles directly into a pyramidal TIFF file, without ever holding
+    the complete image in memory. The final image is built by output tiles of
+    TILE_SIZE x TILE_SIZE px. As soon as an output tile is not overlapped by any
+    of the tiles remaining to be added, it's written to the file. So the memory
+    used only depends on the output tiles "in progress", which is typically one
+    row of tiles.
+    For this to work, the position of all the tiles must be known in advance.
+    The tiles must then be added one at a time, in the same order.
+    The result is the same as with the corresponding weaver (MeanWeaver,
+    CollageWeaver or CollageWeaverReverse).
+    """
+
+    def __init__(self, filename, tiles, weaver=MeanWeaver, compressed=True, background=None):
+        """
+        filename (unicode): the TIFF file to create
+        tiles (list of DataArray or DataArrayShadow): the tiles which will be
+          added, in order. Only their shape, dtype and metadata are used here,
+          so with DataArrayShadows, the data doesn't need to be loaded.
+          All the tiles should have the same dtype.
+        weaver (class): the weaver method, one of MeanWeaver, CollageWeaver,
+          CollageWeaverReverse.
+        compressed (bool): whether the file is LZW compressed or not.
+        background (None or number): value of the pixels not covered by any tile.
+          If None, the minimum of all the tiles is used (like the other weavers),
+          but then the output tiles not completely covered are only written at
+          the end.
+        """
+        try:
+            self._paste = {MeanWeaver: _paste_mean,
+                           CollageWeaver: _paste_collage,
+                           CollageWeaverReverse: _paste_collage_reverse}[weaver]
+        except KeyError:
+            raise ValueError("Invalid weaver %s" % (weaver,))
+        self._use_weights = (weaver is MeanWeaver)
+
+        # Merge the correction metadata (as done by the other weavers)
+        tiles_info = []
+        for t in tiles:
+            md = t.metadata.copy()
+            img.mergeMetadata(md)
+            tiles_info.append((t.shape, md))
+        self._tbbx_px, gbbx_px, gbbx_phy = _get_bounding_boxes(tiles_info)
+        self._dtype = tiles[0].dtype
+        self._background = background
+        self._min = None  # minimum value of all the tiles added so far
+        self._next = 0  # index of the next tile to be added
+
+        # Count for each output tile, the number of tiles which overlap it
+        ts = tiff.TILE_SIZE
+        self._shape = gbbx_px[-1], gbbx_px[-2]
+        self._ntiles = (self._shape[0] - 1) // ts + 1, (self._shape[1] - 1) // ts + 1
+        self._pending = numpy.zeros(self._ntiles, dtype=numpy.int32)
+        for b in self._tbbx_px:
+            self._pending[b[1] // ts:(b[3] - 1) // ts + 1, b[0] // ts:(b[2] - 1) // ts + 1] += 1
+        self._written = numpy.zeros(self._ntiles, dtype=numpy.bool)
+        self._otiles = {}  # (y, x) index -> (data, mask) of output tiles in progress
+
+        c_phy = ((gbbx_phy[0] + gbbx_phy[2]) / 2,
+                 (gbbx_phy[1] + gbbx_phy[3]) / 2)
+        md = tiles_info[0][1]
+        md[model.MD_POS] = c_phy
+        logging.debug("Generating global image of size %dx%d px in %s",
+                      self._shape[1], self._shape[0], filename)
+        self._writer = tiff.TiledPyramidWriter(filename, self._shape, self._dtype, md, compressed)
+
+    def _get_output_tile(self, y, x):
+        """
+        return (numpy.array, numpy.array of bool): the data and mask of the output tile
+        """
+        try:
+            return self._otiles[(y, x)]
+        except KeyError:
+            ts = tiff.TILE_SIZE
+            shape = min(ts, self._shape[0] - y * ts), min(ts, self._shape[1] - x * ts)
+            otile = numpy.empty(shape, dtype=self._dtype), numpy.zeros(shape, dtype=numpy.bool)
+            self._otiles[(y, x)] = otile
+            return otile
+
+    def addTile(self, tile):
+        """
+        tile (DataArray or DataArrayShadow): the next tile, in the order passed
+          at initialisation.
+        """
+        if self._next >= len(self._tbbx_px):
+            raise ValueError("All the %d tiles have already been added" % (len(self._tbbx_px),))
+        b = self._tbbx_px[self._next]
+        self._next += 1
+        if isinstance(tile, model.DataArrayShadow):
+            tile = tile.getData()
+        if tile.shape != (b[3] - b[1], b[2] - b[0]):
+            raise ValueError("Tile has shape %s, while expected %s" % (tile.shape, (b[3] - b[1], b[2] - b[0])))
+
+        tmin = numpy.amin(tile)
+        self._min = tmin if self._min is None else min(self._min, tmin)
+        w = _get_gradient_weights(tile.shape) if self._use_weights else None
+
+        ts = tiff.TILE_SIZE
+        for y in range(b[1] // ts, (b[3] - 1) // ts + 1):
+            for x in range(b[0] // ts, (b[2] - 1) // ts + 1):
+                # Intersection of the tile with the output tile (in global px)
+                l, t = max(b[0], x * ts), max(b[1], y * ts)
+                r, btm = min(b[2], (x + 1) * ts), min(b[3], (y + 1) * ts)
+                data, mask = self._get_output_tile(y, x)
+                oroi = (slice(t - y * ts, btm - y * ts), slice(l - x * ts, r - x * ts))
+                troi = (slice(t - b[1], btm - b[1]), slice(l - b[0], r - b[0]))
+                moi = mask[oroi]
+                self._paste(data[oroi], moi, tile[troi], None if w is None else w[troi])
+                moi[...] = True
+
+                self._pending[y, x] -= 1
+                if self._pending[y, x] == 0:
+                    self._flush(y, x)
+
+    def _flush(self, y, x, background=None):
+        """
+        Write an output tile to the file, if it's complete
+        background (None or number): value for the pixels without data. If None,
+          and the tile is not complete, it's not written.
+        """
+        data, mask = self._get_output_tile(y, x)
+        if not mask.all():
+            if background is None:
+                background = self._background
+                if background is None:
+                    return  # Write it at the end, when the minimum is known
+            data[~mask] = background
+        del self._otiles[(y, x)]
+        self._writer.writeTile(x, y, data)
+        self._written[y, x] = True
+
+    def close(self):
+        """
+        Write the rest of the image, and close the file.
+        All the tiles should have been added.
+        """
+        if self._next < len(self._tbbx_px):
+            logging.warning("Only %d tiles added out of %d", self._next, len(self._tbbx_px))
+
+        background = self._background
+        if background is None:
+            background = self._min if self._min is not None else 0
+        for y, x in zip(*numpy.nonzero(~self._written)):
+            self._flush(y, x, background)
+        self._writer.close()
@@ -29,8 +29,10 @@ import random
 import copy
 import os
 import itertools
+import time
 
 from odemis.acq.stitching import IdentityRegistrar, ShiftRegistrar, GlobalShiftRegistrar
+from concurrent import futures
 from odemis.dataio import find_fittest_converter
 from odemis.util.img import ensure2DImage
 import odemis
@@ -39,6 +41,9 @@ from stitching_test import decompose_image
 
 logging.getLogger().setLevel(logging.DEBUG)
 
+# Export TEST_BENCHMARK = 1 to also run the (long) benchmarks
+TEST_BENCHMARK = (os.environ.get("TEST_BENCHMARK", 0) != 0)  # Default to not run them
+
 # Find path for test images
 IMG_PATH = os.path.dirname(odemis.__file__)
 IMGS = [IMG_PATH + "/driver/songbird-sim-sem.h5",
@@ -815,6 +820,95 @@ class TestGlobalShiftRegistrar(unittest.TestCase):
                     self.assertAlmostEqual(dep_tile[0], p[0] + r1 * px_size[0])
                     self.assertAlmostEqual(dep_tile[1], p[1] + r2 * px_size[1])
 
+    def test_synthetic_grid(self):
+        """
+        Checks the positions are correct when registering a grid of small
+        synthetic tiles.
+        """
+        numpy.random.seed(1)
+        self._register_grid(10)
+
+    @unittest.skipIf(not TEST_BENCHMARK, "Benchmark not requested")
+    def test_benchmark_grid(self):
+        """
+        Measures the time to register large grids of small synthetic tiles, and
+        checks the positions are still correct.
+        """
+        numpy.random.seed(1)
+        for num in (50, 200):
+            self._register_grid(num)
+
+    def _register_grid(self, num):
+        """
+        Registers a grid of num x num synthetic tiles, and checks the positions
+        num (int): number of tiles in each dimension
+        """
+        tile_size = 32
+        o = 0.3
+        # Noise has a lot of features => every shift can be measured
+        shape = (int(tile_size * (num - num * o + o + 1)),) * 2
+        img = numpy.random.randint(0, 4096, shape).astype(numpy.uint16)
+        tiles, real_pos = decompose_image(img, o, num, "horizontalZigzag")
+        px_size = tiles[0].metadata[model.MD_PIXEL_SIZE]
+
+        registrar = GlobalShiftRegistrar()
+        tstart = time.time()
+        for tile in tiles:
+            registrar.addTile(tile)
+        tadd = time.time() - tstart
+        tstart = time.time()
+        registered_pos = registrar.getPositions()[0]
+        tpos = time.time() - tstart
+        logging.info("Registered %dx%d tiles in %g s (%g ms/tile), positions in %g s",
+                     num, num, tadd, tadd * 1e3 / len(tiles), tpos)
+
+        diff = numpy.absolute(numpy.subtract(registered_pos, real_pos))
+        numpy.testing.assert_array_less(diff.flatten(), px_size[0] * 5,
+                    "Position %s pxs off for %s x %s tiles" % (max(diff.flatten()) / px_size[0], num, num))
+
+        # Same quality as the minimum spanning tree computed on the whole graph
+        global_pos = registrar._assemble_mosaic()
+        self.assertEqual(len(global_pos), len(tiles))
+        for ti, p in zip(registrar.acq_order, registered_pos):
+            gp = global_pos[tuple(ti)]
+            gp = (real_pos[0][0] + gp[0] * px_size[0], real_pos[0][1] - gp[1] * px_size[1])
+            numpy.testing.assert_allclose(gp, p, atol=px_size[0] * 5)
+
+    def test_executor(self):
+        """
+        Checks computing the shifts in the background gives the same positions
+        as computing them synchronously.
+        """
+        tile_size = 32
+        o = 0.3
+        num = 10
+        numpy.random.seed(1)
+        shape = (int(tile_size * (num - num * o + o + 1)),) * 2
+        img = numpy.random.randint(0, 4096, shape).astype(numpy.uint16)
+        tiles, real_pos = decompose_image(img, o, num, "horizontalZigzag")
+
+        registrar = GlobalShiftRegistrar()
+        for tile in tiles:
+            registrar.addTile(tile)
+        sync_pos = registrar.getPositions()[0]
+
+        executor = futures.ThreadPoolExecutor(max_workers=4)
+        try:
+            registrar = GlobalShiftRegistrar(executor)
+            tstart = time.time()
+            for tile in tiles:
+                registrar.addTile(tile)
+            tadd = time.time() - tstart
+            tstart = time.time()
+            async_pos = registrar.getPositions()[0]
+            tpos = time.time() - tstart
+            logging.info("Added %d tiles in %g s, positions in %g s", len(tiles), tadd, tpos)
+            self.assertEqual(registrar.getPendingShifts(), [])
+        finally:
+            executor.shutdown()
+
+        numpy.testing.assert_array_equal(async_pos, sync_pos)
+
 
 if __name__ == '__main__':
     unittest.main()
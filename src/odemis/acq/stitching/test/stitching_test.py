@@ -22,15 +22,18 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from concurrent.futures import CancelledError
 import copy
 import numpy
 from odemis import model
 import odemis
-from odemis.acq.stitching import register, weave, REGISTER_IDENTITY, REGISTER_SHIFT, WEAVER_COLLAGE, WEAVER_MEAN
+from odemis.acq.stitching import register, weave, REGISTER_IDENTITY, REGISTER_SHIFT, WEAVER_COLLAGE, WEAVER_MEAN, \
+    RegistrationPipeline
 from odemis.dataio import find_fittest_converter
 from odemis.util.img import ensure2DImage
 import os
 import random
+import threading
 import unittest
 
 # Find path for test images
@@ -169,6 +172,55 @@ class TestRegister(unittest.TestCase):
                     self.assertAlmostEqual(dep_pos[j][0], tile_pos[0] + rnd1[i] * px_size[0])
                     self.assertAlmostEqual(dep_pos[j][1], tile_pos[1] + rnd2[i] * px_size[1])
 
+    def test_pipeline(self):
+        """
+        Test registering the tiles while they are "acquired"
+        """
+        for img in IMGS:
+            conv = find_fittest_converter(img)
+            data = conv.read_data(img)[0]
+            img = ensure2DImage(data)
+            num = 3
+            o = 0.3
+            a = "horizontalZigzag"
+            [tiles, pos] = decompose_image(img, o, num, a)
+
+            all_tiles = [(t, t) for t in tiles]
+            exp_tiles = register(all_tiles)
+
+            f = model.ProgressiveFuture()
+            pipeline = RegistrationPipeline()
+            for t in all_tiles:
+                pipeline.addTile(t)
+            upd_tiles = pipeline.getRegisteredTiles(f)
+
+            self.assertEqual(len(upd_tiles), len(exp_tiles))
+            for ut, et in zip(upd_tiles, exp_tiles):
+                for u, e in zip(ut, et):
+                    self.assertEqual(u.metadata[model.MD_POS], e.metadata[model.MD_POS])
+
+        # Cancelling is always possible
+        pipeline = RegistrationPipeline()
+        for t in tiles:
+            pipeline.addTile(t)
+        pipeline.cancel()
+
+        # Waiting stops as soon as the future is cancelled. The only thread
+        # is blocked, so that the shifts are still pending.
+        pipeline = RegistrationPipeline(max_workers=1)
+        unblock = threading.Event()
+        pipeline._executor.submit(unblock.wait)
+        for t in tiles:
+            pipeline.addTile(t)
+        f = model.ProgressiveFuture()
+        f.cancel()
+        try:
+            with self.assertRaises(CancelledError):
+                pipeline.getRegisteredTiles(f)
+        finally:
+            unblock.set()
+
+
 class TestWeave(unittest.TestCase):
 
     def test_one_tile(self):
@@ -26,7 +26,9 @@ import logging
 import numpy
 from odemis import model
 import odemis
-from odemis.acq.stitching import CollageWeaver, MeanWeaver, CollageWeaverReverse
+from odemis.acq.stitching import CollageWeaver, MeanWeaver, CollageWeaverReverse, \
+    PyramidalFileWeaver, weave_to_file, WEAVER_COLLAGE
+from odemis.dataio import tiff
 from odemis.dataio import find_fittest_converter
 from odemis.util.img import ensure2DImage
 import os
@@ -469,5 +471,73 @@ class TestCollageWeaverReverse(unittest.TestCase):
         numpy.testing.assert_equal(o, 256 * numpy.ones((80, 30)))
 
 
+class TestPyramidalFileWeaver(unittest.TestCase):
+
+    FILENAME = u"test-weaver" + tiff.EXTENSIONS[0]
+
+    def setUp(self):
+        numpy.random.seed(1)  # for reproducibility
+
+    def tearDown(self):
+        try:
+            os.remove(self.FILENAME)
+        except OSError:
+            pass
+
+    def test_same_as_weaver(self):
+        """
+        The file should contain the same image as the one in memory
+        """
+        img = numpy.random.randint(0, 4096, (1000, 1300)).astype(numpy.uint16)
+        for weaver_cls in (MeanWeaver, CollageWeaver, CollageWeaverReverse):
+            for o, a in [(0.2, "horizontalZigzag"), (0.4, "verticalLines")]:
+                # With shift, so that there are some empty areas
+                tiles, _ = decompose_image(img, o, 4, a, True)
+
+                weaver = weaver_cls()
+                for t in tiles:
+                    weaver.addTile(t)
+                exp = weaver.getFullImage()
+
+                fweaver = PyramidalFileWeaver(self.FILENAME, tiles, weaver_cls)
+                for t in tiles:
+                    fweaver.addTile(t)
+                fweaver.close()
+
+                rdata = tiff.open_data(self.FILENAME)
+                outd = rdata.content[0]
+                self.assertEqual(outd.shape, exp.shape)
+                self.assertGreaterEqual(outd.maxzoom, 1)
+                numpy.testing.assert_array_equal(outd.getData(), exp)
+                numpy.testing.assert_almost_equal(outd.metadata[model.MD_POS], exp.metadata[model.MD_POS])
+
+                # The first zoom level is the average of 2x2 px
+                tile = outd.getTile(0, 0, 1)
+                exp_sub = exp[:512, :512].reshape(256, 2, 256, 2).mean(axis=(1, 3))
+                numpy.testing.assert_allclose(tile, exp_sub, atol=1)
+
+    def test_weave_to_file(self):
+        """
+        Tiles added one at a time from a list of DataArrayShadows
+        """
+        img = numpy.random.randint(0, 255, (900, 900)).astype(numpy.uint8)
+        tiles, _ = decompose_image(img, 0.2, 3, "horizontalLines", False)
+        tiff.export(self.FILENAME, tiles)
+        stiles = tiff.open_data(self.FILENAME).content
+
+        weaver = CollageWeaver()
+        for t in stiles:
+            weaver.addTile(t.getData())
+        exp = weaver.getFullImage()
+
+        fn_out = u"test-weaver-out" + tiff.EXTENSIONS[0]
+        try:
+            weave_to_file(stiles, fn_out, WEAVER_COLLAGE)
+            outd = tiff.read_data(fn_out)[0]
+        finally:
+            os.remove(fn_out)
+        numpy.testing.assert_array_equal(outd, exp)
+
+
 if __name__ == '__main__':
     unittest.main()
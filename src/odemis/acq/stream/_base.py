@@ -64,6 +64,10 @@ class Stream(object):
     # Minimum overhead time in seconds when acquiring an image
     SETUP_OVERHEAD = 0.1
 
+    # If True, the histogram is computed on every pixel of the latest image.
+    # Otherwise, it's based on a sub-sample of the successive images (faster).
+    EXACT_HISTOGRAM = True
+
     def __init__(self, name, detector, dataflow, emitter, focuser=None, opm=None,
                  hwdetvas=None, hwemtvas=None, detvas=None, emtvas=None, raw=None,
                  acq_type=None):
@@ -198,8 +202,10 @@ class Stream(object):
         # Histogram of the current image _or_ slightly older image.
         # Note it's an ndarray. Use .tolist() to get a python list.
         self.histogram = model.VigilantAttribute(numpy.empty(0), readonly=True)
-        self.histogram._full_hist = numpy.ndarray(0) # for finding the outliers
+        # Histogram with more bins, for finding the outliers
+        self.histogram._full_hist = numpy.ndarray(0)
         self.histogram._edges = None
+        self._hist_acc = img.HistogramAccumulator(exact=self.EXACT_HISTOGRAM)
 
         # Tuple of (int, str) or (None, None): loglevel and message
         self.status = model.VigilantAttribute((None, None), readonly=True)
@@ -862,8 +868,9 @@ class Stream(object):
         return (DataArray): The merged image
         """
         # calculates the size of the merged image
-        width_zoomed = das.shape[1] / (2 ** z)
-        height_zoomed = das.shape[0] / (2 ** z)
+        dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        width_zoomed = das.shape[dims.index("X")] / (2 ** z)
+        height_zoomed = das.shape[dims.index("Y")] / (2 ** z)
         # calculates the number of tiles on both axes
         num_tiles_x = int(math.ceil(width_zoomed / das.tile_shape[1]))
         num_tiles_y = int(math.ceil(height_zoomed / das.tile_shape[0]))
@@ -986,7 +993,7 @@ class Stream(object):
         self._updateDRange(data)
 
         # Initially, _drange might be None, in which case it will be guessed
-        hist, edges = img.histogram(data, irange=self._drange)
+        hist, edges = self._hist_acc.update(data, irange=self._drange)
         if hist.size > 256:
             chist = img.compactHistogram(hist, 256)
         else:
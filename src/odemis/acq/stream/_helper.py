@@ -33,10 +33,11 @@ from odemis.acq import align
 from odemis.acq.stream._sync import MomentOfInertiaMDStream
 from odemis.model import VigilantAttributeBase, MD_POL_NONE
 from odemis.util import img, almost_equal
+from odemis.util.timeseries import TimeSeriesBuffer
 import time
 
 from ._base import Stream, UNDEFINED_ROI, POL_POSITIONS
-from ._live import LiveStream
+from ._live import LiveStream, CHRONOGRAM_INIT_SAMPLES, CHRONOGRAM_MAX_SAMPLES
 
 
 class RepetitionStream(LiveStream):
@@ -690,8 +691,9 @@ class MonochromatorSettingsStream(PMTSettingsStream):
         del self.histogram
 
         # .raw is an array of floats with time on the first dim, and count/date
-        # on the second dim.
-        self.raw = model.DataArray(numpy.empty((0, 2), dtype=numpy.float64))
+        # on the second dim. It's a snapshot of the samples in the window.
+        self._samples = TimeSeriesBuffer(CHRONOGRAM_INIT_SAMPLES, CHRONOGRAM_MAX_SAMPLES)
+        self.raw = model.DataArray(self._samples.snapshot())
         md = {
             model.MD_DIMS: "T",
             model.MD_DET_TYPE: model.MD_DT_NORMAL,
@@ -727,13 +729,12 @@ class MonochromatorSettingsStream(PMTSettingsStream):
         """
         Adds a new count and updates the window
         """
-        # find first element still part of the window
-        oldest = date - self.windowPeriod.value
-        first = numpy.searchsorted(self.raw[:, 1], oldest)
+        self._samples.append(count, date)
+        # delete all old data
+        self._samples.discard_older(date - self.windowPeriod.value)
 
         # We must update .raw atomically as _updateImage() can run simultaneously
-        new = numpy.array([[count, date]], dtype=numpy.float64)
-        self.raw = model.DataArray(numpy.append(self.raw[first:], new, axis=0))
+        self.raw = model.DataArray(self._samples.snapshot())
 
     def _updateImage(self):
         try:
@@ -1343,7 +1344,8 @@ class ScannedTCSettingsStream(RepetitionStream):
         self.dwellTime = model.FloatContinuous(10e-6, range=(scanner.dwellTime.range[0], 100), unit="s")
 
         # Raw: series of data (normalized)/acq date (s)
-        self.raw = model.DataArray(numpy.empty((0, 2), dtype=numpy.float64))
+        self._samples = TimeSeriesBuffer(CHRONOGRAM_INIT_SAMPLES, CHRONOGRAM_MAX_SAMPLES)
+        self.raw = model.DataArray(self._samples.snapshot())
         md = {
             model.MD_DIMS: "T",
             model.MD_DET_TYPE: model.MD_DT_NORMAL,
@@ -1371,13 +1373,12 @@ class ScannedTCSettingsStream(RepetitionStream):
         """
         Adds a new count and updates the window
         """
-        # find first element still part of the window
-        oldest = date - self.windowPeriod.value
-        first = numpy.searchsorted(self.raw[:, 1], oldest)
+        self._samples.append(count, date)
+        # delete all old data
+        self._samples.discard_older(date - self.windowPeriod.value)
 
         # We must update .raw atomically as _updateImage() can run simultaneously
-        new = numpy.array([[count, date]], dtype=numpy.float64)
-        self.raw = model.DataArray(numpy.append(self.raw[first:], new, axis=0))
+        self.raw = model.DataArray(self._samples.snapshot())
 
     def _updateImage(self):
         try:
@@ -28,18 +28,29 @@ from odemis import model
 from odemis.acq.align import FindEbeamCenter
 from odemis.model import MD_POS_COR, VigilantAttributeBase
 from odemis.util import img, conversion, fluo
+from odemis.util.timeseries import TimeSeriesBuffer
 import threading
 import time
 import weakref
 
 from ._base import Stream
 
+# Number of samples the chronogram streams can keep initially, and at most.
+# The buffer grows as needed to hold the whole window period, up to the maximum
+# (eg, 70 min at 1 ms per sample, using 128 MB). Beyond it, the oldest samples
+# are dropped (with a warning).
+CHRONOGRAM_INIT_SAMPLES = 2 ** 12
+CHRONOGRAM_MAX_SAMPLES = 2 ** 22
+
 
 class LiveStream(Stream):
     """
     Abstract class for any stream that can do continuous acquisition.
     """
 
+    # The histogram is only for display, and is computed on every new image
+    EXACT_HISTOGRAM = False
+
     def __init__(self, name, detector, dataflow, emitter, forcemd=None, **kwargs):
         """
         forcemd (None or dict of MD_* -> value): force the metadata of the
@@ -712,8 +723,9 @@ class CameraCountStream(CameraStream):
         del self.histogram
 
         # .raw is an array of floats with time on the first dim, and count/date
-        # on the second dim.
-        self.raw = [model.DataArray(numpy.empty((0, 2), dtype=numpy.float64))]
+        # on the second dim. It's a snapshot of the samples in the window.
+        self._samples = TimeSeriesBuffer(CHRONOGRAM_INIT_SAMPLES, CHRONOGRAM_MAX_SAMPLES)
+        self.raw = [model.DataArray(self._samples.snapshot())]
         md = {
             model.MD_DIMS: "T",
             model.MD_DET_TYPE: model.MD_DT_NORMAL,
@@ -745,14 +757,12 @@ class CameraCountStream(CameraStream):
         """
         Adds a new count and updates the window
         """
-        raw = self.raw[0]
+        self._samples.append(count, date)
         # delete all old data
-        oldest = date - self.windowPeriod.value
-        first = numpy.searchsorted(raw[:, 1], oldest)
+        self._samples.discard_older(date - self.windowPeriod.value)
 
         # We must update .raw atomically as _updateImage() can run simultaneously
-        new = numpy.array([[count, date]], dtype=numpy.float64)
-        self.raw = [model.DataArray(numpy.append(raw[first:], new, axis=0))]
+        self.raw = [model.DataArray(self._samples.snapshot())]
 
     def _updateImage(self):
         try:
@@ -23,6 +23,9 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 
 from __future__ import division
 
+from concurrent import futures
+import functools
+import itertools
 import threading
 import weakref
 import logging
@@ -32,13 +35,97 @@ import gc
 import numpy
 
 from odemis import model
-from odemis.util import img
+from odemis.util import img, LRUCache
+from odemis.util.conversion import get_tile_md_pos
 from scipy import ndimage
 from odemis.model import MD_PIXEL_SIZE
 from odemis.acq.stream._static import StaticSpectrumStream
 from abc import abstractmethod
 
 
+class TileCache(object):
+    """
+    Cache of the tiles of pyramidal images (DataArrayShadow), shared by all the
+    projections of the process. It has two tiers, each with its own memory
+    budget: the raw tiles (as read from the file) and the projected tiles
+    (RGB). When a budget is exceeded, the least recently used tiles are dropped.
+    """
+
+    def __init__(self, raw_size=256 * 2 ** 20, proj_size=256 * 2 ** 20):
+        """
+        raw_size (0 <= int): maximum memory used by the raw tiles (in bytes)
+        proj_size (0 <= int): maximum memory used by the projected tiles (in bytes)
+        """
+        self.raw = LRUCache(max_size=raw_size)
+        self.projected = LRUCache(max_size=proj_size)
+        # object -> int: unique identifier of each object caching tiles. Unlike
+        # id(), it's never reused, so a new object cannot get the old tiles.
+        self._tokens = weakref.WeakKeyDictionary()
+        self._next_token = 0
+        self._lock = threading.Lock()
+
+    def getToken(self, obj):
+        """
+        Return a unique identifier for the object, to be used in the keys
+        obj (object): the owner of some tiles (typically a DataArrayShadow or
+          a projection)
+        return (int): the identifier (always the same for the same object)
+        """
+        with self._lock:
+            try:
+                return self._tokens[obj]
+            except KeyError:
+                self._next_token += 1
+                self._tokens[obj] = self._next_token
+                return self._next_token
+
+    def setMaxSizes(self, raw_size=None, proj_size=None):
+        """
+        Change the memory budget of the cache. Tiles are dropped if needed.
+        raw_size (None or 0 <= int): maximum memory used by the raw tiles (in
+          bytes). None to leave it unchanged.
+        proj_size (None or 0 <= int): maximum memory used by the projected tiles
+          (in bytes). None to leave it unchanged.
+        """
+        if raw_size is not None:
+            self.raw.max_size = raw_size
+        if proj_size is not None:
+            self.projected.max_size = proj_size
+
+    def clear(self):
+        self.raw.clear()
+        self.projected.clear()
+
+    def getStatistics(self):
+        """
+        return (dict str -> dict str -> number): for the "raw" and "projected"
+          tiers: the number of tiles ("count"), the memory used ("size"), the
+          maximum memory ("max_size"), the number of "hits" and "misses", and
+          the "hit_rate" (ratio between 0 and 1).
+        """
+        stats = {}
+        for name, cache in (("raw", self.raw), ("projected", self.projected)):
+            nreq = cache.hits + cache.misses
+            stats[name] = {"count": len(cache),
+                           "size": cache.size,
+                           "max_size": cache.max_size,
+                           "hits": cache.hits,
+                           "misses": cache.misses,
+                           "hit_rate": cache.hits / nreq if nreq else 0,
+                          }
+        return stats
+
+
+# The tile cache used by all the RGBSpatialProjections
+tile_cache = TileCache()
+
+# Number of threads reading and projecting the tiles, shared by all the
+# RGBSpatialProjections. Note that the tiles of a same file are read one at a
+# time, but the projections (and the reading of other files) run in parallel.
+TILE_LOADING_THREADS = 4
+_tile_executor = futures.ThreadPoolExecutor(max_workers=TILE_LOADING_THREADS)
+
+
 class DataProjection(object):
 
     def __init__(self, stream):
@@ -131,6 +218,10 @@ class RGBProjection(DataProjection):
 
         self.image = model.VigilantAttribute(None)
 
+        # Incremented every time the projection settings change, so that the
+        # previously projected tiles are not used anymore.
+        self._projectedTilesGen = 0
+
         # Don't call at init, so don't set metadata if default value
         self.stream.tint.subscribe(self._onTint)
         self.stream.intensityRange.subscribe(self._onIntensityRange)
@@ -160,7 +251,7 @@ class RGBProjection(DataProjection):
         tiles cached (and visible in the new image) have to be recomputed too
         """
         # set projected tiles cache as invalid
-        self._projectedTilesInvalid = True
+        self._projectedTilesGen += 1
         self._shouldUpdateImage()
 
     def onTint(self, value):
@@ -230,6 +321,13 @@ class RGBSpatialProjection(RGBProjection):
     RGBSpatialProjection might be created (via the use of the __new__ operator).
     That is the recommended way to create a RGBSpatialProjection.
     """
+    # If True, once the visible tiles are loaded, the tiles around them and the
+    # ones of the next coarser and finer zoom levels are loaded in background.
+    PREFETCH_TILES = True
+    # Minimum time (s) between two partial updates of .image, while the tiles
+    # are loading
+    PROGRESSIVE_PERIOD = 0.2
+
     def __new__(cls, stream):
 
         if isinstance(stream, StaticSpectrumStream):
@@ -241,6 +339,12 @@ class RGBSpatialProjection(RGBProjection):
         '''
         stream (Stream): the Stream to project
         '''
+        # (gen, x, y, z) -> Future: the tiles being loaded
+        self._tile_futures = {}
+        self._tile_futures_lock = threading.Lock()
+        # Futures of the tiles scheduled by the last update of the image
+        self._scheduled_tiles = []
+
         super(RGBSpatialProjection, self).__init__(stream)
 
         # handle z stack
@@ -265,12 +369,6 @@ class RGBSpatialProjection(RGBProjection):
             self.rect = model.TupleContinuous(full_rect, rect_range)
             self.mpp.subscribe(self._onMpp)
             self.rect.subscribe(self._onRect)
-            # initialize the projected tiles cache
-            self._projectedTilesCache = {}
-            # initialize the raw tiles cache
-            self._rawTilesCache = {}
-            # When True, the projected tiles cache should be invalidated
-            self._projectedTilesInvalid = True
 
         self._shouldUpdateImage()
 
@@ -306,7 +404,8 @@ class RGBSpatialProjection(RGBProjection):
         return model.DataArray(rgbim, md)
 
     def _onZIndex(self, value):
-        self._shouldUpdateImage()
+        # The projected tiles are from a different Z
+        self._shouldUpdateImageEntirely()
 
     def getBoundingBox(self):
         ''' Get the bounding box of the whole image, whether it`s tiled or not.
@@ -373,43 +472,31 @@ class RGBSpatialProjection(RGBProjection):
             int(round(rect[3] / (-ps[1]) + img_shape[1] / 2)) - 1,
         )
 
-    def _getTile(self, x, y, z, prev_raw_cache, prev_proj_cache):
+    def _getTile(self, x, y, z, gen):
         """
-        Get a tile from a DataArrayShadow. Uses cache.
-        The cache for projected tiles and the cache for raw tiles has always the same tiles
+        Get a tile from a DataArrayShadow. Uses the (process-wide) tile cache.
         x (int): X coordinate of the tile
         y (int): Y coordinate of the tile
         z (int): zoom level where the tile is
-        prev_raw_cache (dictionary): raw tiles cache from the
-            last execution of _updateImage
-        prev_proj_cache (dictionary): projected tiles cache from the
-            last execution of _updateImage
+        gen (int): generation of the projection settings
         return (DataArray, DataArray): raw tile and projected tile
         """
-        # the key of the tile on the cache
-        tile_key = "%d-%d-%d" % (x, y, z)
-
-        # if the raw tile has been already cached, read it from the cache
-        if tile_key in prev_raw_cache:
-            raw_tile = prev_raw_cache[tile_key]
-        elif tile_key in self._rawTilesCache:
-            raw_tile = self._rawTilesCache[tile_key]
-        else:
+        das = self.stream.raw[0]
+        raw_key = (tile_cache.getToken(das), x, y, z)
+        raw_tile = tile_cache.raw.get(raw_key)
+        if raw_tile is None:
             # The tile was not cached, so it must be read from the file
-            raw_tile = self.stream.raw[0].getTile(x, y, z)
-
-        # if the projected tile has been already cached, read it from the cache
-        if tile_key in prev_proj_cache:
-            proj_tile = prev_proj_cache[tile_key]
-        elif tile_key in self._projectedTilesCache:
-            proj_tile = self._projectedTilesCache[tile_key]
-        else:
-            # The tile was not cached, so it must be projected again
+            raw_tile = das.getTile(x, y, z)
+            tile_cache.raw[raw_key] = raw_tile
+
+        proj_key = (tile_cache.getToken(self), gen, x, y, z)
+        proj_tile = tile_cache.projected.get(proj_key)
+        if proj_tile is None:
+            # The tile was not cached (with the current settings), so it must
+            # be projected again
             proj_tile = self._projectTile(raw_tile)
+            tile_cache.projected[proj_key] = proj_tile
 
-        # cache raw and projected tiles
-        self._rawTilesCache[tile_key] = raw_tile
-        self._projectedTilesCache[tile_key] = proj_tile
         return raw_tile, proj_tile
 
     def _projectTile(self, tile):
@@ -437,9 +524,129 @@ class RGBSpatialProjection(RGBProjection):
 
         return self._projectXY2RGB(tile, self.stream.tint.value)
 
+    def _getNumTiles(self, z):
+        """
+        Compute the number of tiles of a zoom level
+        z (int): zoom level
+        return (int, int): number of tiles in X and Y
+        """
+        das = self.stream.raw[0]
+        dims = das.metadata.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        ts = das.tile_shape
+        w = das.shape[dims.index("X")] // 2 ** z
+        h = das.shape[dims.index("Y")] // 2 ** z
+        return int(math.ceil(w / ts[0])), int(math.ceil(h / ts[1]))
+
+    def _requestTile(self, x, y, z, gen):
+        """
+        Schedule the loading of a tile, unless it's already being loaded
+        x (int): X coordinate of the tile
+        y (int): Y coordinate of the tile
+        z (int): zoom level where the tile is
+        gen (int): generation of the projection settings
+        return (Future): returns the raw tile and projected tile (cf _getTile())
+        """
+        key = (gen, x, y, z)
+        with self._tile_futures_lock:
+            f = self._tile_futures.get(key)
+            if f is not None and not f.cancelled():
+                return f
+            f = _tile_executor.submit(self._getTile, x, y, z, gen)
+            self._tile_futures[key] = f
+
+        self._scheduled_tiles.append(f)
+        f.add_done_callback(functools.partial(self._onTileLoaded, key))
+        return f
+
+    def _onTileLoaded(self, key, f):
+        with self._tile_futures_lock:
+            if self._tile_futures.get(key) is f:
+                del self._tile_futures[key]
+
+    def _cancelScheduledTiles(self):
+        """
+        Cancel the loading of the tiles scheduled previously, and not yet started
+        """
+        for f in self._scheduled_tiles:
+            f.cancel()
+        self._scheduled_tiles = []
+
+    def _prefetchTiles(self, x1, y1, x2, y2, z, gen):
+        """
+        Schedule the loading of the tiles which are likely to be needed next:
+        the ones just around the given area, and the ones covering the same area
+        at the next coarser and finer zoom levels.
+        x1, y1, x2, y2 (ints): area of the tiles displayed (inclusive)
+        z (int): zoom level of the tiles displayed
+        gen (int): generation of the projection settings
+        """
+        das = self.stream.raw[0]
+        areas = [(x1 - 1, y1 - 1, x2 + 1, y2 + 1, z)]
+        if z < das.maxzoom:
+            areas.append((x1 // 2, y1 // 2, x2 // 2, y2 // 2, z + 1))
+        if z > 0:
+            areas.append((x1 * 2, y1 * 2, x2 * 2 + 1, y2 * 2 + 1, z - 1))
+
+        for ax1, ay1, ax2, ay2, az in areas:
+            nx, ny = self._getNumTiles(az)
+            for x, y in itertools.product(range(max(0, ax1), min(nx, ax2 + 1)),
+                                          range(max(0, ay1), min(ny, ay2 + 1))):
+                if az == z and x1 <= x <= x2 and y1 <= y <= y2:
+                    continue  # Already loaded
+                if (tile_cache.getToken(self), gen, x, y, az) in tile_cache.projected:
+                    continue
+                self._requestTile(x, y, az, gen)
+
+    def _getPlaceholderTile(self, x, y, z, gen):
+        """
+        Create a temporary projected tile, to be displayed while the actual tile
+        is loading. It's an enlarged part of the tile of the coarser zoom level,
+        if it's available, or a black tile otherwise.
+        x (int): X coordinate of the tile
+        y (int): Y coordinate of the tile
+        z (int): zoom level where the tile is
+        gen (int): generation of the projection settings
+        return (DataArray): RGB tile, with the same shape and metadata as the
+          actual tile
+        """
+        das = self.stream.raw[0]
+        md = das.metadata.copy()
+        dims = md.get(model.MD_DIMS, "CTZYX"[-das.ndim::])
+        tw, th = das.tile_shape
+        w = min(tw, das.shape[dims.index("X")] // 2 ** z - x * tw)
+        h = min(th, das.shape[dims.index("Y")] // 2 ** z - y * th)
+
+        rgb = None
+        if z < das.maxzoom:
+            parent = tile_cache.projected.get((tile_cache.getToken(self), gen, x // 2, y // 2, z + 1))
+            if parent is not None:
+                ox, oy = (x % 2) * tw // 2, (y % 2) * th // 2
+                rgb = parent[oy:oy + (h + 1) // 2, ox:ox + (w + 1) // 2]
+                rgb = rgb.repeat(2, axis=0).repeat(2, axis=1)[:h, :w]
+                if rgb.shape[:2] != (h, w):
+                    rgb = None
+        if rgb is None:
+            rgb = numpy.zeros((h, w, 3), dtype=numpy.uint8)
+
+        # Same metadata as if it had been read from the file
+        ps = md.get(model.MD_PIXEL_SIZE, (1, 1))
+        md[model.MD_PIXEL_SIZE] = tuple(p * 2 ** z for p in ps)
+        shape = tuple({"X": w, "Y": h}.get(d, s) for d, s in zip(dims, das.shape))
+        tile = model.DataArray(numpy.empty(shape, dtype=numpy.uint8), md)
+        md[model.MD_POS] = get_tile_md_pos((x, y), das.tile_shape, tile, das)
+
+        md = self._find_metadata(md)
+        md[model.MD_DIMS] = "YXC"  # RGB format
+        rgb = model.DataArray(rgb, md)
+        rgb.flags.writeable = False
+        return rgb
+
     def _getTilesFromSelectedArea(self):
         """
         Get the tiles inside the region defined by .rect and .mpp
+        The tiles not in the cache are loaded in parallel, and .image is updated
+        with the tiles already available (and placeholders for the others)
+        while waiting for them.
         return (DataArray, DataArray): Raw tiles and projected tiles
         """
         # This custom exception is used when the .mpp or .rect values changes while
@@ -449,63 +656,81 @@ class RGBSpatialProjection(RGBProjection):
 
         das = self.stream.raw[0]
 
-        # store the previous cache to use in this execution
-        prev_raw_cache = self._rawTilesCache
-        prev_proj_cache = self._projectedTilesCache
         # Execute at least once. If mpp and rect changed in
         # the last execution of the loops, execute again
         need_recompute = True
         while need_recompute:
+            # The tiles requested previously are not necessarily needed anymore
+            self._cancelScheduledTiles()
+
+            gen = self._projectedTilesGen
             z = self._zFromMpp()
             rect = self._rectWorldToPixel(self.rect.value)
             # convert the rect coords to tile indexes
             rect = [l / (2 ** z) for l in rect]
             rect = [int(math.floor(l / das.tile_shape[0])) for l in rect]
             x1, y1, x2, y2 = rect
-            # the 4 lines below avoids that lots of old tiles
-            # stays in instance caches
-            prev_raw_cache.update(self._rawTilesCache)
-            prev_proj_cache.update(self._projectedTilesCache)
-            # empty current caches
-            self._rawTilesCache = {}
-            self._projectedTilesCache = {}
-
-            raw_tiles = []
-            projected_tiles = []
+
+            tiles = {}  # (x, y) -> raw tile, projected tile
+            # Load the tiles from the center, as it's where the user looks first
+            xc, yc = (x1 + x2) / 2, (y1 + y2) / 2
+            to_load = sorted(itertools.product(range(x1, x2 + 1), range(y1, y2 + 1)),
+                             key=lambda i: (i[0] - xc) ** 2 + (i[1] - yc) ** 2,
+                             reverse=True)
+            loading = {}  # Future -> (x, y)
             need_recompute = False
             try:
-                for x in range(x1, x2 + 1):
-                    rt_column = []
-                    pt_column = []
-
-                    for y in range(y1, y2 + 1):
-                        # the projected tiles cache is invalid
-                        if self._projectedTilesInvalid:
-                            self._projectedTilesCache = {}
-                            prev_proj_cache = {}
-                            self._projectedTilesInvalid = False
-                            raise NeedRecomputeException()
-
-                        # check if the image changed in the middle of the process
-                        if self._im_needs_recompute.is_set():
-                            self._im_needs_recompute.clear()
-                            # Raise the exception, so everything will be calculated again,
-                            # but using the cache from the last execution
-                            raise NeedRecomputeException()
-
-                        raw_tile, proj_tile = \
-                                self._getTile(x, y, z, prev_raw_cache, prev_proj_cache)
-                        rt_column.append(raw_tile)
-                        pt_column.append(proj_tile)
-
-                    raw_tiles.append(tuple(rt_column))
-                    projected_tiles.append(tuple(pt_column))
+                tnext = time.time() + self.PROGRESSIVE_PERIOD
+                while to_load or loading:
+                    # Only schedule a few tiles at a time, so that if the area
+                    # changes, not too many unneeded tiles are loaded.
+                    while to_load and len(loading) < TILE_LOADING_THREADS:
+                        x, y = to_load.pop()
+                        raw_tile = tile_cache.raw.get((tile_cache.getToken(das), x, y, z))
+                        proj_tile = tile_cache.projected.get((tile_cache.getToken(self), gen, x, y, z))
+                        if raw_tile is not None and proj_tile is not None:
+                            tiles[(x, y)] = raw_tile, proj_tile
+                        else:
+                            loading[self._requestTile(x, y, z, gen)] = (x, y)
+
+                    if loading:
+                        done, _ = futures.wait(list(loading.keys()), timeout=0.05,
+                                               return_when=futures.FIRST_COMPLETED)
+                        for f in done:
+                            tiles[loading.pop(f)] = f.result()
+
+                    # the projection settings changed
+                    if self._projectedTilesGen != gen:
+                        raise NeedRecomputeException()
+
+                    # check if the image changed in the middle of the process
+                    if self._im_needs_recompute.is_set():
+                        self._im_needs_recompute.clear()
+                        # Raise the exception, so everything will be calculated again,
+                        # but using the tiles already cached
+                        raise NeedRecomputeException()
+
+                    if loading and time.time() > tnext:
+                        # Show the tiles already available
+                        self.image.value = tuple(
+                            tuple(tiles[(x, y)][1] if (x, y) in tiles
+                                  else self._getPlaceholderTile(x, y, z, gen)
+                                  for y in range(y1, y2 + 1))
+                            for x in range(x1, x2 + 1))
+                        tnext = time.time() + self.PROGRESSIVE_PERIOD
 
             except NeedRecomputeException:
                 # image changed
                 need_recompute = True
 
-        return tuple(raw_tiles), tuple(projected_tiles)
+        if self.PREFETCH_TILES:
+            self._prefetchTiles(x1, y1, x2, y2, z, gen)
+
+        raw_tiles = tuple(tuple(tiles[(x, y)][0] for y in range(y1, y2 + 1))
+                          for x in range(x1, x2 + 1))
+        projected_tiles = tuple(tuple(tiles[(x, y)][1] for y in range(y1, y2 + 1))
+                                for x in range(x1, x2 + 1))
+        return raw_tiles, projected_tiles
 
     def _updateImage(self):
         """ Recomputes the image with all the raw data available
@@ -559,25 +784,20 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
     def projectAsRaw(self):
         try:
             data = self.stream.calibrated.value
-            raw_md = self.stream.calibrated.value.metadata
+            raw_md = data.metadata
             md = {}
 
             md[model.MD_PIXEL_SIZE] = raw_md[model.MD_PIXEL_SIZE]  # pixel size
             md[model.MD_POS] = raw_md[model.MD_POS]
-            # Average time values if they exist.
-            if data.shape[1] > 1:
-                t = data.shape[1] - 1
-                data = numpy.mean(data[0:t], axis=1)
-                data = data[:, 0, :, :]
-            else:
-                data = data[:, 0, 0, :, :]
 
             # pick only the data inside the bandwidth
             spec_range = self.stream._get_bandwidth_in_pixel()
 
             logging.debug("Spectrum range picked: %s px", spec_range)
 
-            av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
+            # The index is averaged over time (if there is time data)
+            spec_index = self.stream._get_spectrum_index()
+            av_data = spec_index.mean(spec_range[0], spec_range[1])
             av_data = img.ensure2DImage(av_data).astype(data.dtype)
             return model.DataArray(av_data, md)
 
@@ -597,19 +817,11 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
         """
 
         try:
-            data = self.stream.calibrated.value
             raw_md = self.stream.calibrated.value.metadata
             md = {}
 
             md[model.MD_PIXEL_SIZE] = raw_md[model.MD_PIXEL_SIZE]  # pixel size
             md[model.MD_POS] = raw_md[model.MD_POS]
-            # Average time values if they exist.
-            if data.shape[1] > 1:
-                t = data.shape[1] - 1
-                data = numpy.mean(data[0:t], axis=1)
-                data = data[:, 0, :, :]
-            else:
-                data = data[:, 0, 0, :, :]
 
             # pick only the data inside the bandwidth
             spec_range = self.stream._get_bandwidth_in_pixel()
@@ -618,9 +830,12 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
 
             irange = self.stream._getDisplayIRange()  # will update histogram if not yet present
 
+            # Each band average is just a subtraction of the cumulative sums
+            # (which are averaged over time, if there is time data)
+            spec_index = self.stream._get_spectrum_index()
+
             if not hasattr(self.stream, "fitToRGB") or not self.stream.fitToRGB.value:
-                # TODO: use better intermediary type if possible?, cf semcomedi
-                av_data = numpy.mean(data[spec_range[0]:spec_range[1] + 1], axis=0)
+                av_data = spec_index.mean(spec_range[0], spec_range[1])
                 av_data = img.ensure2DImage(av_data)
                 rgbim = img.DataArray2RGB(av_data, irange)
 
@@ -636,20 +851,20 @@ class RGBSpatialSpectrumProjection(RGBSpatialProjection):
                 brange = [spec_range[0], int(round(spec_range[0] + len_rng / 3)) - 1]
                 grange = [brange[1] + 1, int(round(spec_range[0] + 2 * len_rng / 3)) - 1]
                 rrange = [grange[1] + 1, spec_range[1]]
-                # ensure each range contains at least one pixel
-                brange[1] = max(brange)
-                grange[1] = max(grange)
-                rrange[1] = max(rrange)
+                # ensure each range contains at least one pixel, within the band
+                # (if the band is narrow, the sub-ranges overlap)
+                for r in (brange, grange, rrange):
+                    r[0] = min(r[0], spec_range[1])
+                    r[1] = min(max(r), spec_range[1])
 
-                # FIXME: unoptimized, as each channel is duplicated 3 times, and discarded
-                av_data = numpy.mean(data[rrange[0]:rrange[1] + 1], axis=0)
+                av_data = spec_index.mean(rrange[0], rrange[1])
                 av_data = img.ensure2DImage(av_data)
                 rgbim = img.DataArray2RGB(av_data, irange)
-                av_data = numpy.mean(data[grange[0]:grange[1] + 1], axis=0)
+                av_data = spec_index.mean(grange[0], grange[1])
                 av_data = img.ensure2DImage(av_data)
                 gim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 1] = gim[:, :, 0]
-                av_data = numpy.mean(data[brange[0]:brange[1] + 1], axis=0)
+                av_data = spec_index.mean(brange[0], brange[1])
                 av_data = img.ensure2DImage(av_data)
                 bim = img.DataArray2RGB(av_data, irange)
                 rgbim[:, :, 2] = bim[:, :, 0]
@@ -708,7 +923,7 @@ class LineSpectrumProjection(RGBProjection):
         else:
             t = 0
 
-        spec2d = self.stream.calibrated.value[:, t, 0, :, :]  # same data but remove useless dims
+        calibrated = self.stream.calibrated.value
         width = self.stream.selectionWidth.value
 
         # Number of points to return: the length of the line
@@ -726,8 +941,9 @@ class LineSpectrumProjection(RGBProjection):
         # Coordinates of each point: ndim of data (5-2), pos on line (Y), spectrum (X)
         # The line is scanned from the end till the start so that the spectra
         # closest to the origin of the line are at the bottom.
-        coord = numpy.empty((3, width, n, spec2d.shape[0]))
-        coord[0] = numpy.arange(spec2d.shape[0])  # spectra = all
+        nc = calibrated.shape[0]
+        coord = numpy.empty((3, width, n, nc))
+        coord[0] = numpy.arange(nc)  # spectra = all
         coord_spc = coord.swapaxes(2, 3)  # just a view to have (line) space as last dim
         coord_spc[-1] = numpy.linspace(end[0], start[0], n)  # X axis
         coord_spc[-2] = numpy.linspace(end[1], start[1], n)  # Y axis
@@ -743,6 +959,18 @@ class LineSpectrumProjection(RGBProjection):
         coord_cw = coord[1:].swapaxes(0, 2).swapaxes(1, 3)  # view with coordinates and width as last dims
         coord_cw += width_coord
 
+        # Only get the (calibrated) data around the line. All the points used
+        # by the interpolation are within the bounding box, and the ones out of
+        # the data are still out of the cropped data.
+        shape = calibrated.shape
+        y0 = int(min(max(0, math.floor(coord[1].min())), shape[-2] - 1))
+        y1 = int(min(max(1, math.floor(coord[1].max()) + 2), shape[-2]))
+        x0 = int(min(max(0, math.floor(coord[2].min())), shape[-1] - 1))
+        x1 = int(min(max(1, math.floor(coord[2].max()) + 2), shape[-1]))
+        spec2d = calibrated[:, t, 0, y0:y1, x0:x1]  # same data but remove useless dims
+        coord[1] -= y0
+        coord[2] -= x0
+
         # Interpolate the values based on the data
         if width == 1:
             # simple version for the most usual case
@@ -757,7 +985,7 @@ class LineSpectrumProjection(RGBProjection):
         assert spec1d.shape == (n, spec2d.shape[0])
 
         # Use metadata to indicate spatial distance between pixel
-        pxs_data = self.stream.calibrated.value.metadata[MD_PIXEL_SIZE]
+        pxs_data = calibrated.metadata[MD_PIXEL_SIZE]
 
         if pxs_data[0] is not None:
             pxs = math.hypot(v[0] * pxs_data[0], v[1] * pxs_data[1]) / (n - 1)
@@ -765,7 +993,7 @@ class LineSpectrumProjection(RGBProjection):
             logging.warning("Pixel size should have two dimensions")
             return None, None
 
-        raw_md = self.stream.calibrated.value.metadata
+        raw_md = calibrated.metadata
         md = raw_md.copy()
         md[model.MD_DIMS] = "XC"  # RGB format
         md[MD_PIXEL_SIZE] = (None, pxs)  # for the spectrum, use get_spectrum_range()
@@ -862,7 +1090,6 @@ class PixelTemporalSpectrumProjection(RGBProjection):
 
         x, y = self.stream.selected_pixel.value
 
-        spec2d = self.stream.calibrated.value[:, :, 0, :, :]  # same data but remove useless dims
         md = dict(data.metadata)
         md[model.MD_DIMS] = "TC"
 
@@ -870,7 +1097,7 @@ class PixelTemporalSpectrumProjection(RGBProjection):
         # of the pixels to be taken into account
         width = self.stream.selectionWidth.value
         if width == 1:  # short-cut for simple case
-            data = spec2d[:, :, y, x]
+            data = data[:, :, 0, y, x]
             data = numpy.swapaxes(data, 0, 1)
             return model.DataArray(data, md)
 
@@ -880,16 +1107,18 @@ class PixelTemporalSpectrumProjection(RGBProjection):
         # masked array would also work, but that'd imply having a huge mask.
         radius = width / 2
         n = 0
+        # Only get the (calibrated) data of the square around the point
+        x0, x1 = max(0, int(x - radius)), min(int(x + radius) + 1, data.shape[-1])
+        y0, y1 = max(0, int(y - radius)), min(int(y + radius) + 1, data.shape[-2])
+        spec2d = data[:, :, 0, y0:y1, x0:x1]  # same data but remove useless dims
         # TODO: use same cleverness as mean() for dtype?
         datasum = numpy.zeros((spec2d.shape[0], spec2d.shape[1]), dtype=numpy.float64)
         # Scan the square around the point, and only pick the points in the circle
-        for px in range(max(0, int(x - radius)),
-                        min(int(x + radius) + 1, spec2d.shape[-1])):
-            for py in range(max(0, int(y - radius)),
-                            min(int(y + radius) + 1, spec2d.shape[-2])):
+        for px in range(x0, x1):
+            for py in range(y0, y1):
                 if math.hypot(x - px, y - py) <= radius:
                     n += 1
-                    datasum += spec2d[:, :, py, px]
+                    datasum += spec2d[:, :, py - y0, px - x0]
 
         mean = datasum / n
         mean = numpy.swapaxes(mean, 0, 1)
@@ -946,9 +1175,8 @@ class MeanSpectrumProjection(DataProjection):
         md = dict(data.metadata)
         md[model.MD_DIMS] = "C"
 
-        # flatten all but the C dimension, for the average
-        data = data.reshape((data.shape[0], numpy.prod(data.shape[1:])))
-        av_data = numpy.mean(data, axis=1)
+        # Average over all but the C dimension, shared with the spatial projection
+        av_data = self.stream._get_spectrum_index().mean_spectrum()
 
         self.image.value = model.DataArray(av_data, md)
 
@@ -995,7 +1223,6 @@ class SinglePointSpectrumProjection(DataProjection):
             t = self.stream._tl_px_values.index(self.stream.selected_time.value)
         else:
             t = 0
-        spec2d = self.stream.calibrated.value[:, t, 0, :, :]  # same data but remove useless dims
 
         md = dict(data.metadata)
         md[model.MD_DIMS] = "C"
@@ -1004,7 +1231,7 @@ class SinglePointSpectrumProjection(DataProjection):
         # of the pixels to be taken into account
         width = self.stream.selectionWidth.value
         if width == 1:  # short-cut for simple case
-            data = spec2d[:, y, x]
+            data = data[:, t, 0, y, x]
             return model.DataArray(data, md)
 
         # There are various ways to do it with numpy. As typically the spectrum
@@ -1013,16 +1240,18 @@ class SinglePointSpectrumProjection(DataProjection):
         # masked array would also work, but that'd imply having a huge mask.
         radius = width / 2
         n = 0
+        # Only get the (calibrated) data of the square around the point
+        x0, x1 = max(0, int(x - radius)), min(int(x + radius) + 1, data.shape[-1])
+        y0, y1 = max(0, int(y - radius)), min(int(y + radius) + 1, data.shape[-2])
+        spec2d = data[:, t, 0, y0:y1, x0:x1]  # same data but remove useless dims
         # TODO: use same cleverness as mean() for dtype?
         datasum = numpy.zeros(spec2d.shape[0], dtype=numpy.float64)
         # Scan the square around the point, and only pick the points in the circle
-        for px in range(max(0, int(x - radius)),
-                        min(int(x + radius) + 1, spec2d.shape[-1])):
-            for py in range(max(0, int(y - radius)),
-                            min(int(y + radius) + 1, spec2d.shape[-2])):
+        for px in range(x0, x1):
+            for py in range(y0, y1):
                 if math.hypot(x - px, y - py) <= radius:
                     n += 1
-                    datasum += spec2d[:, py, px]
+                    datasum += spec2d[:, py - y0, px - x0]
 
         mean = datasum / n
 
@@ -1080,18 +1309,18 @@ class SinglePointTemporalProjection(DataProjection):
         if isinstance(self.stream.raw, list):
             x, y = self.stream.selected_pixel.value
             c = self.stream._wl_px_values.index(self.stream.selected_wavelength.value)
-            chrono2d = self.stream.calibrated.value[c, :, 0, :, :]  # same data but remove useless dims
+            calibrated = self.stream.calibrated.value
 
             md = {}
             md[model.MD_DIMS] = "T"
-            if model.MD_TIME_LIST in chrono2d.metadata:
-                md[model.MD_TIME_LIST] = chrono2d.metadata[model.MD_TIME_LIST]
+            if model.MD_TIME_LIST in calibrated.metadata:
+                md[model.MD_TIME_LIST] = calibrated.metadata[model.MD_TIME_LIST]
 
             # We treat width as the diameter of the circle which contains the center
             # of the pixels to be taken into account
             width = self.stream.selectionWidth.value
             if width == 1:  # short-cut for simple case
-                data = chrono2d[:, y, x]
+                data = calibrated[c, :, 0, y, x]
                 return model.DataArray(data, md)
 
             # There are various ways to do it with numpy. As typically the spectrum
@@ -1100,16 +1329,18 @@ class SinglePointTemporalProjection(DataProjection):
             # masked array would also work, but that'd imply having a huge mask.
             radius = width / 2
             n = 0
+            # Only get the (calibrated) data of the square around the point
+            x0, x1 = max(0, int(x - radius)), min(int(x + radius) + 1, calibrated.shape[-1])
+            y0, y1 = max(0, int(y - radius)), min(int(y + radius) + 1, calibrated.shape[-2])
+            chrono2d = calibrated[c, :, 0, y0:y1, x0:x1]  # same data but remove useless dims
             # TODO: use same cleverness as mean() for dtype?
             datasum = numpy.zeros(chrono2d.shape[0], dtype=numpy.float64)
             # Scan the square around the point, and only pick the points in the circle
-            for px in range(max(0, int(x - radius)),
-                            min(int(x + radius) + 1, chrono2d.shape[-1])):
-                for py in range(max(0, int(y - radius)),
-                                min(int(y + radius) + 1, chrono2d.shape[-2])):
+            for px in range(x0, x1):
+                for py in range(y0, y1):
                     if math.hypot(x - px, y - py) <= radius:
                         n += 1
-                        datasum += chrono2d[:, py, px]
+                        datasum += chrono2d[:, py - y0, px - x0]
 
             mean = datasum / n
             return model.DataArray(mean.astype(chrono2d.dtype), md)
@@ -26,6 +26,7 @@ see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import collections
+from concurrent import futures
 import logging
 import gc
 import math
@@ -34,13 +35,23 @@ import copy
 from odemis import model
 from odemis.acq import calibration
 from odemis.model import MD_POS, MD_POL_MODE, MD_POL_NONE, VigilantAttribute
-from odemis.util import img, conversion, angleres, spectrum, find_closest, almost_equal
+from odemis.util import img, conversion, angleres, spectrum, find_closest, almost_equal, \
+    LRUCache
 import threading
 import weakref
 import time
 
 from ._base import Stream
 
+# Maximum memory used to cache the polar projections of the AR data
+AR_POLAR_CACHE_SIZE = 256 * 2 ** 20  # bytes
+# Number of positions, around the one displayed, converted in advance
+AR_PREFETCH_POSITIONS = 8
+AR_PREFETCH_THREADS = 2
+# Maximum size of the image used to compute the quick projection displayed
+# while the full one is computed
+AR_PREVIEW_SIZE = 256  # px
+
 
 class StaticStream(Stream):
     """
@@ -171,8 +182,9 @@ class Static2DStream(StaticStream):
 
         metadata = copy.copy(raw[0].metadata)
 
-        # If there are 5 dims in CTZYX, eliminate CT and only take spatial dimensions
-        if raw[0].ndim >= 3:
+        # If there are 5 dims in CTZYX, eliminate CT and only take spatial dimensions.
+        # Pyramidal data is only read by (2D) tiles, so it's kept as-is.
+        if raw[0].ndim >= 3 and not hasattr(raw[0], 'maxzoom'):
             dims = metadata.get(model.MD_DIMS, "CTZYX"[-raw[0].ndim::])
             if dims[-3:] != "ZYX":
                 logging.warning("Metadata has %s dimensions, which may be invalid.", dims)
@@ -191,7 +203,7 @@ class Static2DStream(StaticStream):
             metadata[model.MD_DIMS] = "CTZYX"[-raw[0].ndim::]
 
         # Define if z-index should be created.
-        if len(raw[0].shape) == 3 and metadata[model.MD_DIMS] == "ZYX":
+        if len(raw[0].shape) == 3 and metadata.get(model.MD_DIMS) == "ZYX":
             try:
                 pxs = metadata[model.MD_PIXEL_SIZE]
                 pos = metadata[model.MD_POS]
@@ -361,7 +373,12 @@ class StaticARStream(StaticStream):
         name (string)
         data (model.DataArray(Shadow) of shape (YX) or list of such DataArray(Shadow)).
          The metadata MD_POS, MD_AR_POLE and MD_POL_MODE should be provided
+        preview (bool): if True, when a position is not yet converted, a low
+          resolution projection is first displayed, while the full resolution
+          one is computed.
         """
+        self._preview = kwargs.pop("preview", True)
+
         if not isinstance(data, collections.Iterable):
             data = [data]  # from now it's just a list of DataArray
 
@@ -396,8 +413,14 @@ class StaticARStream(StaticStream):
                 logging.info("Skipping DataArray without known position")
 
         # Cached conversion of the CCD image to polar representation
-        # TODO: automatically fill it in a background thread
-        self._polar = {}  # dict tuple (float, float, str or None) -> DataArray
+        # tuple (float, float, str or None) -> DataArray
+        self._polar = LRUCache(max_size=AR_POLAR_CACHE_SIZE)
+        # Incremented every time the cached projections become invalid
+        self._polar_gen = 0
+        # The positions around the displayed one are converted in advance
+        self._prefetch_executor = futures.ThreadPoolExecutor(max_workers=AR_PREFETCH_THREADS)
+        self._prefetch_futures = {}  # tuple (float, float, str or None) -> Future
+        self._prefetch_lock = threading.RLock()  # RLock, as cancel() calls _onPrefetchDone()
 
         # SEM position VA
         # SEM position displayed, (None, None) == no point selected (x, y)
@@ -440,59 +463,140 @@ class StaticARStream(StaticStream):
         pos (float, float, string or None): position (must be part of the ._pos)
         returns DataArray: the polar projection
         """
-        if pos in self._polar:
-            polard = self._polar[pos]
-        else:
-            # Compute the polar representation
-            data = self._pos[pos]
+        polard = self._polar.get(pos)
+        if polard is not None:
+            return polard
+
+        # If it's already being converted in advance, just wait for it
+        with self._prefetch_lock:
+            f = self._prefetch_futures.get(pos)
+        if f is not None and not f.cancel():
             try:
-                if numpy.prod(data.shape) > (1280 * 1080):
-                    # AR conversion fails with very large images due to too much
-                    # memory consumed (> 2Gb). So, rescale + use a "degraded" type that
-                    # uses less memory. As the display size is small (compared
-                    # to the size of the input image, it shouldn't actually
-                    # affect much the output.
-                    logging.info("AR image is very large %s, will convert to "
-                                 "azimuthal projection in reduced precision.",
-                                 data.shape)
-                    y, x = data.shape
-                    if y > x:
-                        small_shape = 1024, int(round(1024 * x / y))
-                    else:
-                        small_shape = int(round(1024 * y / x)), 1024
-                    # resize
-                    data = img.rescale_hq(data, small_shape)
-
-                # 2 x size of original image (on smallest axis) and at most
-                # the size of a full-screen canvas
-                size = min(min(data.shape) * 2, 1134)
-
-                # TODO: First compute quickly a low resolution and then
-                # compute a high resolution version.
-                # TODO: could use the size of the canvas that will display
-                # the image to save some computation time.
-
-                # Get bg image, if existing. It must match the polarization (defaulting to MD_POL_NONE).
-                bg_image = self._getBackground(data.metadata.get(MD_POL_MODE, MD_POL_NONE))
-
-                if bg_image is None:
-                    # Simple version: remove the background value
-                    data0 = angleres.ARBackgroundSubtract(data)
-                else:
-                    data0 = img.Subtract(data, bg_image)  # metadata from data
+                f.result()
+            except Exception:
+                pass  # Will be computed again, and the error reported then
+            polard = self._polar.get(pos)
+            if polard is not None:
+                return polard
 
-                # Warning: allocates lot of memory, which will not be free'd until
-                # the current thread is terminated.
+        gen = self._polar_gen
+        try:
+            polard = self._computePolar(pos)
+        except Exception:
+            logging.exception("Failed to convert to azimuthal projection")
+            return self._pos[pos]  # display it raw as fallback
 
-                polard = angleres.AngleResolved2Polar(data0, size, hole=False)
+        if gen == self._polar_gen:
+            self._polar[pos] = polard
+        return polard
 
-                # TODO: don't hold too many of them in cache (eg, max 3 * 1134**2)
-                self._polar[pos] = polard
-            except Exception:
-                logging.exception("Failed to convert to azimuthal projection")
-                return data  # display it raw as fallback
+    def _computePolar(self, pos, max_size=None):
+        """
+        Convert the image at the given position into polar projection.
+        pos (float, float, string or None): position (must be part of the ._pos)
+        max_size (None or int): if provided, the image is first reduced to
+          fit this size. Useful to compute quickly a low resolution version.
+        returns DataArray: the polar projection
+        raises Exception: if the conversion failed
+        """
+        data = self._pos[pos]
 
-        return polard
+        # Get bg image, if existing. It must match the polarization (defaulting to MD_POL_NONE).
+        bg_image = self._getBackground(data.metadata.get(MD_POL_MODE, MD_POL_NONE))
+
+        if bg_image is None:
+            # Simple version: remove the background value
+            data0 = angleres.ARBackgroundSubtract(data)
+        else:
+            data0 = img.Subtract(data, bg_image)  # metadata from data
+
+        if max_size is None and numpy.prod(data.shape) > (1280 * 1080):
+            # AR conversion fails with very large images due to too much
+            # memory consumed (> 2Gb). So, rescale + use a "degraded" type that
+            # uses less memory. As the display size is small (compared
+            # to the size of the input image, it shouldn't actually
+            # affect much the output.
+            logging.info("AR image is very large %s, will convert to "
+                         "azimuthal projection in reduced precision.",
+                         data.shape)
+            max_size = 1024
+
+        if max_size is not None and max(data.shape) > max_size:
+            y, x = data.shape
+            if y > x:
+                small_shape = max_size, int(round(max_size * x / y))
+            else:
+                small_shape = int(round(max_size * y / x)), max_size
+            # resize (also updates the pixel size and pole position)
+            data0 = img.rescale_hq(data0, small_shape)
+
+        # 2 x size of original image (on smallest axis) and at most
+        # the size of a full-screen canvas
+        size = min(min(data0.shape) * 2, 1134)
+
+        # TODO: could use the size of the canvas that will display
+        # the image to save some computation time.
+
+        # Warning: allocates lot of memory, which will not be free'd until
+        # the current thread is terminated.
+        return angleres.AngleResolved2Polar(data0, size, hole=False)
+
+    def _prefetchPolar(self, pos):
+        """
+        Convert in the background the positions the closest to the given one
+        (with the same polarization), so that they are ready when the user
+        selects them.
+        pos (float, float, string or None): position currently displayed
+        """
+        x, y, pol = pos
+        others = [p for p in self._pos if p[2] == pol and p != pos and p not in self._polar]
+        others.sort(key=lambda p: math.hypot(p[0] - x, p[1] - y))
+        others = others[:AR_PREFETCH_POSITIONS]
+
+        with self._prefetch_lock:
+            # Forget about the positions not so interesting anymore
+            for p, f in self._prefetch_futures.items():
+                if p not in others:
+                    f.cancel()
+
+            for p in others:
+                if p in self._prefetch_futures:
+                    continue
+                f = self._prefetch_executor.submit(self._prefetchOne, p, self._polar_gen)
+                self._prefetch_futures[p] = f
+                f.add_done_callback(self._onPrefetchDone)
+
+    def _prefetchOne(self, pos, gen):
+        """
+        Convert one position and cache the result
+        pos (float, float, string or None): position to convert
+        gen (int): value of _polar_gen when the conversion was requested
+        """
+        if pos in self._polar:
+            return
+        polard = self._computePolar(pos)
+        # Don't store an outdated projection (ie, the background has changed)
+        if gen == self._polar_gen:
+            self._polar[pos] = polard
+
+    def _onPrefetchDone(self, f):
+        with self._prefetch_lock:
+            for p, pf in self._prefetch_futures.items():
+                if pf is f:
+                    del self._prefetch_futures[p]
+                    break
+
+        if not f.cancelled() and f.exception() is not None:
+            logging.info("Failed to convert in advance AR data to azimuthal projection: %s",
+                         f.exception())
+
+    def _cancelPrefetch(self):
+        """
+        Cancel the conversions not yet started
+        """
+        with self._prefetch_lock:
+            for f in self._prefetch_futures.values():
+                f.cancel()
 
     def _getBackground(self, pol_mode):
         """
@@ -539,18 +643,35 @@ class StaticARStream(StaticStream):
                     pol = self.polarization.value
                 else:
                     pol = None
-                polard = self._project2Polar(pos + (pol,))
-                # update the histogram
-                # TODO: cache the histogram per image
-                # FIXME: histogram should not include the black pixels outside
-                # of the circle. => use a masked array?
-                # reset the drange to ensure that it doesn't depend on older data
-                self._drange = None
-                self._updateHistogram(polard)
-                self.image.value = self._projectXY2RGB(polard)
+                pos = pos + (pol,)
+                if (self._preview and pos not in self._polar and
+                    min(self._pos[pos].shape) > AR_PREVIEW_SIZE):
+                    # Show quickly a rough version, while the full one is computed
+                    try:
+                        self._showPolar(self._computePolar(pos, AR_PREVIEW_SIZE))
+                    except Exception:
+                        logging.info("Failed to compute AR preview", exc_info=True)
+
+                polard = self._project2Polar(pos)
+                self._showPolar(polard)
+                self._prefetchPolar(pos)
         except Exception:
             logging.exception("Updating %s image", self.__class__.__name__)
 
+    def _showPolar(self, polard):
+        """
+        Update the histogram and the image from the given polar projection
+        polard (DataArray): the polar projection
+        """
+        # update the histogram
+        # TODO: cache the histogram per image
+        # FIXME: histogram should not include the black pixels outside
+        # of the circle. => use a masked array?
+        # reset the drange to ensure that it doesn't depend on older data
+        self._drange = None
+        self._updateHistogram(polard)
+        self.image.value = self._projectXY2RGB(polard)
+
     def _onPoint(self, pos):
         self._shouldUpdateImage()
 
@@ -624,10 +745,34 @@ class StaticARStream(StaticStream):
     def _onBackground(self, data):
         """Called after the background has changed"""
         # uncache all the polar images, and update the current image
-        self._polar = {}
+        self._polar_gen += 1
+        self._cancelPrefetch()
+        self._polar.clear()
         super(StaticARStream, self)._onBackground(data)
 
 
+class _TimeAveragedSpectrum(object):
+    """
+    Lazy view of spectrum data (CTZYX) averaged over T. The average is only
+    computed on the part of the data requested along C, as an array of shape CYX.
+    """
+
+    def __init__(self, data):
+        """
+        data (DataArray or calibration.CompensatedSpectrum of shape CTZYX)
+        """
+        self._data = data
+        self.shape = (data.shape[0],) + data.shape[-2:]
+        self.dtype = numpy.dtype(numpy.float64)  # type of numpy.mean()
+
+    def __getitem__(self, key):
+        """
+        key (slice): the part of C to average
+        return (numpy.ndarray of float of shape CYX)
+        """
+        return numpy.mean(self._data[key][:, :, 0], axis=1)
+
+
 class StaticSpectrumStream(StaticStream):
     """
     A Spectrum stream which displays only one static image/data.
@@ -744,6 +889,13 @@ class StaticSpectrumStream(StaticStream):
         # the raw data after calibration
         self.calibrated = model.VigilantAttribute(image)
 
+        # Cumulative sum of the calibrated data along C, to quickly average
+        # any band. It's only computed when needed, once per calibrated data.
+        self._spec_index = None  # CumulativeSpectrum
+        self._spec_index_data = None  # the calibrated data used for the index
+        self._spec_index_lock = threading.Lock()
+        self.calibrated.subscribe(self._onCalibrated)
+
         if "acq_type" not in kwargs:
             if image.shape[0] > 1 and image.shape[1] > 1:
                 kwargs["acq_type"] = model.MD_AT_TEMPSPECTRUM
@@ -790,6 +942,12 @@ class StaticSpectrumStream(StaticStream):
     def _updateDRange(self, data=None):
         if data is None:
             data = self.calibrated.value
+            if isinstance(data, calibration.CompensatedSpectrum):
+                # Only the extreme values are needed, and the type and metadata
+                # of the compensated data => no need to compute it all at once
+                mn, mx = data.getMinMax()
+                data = model.DataArray(numpy.array([mn, mx], dtype=data.dtype),
+                                       data.metadata)
         super(StaticSpectrumStream, self)._updateDRange(data)
 
     def _updateHistogram(self, data=None):
@@ -862,6 +1020,42 @@ class StaticSpectrumStream(StaticStream):
         assert low_px <= high_px
         return low_px, high_px
 
+    def _get_spectrum_index(self):
+        """
+        Return the cumulative sum of the calibrated data along C, from which
+        the average over any band can be quickly computed. If the data has a T
+        dimension, it's averaged over T.
+        returns (spectrum.CumulativeSpectrum): the index of data of shape CYX
+          (or C11YX if there is no T dimension)
+        """
+        with self._spec_index_lock:
+            data = self.calibrated.value
+            if self._spec_index_data is not data:
+                self._spec_index = None  # Free the memory before computing the new one
+                # The calibrated data (and its average over T) is only computed
+                # one chunk of C at a time
+                if isinstance(data, calibration.CompensatedSpectrum):
+                    chunk_length = data.get_chunk_length()
+                else:
+                    c_size = int(numpy.prod(data.shape[1:])) * 8  # as float64
+                    chunk_length = max(1, calibration.CHUNK_SIZE // max(1, c_size))
+
+                if data.shape[1] > 1:
+                    # Averaged over T only one chunk at a time
+                    data3d = _TimeAveragedSpectrum(data)
+                else:
+                    data3d = data  # C11YX
+                self._spec_index = spectrum.CumulativeSpectrum(data3d, chunk_length)
+                self._spec_index_data = data
+            return self._spec_index
+
+    def _onCalibrated(self, data):
+        # Drop the index of the previous data, it'll be recomputed if needed
+        with self._spec_index_lock:
+            if self._spec_index_data is not data:
+                self._spec_index = None
+                self._spec_index_data = None
+
     # We don't have problems of rerunning this when the data is updated,
     # as the data is static.
     def _updateCalibratedData(self, bckg=None, coef=None):
@@ -890,7 +1084,8 @@ class StaticSpectrumStream(StaticStream):
             raise ValueError("Spectrum data contains no wavelength information")
 
         # will raise an exception if incompatible
-        calibrated = calibration.compensate_spectrum_efficiency(data, bckg, coef)
+        # The compensation is only computed on the part of the data used
+        calibrated = calibration.CompensatedSpectrum(data, bckg, coef)
         self.calibrated.value = calibrated
 
     def _setBackground(self, bckg):
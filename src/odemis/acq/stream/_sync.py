@@ -38,12 +38,14 @@ from odemis import model, util
 from odemis.acq import leech
 from odemis.acq.leech import AnchorDriftCorrector
 from odemis.acq.stream._live import LiveStream
+import os
 import random
 import Queue
+import tempfile
 from odemis.model import MD_POS, MD_DESCRIPTION, MD_PIXEL_SIZE, MD_ACQ_DATE, MD_AD_LIST, \
     MD_DWELL_TIME
 
-from odemis.util import img, units, spot, executeAsyncTask
+from odemis.util import img, units, spot, spectrum, executeAsyncTask
 import threading
 import time
 from odemis.acq import drift
@@ -82,6 +84,10 @@ class MultipleDetectorStream(Stream):
     """
     __metaclass__ = ABCMeta
 
+    # Size (in bytes) above which the data of a stream is stored in a temporary
+    # file, mapped in memory, instead of only in RAM. If None, half of the RAM.
+    MEMMAP_MIN_SIZE = None
+
     def __init__(self, name, streams):
         """
         streams (list of Streams): they should all have the same emitter (which
@@ -167,6 +173,9 @@ class MultipleDetectorStream(Stream):
 
         # all the data received, in order, for each stream
         self._acq_data = [[] for _ in streams]
+        # for each stream, None or the array preallocated to contain all the
+        # data of the acquisition (then, _acq_data contains views on it)
+        self._acq_cubes = [None for _ in streams]
 
         self._acq_min_date = None  # minimum acquisition time for the data to be acceptable
 
@@ -538,6 +547,97 @@ class MultipleDetectorStream(Stream):
         """
         return data
 
+    def _createCube(self, shape, dtype):
+        """
+        Allocate an array to store the data of a whole acquisition. If it's very
+        big, it's backed by a temporary file.
+        shape (tuple of ints): shape of the array
+        dtype (numpy.dtype): type of the array
+        return (numpy.ndarray): the (uninitialised) array
+        """
+        size = numpy.prod(shape) * numpy.dtype(dtype).itemsize
+        min_size = self.MEMMAP_MIN_SIZE
+        if min_size is None:
+            try:
+                min_size = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+            except (ValueError, OSError):
+                min_size = float("inf")
+
+        if size >= min_size:
+            logging.info("Storing acquisition data of %d MB in a temporary file",
+                         size // 2 ** 20)
+            # The file is deleted as soon as the array is not used anymore
+            f = tempfile.TemporaryFile(prefix="odemis-acq-")
+            return numpy.memmap(f, dtype=dtype, mode="w+", shape=shape)
+        else:
+            return numpy.empty(shape, dtype=dtype)
+
+    def _allocateCube(self, n, data, rep):
+        """
+        Called when the first data of a stream is received, to allocate the
+        array for the final data, so that each data can be directly copied into
+        it.
+        Note: this version doesn't allocate anything (so all the data is kept
+          until the end of the acquisition). Override it, and _getCubeSlot(),
+          to avoid this.
+        n (0<=int): the detector/stream index
+        data (value): the first data, as returned by _preprocessData()
+        rep (int, int): number of pixels in X, Y
+        return (None or numpy.ndarray): the array to contain all the data
+        """
+        return None
+
+    def _getCubeSlot(self, n, cube, i, rep):
+        """
+        Locate where the data of a pixel goes in the final array
+        n (0<=int): the detector/stream index
+        cube (numpy.ndarray): the array returned by _allocateCube()
+        i (0<=int): index of the pixel (X changing fast, then Y)
+        rep (int, int): number of pixels in X, Y
+        return (numpy.ndarray): a view on the cube, of the same shape as the data
+        """
+        raise NotImplementedError()
+
+    def _storeData(self, n, i, rep):
+        """
+        Copy the last data of a stream into the preallocated array (if there is
+          one), so that the original data can be discarded.
+        n (0<=int): the detector/stream index
+        i (0<=int): index of the pixel (X changing fast, then Y)
+        rep (int, int): number of pixels in X, Y
+        """
+        data = self._acq_data[n][-1]
+        cube = self._acq_cubes[n]
+        if cube is None:
+            if i != 0:
+                return  # No cube for this stream
+            if isinstance(data, numpy.ndarray):
+                cube = self._allocateCube(n, data, rep)
+            if cube is None:
+                return
+            self._acq_cubes[n] = cube
+
+        slot = self._getCubeSlot(n, cube, i, rep)
+        if slot.shape != data.shape:
+            logging.warning("Data of stream %d has shape %s, while expected %s, "
+                            "will keep it separately", n, data.shape, slot.shape)
+            self._acq_cubes[n] = None
+            return
+        slot[...] = data
+        self._acq_data[n][-1] = model.DataArray(slot, data.metadata)
+
+    def _getCube(self, n, raw_das):
+        """
+        n (0<=int): the detector/stream index
+        raw_das (list of DataArray): all the data of the stream
+        return (None or numpy.ndarray): the preallocated array, if all the data
+          has been stored in it
+        """
+        cube = self._acq_cubes[n]
+        if cube is None or len(raw_das) != numpy.prod(self.repetition.value):
+            return None
+        return cube
+
     def _onCompletedData(self, n, raw_das):
         """
         Called at the end of an entire acquisition. It should assemble the data
@@ -632,7 +732,7 @@ class MultipleDetectorStream(Stream):
         main_data = model.DataArray(main_data, metadata=md)
         return main_data
 
-    def _assembleTiles(self, rep, data_list):
+    def _assembleTiles(self, rep, data_list, cube=None):
         """
         Convert a series of tiles acquisitions into an image (2D)
         rep (2 x 0<ints): Number of tiles in the output (Y, X)
@@ -642,15 +742,18 @@ class MultipleDetectorStream(Stream):
             If multiple images were recorded per pixel position, the number of pixels X*Y (scan positions)
             does not match len(data_list). Every multiple of X*Y represents the same pixel (scan position).
             Multiple scans per pixel will be averaged.
+        cube (None or numpy.ndarray of shape Y*T, X*S): if not None, the data
+          already assembled (cf _storeData())
         return (DataArray of shape Y*T, X*S): the data with the correct metadata
         """
         # N = len(data_list)
         T, S = data_list[0].shape
         X, Y = rep
-        # copy into one big array N, Y, X
-        arr = numpy.array(data_list)
-
-        if T == 1 and S == 1:
+        if cube is not None:
+            arr = cube
+        elif T == 1 and S == 1:
+            # copy into one big array N, Y, X
+            arr = numpy.array(data_list)
             # fast path: the data is already ordered just copy
             # reshape to get a 2D image
             # check if number of px scans (rep) is equal to number of images acquired (arr)
@@ -663,6 +766,8 @@ class MultipleDetectorStream(Stream):
                 # average images
                 arr = numpy.mean(arr, 2).astype(data_list[0].dtype)
         else:
+            # copy into one big array N, Y, X
+            arr = numpy.array(data_list)
             # need to reorder data by tiles
             # change N to Y, X
             arr.shape = (Y, X, T, S)
@@ -759,8 +864,23 @@ class SEMCCDMDStream(MultipleDetectorStream):
     moving the SEM spot and starts a new CCD acquisition at each spot. It brings
     a bit more overhead than linking directly the event of the SEM to the CCD
     detector trigger, but it's very reliable.
+    Optionally, when the hardware supports it, the spots are scanned by batches
+    along the lines, with the CCD triggered directly by the e-beam (cf
+    BATCH_ACQUISITION).
     """
 
+    # If True, and the hardware supports it, the e-beam scans a whole batch of
+    # spots (a segment of a line) at once, and the CCD is triggered by the
+    # e-beam at each new spot (cf _acquireBatch()). It's much faster for short
+    # exposure times, but it relies on the CCD driver being ready for the next
+    # trigger in time, which is not the case of every driver. So it's only
+    # used when explicitly requested.
+    BATCH_ACQUISITION = False
+    # In batch acquisition, extra time the e-beam stays on each spot, compared
+    # to the CCD exposure + readout time, to be sure the CCD is ready to receive
+    # the next trigger: relative (ratio) and absolute (s)
+    BATCH_DWELL_MARGIN = (0.1, 5e-3)
+
     def __init__(self, name, streams):
         """
         streams (list of Streams): in addition to the requirements of
@@ -797,6 +917,10 @@ class SEMCCDMDStream(MultipleDetectorStream):
         self._trigger = self._ccd.softwareTrigger
         self._ccd_idx = len(self._streams) - 1  # optical detector is always last in streams
 
+        # During a batch acquisition: number of spots in the batch, and for
+        # each stream, all the data received. Otherwise, None.
+        self._acq_batch = None
+
     def _estimateRawAcquisitionTime(self):
         """
         return (float): time in s for acquiring the whole image, without drift
@@ -880,6 +1004,18 @@ class SEMCCDMDStream(MultipleDetectorStream):
 
         return exp + readout
 
+    def _allocateCube(self, n, data, rep):
+        # Default is to assume the data is 2D, and tile it (cf _assembleTiles())
+        if data.ndim != 2:
+            return None
+        T, S = data.shape
+        return self._createCube((rep[1] * T, rep[0] * S), data.dtype)
+
+    def _getCubeSlot(self, n, cube, i, rep):
+        T, S = cube.shape[0] // rep[1], cube.shape[1] // rep[0]
+        y, x = divmod(i, rep[0])
+        return cube[y * T:(y + 1) * T, x * S:(x + 1) * S]
+
     def _onCompletedData(self, n, raw_das):
         """
         Called at the end of an entire acquisition. It should assemble the data
@@ -891,7 +1027,8 @@ class SEMCCDMDStream(MultipleDetectorStream):
         """
 
         # Default is to assume the data is 2D and assemble it.
-        da = self._assembleTiles(self.repetition.value, raw_das)
+        da = self._assembleTiles(self.repetition.value, raw_das,
+                                 self._getCube(n, raw_das))
 
         # explicitly add names of acquisition to make sure they are different
         da.metadata[MD_DESCRIPTION] = self._streams[n].name.value
@@ -921,6 +1058,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
           Exceptions if error
         """
         # TODO: handle better very large grid acquisition (than memory oops)
+        batch = False  # True if the spots are acquired by batches
         try:
             self._acq_done.clear()
             px_time = self._adjustHardwareSettings()
@@ -934,6 +1072,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             sub_pxs = self._emitter.pixelSize.value  # sub-pixel size
 
             self._acq_data = [[] for _ in self._streams]  # just to be sure it's really empty
+            self._acq_cubes = [None for _ in self._streams]
             self._raw = []
             self._anchor_raw = []
             logging.debug("Starting repetition stream acquisition with components %s",
@@ -948,7 +1087,10 @@ class SEMCCDMDStream(MultipleDetectorStream):
             # Rationale: using the .newPosition Event on the e-beam is not
             # reliable enough as the CCD driver may not receive the data in time.
             # (it might be solvable for most hardware by improving the drivers
-            # to put the CCD into special "burst" mode). We could almost use
+            # to put the CCD into special "burst" mode). That is why the batch
+            # acquisition, which does rely on it, is only used when
+            # BATCH_ACQUISITION is explicitly set, and with a safety margin on
+            # the dwell time of each spot (cf _acquireBatch()). We could almost use
             # .get() on the CCD, but it's slow, and it's not cancellable. If we
             # use synchronisation also on the e-beam, we cannot stop the scan
             # immediately after the CCD image is received. So we would either
@@ -967,10 +1109,26 @@ class SEMCCDMDStream(MultipleDetectorStream):
             # retrigger, or unsynchronise/resynchronise just before the end of
             # last scan).
 
-            # prepare detector
-            self._ccd_df.synchronizedOn(self._trigger)
-            # subscribe to last entry in _subscribers (optical detector)
-            self._ccd_df.subscribe(self._subscribers[self._ccd_idx])
+            batch = self._canAcquireBatch(spot_pos)
+            if batch:
+                # Leave the CCD enough time to be ready for the next spot
+                ratio, extra = self.BATCH_DWELL_MARGIN
+                batch_dt = px_time * (1 + ratio) + extra
+                if batch_dt > self._emitter.dwellTime.range[1]:
+                    logging.debug("Cannot acquire by batch, as dwell time %g s is too long",
+                                  batch_dt)
+                    batch = False
+                else:
+                    self._emitter.dwellTime.value = self._emitter.dwellTime.clip(batch_dt)
+                    px_time = self._emitter.dwellTime.value
+                    logging.debug("Will acquire the spots by batches along the lines, "
+                                  "with dwell time = %g s", px_time)
+
+            # prepare detector (in batch mode, it's done for each batch)
+            if not batch:
+                self._ccd_df.synchronizedOn(self._trigger)
+                # subscribe to last entry in _subscribers (optical detector)
+                self._ccd_df.subscribe(self._subscribers[self._ccd_idx])
 
             # Instead of subscribing/unsubscribing to the SEM for each pixel,
             # we've tried to keep subscribed, but request to be unsynchronised/
@@ -1010,6 +1168,16 @@ class SEMCCDMDStream(MultipleDetectorStream):
                     f.result()
                     time_move_pol_left -= time_move_pol_once
 
+                if batch:
+                    for px_idx, npx in self._iterBatches(rep, leech_np):
+                        leech_time_left = (tot_num - n + 1) * leech_time_ppx
+                        extra_time = leech_time_left + time_move_pol_left
+                        self._acquireBatch(n, px_idx, npx, spot_pos, px_time, sub_pxs,
+                                           tot_num, leech_np, extra_time, future)
+                        n += npx
+                        logging.debug("Done acquiring image number %s out of %s." % (n, tot_num))
+                    continue
+
                 # iterate over pixel positions for scanning
                 for px_idx in numpy.ndindex(*rep[::-1]):  # last dim (X) iterates first
                     trans = tuple(spot_pos[px_idx])  # spot position
@@ -1071,6 +1239,8 @@ class SEMCCDMDStream(MultipleDetectorStream):
             for s, sub in zip(self._streams, self._subscribers):
                 s._dataflow.unsubscribe(sub)
             self._ccd_df.synchronizedOn(None)
+            if batch:
+                self._df0.synchronizedOn(None)
 
             self._raw = []
             self._anchor_raw = []
@@ -1084,10 +1254,240 @@ class SEMCCDMDStream(MultipleDetectorStream):
             for s in self._streams:
                 s._unlinkHwVAs()
             self._acq_data = [[] for _ in self._streams]  # regain a bit of memory
+            self._acq_cubes = [None for _ in self._streams]
+            self._acq_batch = None
             self._dc_estimator = None
             self._current_future = None
             self._acq_done.set()
 
+    def _canAcquireBatch(self, spot_pos):
+        """
+        Check whether the spots can be acquired by batch (cf _acquireBatch()).
+        It must be called after _adjustHardwareSettings().
+        spot_pos (numpy ndarray of shape (Y,X,2)): the positions of the spots
+        return (bool): True if the batch acquisition can be used
+        """
+        if not self.BATCH_ACQUISITION:
+            return False
+        # Only one SEM detector is synchronized on the batch scan
+        if len(self._streams) > 2:
+            logging.debug("Cannot acquire by batch with %d e-beam streams",
+                          len(self._streams) - 1)
+            return False
+        # The e-beam must tell when it's at a new spot, and the SEM detector
+        # must only scan once per batch.
+        if not (hasattr(self._emitter, "newPosition") and
+                hasattr(self._det0, "softwareTrigger")):
+            return False
+        # In fuzzing, each spot is a small scan => not compatible
+        if tuple(self._emitter.resolution.value) != (1, 1):
+            return False
+        # The distance between the spots must be a possible scale
+        if spot_pos.shape[1] > 1:
+            dist = spot_pos[0, 1, 0] - spot_pos[0, 0, 0]
+            if not self._emitter.scale.range[0][0] <= dist <= self._emitter.scale.range[1][0]:
+                logging.debug("Cannot scan spots separated by %g px at once", dist)
+                return False
+        return True
+
+    def _iterBatches(self, rep, leech_np):
+        """
+        Split the spots into batches: segments of a line, which stop when a
+        leech has to run.
+        rep (int, int): number of spots in X, Y
+        leech_np (list of 0<int or None): for each leech, number of pixels before
+          it should run. It's read before each batch, so it can be updated.
+        yields ((int, int), 0<int): index (Y, X) of the first spot, and number
+          of spots in the batch
+        """
+        for y in range(rep[1]):
+            x = 0
+            while x < rep[0]:
+                npx = min([rep[0] - x] + [np for np in leech_np if np is not None])
+                npx = max(1, npx)
+                yield (y, x), npx
+                x += npx
+
+    def _onData(self, n, df, data):
+        batch = self._acq_batch
+        if batch is None:
+            return super(SEMCCDMDStream, self)._onData(n, df, data)
+
+        logging.debug("Stream %d data received for batch", n)
+        if self._acq_min_date > data.metadata.get(model.MD_ACQ_DATE, 0):
+            logging.warning("Dropping data because it started %g s too early",
+                            self._acq_min_date - data.metadata.get(model.MD_ACQ_DATE, 0))
+            return
+
+        # The SEM sends one data for the whole batch, the CCD one per spot
+        npx, batch_data = batch
+        if not self._acq_complete[n].is_set():
+            batch_data[n].append(data)
+            if n != self._ccd_idx or len(batch_data[n]) >= npx:
+                self._acq_complete[n].set()
+
+    def _acquireBatch(self, n, px_idx, npx, spot_pos, px_time, sub_pxs,
+                      tot_num, leech_np, extra_time, future):
+        """
+        Acquires the data of a batch of spots, along a line. The e-beam is
+        configured to scan all the spots of the batch at once, and the CCD is
+        triggered by the e-beam each time it moves to the next spot. The CCD
+        frames are matched to the spots by their order of acquisition.
+        :param n (int): number of points (pixel positions) acquired so far
+        :param px_idx (int, int): index (Y, X) of the first spot of the batch
+        :param npx (0<int): number of spots in the batch
+        :param spot_pos (numpy ndarray of shape (Y,X,2)): position of every spot
+        :param px_time (0<float): expected time spend for one pixel
+        :param sub_pxs (float, float): pixel size of the e-beam scanner (at scale 1)
+        :param tot_num (int): total number of images
+        :param leech_np (list of 0<int or None): for each leech, number of pixels before the leech should be
+                executed again. It's automatically updated inside the list. (np = next pixels)
+        :param extra_time (float): # extra time needed taking leeches into account and moving polarizer HW if present
+        :param future: current future running for the whole acquisition
+        """
+        y, x = px_idx
+        first_pos = spot_pos[y, x]
+        last_pos = spot_pos[y, x + npx - 1]
+        trans = ((first_pos[0] + last_pos[0]) / 2, first_pos[1])
+        if npx > 1:
+            dist = (last_pos[0] - first_pos[0]) / (npx - 1)
+            scale = self._emitter.scale.clip((dist, dist))
+        else:
+            scale = (1, 1)
+
+        # take care of drift
+        if self._dc_estimator:
+            trans = (trans[0] - self._dc_estimator.tot_drift[0],
+                     trans[1] - self._dc_estimator.tot_drift[1])
+
+        # always in this order
+        self._emitter.scale.value = scale
+        self._emitter.resolution.value = (npx, 1)
+        cptrans = self._emitter.translation.clip(trans)
+        self._emitter.translation.value = cptrans
+        if self._emitter.translation.value != cptrans:
+            if self._dc_estimator:
+                logging.error("Drift of %s px caused acquisition region out "
+                              "of bounds: needed to scan spots at %s.",
+                              self._dc_estimator.tot_drift, trans)
+            else:
+                logging.error("Unexpected clipping in the scan spots position %s", trans)
+        logging.debug("Scanning %d spots at %s, with scale %s",
+                      npx, self._emitter.translation.value, self._emitter.scale.value)
+
+        sem_time = self._emitter.dwellTime.value * npx
+        rep = self.repetition.value
+        failures = 0  # keeps track of acquisition failures
+        while True:  # Done only once normally, excepted in case of failures
+            start = time.time()
+            self._acq_min_date = start
+            self._acq_batch = (npx, [[] for _ in self._streams])
+            for ce in self._acq_complete:
+                ce.clear()
+
+            if self._acq_state == CANCELLED:
+                raise CancelledError()
+
+            # The CCD acquires one frame each time the e-beam moves to a new
+            # spot, and the e-beam only scans the batch once, when requested.
+            # Note: the CCD is only synchronized during the batch, so that
+            # scans by the leeches do not trigger it.
+            self._ccd_df.synchronizedOn(self._emitter.newPosition)
+            self._ccd_df.subscribe(self._subscribers[self._ccd_idx])
+            self._df0.synchronizedOn(self._det0.softwareTrigger)
+            self._df0.subscribe(self._subscribers[0])
+            self._det0.softwareTrigger.notify()
+
+            # wait for detector to acquire all the images
+            timedout = self._waitForImage(px_time * npx)
+            dur = time.time() - start
+            if not timedout:
+                # Normally, the SEM acquisition has already completed
+                timedout = not self._acq_complete[0].wait(sem_time * 1.5 + 5)
+
+            for s, sub in zip(self._streams, self._subscribers):
+                s._dataflow.unsubscribe(sub)
+            self._df0.synchronizedOn(None)
+            self._ccd_df.synchronizedOn(None)
+
+            if self._acq_state == CANCELLED:
+                raise CancelledError()
+
+            batch_data = self._acq_batch[1]
+            self._acq_batch = None
+            sem_data = batch_data[0][0] if batch_data[0] else None
+            if timedout or dur < px_time * npx * 0.95 or sem_data.shape[-1] != npx:
+                if timedout:
+                    logging.warning("Acquisition of repetition stream for "
+                                    "spots %s +%d timed out after %g s "
+                                    "(received %d frames). Will try again",
+                                    px_idx, npx, dur, len(batch_data[self._ccd_idx]))
+                elif dur < px_time * npx * 0.95:
+                    logging.warning("Repetition stream acquisition took less than %g s: %g s, will try again",
+                                    px_time * npx, dur)
+                else:
+                    logging.warning("SEM data has shape %s, while expected %d spots, will try again",
+                                    sem_data.shape, npx)
+                failures += 1
+                if failures >= 3:
+                    # In three failures we just give up
+                    raise IOError("Repetition stream acquisition repeatedly fails to synchronize")
+
+                # Restart the acquisition, hoping this time we will synchronize
+                # properly
+                time.sleep(1)
+                continue
+
+            # The frames are normally received in order, but the acquisition
+            # date is the most reliable way to know in which order the spots
+            # were scanned.
+            ccd_frames = sorted(batch_data[self._ccd_idx][:npx],
+                                key=lambda d: d.metadata.get(MD_ACQ_DATE, 0))
+
+            # MD_POS of the SEM data is the center of the batch, but each spot
+            # needs the position of the e-beam (without the shift for drift
+            # correction)
+            sem_md = sem_data.metadata
+            raw_pos = sem_md[MD_POS]
+            drift_shift = self._dc_estimator.tot_drift if self._dc_estimator else (0, 0)
+            spot_dist = scale[0] * sub_pxs[0]
+            for i, ccd_data in enumerate(ccd_frames):
+                pos = (raw_pos[0] + (i - (npx - 1) / 2) * spot_dist, raw_pos[1])
+                md = sem_md.copy()
+                md[MD_POS] = pos
+                self._acq_data[0].append(model.DataArray(sem_data[..., i:i + 1], md))
+
+                cor_pos = (pos[0] + drift_shift[0] * sub_pxs[0],
+                           pos[1] - drift_shift[1] * sub_pxs[1])  # Y is upside down
+                ccd_data.metadata[MD_POS] = cor_pos
+                self._acq_data[self._ccd_idx].append(
+                    self._preprocessData(self._ccd_idx, ccd_data, (y, x + i)))
+                logging.debug("Processed CCD data %d = %s", n + i, (y, x + i))
+
+                # Copy the data into the final arrays (if only one image per pixel)
+                if tot_num == numpy.prod(rep):
+                    for si in range(len(self._streams)):
+                        self._storeData(si, n + i, rep)
+
+                self._updateProgress(future, dur / npx, n + i + 1, tot_num, extra_time)
+
+            # Check if it's time to run a leech (the batch stops just at the leech)
+            for li, l in enumerate(self.leeches):
+                if leech_np[li] is None:
+                    continue
+                leech_np[li] -= npx
+                if leech_np[li] <= 0:
+                    try:
+                        np = l.next([d[-1] for d in self._acq_data])
+                    except Exception:
+                        logging.exception("Leech %s failed, will retry next pixel", l)
+                        np = 1  # try again next pixel
+                    leech_np[li] = np
+                    if self._acq_state == CANCELLED:
+                        raise CancelledError()
+
+            break
+
     def _waitForImage(self, px_time):
         """
         Wait for the detector to acquire the image
@@ -1223,6 +1623,12 @@ class SEMCCDMDStream(MultipleDetectorStream):
             self._acq_data[-1][-1] = self._preprocessData(self._ccd_idx, ccd_data, px_idx)
             logging.debug("Processed CCD data %d = %s", n, px_idx)
 
+            # Copy the data into the final arrays (if only one image per pixel)
+            rep = self.repetition.value
+            if tot_num == numpy.prod(rep):
+                for si in range(len(self._streams)):
+                    self._storeData(si, n, rep)
+
             self._updateProgress(future, time.time() - start, n + 1, tot_num, extra_time)
 
             # Check if it's time to run a leech
@@ -1299,6 +1705,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             rep = self.repetition.value  # (int, int): 2D grid of pixel positions to be acquired
             sub_pxs = self._emitter.pixelSize.value  # sub-pixel size
             self._acq_data = [[] for _ in self._streams]  # just to be sure it's really empty
+            self._acq_cubes = [None for _ in self._streams]
             self._raw = []
             self._anchor_raw = []
             logging.debug("Starting repetition stream acquisition with components %s and scan stage %s",
@@ -1430,6 +1837,8 @@ class SEMCCDMDStream(MultipleDetectorStream):
                     ccd_data = self._acq_data[-1][-1]
                     self._acq_data[-1][-1] = self._preprocessData(len(self._streams), ccd_data, px_idx)
                     logging.debug("Processed CCD data %d = %s", n, px_idx)
+                    for si in range(len(self._streams)):
+                        self._storeData(si, n, rep)
 
                     n += 1
                     leech_time_left = (tot_num - n) * leech_time_ppx
@@ -1505,6 +1914,7 @@ class SEMCCDMDStream(MultipleDetectorStream):
             for s in self._streams:
                 s._unlinkHwVAs()
             self._acq_data = [[] for _ in self._streams]  # regain a bit of memory
+            self._acq_cubes = [None for _ in self._streams]
             self._dc_estimator = None
             self._current_future = None
             self._acq_done.set()
@@ -1591,6 +2001,7 @@ class SEMMDStream(MultipleDetectorStream):
             pos_flat = spot_pos.reshape((-1, 2))  # X/Y together (X iterates first)
             rep = self.repetition.value
             self._acq_data = [[] for _ in self._streams]  # just to be sure it's really empty
+            self._acq_cubes = [None for _ in self._streams]
             self._raw = []
             self._anchor_raw = []
             logging.debug("Starting e-beam sync acquisition with components %s",
@@ -1721,6 +2132,7 @@ class SEMMDStream(MultipleDetectorStream):
             for s in self._streams:
                 s._unlinkHwVAs()
             self._acq_data = [[] for _ in self._streams]  # regain a bit of memory
+            self._acq_cubes = [None for _ in self._streams]
             self._dc_estimator = None
             self._current_future = None
             self._acq_done.set()
@@ -1733,6 +2145,27 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
     image).
     """
 
+    # If not None, the spikes (typically caused by cosmic rays) are removed
+    # from the spectrum data at the end of the acquisition, with this threshold
+    # (cf util.spectrum.remove_spikes()).
+    SPIKE_REMOVAL_THRESHOLD = None
+    # Number of spectra corrected at once, to limit the memory usage
+    SPIKE_REMOVAL_CHUNK = 4096
+
+    def _allocateCube(self, n, data, rep):
+        if n != self._ccd_idx:
+            return super(SEMSpectrumMDStream, self)._allocateCube(n, data, rep)
+        if data.ndim != 2 or data.shape[0] != 1:
+            return None
+        # C11YX
+        return self._createCube((data.shape[1], 1, 1, rep[1], rep[0]), data.dtype)
+
+    def _getCubeSlot(self, n, cube, i, rep):
+        if n != self._ccd_idx:
+            return super(SEMSpectrumMDStream, self)._getCubeSlot(n, cube, i, rep)
+        y, x = divmod(i, rep[0])
+        return cube[numpy.newaxis, :, 0, 0, y, x]  # 1 x C, as the data received
+
     def _onCompletedData(self, n, raw_das):
         if n != self._ccd_idx:
             return super(SEMSpectrumMDStream, self)._onCompletedData(n, raw_das)
@@ -1741,7 +2174,12 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
 
         # assemble all the CCD data into one
         rep = self.repetition.value
-        spec_data = self._assembleSpecData(raw_das, rep)
+        spec_data = self._assembleSpecData(raw_das, rep, self._getCube(n, raw_das))
+        if self.SPIKE_REMOVAL_THRESHOLD is not None:
+            # In-place, as the data might be (almost) as big as the memory
+            _, npixels, nspikes = spectrum.remove_spikes(spec_data, self.SPIKE_REMOVAL_THRESHOLD,
+                                                         self.SPIKE_REMOVAL_CHUNK, out=spec_data)
+            logging.info("Removed %d spikes in %d spectra", nspikes, npixels)
 
         # Compute metadata based on SEM metadata
         sem_data = self._raw[0]  # _onCompletedData() should be called in order
@@ -1758,7 +2196,7 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
         spec_data.metadata[MD_DESCRIPTION] = self._streams[n].name.value
         self._raw.append(spec_data)
 
-    def _assembleSpecData(self, data_list, repetition):
+    def _assembleSpecData(self, data_list, repetition, cube=None):
         """
         Take all the data received from the spectrometer and assemble it in a
         cube.
@@ -1766,22 +2204,26 @@ class SEMSpectrumMDStream(SEMCCDMDStream):
         data_list (list of M DataArray of shape (1, N)): all the data received
         repetition (list of 2 int): X,Y shape of the high dimensions of the cube
          so that X * Y = M
+        cube (None or numpy.ndarray of shape (N, 1, 1, Y, X)): if not None, the
+          data already assembled (cf _storeData())
         return (DataArray)
         """
         assert len(data_list) > 0
 
+        # copy the metadata from the first point and add the ones from metadata
+        md = data_list[0].metadata.copy()
+        if cube is not None:
+            return model.DataArray(cube, metadata=md)
+
         # each element of acq_spect_buf has a shape of (1, N)
         # reshape to (N, 1)
-        for e in data_list:
-            e.shape = e.shape[::-1]
+        data_list = [e.reshape(e.shape[::-1]) for e in data_list]
         # concatenate into one big array of (N, number of pixels)
         spec_data = numpy.concatenate(data_list, axis=1)
         # reshape to (C, 1, 1, Y, X) (as C must be the 5th dimension)
         spec_res = data_list[0].shape[0]
         spec_data.shape = (spec_res, 1, 1, repetition[1], repetition[0])
 
-        # copy the metadata from the first point and add the ones from metadata
-        md = data_list[0].metadata.copy()
         return model.DataArray(spec_data, metadata=md)
 
 class SEMTemporalMDStream(MultipleDetectorStream):
@@ -2019,6 +2461,20 @@ class SEMTemporalSpectrumMDStream(SEMCCDMDStream):
     Data format: SEM (2D=XY) + TemporalSpectrum(4D=CT1YX).
     """
 
+    def _allocateCube(self, n, data, rep):
+        if n != self._ccd_idx:
+            return super(SEMTemporalSpectrumMDStream, self)._allocateCube(n, data, rep)
+        if data.ndim != 2:
+            return None
+        # Data is TC => CT1YX
+        return self._createCube(data.shape[::-1] + (1, rep[1], rep[0]), data.dtype)
+
+    def _getCubeSlot(self, n, cube, i, rep):
+        if n != self._ccd_idx:
+            return super(SEMTemporalSpectrumMDStream, self)._getCubeSlot(n, cube, i, rep)
+        y, x = divmod(i, rep[0])
+        return cube[:, :, 0, y, x].T  # TC, as the data received
+
     def _onCompletedData(self, n, raw_das):
         """
         n: (int) index of detector
@@ -2032,7 +2488,7 @@ class SEMTemporalSpectrumMDStream(SEMCCDMDStream):
 
         # assemble all the CCD data into one
         rep = self.repetition.value
-        temp_spec_data = self._assembleTempSpecData(raw_das, rep)
+        temp_spec_data = self._assembleTempSpecData(raw_das, rep, self._getCube(n, raw_das))
 
         # Compute metadata based on SEM metadata
         sem_data = self._raw[0]
@@ -2049,7 +2505,7 @@ class SEMTemporalSpectrumMDStream(SEMCCDMDStream):
 
         self._raw.append(temp_spec_data)
 
-    def _assembleTempSpecData(self, data_list, repetition):
+    def _assembleTempSpecData(self, data_list, repetition, cube=None):
         """
         Take all the data received from the streak camera and assemble it in a
         hypercube.
@@ -2057,21 +2513,24 @@ class SEMTemporalSpectrumMDStream(SEMCCDMDStream):
         data_list (list of M DataArrays of shape (lambda, time)): all the data received
         repetition (list of 2 int): X,Y shape of the higher dimensions of the hypercube
         so that X * Y = M (aka number of ebeam positions)
+        cube (None or numpy.ndarray of shape CT1YX): if not None, the data
+          already assembled (cf _storeData())
         return (DataArray): hypercube (ndarray with shape: CT1YX) + MD (dict)
         """
         assert len(data_list) > 0
+        if cube is not None:
+            return model.DataArray(cube, metadata=data_list[0].metadata.copy())
 
         # each image has a shape of (time, lambda)
-        # transpose to (lambda, time)
-        for index, img in enumerate(data_list):
-            data_list[index] = img.T
-
-        # concatenate into one big array of (lambda, time, z=1, ebeam pos y, ebeam pos x)
-        # CTZYX, ebeam scans x and then y (x slow axis)
-        ts_data = numpy.concatenate(data_list, axis=1)
-        # reshape to (C, T, 1, Y, X)
-        spec_res = data_list[0].shape[0]
-        temp_res = data_list[0].shape[1]
+        temp_res, spec_res = data_list[0].shape
+
+        # copy into one big array of (ebeam pos, time, lambda),
+        # ebeam scans x and then y (x fast axis)
+        ts_data = numpy.array(data_list)
+        ts_data.shape = (repetition[1], repetition[0], temp_res, spec_res)
+        # reorder to (lambda, time, ebeam pos y, ebeam pos x) and add z=1 => CTZYX
+        ts_data = numpy.transpose(ts_data, (3, 2, 0, 1))
+        ts_data = numpy.ascontiguousarray(ts_data)
         ts_data.shape = (spec_res, temp_res, 1, repetition[1], repetition[0])
 
         # copy the metadata from the first point and add the ones from metadata
@@ -2086,6 +2545,12 @@ class SEMARMDStream(SEMCCDMDStream):
     image).
     """
 
+    def _allocateCube(self, n, data, rep):
+        if n != self._ccd_idx:
+            return super(SEMARMDStream, self)._allocateCube(n, data, rep)
+        # Each AR image is kept separately
+        return None
+
     def _onCompletedData(self, n, raw_das):
         """
         n: (int) index of detector
@@ -20,7 +20,7 @@ import logging
 import numpy
 from odemis import model, dataio
 from odemis.acq import calibration
-from odemis.util import img
+from odemis.util import img, spectrum
 import os
 import time
 import unittest
@@ -342,6 +342,100 @@ class TestSpectrum(unittest.TestCase):
         for vo, vc, wl in zip(spec[..., 3, 3], compensated[..., 3, 3], wld):
             if wl <= wl_calib[0]:
                 self.assertEqual(vo * dcalib[0], vc)
+    def test_compensated_view(self):
+        """Test the lazy compensation gives the same result as the full one"""
+        data = numpy.random.randint(0, 1000, size=(51, 1, 1, 20, 30)).astype(numpy.uint16)
+        wld = 433e-9 + numpy.array(range(data.shape[0])) * 0.1e-9
+        spec = model.DataArray(data, metadata={model.MD_WL_LIST: wld})
+
+        dbckg = numpy.random.randint(0, 100, size=(51, 1, 1, 1, 1)).astype(numpy.uint16)
+        bckg = model.DataArray(dbckg, metadata={model.MD_WL_LIST: wld})
+
+        dcalib = numpy.array([1, 1.3, 2, 3.5, 4, 5, 0.1, 6, 9.1], dtype=numpy.float)
+        dcalib.shape = (dcalib.shape[0], 1, 1, 1, 1)
+        wl_calib = 430e-9 + numpy.array(range(dcalib.shape[0])) * 1e-9
+        calib = model.DataArray(dcalib, metadata={model.MD_WL_LIST: wl_calib})
+
+        for b, c in ((bckg, None), (None, calib), (bckg, calib)):
+            full = calibration.compensate_spectrum_efficiency(spec, b, c)
+            view = calibration.CompensatedSpectrum(spec, b, c)
+            self.assertEqual(view.shape, full.shape)
+            self.assertEqual(view.dtype, full.dtype)
+            numpy.testing.assert_equal(view.metadata[model.MD_WL_LIST], wld)
+
+            # pixel spectrum, band plane, line, single value, advanced indexing
+            for key in ((slice(None), 0, 0, 3, 5),
+                        (slice(10, 21),),
+                        (slice(None), 0, 0, 7, slice(2, 25)),
+                        (-1, 0, 0, 19, 29),
+                        (Ellipsis, 4, 4),
+                        ([2, 4, 8],)):
+                numpy.testing.assert_array_equal(view[key], full[key])
+
+            md_view = view[:, 0, 0, 3, 5]
+            numpy.testing.assert_equal(md_view.metadata[model.MD_WL_LIST], wld)
+
+            # Fully computed, by small chunks
+            calibration.CHUNK_SIZE = 20 * 30 * 8 * 4
+            try:
+                da = view.getData()
+                mn, mx = view.getMinMax()
+            finally:
+                calibration.CHUNK_SIZE = 16 * 1024 * 1024
+            self.assertEqual(da.dtype, numpy.float32)
+            numpy.testing.assert_allclose(da, full, rtol=1e-6)
+            self.assertEqual((mn, mx), (full.min(), full.max()))
+
+    def test_compensated_scalar(self):
+        """Test reading a single value of the lazy compensation"""
+        data = numpy.random.randint(0, 1000, size=(51, 1, 1, 20, 30)).astype(numpy.uint16)
+        data[5, 0, 0, 2, 3] = 0  # Lower than the background
+        wld = 433e-9 + numpy.array(range(data.shape[0])) * 0.1e-9
+        spec = model.DataArray(data, metadata={model.MD_WL_LIST: wld})
+
+        dbckg = numpy.random.randint(1, 100, size=(51, 1, 1, 1, 1)).astype(numpy.uint16)
+        bckg = model.DataArray(dbckg, metadata={model.MD_WL_LIST: wld})
+
+        dcalib = numpy.array([1, 1.3, 2, 3.5, 4, 5, 0.1, 6, 9.1], dtype=numpy.float)
+        dcalib.shape = (dcalib.shape[0], 1, 1, 1, 1)
+        wl_calib = 430e-9 + numpy.array(range(dcalib.shape[0])) * 1e-9
+        calib = model.DataArray(dcalib, metadata={model.MD_WL_LIST: wl_calib})
+
+        for b, c in ((bckg, None), (None, calib), (bckg, calib)):
+            full = calibration.compensate_spectrum_efficiency(spec, b, c)
+            view = calibration.CompensatedSpectrum(spec, b, c)
+            for key in ((5, 0, 0, 2, 3), (0, 0, 0, 0, 0), (-1, -1, 0, -2, 29), (50, 0, 0, 19, -30)):
+                v = view[key]
+                self.assertEqual(numpy.ndim(v), 0)
+                self.assertEqual(v.dtype, full.dtype)
+                self.assertEqual(v, full[key])
+
+            # Mix of integers and slices
+            numpy.testing.assert_array_equal(view[5, 0, 0, 2:4, 3], full[5, 0, 0, 2:4, 3])
+
+            with self.assertRaises(IndexError):
+                view[51, 0, 0, 0, 0]
+            with self.assertRaises(IndexError):
+                view[0, 0, 0, 20, 0]
+
+    def test_compensated_index(self):
+        """Test the cumulative spectrum can be computed from the lazy compensation"""
+        data = numpy.random.randint(0, 1000, size=(51, 1, 1, 20, 30)).astype(numpy.uint16)
+        wld = 433e-9 + numpy.array(range(data.shape[0])) * 0.1e-9
+        spec = model.DataArray(data, metadata={model.MD_WL_LIST: wld})
+
+        dcalib = numpy.array([1, 1.3, 2, 3.5], dtype=numpy.float)
+        dcalib.shape = (dcalib.shape[0], 1, 1, 1, 1)
+        wl_calib = 430e-9 + numpy.array(range(dcalib.shape[0])) * 3e-9
+        calib = model.DataArray(dcalib, metadata={model.MD_WL_LIST: wl_calib})
+
+        full = calibration.compensate_spectrum_efficiency(spec, coef=calib)
+        view = calibration.CompensatedSpectrum(spec, coef=calib)
+        index = spectrum.CumulativeSpectrum(view, chunk_length=7)
+        numpy.testing.assert_allclose(index.mean(3, 40), full[3:41].mean(axis=0))
+        numpy.testing.assert_allclose(index.mean_spectrum(),
+                                      full.reshape(full.shape[0], -1).mean(axis=1))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1208,6 +1208,63 @@ class SPARCTestCase(unittest.TestCase):
         numpy.testing.assert_allclose(spec_md[model.MD_PIXEL_SIZE], exp_pxs)
 
 
+    def test_acq_spec_batch(self):
+        """
+        Test acquisition for Spectrometer, with the spots scanned by batch or
+        one at a time
+        """
+        sems = stream.SEMStream("test sem", self.sed, self.sed.data, self.ebeam)
+        specs = stream.SpectrumSettingsStream("test spec", self.spec, self.spec.data, self.ebeam)
+        sps = stream.SEMSpectrumMDStream("test sem-spec", [sems, specs])
+
+        specs.roi.value = (0.15, 0.6, 0.8, 0.8)
+        self.spec.exposureTime.value = 0.01  # s
+        specs.repetition.value = (12, 5)
+        exp_pos, exp_pxs, exp_res = self._roiToPhys(specs)
+
+        # Record the position of each spot, as received by each stream
+        spot_pos = {}
+        orig_on_completed_data = sps._onCompletedData
+
+        def on_completed_data(n, raw_das):
+            spot_pos[n] = [d.metadata[model.MD_POS] for d in raw_das]
+            orig_on_completed_data(n, raw_das)
+
+        sps._onCompletedData = on_completed_data
+
+        raws = []
+        all_spot_pos = []
+        for batch in (True, False):
+            sps.BATCH_ACQUISITION = batch
+            spot_pos.clear()
+            timeout = 1 + 2.5 * sps.estimateAcquisitionTime()
+            start = time.time()
+            f = sps.acquire()
+            data = f.result(timeout)
+            logging.debug("Acquisition with batch = %s took %g s", batch, time.time() - start)
+            self.assertEqual(len(data), 2)
+
+            sem_da, sp_da = data
+            self.assertEqual(sem_da.shape, exp_res[::-1])
+            self.assertEqual(sp_da.shape[-2:], exp_res[::-1])
+            sem_md = sem_da.metadata
+            spec_md = sp_da.metadata
+            numpy.testing.assert_allclose(sem_md[model.MD_POS], spec_md[model.MD_POS])
+            numpy.testing.assert_allclose(spec_md[model.MD_POS], exp_pos)
+            numpy.testing.assert_allclose(spec_md[model.MD_PIXEL_SIZE], exp_pxs)
+            raws.append(data)
+            self.assertEqual(len(spot_pos[0]), numpy.prod(exp_res))
+            self.assertEqual(len(spot_pos[1]), numpy.prod(exp_res))
+            all_spot_pos.append(spot_pos.copy())
+
+        # Same spectra, and the spots at the same positions, whichever way they are scanned
+        self.assertEqual(raws[0][1].shape, raws[1][1].shape)
+        numpy.testing.assert_array_equal(raws[0][1], raws[1][1])
+        # Spots only differ at most by rounding to the e-beam pixels
+        epxs = self.ebeam.pixelSize.value
+        for n in (0, 1):
+            numpy.testing.assert_allclose(all_spot_pos[0][n], all_spot_pos[1][n], atol=epxs[0])
+
 #     @skip("simple")
     def test_acq_fuz(self):
         """
@@ -3405,6 +3462,61 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         self.assertFalse(im2d1 is im2dc)
 
+    def test_ar_prefetch(self):
+        """Test StaticARStream converts in advance the positions around"""
+        md = {model.MD_SW_VERSION: "1.0-test",
+             model.MD_HW_NAME: "fake ccd",
+             model.MD_DESCRIPTION: "AR",
+             model.MD_ACQ_DATE: time.time(),
+             model.MD_BPP: 12,
+             model.MD_BINNING: (1, 1), # px, px
+             model.MD_SENSOR_PIXEL_SIZE: (13e-6, 13e-6), # m/px
+             model.MD_PIXEL_SIZE: (4e-5, 4e-5), # m/px
+             model.MD_EXP_TIME: 1.2, # s
+             model.MD_AR_POLE: (126.5, 32.5),
+             model.MD_LENS_MAG: 0.4, # ratio
+            }
+
+        # 3 x 3 AR positions
+        data = []
+        for i in range(9):
+            mdi = dict(md)
+            mdi[model.MD_POS] = (1.2e-3 + (i % 3) * 1e-6, -30e-3 + (i // 3) * 1e-6)
+            data.append(model.DataArray(1500 + i + numpy.zeros((256, 512), dtype=numpy.uint16), mdi))
+
+        ars = stream.StaticARStream("test", data)
+
+        # wait a bit for the image to update
+        e = threading.Event()
+        def on_im(im):
+            if im is not None:
+                e.set()
+        ars.image.subscribe(on_im)
+        e.wait(30)
+
+        # All the other positions should be (soon) cached
+        for i in range(30):
+            if len(ars._polar) == len(data):
+                break
+            time.sleep(1)
+        else:
+            self.fail("Only %d positions converted" % (len(ars._polar),))
+
+        # Selecting another position uses the cached projection
+        p = (data[4].metadata[model.MD_POS] + (None,))
+        polard = ars._polar.get(p)
+        self.assertIs(ars._project2Polar(p), polard)
+
+        # The cache is bounded in memory
+        ars._polar.max_size = polard.nbytes * 3
+        self.assertLessEqual(len(ars._polar), 3)
+
+        # Changing the background invalidates the cache
+        e.clear()
+        ars.background.value = model.DataArray(numpy.ones((256, 512), dtype=numpy.uint16), md)
+        e.wait(30)
+        self.assertIsNot(ars._project2Polar(p), polard)
+
     def test_ar_das(self):
         """Test StaticARStream with a DataArrayShadow"""
         logging.info("setting up stream")
@@ -3644,6 +3756,16 @@ class StaticStreamsTestCase(unittest.TestCase):
         im2d = proj_spatial.image.value
         self.assertEqual(im2d.shape, spec.shape[-2:] + (3,))
 
+        # Narrow bands at the end of the spectrum (1 and 2 px) are also fine
+        wl = spectrum.get_wavelength_per_pixel(spec)
+        for low in (wl[-1], wl[-2]):
+            prev_im = proj_spatial.image.value
+            specs.spectrumBandwidth.value = (low, wl[-1])
+            time.sleep(0.5)  # wait a bit for the image to update
+            im2d = proj_spatial.image.value
+            self.assertIsNot(im2d, prev_im)
+            self.assertEqual(im2d.shape, spec.shape[-2:] + (3,))
+
     def test_spec_0d(self):
         """Test StaticSpectrumStream 0D"""
         spec = self._create_spec_data()
@@ -4007,6 +4129,13 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         tiff.DataArrayShadowPyramidalTIFF._getTileOldSP = tiff.DataArrayShadowPyramidalTIFF.getTile
         tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        # get the old function back to the class, even if the test fails
+        self.addCleanup(setattr, tiff.DataArrayShadowPyramidalTIFF, "getTile",
+                        tiff.DataArrayShadowPyramidalTIFF._getTileOldSP)
+        # Only count the tiles needed for display
+        self.addCleanup(setattr, stream.RGBSpatialProjection, "PREFETCH_TILES",
+                        stream.RGBSpatialProjection.PREFETCH_TILES)
+        stream.RGBSpatialProjection.PREFETCH_TILES = False
 
         POS = (5.0, 7.0)
         size = (3000, 2000, 3)
@@ -4052,11 +4181,11 @@ class StaticStreamsTestCase(unittest.TestCase):
         self.assertEqual(len(pj.image.value), 3)
         self.assertEqual(len(pj.image.value[0]), 4)
 
-        # half image (right side), only the center tiles will are cached
+        # half image (right side), all the tiles are still in the cache
         pj.rect.value = (POS[0], POS[1] + 0.001, POS[0] + 0.0015, POS[1] - 0.001)
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        self.assertEqual(40, len(read_tiles))
+        self.assertEqual(28, len(read_tiles))
         self.assertEqual(len(pj.image.value), 4)
         self.assertEqual(len(pj.image.value[0]), 4)
 
@@ -4065,7 +4194,7 @@ class StaticStreamsTestCase(unittest.TestCase):
         
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        self.assertEqual(40, len(read_tiles))
+        self.assertEqual(28, len(read_tiles))
         self.assertEqual(len(pj.image.value), 1)
         self.assertEqual(len(pj.image.value[0]), 1)
 
@@ -4075,9 +4204,6 @@ class StaticStreamsTestCase(unittest.TestCase):
             # Wait a little bit to make sure the image has been generated
             time.sleep(0.5)
 
-        # get the old function back to the class
-        tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSP
-
     def test_rgb_tiled_stream_zoom(self):
         read_tiles = []
         def getTileMock(self, x, y, zoom):
@@ -4087,6 +4213,13 @@ class StaticStreamsTestCase(unittest.TestCase):
 
         tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ = tiff.DataArrayShadowPyramidalTIFF.getTile
         tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+        # get the old function back to the class, even if the test fails
+        self.addCleanup(setattr, tiff.DataArrayShadowPyramidalTIFF, "getTile",
+                        tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ)
+        # Only count the tiles needed for display
+        self.addCleanup(setattr, stream.RGBSpatialProjection, "PREFETCH_TILES",
+                        stream.RGBSpatialProjection.PREFETCH_TILES)
+        stream.RGBSpatialProjection.PREFETCH_TILES = False
 
         POS = (5.0, 7.0)
         dtype = numpy.uint8
@@ -4187,21 +4320,24 @@ class StaticStreamsTestCase(unittest.TestCase):
         # ensures the first tiles read will not be at the wrong zoom level.
         # However, we do the opposite here, to check it doesn't go too wrong
         # (ie, first load the entire image at min mpp, and then load again at
-        # max mpp). It should at worse have loaded one tile at the min mpp.
+        # max mpp). It should at worse have loaded one tile per loading thread
+        # at the min mpp.
         pj.rect.value = full_image_rect # full image
         # time.sleep(0.0001) # uncomment to test with slight delay between VA changes
         pj.mpp.value = pj.mpp.range[1]  # maximum zoom level
 
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
-        # Only 2 tiles read from disk. It means that the loop inside _updateImage,
-        # triggered by the change on .rect was immediately stopped when .mpp changed
-        if len(read_tiles) == 8:
-            logging.warning("Two tiles read while expected to have just one, but "
+        # No tile read from disk, as the tiles at max mpp are still in the cache.
+        # It means that the loop inside _updateImage, triggered by the change
+        # on .rect was immediately stopped when .mpp changed
+        extra_reads = len(read_tiles) - 5
+        if extra_reads > 0:
+            logging.warning("%d tiles read while expected to have none, but "
                             "this is acceptable as updateImage thread might have "
-                            "gone very fast.")
-        else:
-            self.assertEqual(7, len(read_tiles))
+                            "gone very fast.", extra_reads)
+        self.assertLessEqual(extra_reads, stream.TILE_LOADING_THREADS)
+        self.assertGreaterEqual(extra_reads, 0)
         self.assertEqual(len(pj.image.value), 2)
         self.assertEqual(len(pj.image.value[0]), 1)
 
@@ -4249,8 +4385,13 @@ class StaticStreamsTestCase(unittest.TestCase):
         # Wait a little bit to make sure the image has been generated
         time.sleep(0.5)
 
-        # reads 4 tiles from the disk, no tile is cached becase the zoom changed
-        self.assertEqual(10, len(read_tiles))
+        # reads 3 tiles from the disk, the center tile was already read at zoom 0
+        # (and maybe some more tiles, when the wrong zoom level was loaded)
+        if extra_reads > 0:
+            self.assertGreaterEqual(len(read_tiles), 9 - extra_reads)
+            self.assertLessEqual(len(read_tiles), 9)
+        else:
+            self.assertEqual(9, len(read_tiles))
         self.assertEqual(len(pj.image.value), 2)
         self.assertEqual(len(pj.image.value[0]), 2)
         # top-left pixel of the top-left tile
@@ -4262,8 +4403,113 @@ class StaticStreamsTestCase(unittest.TestCase):
         # bottom pixel of top-left tile
         numpy.testing.assert_array_equal([130, 130, 0], pj.image.value[0][0][255, 255, :])
 
-        # get the old function back to the class
-        tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSZ
+    def test_rgb_tiled_stream_prefetch(self):
+        """
+        Check the tiles around the visible ones are loaded in advance
+        """
+        read_tiles = set()
+        def getTileMock(self, x, y, zoom):
+            read_tiles.add((x, y, zoom))
+            return tiff.DataArrayShadowPyramidalTIFF._getTileOldSF(self, x, y, zoom)
+
+        tiff.DataArrayShadowPyramidalTIFF._getTileOldSF = tiff.DataArrayShadowPyramidalTIFF.getTile
+        tiff.DataArrayShadowPyramidalTIFF.getTile = getTileMock
+
+        POS = (5.0, 7.0)
+        md = {
+            model.MD_POS: POS,
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        }
+        arr = numpy.random.randint(0, 4000, (2000, 3000)).astype(numpy.uint16)
+        data = model.DataArray(arr, metadata=md)
+        tiff.export(FILENAME, data, pyramid=True)
+
+        try:
+            acd = tiff.open_data(FILENAME)
+            ss = stream.StaticSEMStream("test", acd.content[0])
+            pj = stream.RGBSpatialProjection(ss)
+            time.sleep(0.5)
+
+            # Tiny rect in the center, at zoom level 1 => only tile (2, 1) visible
+            pj.mpp.value = 2e-6
+            pj.rect.value = (POS[0] + 1e-5, POS[1] - 1e-5, POS[0] + 2e-5, POS[1] - 2e-5)
+            time.sleep(1)
+            self.assertEqual(len(pj.image.value), 1)
+            self.assertEqual(len(pj.image.value[0]), 1)
+            self.assertIn((2, 1, 1), read_tiles)
+            # The ring around it
+            for x, y in ((1, 0), (3, 2), (1, 2), (3, 0)):
+                self.assertIn((x, y, 1), read_tiles)
+            # The coarser and finer zoom levels
+            self.assertIn((1, 0, 2), read_tiles)
+            for x, y in ((4, 2), (5, 3)):
+                self.assertIn((x, y, 0), read_tiles)
+
+            # Panning to the next tile needs no new read
+            pj.PREFETCH_TILES = False
+            nread = len(read_tiles)
+            pj.rect.value = (POS[0] + 4e-4, POS[1] - 1e-5, POS[0] + 4.1e-4, POS[1] - 2e-5)
+            time.sleep(0.5)
+            self.assertEqual(len(read_tiles), nread)
+            self.assertEqual(len(pj.image.value), 1)
+            tile = acd.content[0].getTile(3, 1, 1)
+            self.assertEqual(pj.image.value[0][0].metadata[model.MD_POS],
+                             tile.metadata[model.MD_POS])
+        finally:
+            tiff.DataArrayShadowPyramidalTIFF.getTile = tiff.DataArrayShadowPyramidalTIFF._getTileOldSF
+
+    def test_rgb_tiled_stream_cache(self):
+        """
+        Check the tile cache respects its memory budget, and the projected tiles
+        are recomputed when the tint changes.
+        """
+        POS = (5.0, 7.0)
+        md = {
+            model.MD_POS: POS,
+            model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+        }
+        arr = numpy.random.randint(0, 4000, (2000, 3000)).astype(numpy.uint16)
+        data = model.DataArray(arr, metadata=md)
+        tiff.export(FILENAME, data, pyramid=True)
+
+        tile_cache = stream.tile_cache
+        prev_raw_size = tile_cache.raw.max_size
+        prev_proj_size = tile_cache.projected.max_size
+        tile_cache.clear()
+        # Only room for 10 tiles in each tier (256x256 px, 2 or 3 bytes per px)
+        tile_cache.setMaxSizes(10 * 256 * 256 * 2, 10 * 256 * 256 * 3)
+        try:
+            acd = tiff.open_data(FILENAME)
+            ss = stream.StaticSEMStream("test", acd.content[0])
+            pj = stream.RGBSpatialProjection(ss)
+            time.sleep(0.5)
+
+            # Full image at full resolution => 12x8 tiles, more than the cache
+            pj.mpp.value = pj.mpp.range[0]
+            pj.rect.value = (POS[0] - 0.0015, POS[1] + 0.001, POS[0] + 0.0015, POS[1] - 0.001)
+            time.sleep(2)
+            self.assertEqual(len(pj.image.value), 12)
+            self.assertEqual(len(pj.image.value[0]), 8)
+            stats = tile_cache.getStatistics()
+            self.assertLessEqual(stats["raw"]["size"], stats["raw"]["max_size"])
+            self.assertLessEqual(stats["projected"]["size"], stats["projected"]["max_size"])
+            self.assertLessEqual(stats["raw"]["count"], 10)
+
+            # Small area => in the cache
+            pj.rect.value = (POS[0] + 0.0014, POS[1] - 0.0009, POS[0] + 0.0015, POS[1] - 0.001)
+            time.sleep(0.5)
+            self.assertEqual(len(pj.image.value), 1)
+            raw_misses = tile_cache.raw.misses
+            proj_misses = tile_cache.projected.misses
+
+            # Changing the tint only needs to project again the tiles
+            ss.tint.value = (255, 0, 0)
+            time.sleep(0.5)
+            self.assertEqual(tile_cache.raw.misses, raw_misses)
+            self.assertGreater(tile_cache.projected.misses, proj_misses)
+            numpy.testing.assert_array_equal(pj.image.value[0][0][..., 1], 0)
+        finally:
+            tile_cache.setMaxSizes(prev_raw_size, prev_proj_size)
 
     def test_rgb_updatable_stream(self):
         """Test RGBUpdatableStream """
@@ -4308,5 +4554,68 @@ class StaticStreamsTestCase(unittest.TestCase):
         self.assertRaises(ValueError, strUpd.update, new_da)
 
 
+class MDStreamAssemblyTestCase(unittest.TestCase):
+    """
+    Tests the assembly of the data of the MDStreams, without hardware
+    """
+
+    def _store_all(self, mds, n, data_list, rep):
+        mds._acq_data = [[] for _ in range(n + 1)]
+        mds._acq_cubes = [None] * (n + 1)
+        for i, d in enumerate(data_list):
+            mds._acq_data[n].append(d)
+            mds._storeData(n, i, rep)
+        return mds._acq_data[n]
+
+    def test_spec_cube(self):
+        """
+        The preallocated spectrum cube is identical to the assembled one
+        """
+        # Only the assembly methods are used, so no need for real streams
+        mds = stream.SEMSpectrumMDStream.__new__(stream.SEMSpectrumMDStream)
+        mds._ccd_idx = 1
+        rep = (7, 5)
+        data_list = [model.DataArray(numpy.random.randint(0, 1000, (1, 64)).astype(numpy.uint16),
+                                     {model.MD_EXP_TIME: 0.1})
+                     for _ in range(numpy.prod(rep))]
+        exp = mds._assembleSpecData([d.copy() for d in data_list], rep)
+        self.assertEqual(exp.shape, (64, 1, 1, 5, 7))
+
+        for memmap_size in (None, 0):
+            mds.MEMMAP_MIN_SIZE = memmap_size
+            stored = self._store_all(mds, 1, data_list, rep)
+            numpy.testing.assert_array_equal(stored[-1], data_list[-1])
+            cube = mds._acq_cubes[1]
+            self.assertIsNotNone(cube)
+            if memmap_size == 0:
+                self.assertIsInstance(cube, numpy.memmap)
+            spec = mds._assembleSpecData(stored, rep, cube)
+            numpy.testing.assert_array_equal(spec, exp)
+            self.assertEqual(spec.metadata[model.MD_EXP_TIME], 0.1)
+
+            # Without the cube, the views are assembled the same way
+            spec = mds._assembleSpecData(stored, rep)
+            numpy.testing.assert_array_equal(spec, exp)
+
+    def test_temp_spec_cube(self):
+        """
+        The preallocated temporal spectrum cube has the data at the right place
+        """
+        mds = stream.SEMTemporalSpectrumMDStream.__new__(stream.SEMTemporalSpectrumMDStream)
+        mds._ccd_idx = 1
+        rep = (4, 3)
+        data_list = [model.DataArray(numpy.random.randint(0, 1000, (16, 32)).astype(numpy.uint16))
+                     for _ in range(numpy.prod(rep))]
+        stored = self._store_all(mds, 1, data_list, rep)
+        tsd = mds._assembleTempSpecData(stored, rep, mds._acq_cubes[1])
+        self.assertEqual(tsd.shape, (32, 16, 1, 3, 4))
+        for i, d in enumerate(data_list):
+            y, x = divmod(i, rep[0])
+            numpy.testing.assert_array_equal(tsd[:, :, 0, y, x], d.T)
+
+        tsd_list = mds._assembleTempSpecData([d.copy() for d in data_list], rep)
+        numpy.testing.assert_array_equal(tsd_list, tsd)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -177,6 +177,29 @@ def list_components(pretty=True):
 
     print_component_tree(microscope, pretty=pretty)
 
+def list_startup_times(pretty=True):
+    """
+    Print when each component was instantiated by the back-end, relative to the
+      first component, and how long it took.
+    pretty (bool): if True, display with pretty-printing
+    """
+    try:
+        microscope = model.getMicroscope()
+    except Exception:
+        raise IOError("Failed to contact the back-end")
+
+    times = microscope.startupTimes.value
+    if not times:
+        return
+    t0 = min(s for s, e in times.values())
+    if pretty:
+        print(u"%-32s %10s %10s" % (u"component", u"start (s)", u"duration (s)"))
+    for n, (s, e) in sorted(times.items(), key=lambda i: i[1]):
+        if pretty:
+            print(u"%-32s %10.3f %10.3f" % (n, s - t0, e - s))
+        else:
+            print(u"%s\tstart:%f\tduration:%f" % (n, s - t0, e - s))
+
 def print_axes(name, value, pretty):
     if pretty:
         print(u"\t%s (RO Attribute)" % (name,))
@@ -808,6 +831,8 @@ def main(args):
                          "a specific hardware to scan can be specified.")
     dm_grpe.add_argument("--list", "-l", dest="list", action="store_true", default=False,
                          help="list the components of the microscope")
+    dm_grpe.add_argument("--startup-times", dest="startuptimes", action="store_true", default=False,
+                         help="list when each component was started by the back-end, and how long it took")
     dm_grpe.add_argument("--list-prop", "-L", dest="listprop", metavar="<component>",
                          help="list the properties of a component. Use '*' to list all the components.")
     dm_grpe.add_argument("--set-attr", "-s", dest="setattr", nargs="+", action='append',
@@ -878,7 +903,7 @@ def main(args):
 
     # anything to do?
     if not any((options.check, options.kill, options.scan,
-        options.list, options.stop, options.move,
+        options.list, options.startuptimes, options.stop, options.move,
         options.position, options.reference,
         options.listprop, options.setattr, options.upmd,
         options.acquire, options.live)):
@@ -925,6 +950,8 @@ def main(args):
             kill_backend()
         elif options.list:
             list_components(pretty=not options.machine)
+        elif options.startuptimes:
+            list_startup_times(pretty=not options.machine)
         elif options.listprop is not None:
             list_properties(options.listprop, pretty=not options.machine)
         elif options.setattr is not None:
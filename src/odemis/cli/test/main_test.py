@@ -162,6 +162,22 @@ class TestWithBackend(unittest.TestCase):
         self.assertTrue("Light Engine" in output)
         self.assertTrue("Camera" in output)
 
+    def test_startup_times(self):
+        try:
+            # change the stdout
+            out = StringIO.StringIO()
+            sys.stdout = out
+
+            cmdline = "cli --startup-times"
+            ret = main.main(cmdline.split())
+        except SystemExit as exc:
+            ret = exc.code
+        self.assertEqual(ret, 0, "trying to run '%s'" % cmdline)
+
+        output = out.getvalue()
+        self.assertTrue("Light Engine" in output)
+        self.assertTrue("Camera" in output)
+
     def test_check(self):
         try:
             cmdline = "cli --check"
@@ -24,10 +24,14 @@ from __future__ import division
 import collections
 import h5py
 import logging
+import math
 import numpy
 from odemis import model
+from odemis.model import DataArrayShadow, AcquisitionData
 from odemis.util import spectrum, img, fluo
+from odemis.util.conversion import get_tile_md_pos
 import os
+import threading
 import time
 
 
@@ -36,7 +40,11 @@ FORMAT = "HDF5"
 # list of file-name extensions possible, the first one is the default when saving a file
 EXTENSIONS = [u".h5", u".hdf5"]
 LOSSY = False
-CAN_SAVE_PYRAMID = False
+CAN_SAVE_PYRAMID = True
+TILE_SIZE = 256  # Tile size of the reduced resolution levels
+# Size (in bytes) aimed for each chunk of the datasets. It's the size of the
+# default chunk cache of HDF5, so that a chunk being accessed stays in memory.
+CHUNK_SIZE = 1024 * 1024
 
 # We are trying to follow the same format as SVI, as defined here:
 # http://www.svi.nl/HDF5
@@ -51,6 +59,8 @@ CAN_SAVE_PYRAMID = False
 #       + Image (HDF5 Image with Dimension Scales CTZXY)
 #       + DimensionScale*
 #       + *Offset (position on the axis)
+#       + Pyramid (our extension, optional, to contain reduced resolution images)
+#         + Zoom* (1, 2...: same shape as Image, but with XY divided by 2**zoom)
 #     + PhysicalData
 #     + SVIData (Not necessary for us)
 
@@ -131,9 +141,17 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     group (HDF group): the group that will contain the dataset
     dataset_name (string): name of the dataset
     image (numpy.ndimage): the image to create. It should have at least 2 dimensions
+    kwargs: passed to create_dataset(). If chunks is not specified, a chunk
+      shape adapted to the dimensions of the image is used.
     returns the new dataset
     """
     assert(len(image.shape) >= 2)
+    if "chunks" not in kwargs:
+        if hasattr(image, "metadata"):
+            dims = image.metadata.get(model.MD_DIMS, "CTZYX"[-image.ndim::])
+        else:
+            dims = "CTZYX"[-image.ndim::]
+        kwargs["chunks"] = _get_chunk_shape(image.shape, image.dtype, dims)
     image_dataset = group.create_dataset(dataset_name, data=image, **kwargs)
 
     # numpy.string_ is to force fixed-length string (necessary for compatibility)
@@ -161,11 +179,50 @@ def _create_image_dataset(group, dataset_name, image, **kwargs):
     return image_dataset
 
 
-def _read_image_dataset(dataset):
+def _get_chunk_shape(shape, dtype, dims):
+    """
+    Compute the shape of the chunks of a dataset, so that both typical accesses
+    are fast: all the data at one pixel (eg, the spectrum), and one XY plane
+    (eg, the image at one wavelength).
+    shape (tuple of int): shape of the whole dataset
+    dtype (numpy.dtype): type of the data
+    dims (str): name of each dimension (eg, "CTZYX")
+    returns (tuple of int): the shape of one chunk
     """
-    Get a numpy array from a dataset respecting the HDF5 image specification.
-    returns (numpy.ndimage): it has at least 2 dimensions and if RGB, it has
-     a 3 dimensions and the metadata MD_DIMS indicates the order.
+    nitems = max(1, CHUNK_SIZE // numpy.dtype(dtype).itemsize)
+    total = numpy.prod(shape)
+    if len(dims) != len(shape):
+        dims = "CTZYX"[-len(shape)::]
+    if total <= nitems or "X" not in dims or "Y" not in dims:
+        return tuple(shape)
+
+    chunk = [1] * len(shape)
+    sdims = [dims.index("X"), dims.index("Y")]
+    hdims = [i for i, s in enumerate(shape) if i not in sdims and s > 1]
+    if not hdims:
+        # Just an image => tiles, the same size as the pyramid tiles
+        for i in sdims:
+            chunk[i] = min(shape[i], TILE_SIZE)
+        return tuple(chunk)
+
+    # If a chunk covers a fraction f of the high dimensions and a fraction f
+    # of the XY plane, then reading the data at one pixel or reading one plane
+    # both read f of the whole data. Pick f so that a chunk fits CHUNK_SIZE.
+    f = math.sqrt(nitems / total)
+    for idims in (hdims, sdims):
+        fd = f ** (1 / len(idims))
+        for i in idims:
+            chunk[i] = min(max(1, int(shape[i] * fd)), shape[i])
+
+    return tuple(chunk)
+
+
+def _check_image_dataset(dataset):
+    """
+    Check that a dataset respects the HDF5 image specification, without reading
+    the data.
+    returns (dict): the metadata which can be deduced from the image format (ie,
+     if RGB, MD_DIMS indicates the order of the 3 dimensions).
     raises
      IOError: if it doesn't conform to the standard
      NotImplementedError: if the image uses so fancy standard features
@@ -180,7 +237,7 @@ def _read_image_dataset(dataset):
     # conversion is almost entirely different depending on subclass
     subclass = dataset.attrs.get("IMAGE_SUBCLASS", "IMAGE_GRAYSCALE")
 
-    image = model.DataArray(dataset[...])
+    md = {}
     if subclass == "IMAGE_GRAYSCALE":
         pass
     elif subclass == "IMAGE_TRUECOLOR":
@@ -199,9 +256,9 @@ def _read_image_dataset(dataset):
 
         if il_mode == "INTERLACE_PLANE":
             # colour is first dim
-            image.metadata[model.MD_DIMS] = "CYX"
+            md[model.MD_DIMS] = "CYX"
         elif il_mode == "INTERLACE_PIXEL":
-            image.metadata[model.MD_DIMS] = "YXC"
+            md[model.MD_DIMS] = "YXC"
         else:
             raise NotImplementedError("Unable to handle images of subclass '%s'" % subclass)
 
@@ -213,7 +270,7 @@ def _read_image_dataset(dataset):
     if dorig != "UL":
         logging.warning("Image rotation %d not handled", dorig)
 
-    return image
+    return md
 
 
 def _add_image_info(group, dataset, image):
@@ -610,13 +667,17 @@ def _read_image_info(group):
     return md
 
 
-def _parse_physical_data(pdgroup, da):
+def _read_physical_data(pdgroup, shape, md):
     """
-    Parse the metadata found in PhysicalData, and cut the DataArray if necessary.
+    Parse the metadata found in PhysicalData, and find out whether the image
+    must be cut in channels.
     pdgroup (HDF Group): the group "PhysicalData" associated to an image
-    da (DataArray): the DataArray that was obtained by reading the ImageData
-    returns (list of DataArrays): The same data, but broken into smaller 
-      DataArrays if necessary, and with additional metadata.
+    shape (tuple of int): the shape of the image in ImageData
+    md (dict): the metadata already known about the image. If the image is not
+      cut, it's updated with the additional metadata.
+    returns (list of (None or int, dict)): for each (sub-)image, the index in the
+      first dimension (C) of the image, or None if it's the whole image, and
+      its metadata.
     """
     # The information in PhysicalData might be different for each channel (e.g.
     # fluorescence image). In this case, the DA must be separated into smaller
@@ -632,18 +693,16 @@ def _parse_physical_data(pdgroup, da):
 
     if n > 1:
         # need to separate it
-        if n != da.shape[0]:
+        if n != shape[0]:
             logging.warning("Image has %d channels and %d metadata, failed to map",
-                            da.shape[0], n)
-            das = [da]
+                            shape[0], n)
+            chans = [(None, md)]
         else:
-            # list(da) does almost what we need, but metadata is shared
-            das = [model.DataArray(c, da.metadata.copy()) for c in da]
+            chans = [(c, md.copy()) for c in range(n)]
     else:
-        das = [da]
+        chans = [(None, md)]
 
-    for i, d in enumerate(das):
-        md = d.metadata
+    for i, (c, md) in enumerate(chans):
         try:
             cd = pdgroup["ChannelDescription"][i]
             md[model.MD_DESCRIPTION] = cd.decode("utf-8", "replace")
@@ -690,7 +749,7 @@ def _parse_physical_data(pdgroup, da):
         read_metadata(pdgroup, i, md, "TriggerDelay", model.MD_TRIGGER_DELAY, converter=float)
         read_metadata(pdgroup, i, md, "TriggerRate", model.MD_TRIGGER_RATE, converter=float)
 
-    return das
+    return chans
 
 
 def read_metadata(pdgroup, c_index, md, name, md_key, converter, bad_states=(ST_INVALID,)):
@@ -1109,13 +1168,41 @@ def _add_svi_info(group):
     gi["URL"] = "www.delmic.com"
 
 
-def _add_acquistion_svi(group, data, mds, **kwargs):
+def _add_image_pyramid(group, image, **kwargs):
+    """
+    Adds the reduced resolution images of an image, so that it's possible to
+    quickly display it, or just a part of it.
+    group (HDF Group): the group that contains the image (named "ImageData")
+    image (DataArray of shape CTZYX): the image. Each channel is reduced
+      independently, so T and Z must be of length 1.
+    kwargs: passed to create_dataset()
+    """
+    assert image.ndim == 5 and image.shape[1:3] == (1, 1)
+    gp = group.create_group("Pyramid")
+
+    # Each level is computed from the previous one
+    planes = [numpy.asarray(p) for p in image[:, 0, 0]]
+    shape = image.shape
+    z = 0
+    while shape[-1] >= TILE_SIZE and shape[-2] >= TILE_SIZE:
+        z += 1
+        shape = image.shape[:-2] + (image.shape[-2] // 2 ** z, image.shape[-1] // 2 ** z)
+        planes = [img.rescale_hq(p, shape[-2:]) for p in planes]
+        level = numpy.array(planes).reshape(shape)
+        chunks = (1, 1, 1, min(shape[-2], TILE_SIZE), min(shape[-1], TILE_SIZE))
+        gp.create_dataset("Zoom%d" % (z,), data=level, chunks=chunks, **kwargs)
+
+
+def _add_acquistion_svi(group, data, mds, pyramid=False, **kwargs):
     """
     Adds the acquisition data according to the sub-format by SVI
     group (HDF Group): the group that will contain the metadata (named "PhysicalData")
     data (DataArray): image with (global) metadata, all the images must
       have the same shape.
     mds (None or list of dict): metadata for each C of the image (if different) 
+    pyramid (boolean): whether to also store reduced resolution images. It's
+      only possible on (each channel of) a 2D image. Otherwise, it's skipped.
+    kwargs: passed to create_dataset()
     """
     gi = group.create_group("ImageData")
 
@@ -1126,6 +1213,14 @@ def _add_acquistion_svi(group, data, mds, **kwargs):
     # TODO: use scaleoffset to store the number of bits used (MD_BPP)
     ids = _create_image_dataset(gi, "Image", data, **kwargs)
     _add_image_info(gi, ids, data)
+    if pyramid:
+        # Channels are only read separately if they have separate metadata
+        if (data.ndim == 5 and data.shape[1:3] == (1, 1) and
+            (data.shape[0] == 1 or mds is not None)):
+            _add_image_pyramid(gi, data, **kwargs)
+        else:
+            logging.info("Not saving reduced resolution images for data of shape %s",
+                         data.shape)
     _add_image_metadata(group, data, mds)
     _add_svi_info(group)
 
@@ -1296,115 +1391,290 @@ def _updateRGBMD(da):
     da.metadata[model.MD_DIMS] = dims
 
 
-def _thumbFromHDF5(filename):
+class DataArrayShadowHDF5(DataArrayShadow):
     """
-    Read thumbnails from an HDF5 file.
-    Expects to find them as IMAGE in Preview/Image.
-    return (list of model.DataArray)
+    This class implements the read of an image in an HDF5 file. The data is
+    only read from the file when requested, entirely or just a part of it.
     """
-    f = h5py.File(filename, "r")
 
-    thumbs = []
-    # look for the Preview directory
-    try:
-        grp = f["Preview"]
-    except KeyError:
-        # no thumbnail
-        return thumbs
-
-    # scan for images
-    for name, ds in grp.items():
-        # an image? (== has the attribute CLASS: IMAGE)
-        if isinstance(ds, h5py.Dataset) and ds.attrs.get("CLASS") == "IMAGE":
-            try:
-                da = _read_image_dataset(ds)
-            except Exception:
-                logging.info("Skipping image '%s' which couldn't be read.", name)
-                continue
+    def __init__(self, dataset, index, shape, dtype, metadata=None, lock=None):
+        """
+        Constructor
+        dataset (h5py.Dataset): the dataset containing the image
+        index (tuple of int): index of the image in the first dimensions of the
+          dataset (eg, a channel). Empty if the image is the whole dataset.
+        shape (tuple of int): The shape of the corresponding DataArray
+        dtype (numpy.dtype): The data type
+        metadata (dict str->val): The metadata
+        lock (threading.Lock): The lock that controls the access to the HDF5 file
+        """
+        self._dataset = dataset
+        self._index = index
+        self._lock = lock or threading.Lock()
+
+        DataArrayShadow.__init__(self, shape, dtype, metadata)
+
+    def getData(self):
+        """
+        Fetches the whole data (at full resolution) of image.
+        return DataArray: the data, with its metadata
+        """
+        return self[...]
+
+    def __getitem__(self, key):
+        """
+        Fetches only a part of the data (aka hyperslab), selected in the same
+        way as with a numpy array. Only the part needed is read from the file,
+        if the selection consists of integers, (forward) slices and Ellipsis.
+        key (int, slice, Ellipsis or tuple of them): the selection
+        return DataArray: the selected data, with a copy of the metadata
+        """
+        if isinstance(key, list) and any(isinstance(k, slice) or k is Ellipsis for k in key):
+            # Old numpy convention, still used in some places
+            key = tuple(key)
+        elif not isinstance(key, tuple):
+            key = (key,)
 
-            if name == "Image":
-                try:
-                    da.metadata = _read_image_info(grp)
-                except Exception:
-                    logging.debug("Failed to parse metadata of acquisition '%s'", name)
-                    continue
+        try:
+            with self._lock:
+                data = self._dataset[self._index + key]
+        except (TypeError, ValueError):
+            # h5py doesn't support all the selections of numpy (eg, reverse order)
+            logging.debug("Reading all the data to select %s", key)
+            with self._lock:
+                data = self._dataset[self._index + (Ellipsis,)]
+            data = data[key]
 
-            thumbs.append(da)
+        return model.DataArray(data, self.metadata.copy())
 
-    return thumbs
 
+class DataArrayShadowPyramidalHDF5(DataArrayShadowHDF5):
+    """
+    This class implements the read of an image in an HDF5 file which also has
+    reduced resolution images. IOW, the image can also be read tile by tile.
+    The image has the same shape as the dataset (eg, CTZYX), but the tiles are
+    only 2D (YX).
+    """
 
-def _dataFromSVIHDF5(f):
+    def __init__(self, dataset, levels, index, shape, dtype, metadata=None, lock=None):
+        """
+        Constructor
+        dataset (h5py.Dataset): the dataset containing the image
+        levels (list of h5py.Dataset): the reduced resolution images, for
+          each zoom level > 0
+        index (tuple of int): index of the image in the first dimensions of the
+          dataset. Empty if the image is the whole dataset.
+        shape (tuple of int): The shape of the corresponding DataArray. All
+          the dimensions except the last two (YX) must be of length 1.
+        dtype (numpy.dtype): The data type
+        metadata (dict str->val): The metadata
+        lock (threading.Lock): The lock that controls the access to the HDF5 file
+        """
+        if len(shape) < 2 or any(s != 1 for s in shape[:-2]):
+            raise ValueError("Tiled images must be 2D, but got shape %s" % (shape,))
+        DataArrayShadowHDF5.__init__(self, dataset, index, shape, dtype, metadata, lock)
+        self._levels = [dataset] + list(levels)
+        # Index of the 2D image (YX) in the dataset, as read for the tiles
+        self._tile_index = index + (0,) * (len(shape) - 2)
+
+        self.maxzoom = len(levels)
+        self.tile_shape = (TILE_SIZE, TILE_SIZE)
+
+    def getTile(self, x, y, zoom):
+        '''
+        Fetches one tile
+        x (0<=int): X index of the tile.
+        y (0<=int): Y index of the tile
+        zoom (0<=int): zoom level to use. The total shape of the image is shape / 2**zoom.
+            The number of tiles available in an image is ceil((shape//zoom)/tile_shape)
+        return (DataArray): the shape of the DataArray is typically of shape
+        '''
+        if not 0 <= zoom <= self.maxzoom:
+            raise ValueError("Invalid Z value %d" % (zoom,))
+
+        tw, th = self.tile_shape
+        key = self._tile_index + (slice(y * th, (y + 1) * th), slice(x * tw, (x + 1) * tw))
+        with self._lock:
+            tile = self._levels[zoom][key]
+
+        tile = model.DataArray(tile, self.metadata.copy())
+        tile.metadata.pop(model.MD_DIMS, None)  # Tiles are always YX
+        orig_pixel_size = self.metadata.get(model.MD_PIXEL_SIZE, (1, 1))
+        # calculate the pixel size of the tile for the zoom level
+        tile.metadata[model.MD_PIXEL_SIZE] = tuple(ps * 2 ** zoom for ps in orig_pixel_size)
+        # calculate the center of the tile
+        tile.metadata[model.MD_POS] = get_tile_md_pos((x, y), self.tile_shape, tile, self)
+        return tile
+
+
+class AcquisitionDataHDF5(AcquisitionData):
     """
-    Read microscopy data from an HDF5 file using the SVI convention.
-    Expects to find them as IMAGE in XXX/ImageData/Image + XXX/PhysicalData.
-    f (h5py.File): the root of the file
-    return (list of model.DataArray)
+    Implements AcquisitionData for HDF5 files
     """
-    data = []
+    def __init__(self, filename):
+        """
+        Constructor
+        filename (string): The name of the HDF5 file
+        """
+        # lock to avoid race conditions when accessing the HDF5 file, as h5py
+        # doesn't support concurrent accesses.
+        self._lock = threading.Lock()
+        self._file = h5py.File(filename, "r")
+
+        # if follows SVI convention => use the special function
+        # If it has at least one directory like XXX/SVIData => it follows SVI conventions
+        for obj in self._file.values():
+            if (isinstance(obj, h5py.Group) and
+                isinstance(obj.get("SVIData"), h5py.Group)):
+                data = self._getSVIDataArrayShadows()
+                break
+        else:
+            data = self._getAllDataArrayShadows()
+        thumbnails = self._getThumbnailShadows()
 
-    for obj in f.values():
-        # find all the expected and interesting objects
-        try:
-            svidata = obj["SVIData"]
-            imagedata = obj["ImageData"]
-            image = imagedata["Image"]
-            physicaldata = obj["PhysicalData"]
-        except KeyError:
-            continue  # not conforming => try next object
+        AcquisitionData.__init__(self, tuple(data), tuple(thumbnails))
 
-        # Read the raw data
-        try:
-            da = _read_image_dataset(image)
-        except Exception:
-            logging.exception("Failed to read data of acquisition '%s'", obj.name)
+    def _getSVIDataArrayShadows(self):
+        """
+        Create the DataArrayShadows for the data using the SVI convention.
+        Expects to find them as IMAGE in XXX/ImageData/Image + XXX/PhysicalData.
+        return (list of DataArrayShadows)
+        """
+        data = []
 
-        # TODO: read more metadata
-        try:
-            da.metadata.update(_read_image_info(imagedata))
-        except Exception:
-            logging.exception("Failed to parse metadata of acquisition '%s'", obj.name)
+        for obj in self._file.values():
+            # find all the expected and interesting objects
+            try:
+                svidata = obj["SVIData"]
+                imagedata = obj["ImageData"]
+                image = imagedata["Image"]
+                physicaldata = obj["PhysicalData"]
+            except KeyError:
+                continue  # not conforming => try next object
 
-        das = _parse_physical_data(physicaldata, da)
-        data.extend(das)
-    return data
+            try:
+                md = _check_image_dataset(image)
+            except Exception:
+                logging.exception("Failed to read data of acquisition '%s'", obj.name)
+                continue
 
+            # TODO: read more metadata
+            try:
+                md.update(_read_image_info(imagedata))
+            except Exception:
+                logging.exception("Failed to parse metadata of acquisition '%s'", obj.name)
+
+            levels = self._getPyramidLevels(imagedata)
+            for c, cmd in _read_physical_data(physicaldata, image.shape, md):
+                index = () if c is None else (c,)
+                data.append(self._createDataArrayShadow(image, index, cmd, levels))
+
+        return data
+
+    def _createDataArrayShadow(self, dataset, index, md, levels):
+        """
+        Create the DataArrayShadow of an image
+        dataset (h5py.Dataset): the dataset containing the image
+        index (tuple of int): index of the image in the first dimensions of the
+          dataset. Empty if the image is the whole dataset.
+        md (dict str->val): The metadata
+        levels (list of h5py.Dataset): the reduced resolution images (can be empty)
+        return (DataArrayShadowHDF5)
+        """
+        shape = dataset.shape[len(index):]
+        if levels and len(shape) >= 2 and all(s == 1 for s in shape[:-2]):
+            # Like for the pyramidal TIFF, only 2D images are accessed by tile
+            return DataArrayShadowPyramidalHDF5(dataset, levels, index, shape,
+                                                dataset.dtype, md, self._lock)
+
+        return DataArrayShadowHDF5(dataset, index, shape, dataset.dtype, md, self._lock)
+
+    @staticmethod
+    def _getPyramidLevels(imagedata):
+        """
+        Find the reduced resolution images of an image
+        imagedata (HDF Group): the group "ImageData" which contains the image
+        return (list of h5py.Dataset): the images for each zoom level > 0.
+          It's empty if the image has no reduced resolution images.
+        """
+        try:
+            pyramid = imagedata["Pyramid"]
+        except KeyError:
+            return []
+
+        levels = []
+        while "Zoom%d" % (len(levels) + 1,) in pyramid:
+            levels.append(pyramid["Zoom%d" % (len(levels) + 1,)])
+        return levels
+
+    def _getAllDataArrayShadows(self):
+        """
+        Create the DataArrayShadows for any dataset which could be data.
+        return (list of DataArrayShadows)
+        """
+        data = []
+
+        # go rough: return any dataset with numbers (and more than one element)
+        def addIfWorthy(name, obj):
+            try:
+                if not isinstance(obj, h5py.Dataset):
+                    return
+                if not obj.dtype.kind in "biufc":
+                    return
+                if numpy.prod(obj.shape) <= 1:
+                    return
+                # TODO: if it's an image, open it as an image
+                # TODO: try to get some metadata?
+                das = DataArrayShadowHDF5(obj, (), obj.shape, obj.dtype, {}, self._lock)
+            except Exception:
+                logging.info("Skipping '%s' as it doesn't seem a correct data", name)
+                return
+            data.append(das)
+
+        self._file.visititems(addIfWorthy)
+        return data
+
+    def _getThumbnailShadows(self):
+        """
+        Create the DataArrayShadows of the thumbnails.
+        Expects to find them as IMAGE in Preview/Image.
+        return (list of DataArrayShadows)
+        """
+        thumbs = []
+        # look for the Preview directory
+        try:
+            grp = self._file["Preview"]
+        except KeyError:
+            # no thumbnail
+            return thumbs
 
-def _dataFromHDF5(filename):
-    """
-    Read microscopy data from an HDF5 file.
-    filename (string): path of the file to read
-    return (list of model.DataArray)
-    """
-    f = h5py.File(filename, "r")
+        # scan for images
+        for name, ds in grp.items():
+            # an image? (== has the attribute CLASS: IMAGE)
+            if isinstance(ds, h5py.Dataset) and ds.attrs.get("CLASS") == "IMAGE":
+                try:
+                    md = _check_image_dataset(ds)
+                except Exception:
+                    logging.info("Skipping image '%s' which couldn't be read.", name)
+                    continue
 
-    # if follows SVI convention => use the special function
-    # If it has at least one directory like XXX/SVIData => it follows SVI conventions
-    for obj in f.values():
-        if (isinstance(obj, h5py.Group) and
-            isinstance(obj.get("SVIData"), h5py.Group)):
-            return _dataFromSVIHDF5(f)
+                if name == "Image":
+                    try:
+                        md.update(_read_image_info(grp))
+                    except Exception:
+                        logging.debug("Failed to parse metadata of acquisition '%s'", name)
+                        continue
 
-    data = []
-    # go rough: return any dataset with numbers (and more than one element)
+                thumbs.append(DataArrayShadowHDF5(ds, (), ds.shape, ds.dtype, md, self._lock))
 
-    def addIfWorthy(name, obj):
-        try:
-            if not isinstance(obj, h5py.Dataset):
-                return
-            if not obj.dtype.kind in "biufc":
-                return
-            if numpy.prod(obj.shape) <= 1:
-                return
-            # TODO: if it's an image, open it as an image
-            # TODO: try to get some metadata?
-            da = model.DataArray(obj[...])
-        except Exception:
-            logging.info("Skipping '%s' as it doesn't seem a correct data", name)
-        data.append(da)
+        return thumbs
 
-    f.visititems(addIfWorthy)
-    return data
+    def close(self):
+        """
+        Close the file. Afterwards, the data and thumbnails cannot be read anymore.
+        """
+        with self._lock:
+            self._file.close()
 
 
 def _mergeCorrectionMetadata(da):
@@ -1419,7 +1689,7 @@ def _mergeCorrectionMetadata(da):
     return model.DataArray(da, md) # create a view
 
 
-def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
+def _saveAsHDF5(filename, ldata, thumbnail, compressed=True, pyramid=False):
     """
     Saves a list of DataArray as a HDF5 (SVI) file.
     filename (string): name of the file to save
@@ -1427,6 +1697,7 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
      Should have at least one array.
     thumbnail (None or DataArray): see export
     compressed (boolean): whether the file is compressed or not.
+    pyramid (boolean): whether to also save reduced resolution images.
     """
     # h5py will extend the current file by default, so we want to make sure
     # there is no file at all.
@@ -1457,14 +1728,14 @@ def _saveAsHDF5(filename, ldata, thumbnail, compressed=True):
     acq, mds = _groupImages(ldata)
     for i, da in enumerate(acq):
         ga = f.create_group("Acquisition%d" % i)
-        _add_acquistion_svi(ga, da, mds[i], compression=compression)
+        _add_acquistion_svi(ga, da, mds[i], pyramid=pyramid, compression=compression)
 
     f.close()
 
 
 # TODO: allow to append data to a file, or any other way to allow saving large
 # data without having everything in memory simultaneously.
-def export(filename, data, thumbnail=None):
+def export(filename, data, thumbnail=None, pyramid=False):
     '''
     Write an HDF5 file with the given image and metadata
     filename (unicode): filename of the file to create (including path)
@@ -1478,13 +1749,15 @@ def export(filename, data, thumbnail=None):
       (reasonable) size. Must be either 2D array (greyscale) or 3D with last 
       dimension of length 3 (RGB). If the exporter doesn't support it, it will
       be dropped silently.
+    pyramid (boolean): whether to also save reduced resolution images of the
+      2D data (only used when the file is opened with open_data()).
     '''
     # TODO: add an argument to not do any clever data aggregation?
     if not isinstance(data, (list, tuple)):
         # TODO should probably not enforce it: respect duck typing
         assert(isinstance(data, model.DataArray))
         data = [data]
-    _saveAsHDF5(filename, data, thumbnail)
+    _saveAsHDF5(filename, data, thumbnail, pyramid=pyramid)
 
 
 def read_data(filename):
@@ -1504,7 +1777,11 @@ def read_data(filename):
     # to do it without looking at the .filename attribute)
     # see http://pytables.github.io/cookbook/inmemory_hdf5_files.html
 
-    return _dataFromHDF5(filename)
+    acd = open_data(filename)
+    try:
+        return [acd.content[n].getData() for n in range(len(acd.content))]
+    finally:
+        acd.close()
 
 
 def read_thumbnail(filename):
@@ -1519,5 +1796,19 @@ def read_thumbnail(filename):
     """
     # TODO: support filename to be a File or Stream
 
-    return _thumbFromHDF5(filename)
+    acd = open_data(filename)
+    try:
+        return [acd.thumbnails[n].getData() for n in range(len(acd.thumbnails))]
+    finally:
+        acd.close()
+
+
+def open_data(filename):
+    """
+    Opens an HDF5 file, and return an AcquisitionData instance. The data is only
+    read when requested, so opening even a large file is fast.
+    filename (string): path to the file
+    return (AcquisitionData): an opened file
+    """
+    return AcquisitionDataHDF5(filename)
 
@@ -1257,6 +1257,113 @@ class TestHDF5IO(unittest.TestCase):
         self.assertEqual(im.shape, tshape)
         self.assertEqual(im[0, 0].tolist(), [0, 255, 0])
 
+    def testOpenData(self):
+        """
+        Check the data is read lazily, and only partly if requested
+        """
+        dtype = numpy.uint16
+        shape = (128, 1, 1, 100, 200)  # CTZYX
+        md = {model.MD_DESCRIPTION: "spectrum",
+              model.MD_ACQ_DATE: time.time(),
+              model.MD_PIXEL_SIZE: (1e-6, 2e-6),  # m/px
+              model.MD_WL_LIST: (400e-9 + numpy.arange(shape[0]) * 1e-9).tolist(),
+              model.MD_POS: (1e-3, -30e-3),  # m
+              }
+        data = model.DataArray(numpy.random.randint(0, 4096, shape).astype(dtype), md)
+        hdf5.export(FILENAME, data)
+
+        # The chunks should balance the access to a spectrum and to a plane
+        f = h5py.File(FILENAME, "r")
+        chunks = f["Acquisition0/ImageData/Image"].chunks
+        f.close()
+        self.assertLessEqual(numpy.prod(chunks) * data.itemsize, 1.1 * hdf5.CHUNK_SIZE)
+        self.assertGreater(chunks[0], 1)
+        self.assertGreater(chunks[3] * chunks[4], 1)
+
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), 1)
+        das = acd.content[0]
+        self.assertIsInstance(das, model.DataArrayShadow)
+        self.assertFalse(hasattr(das, "maxzoom"))
+        self.assertEqual(das.shape, shape)
+        self.assertEqual(das.dtype, dtype)
+        self.assertEqual(das.metadata[model.MD_POS], md[model.MD_POS])
+        self.assertEqual(das.metadata[model.MD_WL_LIST], md[model.MD_WL_LIST])
+
+        # Spectrum of one pixel
+        spec = das[:, 0, 0, 12, 30]
+        self.assertEqual(spec.shape, (shape[0],))
+        numpy.testing.assert_array_equal(spec, data[:, 0, 0, 12, 30])
+        self.assertEqual(spec.metadata[model.MD_POS], md[model.MD_POS])
+
+        # One plane, and a selection not supported by HDF5
+        numpy.testing.assert_array_equal(das[10, 0, 0], data[10, 0, 0])
+        numpy.testing.assert_array_equal(das[10, 0, 0, ::-1], data[10, 0, 0, ::-1])
+
+        rdata = das.getData()
+        numpy.testing.assert_array_equal(rdata, data)
+        self.assertEqual(rdata.metadata[model.MD_DESCRIPTION], md[model.MD_DESCRIPTION])
+
+        # Once closed, the file can be deleted (on every OS)
+        acd.close()
+        os.remove(FILENAME)
+        self.assertFalse(os.path.exists(FILENAME))
+
+    def testOpenDataPyramid(self):
+        """
+        Check the reduced resolution images are saved and can be read by tile
+        """
+        size = (1000, 800)  # X, Y
+        dtype = numpy.uint16
+        md = {model.MD_PIXEL_SIZE: (1e-6, 1e-6),  # m/px
+              model.MD_POS: (1e-3, -30e-3),  # m
+              }
+        data = model.DataArray(numpy.zeros(size[::-1], dtype), md)
+        data[:, 500:] = 1000  # right half is bright
+        spec = model.DataArray(numpy.ones((10, 1, 1, 80, 100), dtype),
+                               {model.MD_PIXEL_SIZE: (1e-6, 1e-6),
+                                model.MD_WL_LIST: (400e-9 + numpy.arange(10) * 1e-9).tolist()})
+        hdf5.export(FILENAME, [data, spec], pyramid=True)
+
+        acd = hdf5.open_data(FILENAME)
+        self.assertEqual(len(acd.content), 2)
+        das = acd.content[0]
+        # Same shape as the non-pyramidal data, but the tiles are 2D
+        self.assertEqual(das.shape, (1, 1, 1) + size[::-1])
+        self.assertEqual(das.maxzoom, 2)
+        self.assertEqual(das.tile_shape, (256, 256))
+
+        tile = das.getTile(0, 0, 0)
+        self.assertEqual(tile.shape, (256, 256))
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (1e-6, 1e-6))
+
+        # Last zoom level fits in a single tile
+        tile = das.getTile(0, 0, 2)
+        self.assertEqual(tile.shape, (size[1] // 4, size[0] // 4))
+        self.assertEqual(tile.metadata[model.MD_PIXEL_SIZE], (4e-6, 4e-6))
+        self.assertEqual(tile[0, 0], 0)
+        self.assertEqual(tile[0, -1], 1000)
+        numpy.testing.assert_almost_equal(tile.metadata[model.MD_POS], md[model.MD_POS])
+
+        with self.assertRaises(ValueError):
+            das.getTile(0, 0, 3)
+
+        rdata = das.getData()
+        self.assertEqual(rdata.shape, das.shape)
+        numpy.testing.assert_array_equal(rdata[0, 0, 0], data)
+
+        # The spectrum cannot be read by tile
+        self.assertFalse(hasattr(acd.content[1], "maxzoom"))
+        self.assertEqual(acd.content[1].shape, spec.shape)
+        acd.close()
+
+        # read_data() returns the same shape, with or without the pyramid
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(rdata[0].shape, das.shape)
+        hdf5.export(FILENAME, [data, spec])
+        rdata = hdf5.read_data(FILENAME)
+        self.assertEqual(rdata[0].shape, das.shape)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -33,9 +33,10 @@ from odemis.dataio import tiff
 from odemis.util import img
 import os
 import re
+import threading
 import time
 import unittest
-from unittest.case import skip
+from unittest.case import skip, skipIf
 
 import libtiff.libtiff_ctypes as T # for the constant names
 import xml.etree.ElementTree as ET
@@ -44,6 +45,41 @@ import xml.etree.ElementTree as ET
 logging.getLogger().setLevel(logging.DEBUG)
 
 FILENAME = u"test" + tiff.EXTENSIONS[0]
+
+# Export TEST_BENCHMARK = 1 to also run the (long and memory hungry) benchmarks
+TEST_BENCHMARK = (os.environ.get("TEST_BENCHMARK", 0) != 0)  # Default to not run them
+
+
+class RSSMonitor(object):
+    """
+    Measures the peak memory (RSS) used by the process, from its creation
+    until stop() is called, by polling regularly.
+    """
+
+    def __init__(self, period=0.01):
+        self._period = period
+        self._stop = threading.Event()
+        self._start = self._get_rss()
+        self.peak = 0  # bytes more than at init
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _get_rss():
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    def _run(self):
+        while not self._stop.wait(self._period):
+            self.peak = max(self.peak, self._get_rss() - self._start)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._get_rss() - self._start)
+
+
 class TestTiffIO(unittest.TestCase):
 
     def tearDown(self):
@@ -1799,6 +1835,69 @@ class TestTiffIO(unittest.TestCase):
         self.assertEqual(subimage[-1][0], 9893)
         self.assertEqual(subimage[-1][-1], 10148)
 
+    def testExportPyramidParallel(self):
+        """
+        Checks that the file is identical whether the tiles are compressed in
+        parallel or by libtiff
+        """
+        size = (1000, 1100)
+        arr = numpy.random.randint(0, 200, size).astype(numpy.uint16)
+        arr += numpy.arange(size[1], dtype=numpy.uint16)  # smooth, to compress a bit
+        data = model.DataArray(arr)
+
+        threads = tiff.ENCODING_THREADS
+        fn_serial = u"test-serial" + tiff.EXTENSIONS[0]
+        try:
+            tiff.ENCODING_THREADS = 1
+            tiff.export(fn_serial, data, pyramid=True)
+            tiff.ENCODING_THREADS = 4
+            tiff.export(FILENAME, data, pyramid=True)
+
+            with open(fn_serial, "rb") as f:
+                content_serial = f.read()
+            with open(FILENAME, "rb") as f:
+                content = f.read()
+            self.assertEqual(len(content), len(content_serial))
+            self.assertTrue(content == content_serial)
+        finally:
+            tiff.ENCODING_THREADS = threads
+            os.remove(fn_serial)
+
+        rdata = tiff.open_data(FILENAME)
+        self.assertEqual(rdata.content[0].maxzoom, 2)
+        numpy.testing.assert_array_equal(rdata.content[0].getData(), arr)
+
+    @skipIf(not TEST_BENCHMARK, "Benchmark not requested")
+    def testExportPyramidBenchmark(self):
+        """
+        Measures the time and the peak memory usage to export large 16-bit mosaics
+        """
+        for size in ((4096, 4096), (12000, 12000)):
+            # Smooth image with noise, similar to a stitched SEM image.
+            # Generated by blocks of rows, to avoid big temporary arrays.
+            arr = numpy.empty(size, dtype=numpy.uint16)
+            ramp = numpy.linspace(0, 4000, size[1]).astype(numpy.uint16)
+            for y in range(0, size[0], 1024):
+                block = arr[y:y + 1024]
+                block[...] = numpy.random.randint(0, 1000, block.shape, dtype=numpy.uint16)
+                block += ramp
+            data = model.DataArray(arr, {model.MD_PIXEL_SIZE: (1e-6, 1e-6)})
+
+            for nthreads in (1, tiff.ENCODING_THREADS):
+                threads = tiff.ENCODING_THREADS
+                tiff.ENCODING_THREADS = nthreads
+                monitor = RSSMonitor()
+                try:
+                    tstart = time.time()
+                    tiff.export(FILENAME, data, pyramid=True)
+                    dur = time.time() - tstart
+                finally:
+                    tiff.ENCODING_THREADS = threads
+                    monitor.stop()
+                logging.info("Exported %dx%d px with %d threads in %g s, peak RSS +%d MB",
+                             size[1], size[0], nthreads, dur, monitor.peak / 2 ** 20)
+                os.remove(FILENAME)
+
     def testExportThinPyramid(self):           
         """
         Checks that can both write and read back a thin pyramidal grayscale 16 bit image
@@ -22,9 +22,12 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import calendar
+from collections import deque
+from concurrent import futures
 from libtiff import TIFF
 import logging
 import math
+import multiprocessing
 import numpy
 from odemis import model, util
 import odemis
@@ -33,6 +36,7 @@ import operator
 import os
 import re
 import sys
+import tempfile
 import time
 import uuid
 import threading
@@ -66,6 +70,9 @@ STIFF_SPLIT = ".0."  # pattern to replace with the "stiff" multiple file
 
 CAN_SAVE_PYRAMID = True # indicates the support for pyramidal export
 TILE_SIZE = 256 # Tile size of pyramidal images
+# Number of threads used to compress the tiles of pyramidal images. If 1, the
+# tiles are compressed directly by libtiff, while writing.
+ENCODING_THREADS = multiprocessing.cpu_count()
 LOSSY = False
 
 # We try to make it as much as possible looking like a normal (multi-page) TIFF,
@@ -1829,16 +1836,261 @@ def write_image(f, arr, compression=None, write_rgb=False, pyramid=False):
         f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
 
     # write the original image
-    f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
-    # generate the rescaled images and write the tiled image
+    _write_tiles(f, arr, compression, write_rgb)
+    # generate the rescaled images and write the tiled image. Each zoom level
+    # is computed from the previous one, which is much faster than from the
+    # original image, and looks the same.
+    subim = arr
     for resized_shape in resized_shapes:
         # rescale the image
-        subim = img.rescale_hq(arr, resized_shape)
+        subim = img.rescale_hq(subim, resized_shape)
 
         # Before writting the actual data, we set the special metadata
         f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
         # write the tiled image to the TIFF file
-        f.write_tiles(subim, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+        _write_tiles(f, subim, compression, write_rgb)
+
+
+def _getTiffCompression(compression):
+    """
+    compression (None or str): compression name, as accepted by pylibtiff (eg, "lzw")
+    return (int): the libtiff compression value
+    """
+    if compression is None:
+        return T.COMPRESSION_NONE
+    return getattr(T, "COMPRESSION_" + compression.upper())
+
+
+def _setTiledImageFields(f, shape, dtype, compression):
+    """
+    Set the tags of a 2D tiled image, for the current directory. It's the same
+    tags as set by pylibtiff's write_tiles().
+    f (libtiff file handle): Handle of a TIFF file
+    shape (int, int): shape of the image
+    dtype (numpy.dtype): type of the data
+    compression (int): libtiff compression value
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind == "f":
+        sample_format = T.SAMPLEFORMAT_IEEEFP
+    elif dtype.kind in "ub":
+        sample_format = T.SAMPLEFORMAT_UINT
+    elif dtype.kind == "i":
+        sample_format = T.SAMPLEFORMAT_INT
+    else:
+        raise NotImplementedError("Cannot write data of type %s" % (dtype,))
+
+    f.SetField(T.TIFFTAG_COMPRESSION, compression)
+    if compression == T.COMPRESSION_LZW and sample_format != T.SAMPLEFORMAT_IEEEFP:
+        f.SetField(T.TIFFTAG_PREDICTOR, T.PREDICTOR_HORIZONTAL)
+    f.SetField(T.TIFFTAG_BITSPERSAMPLE, dtype.itemsize * 8)
+    f.SetField(T.TIFFTAG_SAMPLEFORMAT, sample_format)
+    f.SetField(T.TIFFTAG_ORIENTATION, T.ORIENTATION_TOPLEFT)
+    f.SetField(T.TIFFTAG_TILEWIDTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_TILELENGTH, TILE_SIZE)
+    f.SetField(T.TIFFTAG_IMAGEWIDTH, shape[1])
+    f.SetField(T.TIFFTAG_IMAGELENGTH, shape[0])
+    f.SetField(T.TIFFTAG_PHOTOMETRIC, T.PHOTOMETRIC_MINISBLACK)
+    f.SetField(T.TIFFTAG_PLANARCONFIG, T.PLANARCONFIG_CONTIG)
+
+
+def _encodeTileRow(data, compression):
+    """
+    Compress one row of tiles, exactly as libtiff does when writing them.
+    As a TIFF handle cannot be shared between threads, it's done by writing the
+    tiles into a temporary TIFF file, and reading back the raw (compressed) data.
+    Most of the time is spent in libtiff, without holding the GIL, so it can
+    run in parallel.
+    data (numpy.array of shape <= TILE_SIZE x N): the part of the image
+    compression (int): libtiff compression value
+    return (list of str): the compressed data of each tile of the row
+    """
+    ntx = (data.shape[1] - 1) // TILE_SIZE + 1
+    fd, path = tempfile.mkstemp(suffix=EXTENSIONS[-1])
+    os.close(fd)
+    try:
+        tf = TIFF.open(path, mode='w')
+        _setTiledImageFields(tf, (TILE_SIZE, data.shape[1]), data.dtype, compression)
+        # Same as pylibtiff: tiles on the border are filled with 0
+        tile = numpy.zeros((TILE_SIZE, TILE_SIZE), dtype=data.dtype)
+        for tx in range(ntx):
+            d = data[:, tx * TILE_SIZE:(tx + 1) * TILE_SIZE]
+            tile[:] = 0
+            tile[:d.shape[0], :d.shape[1]] = d
+            tf.WriteTile(tile.ctypes.data, tx * TILE_SIZE, 0, 0, 0)
+        tf.WriteDirectory()
+        tf.close()
+
+        tf = TIFF.open(path, mode='r')
+        # In the worst case, LZW makes the data a little bigger
+        buf = numpy.empty(tile.nbytes * 2 + 1024, dtype=numpy.uint8)
+        encoded = []
+        for tx in range(ntx):
+            n = T.libtiff.TIFFReadRawTile(tf, tx, buf.ctypes.data, buf.size).value
+            if n < 0:
+                raise IOError("Failed to read back compressed tile %d" % (tx,))
+            encoded.append(buf[:n].tostring())
+        tf.close()
+    finally:
+        os.remove(path)
+
+    return encoded
+
+
+def _write_tiles(f, arr, compression=None, write_rgb=False):
+    """
+    Write a tiled image in the current directory (and close it).
+    The tiles are compressed in parallel, and written in the same order as libtiff
+    does, so the file is identical to the one written by pylibtiff's write_tiles().
+    f (libtiff file handle): Handle of a TIFF file
+    arr (DataArray): DataArray to be written to the file
+    compression (None or str): Compression type to be used on the TIFF file
+    write_rgb (boolean): True if the image is RGB, False if the image is grayscale
+    """
+    nty = (arr.shape[0] - 1) // TILE_SIZE + 1
+    if ENCODING_THREADS <= 1 or compression is None or arr.ndim != 2 or nty < 2:
+        # Not worthy (or not supported) => let libtiff do everything
+        f.write_tiles(arr, TILE_SIZE, TILE_SIZE, compression, write_rgb)
+        return
+
+    compression = _getTiffCompression(compression)
+    _setTiledImageFields(f, arr.shape, arr.dtype, compression)
+    ntx = (arr.shape[1] - 1) // TILE_SIZE + 1
+
+    def write_row(ty, fut):
+        for tx, data in enumerate(fut.result()):
+            r = T.libtiff.TIFFWriteRawTile(f, ty * ntx + tx, data, len(data)).value
+            if r < 0:
+                raise IOError("Failed to write tile %d,%d" % (tx, ty))
+
+    executor = futures.ThreadPoolExecutor(max_workers=ENCODING_THREADS)
+    try:
+        # Compress rows in parallel, but write them in order. Only a few rows
+        # are in progress at a time, to limit the memory usage.
+        encoding = deque()
+        for ty in range(nty):
+            row = arr[ty * TILE_SIZE:(ty + 1) * TILE_SIZE]
+            encoding.append((ty, executor.submit(_encodeTileRow, row, compression)))
+            if len(encoding) >= 2 * ENCODING_THREADS:
+                write_row(*encoding.popleft())
+        while encoding:
+            write_row(*encoding.popleft())
+    finally:
+        executor.shutdown(wait=True)
+
+    f.WriteDirectory()
+
+
+class TiledPyramidWriter(object):
+    """
+    Writes a 2D image in the pyramidal format, one tile at a time, without
+    needing the whole image in memory. The tiles of the full resolution image
+    can be written in any order. Each tile is immediately reduced and stored
+    in the first zoom level. The zoom levels are kept in temporary files (next
+    to the final file), and written when the full resolution image is complete,
+    on close().
+    Note: the zoom levels are computed by successive reductions by 2, so they
+    can be slightly different from the ones of export(pyramid=True).
+    """
+
+    def __init__(self, filename, shape, dtype, metadata, compressed=True):
+        """
+        filename (unicode): filename of the file to create (including path)
+        shape (int, int): shape (YX) of the full image
+        dtype (numpy.dtype): type of the data
+        metadata (dict str->val): metadata of the image, as for a DataArray
+        compressed (boolean): whether the file is LZW compressed or not.
+        """
+        self._dtype = numpy.dtype(dtype)
+        # A "fake" DataArray, with the right shape and dtype, but (almost) no
+        # memory, to compute the metadata
+        da = model.DataArray(numpy.lib.stride_tricks.as_strided(numpy.zeros(1, self._dtype),
+                                                                shape, (0,) * len(shape)),
+                             metadata)
+        da = _mergeCorrectionMetadata(da)
+
+        if compressed and self._dtype not in (numpy.int64, numpy.uint64):
+            self._compression = T.COMPRESSION_LZW
+        else:
+            self._compression = T.COMPRESSION_NONE
+
+        filename = _ensure_fs_encoding(filename)
+        self._f = TIFF.open(filename, mode='w')
+        self._f.SetField(T.TIFFTAG_IMAGEDESCRIPTION, _convertToOMEMD([da]))
+        for key, val in _convertToTiffTag(da.metadata).items():
+            try:
+                self._f.SetField(key, val)
+            except Exception:
+                logging.exception("Failed to store tag %s with value '%s'", key, val)
+
+        resized_shapes = _genResizedShapes(da)
+        if resized_shapes:
+            # LibTIFF will automatically write the next N directories as subdirectories
+            # when this tag is present.
+            self._f.SetField(T.TIFFTAG_SUBIFD, [0] * len(resized_shapes))
+        _setTiledImageFields(self._f, shape, self._dtype, self._compression)
+
+        # The zoom levels, stored on disk (same place as the file, as /tmp
+        # might be in memory)
+        tmpdir = os.path.dirname(os.path.abspath(filename))
+        self._levels = []
+        for s in resized_shapes:
+            tmpf = tempfile.TemporaryFile(dir=tmpdir)  # deleted when closed
+            self._levels.append(numpy.memmap(tmpf, dtype=self._dtype, mode="w+", shape=s))
+        self._tile = numpy.zeros((TILE_SIZE, TILE_SIZE), dtype=self._dtype)
+
+    def _writeTile(self, x, y, data, level):
+        """
+        Write one tile in the current directory, and store its reduced version
+        in the next zoom level.
+        x, y (int): tile index
+        data (numpy.array): the data of the tile, at most TILE_SIZE x TILE_SIZE.
+          It's smaller only on the right and bottom borders of the image.
+        level (int): zoom level of the current directory (0 = full resolution)
+        """
+        # libtiff always expects a complete tile
+        self._tile[:] = 0
+        self._tile[:data.shape[0], :data.shape[1]] = data
+        self._f.WriteTile(self._tile.ctypes.data, x * TILE_SIZE, y * TILE_SIZE, 0, 0)
+
+        if level < len(self._levels):
+            # Each pixel of the reduced image is the average of 2x2 pixels, so
+            # the tiles can be reduced independently (as TILE_SIZE is even).
+            hs = data.shape[0] // 2, data.shape[1] // 2
+            if 0 in hs:
+                return
+            sub = img.rescale_hq(data[:hs[0] * 2, :hs[1] * 2], hs)
+            hts = TILE_SIZE // 2
+            self._levels[level][y * hts:y * hts + hs[0], x * hts:x * hts + hs[1]] = sub
+
+    def writeTile(self, x, y, data):
+        """
+        Write one tile of the full resolution image.
+        x, y (int): tile index (ie, position in px // TILE_SIZE)
+        data (numpy.array): the data of the tile. It must be TILE_SIZE x TILE_SIZE,
+          excepted on the right and bottom borders of the image, where it's
+          only the part inside the image.
+        """
+        self._writeTile(x, y, data, 0)
+
+    def close(self):
+        """
+        Write all the zoom levels and close the file. The full resolution image
+        should be complete at that point.
+        """
+        self._f.WriteDirectory()
+
+        for i, lvl in enumerate(self._levels):
+            self._f.SetField(T.TIFFTAG_SUBFILETYPE, T.FILETYPE_REDUCEDIMAGE)
+            _setTiledImageFields(self._f, lvl.shape, self._dtype, self._compression)
+            for y in range(0, lvl.shape[0], TILE_SIZE):
+                for x in range(0, lvl.shape[1], TILE_SIZE):
+                    self._writeTile(x // TILE_SIZE, y // TILE_SIZE,
+                                    lvl[y:y + TILE_SIZE, x:x + TILE_SIZE], i + 1)
+            self._f.WriteDirectory()
+
+        self._levels = []  # Deletes the temporary files
+        self._f.close()
 
 
 def export(filename, data, thumbnail=None, compressed=True, multiple_files=False, pyramid=False):
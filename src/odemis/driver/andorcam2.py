@@ -27,10 +27,12 @@ from ctypes import *
 import ctypes  # for fake AndorV2DLL
 import gc
 import logging
+import math
 import numpy
 from odemis import model, util, dataio
 from odemis.model import HwError, oneway
 from odemis.util import img
+from odemis.util.driver import FrameBufferPool
 import os
 import random
 import threading
@@ -230,6 +232,12 @@ class AndorCapabilities(Structure):
     }
 
 
+# How the frames are passed when acquiring continuously (cf .frameMode)
+FRAME_MODE_LATEST = "latest"  # only the latest frame, the older ones are discarded
+FRAME_MODE_ALL = "all"  # every frame, the circular buffer absorbs slow subscribers
+FRAME_MODE_SUM = "sum"  # the sum of all the frames acquired since the previous one
+
+
 class AndorV2DLL(CDLL):
     """
     Subclass of CDLL specific to andor library, which handles error codes for
@@ -723,6 +731,13 @@ class AndorCam2(model.DigitalCamera):
             self.SetShutter(1, 0, 0, 0)
             self._shutter_period = None
 
+        # When acquiring continuously, by default, only the latest frame is
+        # passed. The other modes pass all the frames acquired, via the
+        # circular buffer of the camera. Changes are taken into account at the
+        # next subscription.
+        self.frameMode = model.StringEnumerated(FRAME_MODE_LATEST,
+                                choices={FRAME_MODE_LATEST, FRAME_MODE_ALL, FRAME_MODE_SUM})
+
         current_temp = self.GetTemperature()
         self.temperature = model.FloatVA(current_temp, unit=u"°C", readonly=True)
         self._metadata[model.MD_SENSOR_TEMP] = current_temp
@@ -733,6 +748,8 @@ class AndorCam2(model.DigitalCamera):
         self.acquisition_lock = threading.Lock()
         self.acquire_must_stop = threading.Event()
         self.acquire_thread = None
+        # Buffers for the frames, recycled once the DataArrays are not used anymore
+        self._buf_pool = FrameBufferPool()
 
         # For temporary stopping the acquisition (kludge for the andorshrk
         # SR303i which cannot communicate during acquisition)
@@ -1136,6 +1153,41 @@ class AndorCam2(model.DigitalCamera):
             timeout_ms = c_uint(int(round(timeout * 1e3))) # ms
             self.atcore.WaitForAcquisitionTimeOut(timeout_ms)
 
+    def GetSizeOfCircularBuffer(self):
+        """
+        returns (int): maximum number of images the circular buffer can store
+        """
+        size = c_int32()
+        self.atcore.GetSizeOfCircularBuffer(byref(size))
+        return size.value
+
+    def GetNumberAvailableImages(self):
+        """
+        returns (int, int): index of the first and last images available in the
+          circular buffer. The index of the first image of the acquisition is 1.
+        raises AndorV2Error 20024 (DRV_NO_NEW_DATA) if there is no image
+        """
+        first, last = c_int32(), c_int32()
+        self.atcore.GetNumberAvailableImages(byref(first), byref(last))
+        return first.value, last.value
+
+    def GetImages16(self, first, last, buf, length):
+        """
+        Copies a series of images from the circular buffer. The images are placed
+        one after another at the beginning of the buffer.
+        first (int): index of the first image to copy
+        last (int): index of the last image to copy
+        buf (ctypes array or pointer of uint16): destination buffer
+        length (int): number of pixels which fit in the buffer
+        returns (int, int): index of the first and last images actually copied.
+          It can be different from the requested images if they have been
+          overwritten in the meantime.
+        """
+        validfirst, validlast = c_int32(), c_int32()
+        self.atcore.GetImages16(c_int32(first), c_int32(last), buf, c_uint32(length),
+                                byref(validfirst), byref(validlast))
+        return validfirst.value, validlast.value
+
     def _getReadoutRates(self):
         """
         returns (set of float): all available readout rates, in Hz
@@ -1837,21 +1889,19 @@ class AndorCam2(model.DigitalCamera):
 
     def _allocate_buffer(self, size):
         """
-        returns a cbuffer of the right size for an image
+        returns a cbuffer of the right size for an image, from the buffer pool
         """
-        cbuffer = (c_uint16 * (size[0] * size[1]))() # empty array
-        return cbuffer
+        return self._buf_pool.get(c_uint16, size[0] * size[1])
 
     def _buffer_as_array(self, cbuffer, size, metadata=None):
         """
         Converts the buffer allocated for the image as an ndarray. zero-copy
+        The buffer goes back to the pool when the array is not used anymore.
         size (2-tuple of int): width, height
         return an ndarray
         """
-        p = cast(cbuffer, POINTER(c_uint16))
-        ndbuffer = numpy.ctypeslib.as_array(p, (size[1], size[0])) # numpy shape is H, W
-        dataarray = model.DataArray(ndbuffer, metadata)
-        return dataarray
+        # numpy shape is H, W
+        return self._buf_pool.as_array(cbuffer, (size[1], size[0]), metadata)
 
     def acquireOne(self):
         """
@@ -1903,18 +1953,106 @@ class AndorCam2(model.DigitalCamera):
         assert(self.GetStatus() == AndorV2DLL.DRV_IDLE) # Just to be sure
 
         # Set up thread
+        frame_mode = self.frameMode.value
+        args = (callback,)
         if self.data._sync_event:
             # need synchronized acquisition
             self._late_events.clear()
             target = self._acquire_thread_synchronized
-        else:
+        elif frame_mode == FRAME_MODE_LATEST:
             # no event (now, and hopefully not during the acquisition)
             target = self._acquire_thread_continuous
+        else:
+            # every frame is needed
+            target = self._acquire_thread_kinetic
+            args = (callback, frame_mode)
         self.acquire_thread = threading.Thread(target=target,
                 name="andorcam acquire flow thread",
-                args=(callback,))
+                args=args)
         self.acquire_thread.start()
 
+    def _abort_acquisition(self, has_hw_lock=False):
+        """
+        Stop the acquisition, if it is running, so that the settings can be
+        updated. To be called from the acquisition thread.
+        has_hw_lock (bool): True if the acquisition thread holds the hw_lock.
+          If so, it's released once the acquisition is stopped.
+        return (bool): True if the hw_lock is still held
+        """
+        try:
+            if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
+                self.atcore.AbortAcquisition()
+                if has_hw_lock:
+                    self.hw_lock.release()
+                    has_hw_lock = False
+                time.sleep(0.1)
+        except AndorV2Error as (errno, strerr):
+            # it was already aborted
+            if errno != 20073: # DRV_IDLE
+                self.acquisition_lock.release()
+                self.acquire_must_stop.clear()
+                raise
+        return has_hw_lock
+
+    def _setup_acquisition(self, mode):
+        """
+        Configure the camera for the next acquisition, with the latest settings.
+        The acquisition must be stopped.
+        mode (AndorV2DLL.AM_*): acquisition mode
+        return (int, int): the size of the image (X, Y)
+        """
+        self.atcore.SetAcquisitionMode(mode)
+        # Seems exposure needs to be re-set after setting acquisition mode
+        self._prev_settings[1] = None # 1 => exposure time
+        return self._update_settings()
+
+    def _recover_acquisition(self, strerr):
+        """
+        Get ready to acquire again after an error while acquiring an image.
+        If the camera seems to have disappeared, it's reinitialised.
+        The acquisition must be set up again afterwards.
+        strerr (str): the error message
+        """
+        try:
+            self.atcore.CancelWait()
+            if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
+                self.atcore.AbortAcquisition()  # Need to stop acquisition to read temperature
+            temp = self.GetTemperature()
+        except AndorV2Error:
+            temp = None
+        # -999°C means the camera is gone
+        if temp == -999:
+            logging.error("Camera seems to have disappeared, will try to reinitialise it")
+            self.Reinitialize()
+        else:
+            time.sleep(0.1)
+            logging.warning("trying again to acquire image after error %s", strerr)
+
+    def _end_acquisition(self, has_hw_lock=False):
+        """
+        Stop the acquisition and release the resources, at the end of the
+        acquisition thread.
+        has_hw_lock (bool): True if the acquisition thread holds the hw_lock
+        """
+        try:
+            if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
+                self.atcore.AbortAcquisition()
+        except AndorV2Error as (errno, strerr):
+            # it was already aborted
+            if errno != 20073: # DRV_IDLE
+                self.acquisition_lock.release()
+                logging.debug("Acquisition thread closed after giving up")
+                self.acquire_must_stop.clear()
+                raise
+        if has_hw_lock:
+            self.hw_lock.release()
+        self.atcore.FreeInternalMemory() # TODO not sure it's needed
+        self.acquisition_lock.release()
+        gc.collect()
+        # TODO: close the shutter if it was opened?
+        logging.debug("Acquisition thread closed")
+        self.acquire_must_stop.clear()
+
     # TODO: try to simplify this thread, by having it always running, and sending
     # commands to start/stop (+pause=hw_request) the acquisition.
     def _acquire_thread_continuous(self, callback):
@@ -1931,25 +2069,10 @@ class AndorCam2(model.DigitalCamera):
                     need_reinit = True # ensure we'll release the hw_lock a bit
                 # need to stop acquisition to update settings
                 if need_reinit or self._need_update_settings():
-                    try:
-                        if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
-                            self.atcore.AbortAcquisition()
-                            if has_hw_lock:
-                                self.hw_lock.release()
-                                has_hw_lock = False
-                            time.sleep(0.1)
-                    except AndorV2Error as (errno, strerr):
-                        # it was already aborted
-                        if errno != 20073: # DRV_IDLE
-                            self.acquisition_lock.release()
-                            self.acquire_must_stop.clear()
-                            raise
-                    # We don't use the kinetic mode as it might go faster than we can
-                    # process them.
-                    self.atcore.SetAcquisitionMode(AndorV2DLL.AM_VIDEO)
-                    # Seems exposure needs to be re-set after setting acquisition mode
-                    self._prev_settings[1] = None # 1 => exposure time
-                    size = self._update_settings()
+                    has_hw_lock = self._abort_acquisition(has_hw_lock)
+                    # We don't read all the images as it might go faster than we can
+                    # process them (cf _acquire_thread_kinetic() for this).
+                    size = self._setup_acquisition(AndorV2DLL.AM_VIDEO)
                     if not has_hw_lock:
                         self.hw_lock.acquire()
                         has_hw_lock = True
@@ -2000,20 +2123,7 @@ class AndorCam2(model.DigitalCamera):
                         raise
                     # This sometimes happen with 20024 (DRV_NO_NEW_DATA) or
                     # 20067 (DRV_P2INVALID) on GetMostRecentImage16()
-                    try:
-                        self.atcore.CancelWait()
-                        if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
-                            self.atcore.AbortAcquisition()  # Need to stop acquisition to read temperature
-                        temp = self.GetTemperature()
-                    except AndorV2Error:
-                        temp = None
-                    # -999°C means the camera is gone
-                    if temp == -999:
-                        logging.error("Camera seems to have disappeared, will try to reinitialise it")
-                        self.Reinitialize()
-                    else:
-                        time.sleep(0.1)
-                        logging.warning("trying again to acquire image after error %s", strerr)
+                    self._recover_acquisition(strerr)
                     need_reinit = True
                     continue
                 else:
@@ -2032,26 +2142,172 @@ class AndorCam2(model.DigitalCamera):
         except Exception:
             logging.exception("Failure during acquisition")
         finally:
-            # ending cleanly
-            try:
-                if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
-                    self.atcore.AbortAcquisition()
-            except AndorV2Error as (errno, strerr):
-                # it was already aborted
-                if errno != 20073: # DRV_IDLE
-                    self.acquisition_lock.release()
-                    logging.debug("Acquisition thread closed after giving up")
-                    self.acquire_must_stop.clear()
-                    raise
-            if has_hw_lock:
-                self.hw_lock.release()
-                has_hw_lock = False
-            self.atcore.FreeInternalMemory() # TODO not sure it's needed
-            self.acquisition_lock.release()
-            gc.collect()
-            # TODO: close the shutter if it was opened?
-            logging.debug("Acquisition thread closed")
-            self.acquire_must_stop.clear()
+            self._end_acquisition(has_hw_lock)
+
+    def _acquire_thread_kinetic(self, callback, frame_mode):
+        """
+        The core of the acquisition thread. Runs until acquire_must_stop is set.
+        Version which keeps acquiring images as frequently as possible, and
+        passes all of them. The images are read from the circular buffer of the
+        camera, so that short delays in the processing don't cause any loss.
+        If the processing is too slow, the oldest images are summed in one frame
+        before the circular buffer gets full. With FRAME_MODE_SUM, all the images
+        available are always summed. The images lost anyway (eg, too
+        long delay) are reported in the MD_DROPPED_FRAMES metadata of the next
+        frame.
+        frame_mode (FRAME_MODE_*): how the frames are passed, for the whole
+          acquisition
+        """
+        summed = (frame_mode == FRAME_MODE_SUM)
+        has_hw_lock = False # status of the lock
+        need_reinit = True
+        failures = 0
+        dropped = 0  # number of images lost since the last frame passed
+        try:
+            while not self.acquire_must_stop.is_set():
+                if self.request_hw:
+                    need_reinit = True # ensure we'll release the hw_lock a bit
+                # need to stop acquisition to update settings
+                if need_reinit or self._need_update_settings():
+                    has_hw_lock = self._abort_acquisition(has_hw_lock)
+                    # Run till abort: all the images are stored in the circular buffer
+                    size = self._setup_acquisition(AndorV2DLL.AM_VIDEO)
+                    if not has_hw_lock:
+                        self.hw_lock.acquire()
+                        has_hw_lock = True
+                    self.atcore.StartAcquisition()
+                    tstart = time.time()  # approximately the start of the first image
+
+                    exposure, accumulate, kinetic = self.GetAcquisitionTimings()
+                    logging.debug("Accumulate time = %f, kinetic = %f", accumulate, kinetic)
+                    readout = size[0] * size[1] * self._metadata[model.MD_READOUT_TIME] # s
+                    # a new image starts every kinetic cycle => play safe
+                    period = max(kinetic, accumulate, exposure + readout)
+                    # Keep half of the buffer to absorb the delays while
+                    # processing the frames
+                    max_backlog = max(1, self.GetSizeOfCircularBuffer() // 2)
+                    next_idx = 1  # index of the next image to read
+                    tlast = tstart  # time of the last image received
+                    need_reinit = False
+
+                try:
+                    # Wait for new images, while regularly checking for cancellation
+                    while True:
+                        if self.acquire_must_stop.is_set():
+                            raise CancelledError()
+
+                        try:
+                            first, last = self.GetNumberAvailableImages()
+                        except AndorV2Error as (errno, strerr):
+                            if errno != 20024: # DRV_NO_NEW_DATA
+                                raise
+                            first, last = next_idx, next_idx - 1
+                        if last >= next_idx:
+                            break
+
+                        # we actually _expect_ a timeout
+                        try:
+                            self.WaitForAcquisition(0.1)
+                        except AndorV2Error as (errno, strerr):
+                            if errno != 20024: # DRV_NO_NEW_DATA
+                                raise
+                            if time.time() > tlast + period + 1:
+                                logging.warning("Timeout after %g s", time.time() - tlast)
+                                raise # seems actually serious
+                    tlast = time.time()
+
+                    if first > next_idx:
+                        # Already overwritten in the circular buffer
+                        dropped += first - next_idx
+                        next_idx = first
+
+                    # Select the images to pass in the next frame. It's decided
+                    # one frame at a time, as the backlog changes while the
+                    # frame is processed.
+                    if summed:
+                        glast = last
+                    elif last - next_idx + 1 > max_backlog:
+                        # Too slow => coalesce the oldest images, before they are lost
+                        glast = last - max_backlog + 1
+                        logging.debug("Summing %d images, as processing is too slow",
+                                      glast - next_idx + 1)
+                    else:
+                        glast = next_idx
+
+                    array, vfirst, vlast = self._read_images(next_idx, glast, size, summed)
+                    dropped += vfirst - next_idx
+                    next_idx = vlast + 1
+                    md = array.metadata
+                    md[model.MD_ACQ_DATE] = tstart + (vfirst - 1) * period
+                    if dropped:
+                        logging.warning("%d images were lost", dropped)
+                        md[model.MD_DROPPED_FRAMES] = dropped
+                        dropped = 0
+                except AndorV2Error as (errno, strerr):
+                    # try again up to 5 times
+                    failures += 1
+                    if failures >= 5:
+                        raise
+                    self._recover_acquisition(strerr)
+                    # The images not read are lost
+                    need_reinit = True
+                    continue
+                else:
+                    failures = 0
+
+                callback(self._transposeDAToUser(array))
+                del array
+        except CancelledError:
+            # received a must-stop event
+            pass
+        except Exception:
+            logging.exception("Failure during acquisition")
+        finally:
+            self._end_acquisition(has_hw_lock)
+
+    def _read_images(self, first, last, size, summed=False):
+        """
+        Reads images from the circular buffer. If several images are requested,
+        they are summed.
+        first (int): index of the first image to read
+        last (int): index of the last image to read
+        size (2-tuple of int): width, height
+        summed (bool): if True, the image is always returned as a sum, even if
+          only one image is read. That ensures the dtype and MD_BPP stay the
+          same whatever the number of images.
+        returns:
+          array (DataArray): the image or the sum of the images. If summed, it's
+            of type uint32, and MD_INTEGRATION_COUNT contains the number of images.
+          vfirst (int): index of the first image actually read
+          vlast (int): index of the last image actually read
+        """
+        metadata = dict(self._metadata) # duplicate
+        npx = size[0] * size[1]
+        if first == last and not summed:
+            cbuffer = self._allocate_buffer(size)
+            vfirst, vlast = self.GetImages16(first, last, cbuffer, npx)
+            array = self._buffer_as_array(cbuffer, size, metadata)
+            return array, vfirst, vlast
+
+        # Read them all in one go, and sum them
+        n = last - first + 1
+        images = numpy.empty((n, size[1], size[0]), dtype=numpy.uint16) # numpy shape is H, W
+        vfirst, vlast = self.GetImages16(first, last,
+                                         images.ctypes.data_as(POINTER(c_uint16)), npx * n)
+        nv = vlast - vfirst + 1
+        if nv > 1 or summed:
+            data = numpy.sum(images[:nv], axis=0, dtype=numpy.uint32)
+            metadata[model.MD_INTEGRATION_COUNT] = nv
+            if summed:
+                # The number of images varies for each frame, so report the
+                # whole dtype, to keep the same data range for all the frames
+                metadata[model.MD_BPP] = 32
+            elif model.MD_BPP in metadata:
+                metadata[model.MD_BPP] += int(math.ceil(math.log(nv, 2)))
+        else:
+            # Copy, to not keep the memory of all the images
+            data = images[0].copy()
+        return model.DataArray(data, metadata), vfirst, vlast
 
     def _acquire_thread_synchronized(self, callback):
         """
@@ -2069,23 +2325,11 @@ class AndorCam2(model.DigitalCamera):
             while not self.acquire_must_stop.is_set():
                 # need to stop acquisition to update settings
                 if need_reinit or self._need_update_settings():
-                    try:
-                        if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
-                            self.atcore.AbortAcquisition()
-                            time.sleep(0.1)
-                    except AndorV2Error as (errno, strerr):
-                        # it was already aborted
-                        if errno != 20073: # DRV_IDLE
-                            self.acquisition_lock.release()
-                            self.acquire_must_stop.clear()
-                            raise
+                    self._abort_acquisition()
                     # TODO: instead use software trigger (ie, SetTriggerMode(10) + SendSoftwareTrigger())
                     # We don't use the kinetic mode as it might go faster than we can
                     # process them.
-                    self.atcore.SetAcquisitionMode(AndorV2DLL.AM_SINGLE)
-                    # Seems exposure needs to be re-set after setting acquisition mode
-                    self._prev_settings[1] = None # 1 => exposure time
-                    size = self._update_settings()
+                    size = self._setup_acquisition(AndorV2DLL.AM_SINGLE)
 
                     exposure, accumulate, kinetic = self.GetAcquisitionTimings()
                     logging.debug("Accumulate time = %f, kinetic = %f", accumulate, kinetic)
@@ -2139,20 +2383,7 @@ class AndorCam2(model.DigitalCamera):
                         raise
                     # This sometimes happen with 20024 (DRV_NO_NEW_DATA) or
                     # 20067 (DRV_P2INVALID) on GetMostRecentImage16()
-                    try:
-                        self.atcore.CancelWait()
-                        if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
-                            self.atcore.AbortAcquisition()  # Need to stop acquisition to read temperature
-                        temp = self.GetTemperature()
-                    except AndorV2Error:
-                        temp = None
-                    # -999°C means the camera is gone
-                    if temp == -999:
-                        logging.error("Camera seems to have disappeared, will try to reinitialise it")
-                        self.Reinitialize()
-                    else:
-                        time.sleep(0.1)
-                        logging.warning("trying again to acquire image after error %s", strerr)
+                    self._recover_acquisition(strerr)
                     need_reinit = True
                     continue
                 else:
@@ -2171,22 +2402,7 @@ class AndorCam2(model.DigitalCamera):
         except Exception:
             logging.exception("Failure during acquisition")
         finally:
-            # ending cleanly
-            try:
-                if self.GetStatus() == AndorV2DLL.DRV_ACQUIRING:
-                    self.atcore.AbortAcquisition()
-            except AndorV2Error as (errno, strerr):
-                # it was already aborted
-                if errno != 20073: # DRV_IDLE
-                    self.acquisition_lock.release()
-                    logging.debug("Acquisition thread closed after giving up")
-                    self.acquire_must_stop.clear()
-                    raise
-            self.atcore.FreeInternalMemory() # TODO not sure it's needed
-            self.acquisition_lock.release()
-            gc.collect()
-            logging.debug("Acquisition thread closed")
-            self.acquire_must_stop.clear()
+            self._end_acquisition()
 
     def _start_acquisition(self):
         """
@@ -2579,8 +2795,12 @@ class FakeAndorV2DLL(object):
         self.roi = (1, self.shape[0], 1, self.shape[1]) # h0, hlast, v0, vlast, starting from 1
         self.binning = (1, 1) # px
 
+        self.acq_start = None
+        self.acq_stop = None
         self.acq_end = None
+        self.acq_period = None
         self.acq_aborted = threading.Event()
+        self.circBufferSize = 32  # number of images in the circular buffer
 
     def Initialize(self, path):
         if not os.path.isdir(path):
@@ -2890,7 +3110,10 @@ class FakeAndorV2DLL(object):
     def StartAcquisition(self):
         self.status = AndorV2DLL.DRV_ACQUIRING
         duration = self.exposure + self._getReadout()
-        self.acq_end = time.time() + duration
+        self.acq_start = time.time()
+        self.acq_stop = None
+        self.acq_period = duration
+        self.acq_end = self.acq_start + duration
 #         if random.randint(0, 10) == 0:  # DEBUG
 #             self.acq_end += 15
 
@@ -2910,7 +3133,9 @@ class FakeAndorV2DLL(object):
             if self.acqmode == 1: # Single scan
                 self.AbortAcquisition()
             elif self.acqmode == 5: # Run till abort
-                self.StartAcquisition()
+                # Next image
+                nb = self._getNumberImages()
+                self.acq_end = self.acq_start + (nb + 1) * self.acq_period
             else:
                 raise NotImplementedError()
         finally:
@@ -2926,9 +3151,60 @@ class FakeAndorV2DLL(object):
         self.acq_aborted.set()
 
     def AbortAcquisition(self):
+        if self.status == AndorV2DLL.DRV_ACQUIRING:
+            self.acq_stop = time.time()
         self.status = AndorV2DLL.DRV_IDLE
         self.acq_aborted.set()
 
+    def _getNumberImages(self):
+        """
+        return (int): number of images acquired since the acquisition started
+        """
+        if self.acq_start is None:
+            return 0
+        end = self.acq_stop if self.acq_stop is not None else time.time()
+        nb = int((end - self.acq_start) / self.acq_period)
+        if self.acqmode == 1: # Single scan
+            nb = min(nb, 1)
+        return nb
+
+    def GetSizeOfCircularBuffer(self, p_size):
+        size = _deref(p_size, c_int32)
+        size.value = self.circBufferSize
+
+    def GetNumberAvailableImages(self, p_first, p_last):
+        first = _deref(p_first, c_int32)
+        last = _deref(p_last, c_int32)
+        nb = self._getNumberImages()
+        if nb == 0:
+            raise AndorV2Error(20024, "DRV_NO_NEW_DATA")
+        first.value = max(1, nb - self.circBufferSize + 1)
+        last.value = nb
+
+    def GetImages16(self, first, last, cbuffer, size, p_validfirst, p_validlast):
+        validfirst = _deref(p_validfirst, c_int32)
+        validlast = _deref(p_validlast, c_int32)
+        first, last = _val(first), _val(last)
+        nb = self._getNumberImages()
+        if not 1 <= first <= nb:
+            raise AndorV2Error(20066, "DRV_P1INVALID")
+        if not first <= last <= nb:
+            raise AndorV2Error(20067, "DRV_P2INVALID")
+        # The oldest images are overwritten
+        first = max(first, nb - self.circBufferSize + 1)
+        if first > last:
+            raise AndorV2Error(20024, "DRV_NO_NEW_DATA")
+
+        res = ((self.roi[1] - self.roi[0] + 1) // self.binning[0],
+               (self.roi[3] - self.roi[2] + 1) // self.binning[1])
+        if res[0] * res[1] * (last - first + 1) > _val(size):
+            raise AndorV2Error(20069, "DRV_P4INVALID")
+        p = cast(cbuffer, POINTER(c_uint16))
+        ndbuffer = numpy.ctypeslib.as_array(p, (last - first + 1, res[1], res[0]))
+        ndbuffer[...] = self._data[self.roi[2] - 1:self.roi[3]:self.binning[1],
+                                   self.roi[0] - 1:self.roi[1]:self.binning[0]]
+        validfirst.value, validlast.value = first, last
+
     def GetMostRecentImage16(self, cbuffer, size):
         p = cast(cbuffer, POINTER(c_uint16))
         res = ((self.roi[1] - self.roi[0] + 1) // self.binning[0],
@@ -36,6 +36,7 @@ import logging
 import numpy
 from odemis import model, util
 from odemis.model import HwError, oneway
+from odemis.util.driver import FrameBufferPool
 import os
 import re
 import threading
@@ -369,6 +370,8 @@ class AndorCam3(model.DigitalCamera):
         self.acquisition_lock = threading.Lock()
         self.acquire_must_stop = threading.Event()
         self.acquire_thread = None
+        # Buffers for the frames, recycled once the DataArrays are not used anymore
+        self._buf_pool = FrameBufferPool()
         # for synchronized acquisition
         self._got_event = threading.Event()
         self._late_events = collections.deque() # events which haven't been handled yet
@@ -1439,7 +1442,7 @@ class AndorCam3(model.DigitalCamera):
         # allocating directly a numpy array doesn't work if there is metadata:
         # ndbuffer = numpy.empty(shape=(stride / 2, size[1]), dtype="uint16")
         # cbuffer = numpy.ctypeslib.as_ctypes(ndbuffer)
-        cbuffer = (c_byte * image_size)() # empty array
+        cbuffer = self._buf_pool.get(c_byte, image_size)
         assert(addressof(cbuffer) % 8 == 0) # the SDK wants it aligned
 
         return cbuffer
@@ -1464,9 +1467,9 @@ class AndorCam3(model.DigitalCamera):
             # SimCam doesn't support stride
             stride = self.GetInt(u"AOIWidth")
 
-        p = cast(cbuffer, POINTER(ityp))
-        ndbuffer = numpy.ctypeslib.as_array(p, (size[1], stride))  # numpy shape is H, W
-        dataarray = model.DataArray(ndbuffer, metadata)
+        # numpy shape is H, W. The buffer goes back to the pool when the array
+        # is not used anymore.
+        dataarray = self._buf_pool.as_array(cbuffer, (size[1], stride), metadata, ityp)
         # crop the array in case of stride (should not cause copy)
         return dataarray[:, :size[0]]
 
@@ -1685,8 +1688,9 @@ class AndorCam3(model.DigitalCamera):
             CancelledError: In case tha acquisition was cancelled
         """
         # We have (probably) time now, let's queue next buffer here
-        # Note we cannot reuse the buffer because we don't know if
-        # the callee still needs it or not
+        # Note we cannot directly reuse the buffer because we don't know if
+        # the callee still needs it or not. The pool only recycles it once it's
+        # not used anymore.
         logging.debug("Queuing a new buffer (queue len = %d)", len(buffers))
         cbuffer = self._allocate_buffer(size)
         self.QueueBuffer(cbuffer)
@@ -1728,6 +1732,9 @@ class AndorCam3(model.DigitalCamera):
                 logging.exception("Failure while checking for newer data in hardware queue")
                 raise
 
+            # The older frame is dropped, so its buffer can be recycled
+            self._buf_pool.put(cbuffer)
+
             # Queue immediately a new buffer to compensate
             logging.debug("Queuing a new buffer (queue len = %d)", len(buffers))
             cbuffer = self._allocate_buffer(size)
@@ -249,6 +249,9 @@ class SEMComedi(model.HwComponent):
         # subdevice, channel, range -> converter from value to value
         self._convert_to_phys = {}
         self._convert_from_phys = {}
+        # (4-tuple int) -> (coefficients, origin, maxdata, calibrated) or None:
+        # subdevice, channel, range, direction -> polynomial to convert arrays
+        self._polynomials = {}
 
         # TODO only look for 2 output channels and len(detectors) input channels
         # On the NI-6251, according to the doc:
@@ -535,17 +538,16 @@ class SEMComedi(model.HwComponent):
 
         return bufsz
 
-    def _get_converter_actual(self, subdevice, channel, range, direction):
+    def _get_calibration_polynomial(self, subdevice, channel, range, direction):
         """
-        Finds the best converter available for the given conditions
+        Finds the calibration polynomial for the given conditions
         subdevice (int): the subdevice index
         channel (int): the channel index
         range (int): the range index
         direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
-        return a callable number -> number
+        return (comedi.polynomial_t or None): the polynomial, or None if the
+          device is not calibrated
         """
-        assert(direction in [comedi.TO_PHYSICAL, comedi.FROM_PHYSICAL])
-
         # 3 possibilities:
         # * the device is hard-calibrated -> simple converter from get_hardcal_converter
         # * the device is soft-calibrated -> polynomial converter from  get_softcal_converter
@@ -573,6 +575,20 @@ class SEMComedi(model.HwComponent):
                 logging.warning("Failed to get converter from calibration")
                 poly = None
 
+        return poly
+
+    def _get_converter_actual(self, subdevice, channel, range, direction):
+        """
+        Finds the best converter available for the given conditions
+        subdevice (int): the subdevice index
+        channel (int): the channel index
+        range (int): the range index
+        direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
+        return a callable number -> number
+        """
+        assert(direction in [comedi.TO_PHYSICAL, comedi.FROM_PHYSICAL])
+
+        poly = self._get_calibration_polynomial(subdevice, channel, range, direction)
         if poly is None:
             # not calibrated
             logging.debug("creating a non calibrated converter for s%dc%dr%d",
@@ -606,15 +622,77 @@ class SEMComedi(model.HwComponent):
         direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
         return a callable number -> number
         """
+        if direction == comedi.TO_PHYSICAL:
+            cache = self._convert_to_phys
+        else:
+            cache = self._convert_from_phys
+
         # get the cached converter, or create a new one
         try:
-            converter = self._convert_to_phys[subdevice, channel, range]
+            converter = cache[subdevice, channel, range]
         except KeyError:
             converter = self._get_converter_actual(subdevice, channel, range, direction)
-            self._convert_to_phys[subdevice, channel, range] = converter
+            cache[subdevice, channel, range] = converter
 
         return converter
 
+    def _get_polynomial_actual(self, subdevice, channel, rng, direction):
+        """
+        Finds the polynomial equivalent to the best converter available for the
+          given conditions
+        subdevice (int): the subdevice index
+        channel (int): the channel index
+        rng (int): the range index
+        direction (enum): comedi.COMEDI_TO_PHYSICAL or comedi.COMEDI_FROM_PHYSICAL
+        return (None or tuple of (numpy.ndarray of float), float, int, bool):
+          coefficients (lowest order first), expansion origin, maximum raw value,
+          and whether it comes from the calibration (or is just a linear
+          approximation from the range). None if the coefficients are not
+          accessible.
+        """
+        assert(direction in [comedi.TO_PHYSICAL, comedi.FROM_PHYSICAL])
+        maxdata = comedi.get_maxdata(self._device, subdevice, channel)
+
+        poly = self._get_calibration_polynomial(subdevice, channel, rng, direction)
+        if poly is None:
+            # Same as comedi.to_phys() and comedi.from_phys()
+            range_info = comedi.get_range(self._device, subdevice,
+                                          channel, rng)
+            rmin, rmax = range_info.min, range_info.max
+            if direction == comedi.TO_PHYSICAL:
+                coefs = numpy.array([rmin, (rmax - rmin) / maxdata])
+                return coefs, 0, maxdata, False
+            else:
+                coefs = numpy.array([0, maxdata / (rmax - rmin)])
+                return coefs, rmin, maxdata, False
+
+        pcoefs = poly.coefficients
+        try:
+            coefs = [pcoefs[i] for i in range(poly.order + 1)]
+        except TypeError:
+            # Older versions of the comedi bindings only give a pointer, which
+            # cannot be indexed
+            logging.warning("Failed to access the calibration coefficients for "
+                            "s%dc%dr%d, conversion will be slow",
+                            subdevice, channel, rng)
+            return None
+        coefs = numpy.array(coefs, dtype=numpy.double)
+        return coefs, poly.expansion_origin, maxdata, True
+
+    def _get_polynomial(self, subdevice, channel, rng, direction):
+        """
+        Finds the polynomial equivalent to the best converter available for the
+          given conditions. See _get_polynomial_actual() for the arguments.
+        """
+        key = (subdevice, channel, rng, direction)
+        # get the cached polynomial, or find it
+        try:
+            return self._polynomials[key]
+        except KeyError:
+            poly = self._get_polynomial_actual(subdevice, channel, rng, direction)
+            self._polynomials[key] = poly
+            return poly
+
     def _to_phys(self, subdevice, channel, range, value):
         """
         Converts a raw value to the physical value, using the best converter
@@ -650,44 +728,23 @@ class SEMComedi(model.HwComponent):
           same as the channels and ranges. dtype should be uint (of any size)
         return (numpy.ndarray of the same shape as data, dtype=double): physical values
         """
-        # FIXME: this is very slow (2us/element), might need to go into numba,
-        # cython, C, or be avoided.
         array = numpy.empty(shape=data.shape, dtype=numpy.double)
-        converters = []
         for i, c in enumerate(channels):
-            converters.append(self._get_converter(subdevice, c, ranges[i],
-                                                  comedi.TO_PHYSICAL))
-
-        # converter needs lsampl (uint32). So for lsampl devices, it's pretty
-        # straightforward, just a matter of convincing SWIG that a numpy.uint32
-        # is a uint32. For sampl devices, everything needs to be converted.
-
-        # Note: it should be possible to access always the values as ctypes
-        # using data.ctypes.strides and
-        # cbuf = data.ctypes.data_as(ctypes.POINTER(ctypes.c_uint32))
-        # but ctypes.addressof(cbuf) != data.ctypes.data
-        # which is a sign of copy (bad)
-        try:
-            flat_data = numpy.reshape(data, numpy.prod(data.shape))
-            cbuf = numpy.ctypeslib.as_ctypes(flat_data)
-        except TypeError:
-            # strided array
-            cbuf = None
-
-        if data.dtype.char == 'L' and cbuf is not None:
-            logging.debug("Using casting to access the raw data")
-            # can just force-cast to a ctype buffer of unsigned int (that swig accepts)
-            # TODO: maybe could be speed-up by something like vectorize()/map()?
-            flat_array = numpy.reshape(array, numpy.prod(data.shape))
-            nchans = len(channels)
-            for i in range(flat_data.size / nchans):
-                for j in range(nchans):
-                    flat_array[nchans * i + j] = converters[j](cbuf[nchans * i + j])
-        else:
-            # Needs real conversion
-            logging.debug("Using full conversion of the raw data")
-            for i, v in numpy.ndenumerate(data):
-                array[i] = converters[i[-1]](int(v))
+            poly = self._get_polynomial(subdevice, c, ranges[i], comedi.TO_PHYSICAL)
+            if poly is None:
+                converter = self._get_converter(subdevice, c, ranges[i],
+                                                comedi.TO_PHYSICAL)
+                self._array_convert_slow(converter, data[..., i], array[..., i])
+                continue
+
+            coefs, origin, maxdata, calibrated = poly
+            d = data[..., i]
+            pd = numpy.polynomial.polynomial.polyval(d - origin, coefs)
+            if not calibrated:
+                # comedi.to_phys() returns NaN when the value is out of range
+                # (as requested with set_global_oor_behavior())
+                pd[(d == 0) | (d == maxdata)] = numpy.nan
+            array[..., i] = pd
 
         return array
 
@@ -702,25 +759,46 @@ class SEMComedi(model.HwComponent):
         return (numpy.ndarray of shape ..., L): raw values, the dtype
           fits the subdevice
         """
-        # FIXME: this is very slow (2us/element), might need to go into numba,
-        # cython, C, or be avoided.
         dtype = self._get_dtype(subdevice)
         # forcing the order is not necessary but just to ensure good performance
         buf = numpy.empty(shape=data.shape, dtype=dtype, order='C')
 
-        # prepare the converters
-        converters = []
         for i, c in enumerate(channels):
-            converters.append(self._get_converter(subdevice, c, ranges[i],
-                                                  comedi.FROM_PHYSICAL))
-
-        # TODO: check if it's possible to avoid multiple type conversion in the call
+            poly = self._get_polynomial(subdevice, c, ranges[i], comedi.FROM_PHYSICAL)
+            if poly is None:
+                converter = self._get_converter(subdevice, c, ranges[i],
+                                                comedi.FROM_PHYSICAL)
+                self._array_convert_slow(converter, data[..., i], buf[..., i])
+                continue
 
-        for i, v in numpy.ndenumerate(data):
-            buf[i] = converters[i[-1]](v)
+            coefs, origin, maxdata, calibrated = poly
+            rd = numpy.polynomial.polynomial.polyval(data[..., i] - origin, coefs)
+            # Round the same way as comedi.from_physical() and comedi.from_phys()
+            # Note: the values are always clipped to the raw range, while
+            # comedi.from_physical() only clips the negative values.
+            if calibrated:
+                rd = numpy.rint(rd)
+            else:
+                rd = numpy.floor(rd + 0.5)
+            buf[..., i] = numpy.clip(rd, 0, maxdata)
 
         return buf
 
+    @staticmethod
+    def _array_convert_slow(converter, data, out):
+        """
+        Converts an array one element at a time (~2 µs per element)
+        converter (callable number -> number): the converter
+        data (numpy.ndarray): the values to convert
+        out (numpy.ndarray of same shape as data): the converted values
+        """
+        if data.dtype.kind in "ui":
+            for i, v in numpy.ndenumerate(data):
+                out[i] = converter(int(v))
+        else:
+            for i, v in numpy.ndenumerate(data):
+                out[i] = converter(float(v))
+
     def _get_dtype(self, subdevice):
         """
         Return the appropriate numpy.dtype for the given subdevice
@@ -200,6 +200,10 @@ class Scanner(model.Emitter):
 
         self.dwellTime = model.FloatContinuous(1e-06, (1e-06, 1000), unit="s")
 
+        # Event notified each time the e-beam moves to a new pixel (only while
+        # someone listens to it, as the scan is then simulated pixel per pixel)
+        self.newPosition = model.Event()
+
         # VAs to control the ebeam, purely fake
         self.probeCurrent = model.FloatEnumerated(1.3e-9,
                           {0.1e-9, 1.3e-9, 2.6e-9, 3.4e-9, 11.564e-9, 23e-9},
@@ -498,10 +502,23 @@ class Detector(model.Detector):
         to the dwell time and resolution and provides the new generated output to
         the Dataflow.
         """
+        scanner = self.parent._scanner
         try:
             while not self._acquisition_must_stop.is_set():
-                dwelltime = self.parent._scanner.dwellTime.value
-                resolution = self.parent._scanner.resolution.value
+                dwelltime = scanner.dwellTime.value
+                resolution = scanner.resolution.value
+                if scanner.newPosition.hasListeners():
+                    # Like the real hardware, wait for the trigger, and then
+                    # scan each pixel, so that the listeners are synchronized
+                    # with the e-beam position.
+                    self.data._waitSync()
+                    if self._acquisition_must_stop.is_set():
+                        break
+                    if self._scan_pixels(scanner, numpy.prod(resolution), dwelltime):
+                        break
+                    callback(self._simulate_image())
+                    continue
+
                 duration = numpy.prod(resolution) * dwelltime
                 if self._acquisition_must_stop.wait(duration):
                     break
@@ -516,6 +533,20 @@ class Detector(model.Detector):
             logging.debug("Acquisition thread closed")
             self._acquisition_must_stop.clear()
 
+    def _scan_pixels(self, scanner, npx, dwelltime):
+        """
+        Simulate the e-beam going through every pixel of the scan, notifying
+        newPosition at each of them.
+        npx (int): number of pixels to scan
+        dwelltime (float): time spent on each pixel
+        return (bool): True if the acquisition was requested to stop
+        """
+        for i in range(npx):
+            scanner.newPosition.notify()
+            if self._acquisition_must_stop.wait(dwelltime):
+                return True
+        return False
+
 
 class SEMDataFlow(model.DataFlow):
     """
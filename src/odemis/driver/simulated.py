@@ -31,6 +31,7 @@ from odemis import model, util
 from odemis.model import isasync, CancellableThreadPoolExecutor, HwError
 import os
 import random
+import threading
 import time
 
 
@@ -66,6 +67,10 @@ class Light(model.Emitter):
             logging.info("Light is on")
 
 
+# Period at which the position is updated during a move (s)
+POS_UPDATE_PERIOD = 0.01
+
+
 class Stage(model.Actuator):
     """
     Simulated stage component. Just pretends to be able to move all around.
@@ -96,6 +101,7 @@ class Stage(model.Actuator):
             raise HwError("stage.fail file present, simulating error")
 
         self._executor = model.CancellableThreadPoolExecutor(max_workers=1)
+        self._move_stop = threading.Event()  # set to interrupt the current move
 
         # RO, as to modify it the client must use .moveRel() or .moveAbs()
         self.position = model.VigilantAttribute({}, unit="m", readonly=True)
@@ -116,34 +122,56 @@ class Stage(model.Actuator):
         pos = self._applyInversion(self._position)
         self.position._set_value(pos, force_write=True)
 
+    def _simulateMove(self, target, dur):
+        """
+        Update the position linearly, until it reaches the target, or the move
+          is stopped.
+        target (dict str -> float): final position of each axis moved (internal)
+        dur (0<=float): duration of the move (s)
+        """
+        start = dict((a, self._position[a]) for a in target)
+        tstart = time.time()
+        tend = tstart + dur
+        while not self._move_stop.wait(min(POS_UPDATE_PERIOD, max(0, tend - time.time()))):
+            now = time.time()
+            if now >= tend:
+                self._position.update(target)
+                break
+            r = (now - tstart) / dur
+            for a, p in target.items():
+                self._position[a] = start[a] + (p - start[a]) * r
+            self._updatePosition()
+        else:
+            logging.debug("Move interrupted at %s", self._position)
+
+        self._updatePosition()
+
     def _doMoveRel(self, shift):
         maxtime = 0
+        target = {}
         for axis, change in shift.items():
-            self._position[axis] += change
+            target[axis] = self._position[axis] + change
             rng = self.axes[axis].range
             if axis in self._inverted:
                 rng = (-rng[1], -rng[0])  # user -> internal range
-            if not rng[0] < self._position[axis] < rng[1]:
+            if not rng[0] < target[axis] < rng[1]:
                 logging.warning("moving axis %s to %f, outside of range %r",
-                                axis, self._position[axis], rng)
+                                axis, target[axis], rng)
             else:
-                logging.info("moving axis %s to %f", axis, self._position[axis])
+                logging.info("moving axis %s to %f", axis, target[axis])
             maxtime = max(maxtime, abs(change) / self.speed.value[axis] + 0.001)
 
         logging.debug("Sleeping %g s", maxtime)
-        time.sleep(maxtime)
-        self._updatePosition()
+        self._simulateMove(target, maxtime)
 
     def _doMoveAbs(self, pos):
         maxtime = 0
         for axis, new_pos in pos.items():
             change = self._position[axis] - new_pos
-            self._position[axis] = new_pos
-            logging.info("moving axis %s to %f", axis, self._position[axis])
+            logging.info("moving axis %s to %f", axis, new_pos)
             maxtime = max(maxtime, abs(change) / self.speed.value[axis])
 
-        time.sleep(maxtime)
-        self._updatePosition()
+        self._simulateMove(pos, maxtime)
 
     @isasync
     def moveRel(self, shift):
@@ -164,7 +192,9 @@ class Stage(model.Actuator):
         return self._executor.submit(self._doMoveAbs, pos)
 
     def stop(self, axes=None):
+        self._move_stop.set()
         self._executor.cancel()
+        self._move_stop.clear()
         logging.info("Stopping all axes: %s", ", ".join(self.axes))
 
 
@@ -24,8 +24,12 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import logging
+import numpy
+from odemis import model
 from odemis.driver import andorcam2
 import os
+import threading
+import time
 import unittest
 from unittest.case import skip
 
@@ -68,6 +72,115 @@ class TestFake(VirtualTestCam, unittest.TestCase):
     camera_type = CLASS_SIM
     camera_kwargs = KWARGS_SIM
 
+    def test_buffer_pool(self):
+        """
+        Check the frame buffers are recycled once the data is not used anymore
+        """
+        self.camera.exposureTime.value = 0.01
+        pool = self.camera._buf_pool
+        nreused = pool.num_reused
+        nmissed = pool.num_missed
+
+        self._nframes = 0
+        self._frames_done = threading.Event()
+        self.camera.data.subscribe(self._receive_and_drop)
+        try:
+            self.assertTrue(self._frames_done.wait(30))
+        finally:
+            self.camera.data.unsubscribe(self._receive_and_drop)
+        time.sleep(0.5)  # wait for the acquisition to end
+
+        nframes = self._nframes
+        logging.info("Received %d frames, with %d buffers reused and %d allocated",
+                     nframes, pool.num_reused - nreused, pool.num_missed - nmissed)
+        # The frames are not kept, so almost every buffer should be recycled
+        self.assertGreater(pool.num_reused - nreused, 0)
+        self.assertLess(pool.num_missed - nmissed, nframes)
+
+        # The data kept is not overwritten by the next frames
+        da1 = self.camera.data.get()
+        da1_copy = da1.copy()
+        da2 = self.camera.data.get()
+        self.assertNotEqual(da1.__array_interface__["data"][0],
+                            da2.__array_interface__["data"][0])
+        numpy.testing.assert_array_equal(da1, da1_copy)
+
+    def _receive_and_drop(self, df, data):
+        self._nframes += 1
+        if self._nframes >= 10:
+            self._frames_done.set()
+
+    def test_frame_mode_all(self):
+        """
+        Check all the frames are passed, even with a slow subscriber
+        """
+        self.camera.exposureTime.value = 0.01
+        self.camera.frameMode.value = andorcam2.FRAME_MODE_ALL
+        self._frames = []
+        self._dtypes = []
+        self._frames_done = threading.Event()
+        try:
+            self.camera.data.subscribe(self._receive_slowly)
+            try:
+                self.assertTrue(self._frames_done.wait(30))
+            finally:
+                self.camera.data.unsubscribe(self._receive_slowly)
+        finally:
+            self.camera.frameMode.value = andorcam2.FRAME_MODE_LATEST
+        time.sleep(0.5)  # wait for the acquisition to end
+
+        counts = [md.get(model.MD_INTEGRATION_COUNT, 1) for md in self._frames]
+        logging.info("Received %d frames, for %d images", len(counts), sum(counts))
+        # The circular buffer got full, so the oldest images got summed
+        self.assertGreater(sum(counts), len(counts))
+        # No frame lost
+        for md in self._frames:
+            self.assertNotIn(model.MD_DROPPED_FRAMES, md)
+        # Frames in order
+        dates = [md[model.MD_ACQ_DATE] for md in self._frames]
+        self.assertEqual(dates, sorted(dates))
+
+    def test_frame_mode_sum(self):
+        """
+        Check the frames acquired while the subscriber is busy are summed
+        """
+        self.camera.exposureTime.value = 0.01
+        self.camera.frameMode.value = andorcam2.FRAME_MODE_SUM
+        self._frames = []
+        self._dtypes = []
+        self._frames_done = threading.Event()
+        try:
+            self.camera.data.subscribe(self._receive_slowly)
+            try:
+                self.assertTrue(self._frames_done.wait(30))
+            finally:
+                self.camera.data.unsubscribe(self._receive_slowly)
+        finally:
+            self.camera.frameMode.value = andorcam2.FRAME_MODE_LATEST
+        time.sleep(0.5)
+        single = self.camera.data.get()
+
+        # All the frames are sums (of at least one image), with the same format
+        for md, dtype in zip(self._frames, self._dtypes):
+            self.assertGreaterEqual(md[model.MD_INTEGRATION_COUNT], 1)
+            self.assertEqual(md[model.MD_BPP], self._frames[0][model.MD_BPP])
+            self.assertGreater(md[model.MD_BPP], single.metadata[model.MD_BPP])
+            self.assertEqual(dtype, numpy.uint32)
+            self.assertNotIn(model.MD_DROPPED_FRAMES, md)
+        # Except maybe the first one, they contain several images
+        for md in self._frames[1:]:
+            self.assertGreater(md[model.MD_INTEGRATION_COUNT], 1)
+        count = self._last_data.metadata[model.MD_INTEGRATION_COUNT]
+        numpy.testing.assert_array_equal(self._last_data, single.astype(numpy.uint32) * count)
+
+    def _receive_slowly(self, df, data):
+        self._frames.append(data.metadata)
+        self._dtypes.append(data.dtype)
+        self._last_data = data
+        if len(self._frames) >= 10:
+            self._frames_done.set()
+        time.sleep(0.2)  # Much longer than the frame period
+
 
 #@skip("simple")
 class StaticTestAndorCam2(VirtualStaticTestCam, unittest.TestCase):
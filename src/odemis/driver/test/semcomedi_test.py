@@ -25,6 +25,7 @@ import Pyro4
 import comedi
 import copy
 import logging
+import math
 import numpy
 import os
 import pickle
@@ -203,6 +204,95 @@ class TestSEM(unittest.TestCase):
         size = self.scanner.resolution.value
         return size[0] * size[1] * dwell + size[1] * settle
 
+    def test_array_conversion(self):
+        """
+        Check the conversion of arrays gives the same values as the conversion
+        of each value independently.
+        """
+        sem = self.sem
+        # raw -> physical, on the AI
+        subd = sem._ai_subdevice
+        channels, ranges = [0, 1], [0, 0]
+        maxdata = comedi.get_maxdata(sem._device, subd, 0)
+        data = numpy.random.randint(0, maxdata + 1, (100, 2)).astype(sem._get_dtype(subd))
+        data[0] = 0, maxdata  # out of range values
+        start = time.time()
+        parray = sem._array_to_phys(subd, channels, ranges, data)
+        logging.info("Converted %d values in %g s", data.size, time.time() - start)
+        for i, v in numpy.ndenumerate(data):
+            exp = sem._to_phys(subd, channels[i[-1]], ranges[i[-1]], int(v))
+            if math.isnan(exp):
+                self.assertTrue(math.isnan(parray[i]))
+            else:
+                self.assertAlmostEqual(parray[i], exp)
+
+        # physical -> raw, on the AO
+        subd = sem._ao_subdevice
+        rng = comedi.get_range(sem._device, subd, 0, 0)
+        data = numpy.random.uniform(rng.min, rng.max, (100, 2))
+        rarray = sem._array_from_phys(subd, channels, ranges, data)
+        self.assertEqual(rarray.dtype, sem._get_dtype(subd))
+        for i, v in numpy.ndenumerate(data):
+            exp = sem._from_phys(subd, channels[i[-1]], ranges[i[-1]], v)
+            self.assertEqual(rarray[i], exp)
+
+    def test_array_conversion_calibrated(self):
+        """
+        Check the conversion of arrays with a non-linear calibration polynomial
+        """
+        sem = self.sem
+
+        class FakePolynomial(object):
+            # Same attributes as comedi.polynomial_t
+            def __init__(self, coefficients, expansion_origin):
+                self.coefficients = coefficients
+                self.expansion_origin = expansion_origin
+                self.order = len(coefficients) - 1
+
+        polys = {comedi.TO_PHYSICAL: FakePolynomial([-5, 1.5e-4, 2e-10], 1000),
+                 comedi.FROM_PHYSICAL: FakePolynomial([32768, 6553.6, -1.2], 0.5)}
+
+        def get_calibration_polynomial(subdevice, channel, rng, direction):
+            return polys[direction]
+
+        # Use the fake polynomials, and ensure they are not cached afterwards
+        sem._get_calibration_polynomial = get_calibration_polynomial
+        orig_polynomials = sem._polynomials
+        sem._polynomials = {}
+        def restore():
+            del sem._get_calibration_polynomial
+            sem._polynomials = orig_polynomials
+        self.addCleanup(restore)
+
+        def polyval(p, v):
+            return sum(c * (v - p.expansion_origin) ** i
+                       for i, c in enumerate(p.coefficients))
+
+        # raw -> physical
+        subd = sem._ai_subdevice
+        channels, ranges = [0, 1], [0, 0]
+        poly = sem._get_polynomial(subd, 0, 0, comedi.TO_PHYSICAL)
+        self.assertIsNotNone(poly)
+        self.assertTrue(poly[3])  # calibrated
+        maxdata = comedi.get_maxdata(sem._device, subd, 0)
+        data = numpy.random.randint(0, maxdata + 1, (100, 2)).astype(sem._get_dtype(subd))
+        parray = sem._array_to_phys(subd, channels, ranges, data)
+        for i, v in numpy.ndenumerate(data):
+            exp = polyval(polys[comedi.TO_PHYSICAL], int(v))
+            self.assertAlmostEqual(parray[i], exp)
+
+        # physical -> raw
+        subd = sem._ao_subdevice
+        self.assertIsNotNone(sem._get_polynomial(subd, 0, 0, comedi.FROM_PHYSICAL))
+        maxdata = comedi.get_maxdata(sem._device, subd, 0)
+        data = numpy.random.uniform(-4, 4, (100, 2))
+        rarray = sem._array_from_phys(subd, channels, ranges, data)
+        self.assertEqual(rarray.dtype, sem._get_dtype(subd))
+        for i, v in numpy.ndenumerate(data):
+            exp = polyval(polys[comedi.FROM_PHYSICAL], v)
+            exp = min(max(0, int(round(exp))), maxdata)
+            self.assertEqual(rarray[i], exp)
+
 #     @unittest.skip("simple")
     def test_acquire(self):
         self.scanner.dwellTime.value = 10e-6 # s
@@ -211,6 +211,26 @@ class StageTest(unittest.TestCase, ActuatorTest):
     def tearDown(self):
         ActuatorTest.tearDown(self)
 
+    def test_progressive_move(self):
+        """
+        Check the position is updated during a move, and stop interrupts it
+        """
+        self.dev.speed.value = {"x": 0.01, "y": 0.01}  # m/s
+        start = self.dev.position.value["x"]
+        f = self.dev.moveRel({"x": 0.005})  # 0.5 s
+        time.sleep(0.2)
+        mid = self.dev.position.value["x"]
+        self.assertTrue(start < mid < start + 0.005)
+
+        self.dev.stop()
+        f.result()
+        end = self.dev.position.value["x"]
+        self.assertTrue(mid <= end < start + 0.005)
+
+        # a new move works normally after a stop
+        self.dev.moveAbs({"x": start}).result()
+        self.assertAlmostEqual(self.dev.position.value["x"], start)
+
 class ChamberTest(unittest.TestCase):
 
     actuator_type = simulated.Chamber
@@ -24,6 +24,7 @@ import logging
 import numpy
 from odemis import model
 from odemis.model import HwError, oneway
+from odemis.util.driver import FrameBufferPool
 import subprocess
 import sys
 import threading
@@ -714,6 +715,9 @@ class Camera(model.DigitalCamera):
             # TODO: this should be per buffer, stored at the same time we
             # (re)allocate the buffer.
             self._buffers_props = res, dtype
+            # The frames are copied from the buffers of the queue to buffers
+            # recycled once the DataArrays are not used anymore
+            self._buf_pool = FrameBufferPool()
 
             rorate = self.GetPixelClock() * 1e6 # MHz -> Hz
             self.readoutRate = model.VigilantAttribute(rorate, readonly=True,
@@ -1023,16 +1027,17 @@ class Camera(model.DigitalCamera):
         return (DataArray): a numpy array corresponding to the data pointed to
         """
         res, dtype = self._buffers_props
-        na = numpy.empty((res[1], res[0]), dtype=dtype)
+        ctype = c_uint8 if numpy.dtype(dtype).itemsize == 1 else c_uint16
+        cbuffer = self._buf_pool.get(ctype, res[0] * res[1])
         # TODO use GetImageMemPitch() if needed: if width is not multiple of 4
         # => create a na height x stride, and then return na[:, :size[0]]
         assert(res[0] % 4 == 0)
-        memmove(na.ctypes.data, mem, na.nbytes)
+        memmove(cbuffer, mem, sizeof(cbuffer))
 
         # release the buffer
         self._dll.is_UnlockSeqBuf(self._hcam, IGNORE_PARAMETER, mem)
 
-        return model.DataArray(na, md)
+        return self._buf_pool.as_array(cbuffer, (res[1], res[0]), md)
 
     # Acquisition methods
     def start_generate(self):
@@ -138,6 +138,7 @@ from abc import ABCMeta, abstractmethod
 import cairo
 from decorator import decorator
 import logging
+import numpy
 from odemis import util
 from odemis.gui import BLEND_DEFAULT, BLEND_SCREEN, BufferSizeEvent
 from odemis.gui import img
@@ -145,7 +146,8 @@ from odemis.gui.comp.overlay.base import WorldOverlay, ViewOverlay
 from odemis.gui.evt import EVT_KNOB_ROTATE, EVT_KNOB_PRESS
 from odemis.gui.util import call_in_wx_main
 from odemis.gui.util.conversion import wxcol_to_frgb
-from odemis.gui.util.img import add_alpha_byte, apply_rotation, apply_shear, apply_flip, get_sub_img
+from odemis.gui.util.img import add_alpha_byte, apply_rotation, apply_shear, apply_flip, get_sub_img, \
+    line_plot_to_pos, bar_plot_to_pos, trace_path
 from odemis.util import intersect
 from odemis.util import no_conflict
 import os
@@ -1750,6 +1752,12 @@ class PlotCanvas(BufferedCanvas):
 
         # The data to be plotted: list of 2-tuples (x, y, for each point)
         self._data = None
+        # Same data, as X and Y arrays, for the computation of the plot
+        self._data_x = None
+        self._data_y = None
+        # Positions (in px) of the plot: key (tuple), (X array, Y array)
+        # It's computed only when the data, the ranges or the size change.
+        self._plot_pos = None
 
         # TODO: these range don't seem to be used (or passed by the callers).
         # We should have .range_x as properties, which lazily computes them whenever
@@ -1762,6 +1770,7 @@ class PlotCanvas(BufferedCanvas):
         self.range_y = None
 
         self.data_prop = None  # data_width, range_x, data_height, range_y
+        self._data_prop_outdated = True  # data_prop needs to be recomputed
 
         self.unit_x = None
         self.unit_y = None
@@ -1795,11 +1804,15 @@ class PlotCanvas(BufferedCanvas):
 
         """
         if data:
+            if len(data[0]) != 2:
+                raise ValueError("The data should be 2D!")
+
+            xy = numpy.array(data, dtype=float)
             # Check if sorted
-            s = all(data[i][0] < data[i + 1][0] for i in xrange(len(data) - 1))
+            diff_x = numpy.diff(xy[:, 0])
             try:
-                if not s:
-                    if any(data[i][0] == data[i + 1][0] for i in xrange(len(data) - 1)):
+                if not (diff_x > 0).all():
+                    if (diff_x == 0).any():
                         raise ValueError("The horizontal data points should be unique.")
                     else:
                         raise ValueError("The horizontal data should be sorted.")
@@ -1808,12 +1821,14 @@ class PlotCanvas(BufferedCanvas):
                 logging.exception("Horizontal data is incorrect, will drop it. Was: %s",
                                   [d[0] for d in data])
                 data = [(i, d[1]) for i, d in enumerate(data)]
+                xy[:, 0] = numpy.arange(len(data))
                 unit_x = None
 
-            if len(data[0]) != 2:
-                raise ValueError("The data should be 2D!")
-
             self._data = data
+            self._data_x = xy[:, 0]
+            self._data_y = xy[:, 1]
+            self._data_prop_outdated = True
+            self._plot_pos = None
 
             self.unit_x = unit_x
             self.unit_y = unit_y
@@ -1829,6 +1844,10 @@ class PlotCanvas(BufferedCanvas):
 
     def clear(self):
         self._data = None
+        self._data_x = None
+        self._data_y = None
+        self._plot_pos = None
+        self._data_prop_outdated = True
         self.unit_y = None
         self.unit_x = None
         self.range_x = None
@@ -1849,16 +1868,19 @@ class PlotCanvas(BufferedCanvas):
 
         """
 
-        try:
-            horz, vert = zip(*data)
-        except TypeError:
-            logging.exception("Failed to separate tuples in %s", data)
-            raise
+        if data is self._data:
+            horz, vert = self._data_x, self._data_y
+        else:
+            try:
+                horz, vert = zip(*data)
+            except TypeError:
+                logging.exception("Failed to separate tuples in %s", data)
+                raise
 
-        min_x = min(horz)
-        max_x = max(horz)
-        min_y = min(vert)
-        max_y = max(vert)
+        min_x = numpy.min(horz)
+        max_x = numpy.max(horz)
+        min_y = numpy.min(vert)
+        max_y = numpy.max(vert)
 
         # If a range is not given, we calculate it from the data
         if not self.range_x:
@@ -1966,9 +1988,10 @@ class PlotCanvas(BufferedCanvas):
         val_x (number): the value in X
         return (tuple of data): X, Y value
         """
-        # TODO: as _data is sorted over X, it would be much faster to use
-        # dichotomy search, cf bisect.bisect() or numpy.searchsorted()
-        return min(self._data, key=lambda v: abs(v[0] - val_x))
+        # As _data is sorted over X, the closest is on either side of the insertion point
+        i = numpy.searchsorted(self._data_x, val_x)
+        idxs = [j for j in (i - 1, i) if 0 <= j < len(self._data)]
+        return self._data[min(idxs, key=lambda j: abs(self._data_x[j] - val_x))]
 
     def SetForegroundColour(self, *args, **kwargs):
         BufferedCanvas.SetForegroundColour(self, *args, **kwargs)
@@ -2002,9 +2025,10 @@ class PlotCanvas(BufferedCanvas):
 
         if self._data:
             data = self._data
-            # TODO: reuse data_prop if the data has not changed
-            data_width, range_x, data_height, range_y = self._calc_data_characteristics(data)
-            self.data_prop = (data_width, range_x, data_height, range_y)
+            if self._data_prop_outdated:
+                self.data_prop = self._calc_data_characteristics(data)
+                self._data_prop_outdated = False
+            data_width, range_x, data_height, range_y = self.data_prop
             ctx = wxcairo.ContextFromDC(self._dc_buffer)
             self._plot_data(ctx, data, data_width, range_x, data_height, range_y)
 
@@ -2019,62 +2043,48 @@ class PlotCanvas(BufferedCanvas):
             elif self.plot_mode == PLOT_MODE_POINT:
                 self._point_plot(ctx, data, data_width, range_x, data_height, range_y)
 
+    def _get_plot_pos(self, data_width, range_x, data_height, range_y):
+        """ Get the positions of the plot, for the current data and size
+
+        The positions are computed all at once, and decimated to about 2 points per pixel column.
+        They are cached, until the data, the ranges, the size or the plot mode change.
+
+        :return: (numpy array of float, numpy array of float) X and Y positions (px)
+
+        """
+        bar = (self.plot_mode == PLOT_MODE_BAR)
+        key = (bar, tuple(self.ClientSize), data_width, range_x, data_height, range_y)
+        if self._plot_pos is not None and self._plot_pos[0] == key:
+            return self._plot_pos[1]
+
+        if bar:
+            pos = bar_plot_to_pos(self._data_x, self._data_y, self.ClientSize,
+                                  data_width, range_x, data_height, range_y)
+        else:
+            pos = line_plot_to_pos(self._data_x, self._data_y, self.ClientSize,
+                                   data_width, range_x, data_height, range_y)
+        self._plot_pos = (key, pos)
+        return pos
+
     def _bar_plot(self, ctx, data, data_width, range_x, data_height, range_y):
         """ Do a bar plot of the current `_data` """
 
         if len(data) < 2:
             return
 
-        vx_to_px = self._val_x_to_pos_x
-        vy_to_py = self._val_y_to_pos_y
-
-        line_to = ctx.line_to
+        pxs, pys = self._get_plot_pos(data_width, range_x, data_height, range_y)
         ctx.set_source_rgb(*self.fill_colour)
-
-        diff = (data[1][0] - data[0][0]) / 2.0
-        px = vx_to_px(data[0][0] - diff, data_width, range_x)
-        py = vy_to_py(0, data_height, range_y)
-
-        ctx.move_to(px, py)
-        # print "-", px, py
-
-        for i, (vx, vy) in enumerate(data[:-1]):
-            py = vy_to_py(vy, data_height, range_y)
-            # print "-", px, py
-            line_to(px, py)
-            px = vx_to_px((data[i + 1][0] + vx) / 2.0, data_width, range_x)
-            # print "-", px, py
-            line_to(px, py)
-
-        py = vy_to_py(data[-1][1], data_height, range_y)
-        # print "-", px, py
-        line_to(px, py)
-
-        diff = (data[-1][0] - data[-2][0]) / 2.0
-        px = vx_to_px(data[-1][0] + diff, data_width, range_x)
-        # print "-", px, py
-        line_to(px, py)
-
-        py = vy_to_py(0, data_height, range_y)
-        # print "-", px, py
-        line_to(px, py)
-
+        trace_path(ctx, pxs, pys)
         ctx.close_path()
         ctx.fill()
 
     def _line_plot(self, ctx, data, data_width, range_x, data_height, range_y):
         """ Do a line plot of the current `_data` """
 
-        ctx.move_to(*self.val_to_pos(data[0], data_width, range_x, data_height, range_y))
+        pxs, pys = self._get_plot_pos(data_width, range_x, data_height, range_y)
+        trace_path(ctx, pxs, pys)
 
         value_to_position = self.val_to_pos
-        line_to = ctx.line_to
-
-        for p in data[1:]:
-            x, y = value_to_position(p, data_width, range_x, data_height, range_y)
-            # logging.debug("drawing to %s", (x, y))
-            line_to(x, y)
-
         if self.plot_closed == PLOT_CLOSE_BOTTOM:
             x, y = value_to_position((range_x[1], 0), data_width, range_x, data_height, range_y)
             ctx.line_to(x, y)
@@ -2090,13 +2100,12 @@ class PlotCanvas(BufferedCanvas):
     def _point_plot(self, ctx, data, data_width, range_x, data_height, range_y):
         """ Do a line plot of the current `_data` """
 
-        value_to_position = self.val_to_pos
+        pxs, pys = self._get_plot_pos(data_width, range_x, data_height, range_y)
         move_to = ctx.move_to
         line_to = ctx.line_to
         bottom_y = self.ClientSize.y
 
-        for p in data:
-            x, y = value_to_position(p, data_width, range_x, data_height, range_y)
+        for x, y in zip(pxs.tolist(), pys.tolist()):
             move_to(x, bottom_y)
             line_to(x, y)
 
@@ -1190,7 +1190,7 @@ class ChronographViewport(PlotViewport):
 
             # Put the data axis with -5% of min and +5% of max:
             # the margin hints the user the display is not clipped
-            extrema = (float(min(data)), float(max(data)))  # float() to avoid numpy arrays
+            extrema = (float(data.min()), float(data.max()))  # float() to avoid numpy arrays
             data_width = extrema[1] - extrema[0]
             if data_width == 0:
                 range_y = (0, extrema[1] * 1.05)
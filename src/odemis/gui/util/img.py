@@ -1115,46 +1115,113 @@ def val_y_to_pos_y(val_y, client_size, data_height=None, range_y=None, data_prop
         return 0
 
 
-def bar_plot(ctx, data, data_width, range_x, data_height, range_y, client_size, fill_colour):
-    """ Do a bar plot of the current `_data` """
+def values_to_pos(xs, ys, client_size, data_width, range_x, data_height, range_y):
+    """ Translate values to positions in pixels, all at once
+    Vectorized version of val_x_to_pos_x() and val_y_to_pos_y(). The values
+    out of range are clipped.
+    xs (numpy array of float): X values
+    ys (numpy array of float): Y values
+    client_size (wx._core.Size)
+    returns (numpy array of float, numpy array of float): X and Y positions
+    """
+    if data_width:
+        pxs = (numpy.clip(xs, range_x[0], range_x[1]) - range_x[0]) * (client_size.x / data_width)
+    else:
+        pxs = numpy.zeros(len(xs))
 
-    if len(data) < 2:
-        return
+    if data_height:
+        pys = (range_y[1] - numpy.clip(ys, range_y[0], range_y[1])) * (client_size.y / data_height)
+    else:
+        pys = numpy.zeros(len(ys))
+
+    return pxs, pys
+
+
+def decimate_minmax(pxs, pys):
+    """ Reduce the number of points to (about) 2 per pixel column
+    Only the points with the minimum and maximum Y in each column are kept, so
+    that the peaks are still visible (contrarily to a simple subsampling). The
+    first and last points are always kept.
+    pxs (numpy array of float): X positions, in increasing order
+    pys (numpy array of float): Y positions
+    returns (numpy array of float, numpy array of float): X and Y positions of
+      the points kept, in the same order
+    """
+    cols = numpy.floor(pxs).astype(numpy.int64)
+    # First index of each column
+    starts = numpy.flatnonzero(numpy.r_[True, cols[1:] != cols[:-1]])
+    if len(pxs) <= 2 * len(starts):
+        return pxs, pys  # Nothing to gain
+
+    # Sort each column by Y => the extremes are the first and last of the column
+    order = numpy.lexsort((pys, cols))
+    ends = numpy.r_[starts[1:], len(pxs)] - 1
+    kept = numpy.unique(numpy.r_[0, order[starts], order[ends], len(pxs) - 1])  # sorted
+    return pxs[kept], pys[kept]
+
+
+def line_plot_to_pos(xs, ys, client_size, data_width, range_x, data_height, range_y):
+    """ Compute the positions of the points of a line plot
+    xs (numpy array of float): X values, in increasing order
+    ys (numpy array of float): Y values
+    client_size (wx._core.Size)
+    returns (numpy array of float, numpy array of float): X and Y positions,
+      decimated to about 2 points per pixel column
+    """
+    pxs, pys = values_to_pos(xs, ys, client_size, data_width, range_x, data_height, range_y)
+    return decimate_minmax(pxs, pys)
 
-    vx_to_px = val_x_to_pos_x
-    vy_to_py = val_y_to_pos_y
 
-    line_to = ctx.line_to
-    ctx.set_source_rgb(*fill_colour)
+def bar_plot_to_pos(xs, ys, client_size, data_width, range_x, data_height, range_y):
+    """ Compute the outline of a bar plot
+    Each bar is centred on its X value, and extends up to the middle of its
+    neighbours.
+    xs (numpy array of float): X values, in increasing order (at least 2)
+    ys (numpy array of float): Y values
+    client_size (wx._core.Size)
+    returns (numpy array of float, numpy array of float): X and Y positions of
+      the outline, starting and finishing at Y = 0, and decimated to about 2
+      points per pixel column
+    """
+    edges = numpy.empty(len(xs) + 1)
+    edges[1:-1] = (xs[:-1] + xs[1:]) / 2
+    edges[0] = xs[0] - (xs[1] - xs[0]) / 2
+    edges[-1] = xs[-1] + (xs[-1] - xs[-2]) / 2
 
-    diff = (data[1][0] - data[0][0]) / 2.0
-    px = vx_to_px(data[0][0] - diff, client_size, data_width, range_x)
-    py = vy_to_py(0, client_size, data_height, range_y)
+    # Each bar is a horizontal segment from its left edge to its right edge
+    bxs = numpy.repeat(edges, 2)[1:-1]
+    bys = numpy.repeat(ys, 2)
+    pxs, pys = values_to_pos(bxs, bys, client_size, data_width, range_x, data_height, range_y)
+    pxs, pys = decimate_minmax(pxs, pys)
 
-    ctx.move_to(px, py)
-    # print "-", px, py
+    _, base_y = values_to_pos([], [0], client_size, data_width, range_x, data_height, range_y)
+    return numpy.r_[pxs[0], pxs, pxs[-1]], numpy.r_[base_y, pys, base_y]
+
+
+def trace_path(ctx, pxs, pys):
+    """ Add the lines going through all the given positions to the current path
+    ctx (cairo.Context): the context to draw on
+    pxs (numpy array of float): X positions
+    pys (numpy array of float): Y positions
+    """
+    line_to = ctx.line_to
+    ctx.move_to(pxs[0], pys[0])
+    for x, y in zip(pxs[1:].tolist(), pys[1:].tolist()):
+        line_to(x, y)
 
-    for i, (vx, vy) in enumerate(data[:-1]):
-        py = vy_to_py(vy, client_size, data_height, range_y)
-        # print "-", px, py
-        line_to(px, py)
-        px = vx_to_px((data[i + 1][0] + vx) / 2.0, client_size, data_width, range_x)
-        # print "-", px, py
-        line_to(px, py)
 
-    py = vy_to_py(data[-1][1], client_size, data_height, range_y)
-    # print "-", px, py
-    line_to(px, py)
+def bar_plot(ctx, data, data_width, range_x, data_height, range_y, client_size, fill_colour):
+    """ Do a bar plot of the current `_data` """
 
-    diff = (data[-1][0] - data[-2][0]) / 2.0
-    px = vx_to_px(data[-1][0] + diff, client_size, data_width, range_x)
-    # print "-", px, py
-    line_to(px, py)
+    if len(data) < 2:
+        return
 
-    py = vy_to_py(0, client_size, data_height, range_y)
-    # print "-", px, py
-    line_to(px, py)
+    data = numpy.asarray(data, dtype=float)
+    pxs, pys = bar_plot_to_pos(data[:, 0], data[:, 1], client_size,
+                               data_width, range_x, data_height, range_y)
 
+    ctx.set_source_rgb(*fill_colour)
+    trace_path(ctx, pxs, pys)
     ctx.close_path()
     ctx.fill()
 
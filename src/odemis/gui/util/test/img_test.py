@@ -828,6 +828,55 @@ class TestOverviewFunctions(unittest.TestCase):
         # self.assertEqual(merged.shape, (10, 10, 3))
         self.assertTrue(numpy.all(merged == 255))
 
+
+class TestPlotPositions(unittest.TestCase):
+    """
+    Test the vectorized computation of the plot positions
+    """
+
+    def test_values_to_pos(self):
+        size = wx.Size(100, 50)
+        xs = numpy.array([0., 5., 10., 12.])
+        ys = numpy.array([-1., 0., 2., 4.])
+        pxs, pys = img.values_to_pos(xs, ys, size, 10, (0, 10), 4, (0, 4))
+        for x, y, px, py in zip(xs, ys, pxs, pys):
+            self.assertAlmostEqual(px, img.val_x_to_pos_x(x, size, 10, (0, 10)))
+            self.assertAlmostEqual(py, img.val_y_to_pos_y(y, size, 4, (0, 4)))
+
+    def test_decimate(self):
+        # Many more points than pixels
+        pxs = numpy.linspace(0, 99.99, 100000)
+        pys = numpy.random.random(pxs.shape) * 50
+        pys[12345] = -10  # a peak (higher value = lower position)
+        dxs, dys = img.decimate_minmax(pxs, pys)
+        self.assertLessEqual(len(dxs), 2 * 100 + 2)
+        self.assertTrue((numpy.diff(dxs) >= 0).all())
+        self.assertIn(-10, dys)
+        self.assertEqual(dxs[0], pxs[0])
+        self.assertEqual(dxs[-1], pxs[-1])
+        self.assertEqual(dys.min(), pys.min())
+        self.assertEqual(dys.max(), pys.max())
+
+        # Less points than pixels => unchanged
+        pxs = numpy.linspace(0, 99, 50)
+        pys = numpy.random.random(pxs.shape)
+        dxs, dys = img.decimate_minmax(pxs, pys)
+        numpy.testing.assert_array_equal(dxs, pxs)
+        numpy.testing.assert_array_equal(dys, pys)
+
+    def test_bar_plot_pos(self):
+        size = wx.Size(100, 50)
+        xs = numpy.array([1., 2., 3.])
+        ys = numpy.array([1., 3., 2.])
+        pxs, pys = img.bar_plot_to_pos(xs, ys, size, 3, (0.5, 3.5), 3, (0, 3))
+        # bottom, 3 bars (2 points each), bottom
+        self.assertEqual(len(pxs), 8)
+        self.assertAlmostEqual(pxs[0], 0)
+        self.assertAlmostEqual(pys[0], 50)
+        self.assertAlmostEqual(pxs[-1], 100)
+        self.assertAlmostEqual(pys[-1], 50)
+        numpy.testing.assert_array_almost_equal(pys[1:-1], [100 / 3, 100 / 3, 0, 0, 50 / 3, 50 / 3])
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -548,10 +548,13 @@ class Microscope(HwComponent):
         if kwargs:
             raise ValueError("Microscope component cannot have initialisation arguments.")
 
-        # These 2 VAs should not modified, but by the backend
+        # These 3 VAs should not modified, but by the backend
         self.alive = _vattributes.VigilantAttribute(set())  # set of components
         # dict str -> int or Exception: name of component -> State
         self.ghosts = _vattributes.VigilantAttribute(dict())
+        # dict str -> (float, float): name of component -> time of start and
+        # end of its (last) instantiation, in s since epoch
+        self.startupTimes = _vattributes.VigilantAttribute(dict())
 
     @roattribute
     def model(self):
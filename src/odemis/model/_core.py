@@ -390,7 +390,7 @@ def createNewContainer(name, validate=True, in_own_process=True):
     # create a container separately
     if in_own_process:
         isready = multiprocessing.Event()
-        p = multiprocessing.Process(name="Container " + name, target=_manageContainer,
+        p = multiprocessing.Process(name="Container " + name, target=_manageContainerProcess,
                                     args=(name, isready))
     else:
         isready = threading.Event()
@@ -444,6 +444,28 @@ def createInNewContainer(container_name, klass, kwargs):
     return container, comp
 
 
+def _reset_logging_locks():
+    """
+    Recreate all the locks of the logging module. To be called in a new process.
+    If a thread was holding one of these locks while the process was forked,
+    the lock would stay acquired forever in the new process.
+    See http://bugs.python.org/issue6721
+    """
+    logging._lock = threading.RLock()
+    for wh in getattr(logging, "_handlerList", []):
+        h = wh()
+        if h is not None:
+            h.createLock()
+
+
+def _manageContainerProcess(name, isready=None):
+    """
+    Same as _manageContainer, but to be run as a separate process
+    """
+    _reset_logging_locks()
+    _manageContainer(name, isready)
+
+
 def _manageContainer(name, isready=None):
     """
     manages the whole life of a container, from birth till death
@@ -29,7 +29,7 @@ import Pyro4
 import inspect
 import logging
 import numpy
-from odemis.model import _metadata
+from odemis.model import _metadata, _shm
 from odemis.util.weak import WeakMethod, WeakRefLostError
 import os
 import threading
@@ -39,6 +39,11 @@ import zmq
 from . import _core
 
 
+# Default number of shared memory slots used by the DataFlows to send the data
+# to other processes (0 to disable the shared memory transport).
+SHM_SLOTS = int(os.environ.get("ODEMIS_DATAFLOW_SHM_SLOTS", "0"))
+
+
 class DataArray(numpy.ndarray):
     """
     Array of data (a numpy nd.array) + metadata.
@@ -187,12 +192,15 @@ class DataFlowBase(object):
 
 # DataFlow object to create on the server (in a component)
 class DataFlow(DataFlowBase):
-    def __init__(self, max_discard=100): # XXX max_discard=100
+    def __init__(self, max_discard=100, shm_slots=None): # XXX max_discard=100
         """
         max_discard (int): mount of messages that can be discarded in a row if
                             a new one is already available. 0 to keep (notify)
                             all the messages (dangerous if callback is slower
                             than the generator).
+        shm_slots (None or int >= 0): number of shared memory slots used to pass
+          the data to the remote listeners without copy. 0 to always send the
+          data over 0MQ. If None, the default (SHM_SLOTS) is used.
         """
         DataFlowBase.__init__(self)
         # different from ._listeners for notify() to do different things
@@ -202,6 +210,10 @@ class DataFlow(DataFlowBase):
         self._ctx = None
         self.pipe = None
         self._max_discard = max_discard
+        if shm_slots is None:
+            shm_slots = SHM_SLOTS
+        self._shm_slots = shm_slots
+        self._shm_ring = None
 
     def _getproxystate(self):
         """
@@ -276,6 +288,13 @@ class DataFlow(DataFlowBase):
         logging.debug("server is registered to send to " + "ipc://" + self._global_name)
         self.pipe.bind("ipc://" + self._global_name)
 
+        if self._shm_slots > 0:
+            if _shm.is_available():
+                self._shm_ring = _shm.ShmRingWriter(self._shm_slots)
+            else:
+                logging.info("Shared memory not available, will send data of %s over 0MQ",
+                             self._global_name)
+
     def _unregister(self):
         """
         unregister the dataflow from the daemon and clean up the 0MQ bindings
@@ -288,6 +307,9 @@ class DataFlow(DataFlowBase):
             self.pipe = None
             self._ctx.term()
             self._ctx = None
+        if self._shm_ring:
+            self._shm_ring.close()
+            self._shm_ring = None
 
     def _count_listeners(self):
         return len(self._listeners) + len(self._remote_listeners)
@@ -364,21 +386,31 @@ class DataFlow(DataFlowBase):
 
             # TODO thread-safe for self.pipe ?
             dformat = {"dtype": str(data.dtype), "shape": data.shape}
+            shmd = None
+            if self._shm_ring and data.nbytes >= _shm.MIN_SIZE:
+                # Only the description of the slot is sent, and the data
+                # is empty. If no slot is free, it's sent the normal way.
+                shmd = self._shm_ring.write(data)
+                if shmd is not None:
+                    dformat["shm"] = shmd
             self.pipe.send_pyobj(dformat, zmq.SNDMORE)
             self.pipe.send_pyobj(data.metadata, zmq.SNDMORE)
-            try:
-                if not data.flags["C_CONTIGUOUS"]:
-                    # if not in C order, it will be received incorrectly
-                    # TODO: if it's just rotated, send the info to reconstruct it
-                    # and avoid the memory copy
-                    raise TypeError("Need C ordered array")
-                self.pipe.send(numpy.getbuffer(data), copy=False)
-            except TypeError:
-                # not all buffers can be sent zero-copy (e.g., has strides)
-                # try harder by copying (which removes the strides)
-                logging.debug("Failed to send data with zero-copy")
-                data = numpy.require(data, requirements=["C_CONTIGUOUS"])
-                self.pipe.send(numpy.getbuffer(data), copy=False)
+            if shmd is not None:
+                self.pipe.send(b"")
+            else:
+                try:
+                    if not data.flags["C_CONTIGUOUS"]:
+                        # if not in C order, it will be received incorrectly
+                        # TODO: if it's just rotated, send the info to reconstruct it
+                        # and avoid the memory copy
+                        raise TypeError("Need C ordered array")
+                    self.pipe.send(numpy.getbuffer(data), copy=False)
+                except TypeError:
+                    # not all buffers can be sent zero-copy (e.g., has strides)
+                    # try harder by copying (which removes the strides)
+                    logging.debug("Failed to send data with zero-copy")
+                    data = numpy.require(data, requirements=["C_CONTIGUOUS"])
+                    self.pipe.send(numpy.getbuffer(data), copy=False)
 
         # publish locally
         DataFlowBase.notify(self, data)
@@ -517,6 +549,9 @@ class SubscribeProxyThread(threading.Thread):
             self._data.hwm = 0
         self._data.connect("ipc://" + uri)
 
+        # access to the shared memory, if the publisher uses it
+        self._shm = _shm.ShmRingReader()
+
         # TODO: we need a more advance support for max_discards to be able to
         # ensure all the data is received when the client needs it.
         # API should be either:
@@ -573,8 +608,17 @@ class SubscribeProxyThread(threading.Thread):
 #                     if discarded:
 #                         logging.debug("Dataflow %s dropped %d arrays", self.uri, discarded)
                     discarded = 0
+                    shmd = array_format.get("shm")
+                    if shmd is not None:
+                        # The data is in shared memory
+                        array = self._shm.read(shmd, array_format["dtype"],
+                                               array_format["shape"])
+                        if array is None:
+                            # Slot already reused => as if it was discarded
+                            logging.debug("Dropping array of %s, no more in shared memory", self.uri)
+                            continue
                     # TODO: any need to use zmq.utils.rebuffer.array_from_buffer()?
-                    if len(array_buf):
+                    elif len(array_buf):
                         array = numpy.frombuffer(array_buf, dtype=array_format["dtype"])
                     else: # frombuffer doesn't support zero length array
                         array = numpy.empty((0,), dtype=array_format["dtype"])
@@ -597,6 +641,7 @@ class SubscribeProxyThread(threading.Thread):
                 self._data.close()
             except Exception:
                 print("Exception closing ZMQ data connection")
+            self._shm.close()
 
 
 def unregister_dataflows(self):
@@ -25,6 +25,8 @@ These are the conventional metadata available in a DataArray.
 # This list of constants are used as key for the metadata
 MD_EXP_TIME = "Exposure time" # s
 MD_ACQ_DATE = "Acquisition date" # s since epoch
+MD_INTEGRATION_COUNT = "Integration count"  # int, number of frames summed to obtain the data (default: 1)
+MD_DROPPED_FRAMES = "Dropped frames"  # int, number of frames lost by the detector since the previous data
 MD_AD_LIST = "Acquisition dates" # s since epoch for each element in dimension T
 # distance between two points on the sample that are seen at the centre of two
 # adjacent pixels considering that these two points are in focus
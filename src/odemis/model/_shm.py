@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 18 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms
+of the GNU General Public License version 2 as published by the Free Software
+Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+# Shared-memory transport for the DataFlows. The publisher copies each array
+# into a "slot" (a file in /dev/shm, mapped in memory), and only a small
+# descriptor of the slot is sent over 0MQ. The subscriber maps the same file
+# and gets a DataArray which directly points to the shared memory.
+#
+# Each slot is protected by a flock():
+#  * the publisher takes an exclusive lock while writing the array. It never
+#    waits: if the slot is locked, it tries the next one.
+#  * each subscriber (process) takes a shared lock as long as at least one
+#    DataArray on the slot is still referenced.
+# A generation number is written at the beginning of the slot, so that the
+# subscriber can detect that the slot has been reused after the descriptor
+# was sent (in which case the array is dropped, as if it had been discarded).
+
+from __future__ import division
+
+import errno
+import fcntl
+import logging
+import mmap
+import numpy
+import os
+import struct
+import threading
+
+
+SHM_DIR = "/dev/shm"
+# The header contains the generation number (uint64). It's larger than needed
+# to keep the data aligned on a cache line.
+HEADER_SIZE = 64
+HEADER_FMT = "<Q"
+# Arrays smaller than this are not worthy of the shared memory (the 0MQ copy
+# is cheaper than locking and mapping)
+MIN_SIZE = 64 * 1024
+
+
+def is_available():
+    """
+    return (bool): True if shared memory can be used on this computer
+    """
+    return os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK)
+
+
+def _try_lock(fd, operation):
+    """
+    Non-blocking flock
+    return (bool): True if the lock was acquired
+    """
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except IOError as ex:
+        if ex.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return False
+        raise
+    return True
+
+
+class _WriterSlot(object):
+    """
+    One shared memory slot, as seen by the publisher
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o660)
+        self.mm = None
+        self.size = 0
+
+    def ensure_size(self, size):
+        """
+        Grow the slot, so that it can contain at least the given size.
+        Must be called with the exclusive lock taken.
+        size (int): number of bytes needed
+        """
+        if size <= self.size:
+            return
+        size = ((size - 1) // mmap.PAGESIZE + 1) * mmap.PAGESIZE
+        if self.mm is not None:
+            self.mm.close()
+        os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+        self.size = size
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        os.close(self.fd)
+        try:
+            os.remove(self.path)
+        except OSError:
+            logging.debug("Failed to remove shared memory file %s", self.path)
+
+
+class ShmRingWriter(object):
+    """
+    Ring of shared memory slots, used by the publisher of a DataFlow
+    """
+    def __init__(self, nslots):
+        """
+        nslots (int > 0): number of slots. The more slots, the more arrays can
+          be held at the same time by the subscribers, before falling back to
+          the normal (copy) transport.
+        """
+        assert nslots > 0
+        self._prefix = os.path.join(SHM_DIR, "odemis-df-%x-%x" % (os.getpid(), id(self)))
+        self._slots = [None] * nslots
+        self._next = 0  # index of the slot to try first
+        self._gen = 0  # last generation number used
+        self._lock = threading.Lock()
+
+    def _get_slot(self, idx):
+        slot = self._slots[idx]
+        if slot is None:
+            slot = _WriterSlot("%s-%d" % (self._prefix, idx))
+            self._slots[idx] = slot
+        return slot
+
+    def write(self, data):
+        """
+        Copy the data into a slot which is not used by any subscriber.
+        data (numpy.ndarray): the array to share
+        return (dict or None): descriptor of the slot (to be passed to
+          ShmRingReader.read()), or None if all the slots are in use.
+        """
+        with self._lock:
+            nslots = len(self._slots)
+            for i in range(nslots):
+                idx = (self._next + i) % nslots
+                slot = self._get_slot(idx)
+                if not _try_lock(slot.fd, fcntl.LOCK_EX):
+                    continue  # some subscriber still holds data in this slot
+
+                try:
+                    slot.ensure_size(HEADER_SIZE + data.nbytes)
+                    self._gen += 1
+                    struct.pack_into(HEADER_FMT, slot.mm, 0, self._gen)
+                    dest = numpy.ndarray(data.shape, data.dtype, buffer=slot.mm,
+                                         offset=HEADER_SIZE)
+                    dest[...] = data  # takes care of the strides
+                finally:
+                    fcntl.flock(slot.fd, fcntl.LOCK_UN)
+
+                self._next = (idx + 1) % nslots
+                return {"path": slot.path, "gen": self._gen}
+
+        return None
+
+    def close(self):
+        """
+        Remove all the slots. The subscribers still holding arrays can continue
+        to use them.
+        """
+        with self._lock:
+            for i, slot in enumerate(self._slots):
+                if slot is not None:
+                    slot.close()
+                    self._slots[i] = None
+
+
+class _ReaderSlot(object):
+    """
+    One shared memory slot, as seen by a subscriber
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.mm = None
+        self.size = 0
+        self.count = 0  # number of _SlotView alive
+        self._lock = threading.Lock()
+
+    def acquire(self, gen):
+        """
+        Lock the slot for reading
+        gen (int): the expected generation number
+        return (bool): True if the slot is locked and contains the generation,
+          False otherwise (and the lock is not held).
+        """
+        with self._lock:
+            if self.count == 0:
+                # The publisher only holds the lock for the time of a copy
+                fcntl.flock(self.fd, fcntl.LOCK_SH)
+                size = os.fstat(self.fd).st_size
+                if size != self.size:
+                    # It has been resized (and no array uses the old map)
+                    self.mm = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+                    self.size = size
+
+            if struct.unpack_from(HEADER_FMT, self.mm, 0)[0] != gen:
+                if self.count == 0:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+                return False
+
+            self.count += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.count -= 1
+            if self.count == 0:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def __del__(self):
+        try:
+            os.close(self.fd)
+        except Exception:
+            pass
+
+
+class _SlotView(object):
+    """
+    Owner of the memory of the arrays pointing to a slot. As it's the base of
+    all these arrays (and their views), it's deleted only when the last of them
+    is deleted, at which point the slot is released.
+    """
+    def __init__(self, slot, array):
+        self._slot = slot
+        self._array = array  # keeps the mmap referenced
+        self.__array_interface__ = array.__array_interface__
+
+    def __del__(self):
+        self._slot.release()
+
+
+class ShmRingReader(object):
+    """
+    Access to the shared memory slots, used by the subscriber of a DataFlow
+    """
+    def __init__(self):
+        self._slots = {}  # path -> _ReaderSlot
+
+    def read(self, desc, dtype, shape):
+        """
+        Get the array stored in a slot, without copy.
+        desc (dict): descriptor as returned by ShmRingWriter.write()
+        dtype (numpy.dtype): type of the array
+        shape (tuple of int): shape of the array
+        return (numpy.ndarray or None): read-only array pointing to the shared
+          memory, or None if the data is not available anymore.
+        """
+        path = desc["path"]
+        slot = self._slots.get(path)
+        if slot is None:
+            try:
+                slot = _ReaderSlot(path)
+            except OSError:
+                logging.warning("Failed to open shared memory %s", path)
+                return None
+            self._slots[path] = slot
+
+        if not slot.acquire(desc["gen"]):
+            return None
+
+        dtype = numpy.dtype(dtype)
+        count = int(numpy.prod(shape))
+        try:
+            array = numpy.frombuffer(slot.mm, dtype=dtype, count=count,
+                                     offset=HEADER_SIZE)
+        except Exception:
+            slot.release()
+            raise
+        # The view will release the slot when all the arrays are gone
+        return numpy.asarray(_SlotView(slot, array)).reshape(shape)
+
+    def close(self):
+        """
+        Forget about all the slots. The arrays already returned stay valid.
+        """
+        self._slots = {}
@@ -23,7 +23,10 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 from Pyro4.core import oneway
 from odemis import model
+from odemis.model import _shm
+import gc
 import logging
+import numpy
 import pickle
 import threading
 import time
@@ -295,6 +298,68 @@ class TestDataFlow(unittest.TestCase):
         
         self.assertEqual(self.left, 0)
 
-        
+
+
+@unittest.skipUnless(_shm.is_available(), "No shared memory available")
+class TestShm(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = _shm.ShmRingWriter(2)
+        self.reader = _shm.ShmRingReader()
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def test_read_write(self):
+        data = numpy.arange(512 * 256, dtype=numpy.uint16).reshape(512, 256)
+        desc = self.writer.write(data)
+        self.assertIsNotNone(desc)
+        rdata = self.reader.read(desc, str(data.dtype), data.shape)
+        numpy.testing.assert_array_equal(rdata, data)
+        self.assertFalse(rdata.flags.writeable)
+
+        # Stridden array
+        sdata = data[:, ::2]
+        desc = self.writer.write(sdata)
+        rdata = self.reader.read(desc, str(sdata.dtype), sdata.shape)
+        numpy.testing.assert_array_equal(rdata, sdata)
+
+        # Bigger array than before => the slot is resized
+        bdata = numpy.ones((1024, 1024), dtype=numpy.uint32)
+        desc = self.writer.write(bdata)
+        rdata = self.reader.read(desc, str(bdata.dtype), bdata.shape)
+        numpy.testing.assert_array_equal(rdata, bdata)
+
+    def test_slot_reuse(self):
+        """
+        Check a slot is not reused while a reader has an array on it
+        """
+        data = [numpy.zeros((256, 256), dtype=numpy.uint16) + i for i in range(4)]
+        desc0 = self.writer.write(data[0])
+        rdata0 = self.reader.read(desc0, "uint16", (256, 256))
+        view0 = rdata0[10:20, 10:20]
+        del rdata0
+        desc1 = self.writer.write(data[1])
+        rdata1 = self.reader.read(desc1, "uint16", (256, 256))
+
+        # Both slots are in use => no more slot available
+        self.assertIsNone(self.writer.write(data[2]))
+        numpy.testing.assert_array_equal(view0, 0)
+        numpy.testing.assert_array_equal(rdata1, 1)
+
+        # Releasing the last view frees the slot
+        del view0
+        gc.collect()
+        desc2 = self.writer.write(data[2])
+        self.assertIsNotNone(desc2)
+        self.assertEqual(desc2["path"], desc0["path"])
+
+        # The old descriptor is not valid anymore
+        self.assertIsNone(self.reader.read(desc0, "uint16", (256, 256)))
+        rdata2 = self.reader.read(desc2, "uint16", (256, 256))
+        numpy.testing.assert_array_equal(rdata2, 2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -616,6 +616,56 @@ class RemoteTest(unittest.TestCase):
         self.assertEqual(count_end, self.count)
         self.assertGreaterEqual(count_end, 1)
 
+    def test_dataflow_shm(self):
+        """
+        Check the data passed via shared memory is correct
+        """
+        self.count = 0
+        self.data_arrays_sent = 0
+        self.expected_shape = (2048, 2048)
+        self.comp.datashm.reset()
+
+        self.comp.datashm.subscribe(self.receive_data_check)
+        time.sleep(0.5)
+        self.comp.datashm.unsubscribe(self.receive_data_check)
+        count_end = self.count
+        print "received %d arrays over %d" % (self.count, self.data_arrays_sent)
+
+        time.sleep(0.1)
+        self.assertEqual(count_end, self.count)
+        self.assertGreaterEqual(count_end, 1)
+
+    def test_dataflow_throughput(self):
+        """
+        Compare the number of arrays received per second via 0MQ and via
+        shared memory
+        """
+        self.expected_shape = (2048, 2048)
+        dur = 3  # s
+        fps = {}
+        for dfname in ("data", "datashm"):
+            df = getattr(self.comp, dfname)
+            df.reset()
+            self.count = 0
+            self.data_arrays_sent = 0
+            df.subscribe(self.receive_data)
+            time.sleep(dur)
+            df.unsubscribe(self.receive_data)
+            fps[dfname] = self.count / dur
+            time.sleep(0.1)
+
+        size = numpy.prod(self.expected_shape) * 2 / 2 ** 20  # MB
+        for dfname, v in fps.items():
+            print "%s: %g arrays/s = %g MB/s" % (dfname, v, v * size)
+        self.assertGreater(fps["datashm"], 0)
+
+    def receive_data_check(self, dataflow, data):
+        self.receive_data(dataflow, data)
+        # Check the content is the one generated
+        row = data[0, 0] % data.shape[0]
+        if row:
+            self.assertTrue(numpy.all(data[row, :] == 255))
+
     def receive_data(self, dataflow, data):
         self.count += 1
         self.assertEqual(data.shape, self.expected_shape)
@@ -828,6 +878,7 @@ class MyComponent(model.Component):
         self.startAcquire = model.Event() # triggers when the acquisition of .data starts
         self.data = FakeDataFlow(sae=self.startAcquire)
         self.datas = SynchronizableDataFlow()
+        self.datashm = FakeDataFlow(shm_slots=4)
 
         self.data_count = 0
         self._df = None
@@ -24,6 +24,7 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division, print_function
 
 import argparse
+from concurrent import futures
 import grp
 from logging import FileHandler
 import logging
@@ -45,6 +46,9 @@ import yaml
 
 DEFAULT_SETTINGS_FILE = "/etc/odemis-settings.yaml"
 
+# Maximum number of components instantiated simultaneously
+MAX_PARALLEL_INSTANTIATIONS = 8
+
 status_to_xtcode = {BACKEND_RUNNING: 0,
                     BACKEND_DEAD: 1,
                     BACKEND_STOPPED: 2,
@@ -76,6 +80,9 @@ class BackendContainer(model.Container):
         self._inst_thread = None # thread running the component instantiation
         self._must_stop = threading.Event()
         self._dry_run = dry_run
+        # Protects the update of .alive, .ghosts, .startupTimes and of the
+        # persistent data, as the components are instantiated in parallel
+        self._inst_lock = threading.RLock()
         # TODO: have an argument to ask for disabling parallel start? same as create_sub_containers?
 
         # parse the instantiation file
@@ -107,13 +114,15 @@ class BackendContainer(model.Container):
         """
 
         def on_va_change(value, comp_name=comp.name, prop_name=prop_name):
-            self._persistent_data[comp_name]['properties'][prop_name] = value
-            self._write_persistent_data()
+            with self._inst_lock:
+                self._persistent_data[comp_name]['properties'][prop_name] = value
+                self._write_persistent_data()
 
-        self._persistent_data.setdefault(comp.name, {}).setdefault('properties', {})
         try:
             va = getattr(comp, prop_name)
-            self._persistent_data[comp.name]['properties'][prop_name] = va.value
+            with self._inst_lock:
+                self._persistent_data.setdefault(comp.name, {}).setdefault('properties', {})
+                self._persistent_data[comp.name]['properties'][prop_name] = va.value
         except AttributeError:
             logging.warning("Persistent property %s not found for component %s." % (prop_name, comp.name))
         else:     
@@ -124,17 +133,18 @@ class BackendContainer(model.Container):
         """
         Update all metadata in ._persistent_data and write values to settings file.
         """
-        for comp in self._instantiator.components:
-            _, md_names = self._instantiator.get_persistent(comp.name)
-            md_values = comp.getMetadata()
-            for md in md_names:
-                self._persistent_data.setdefault(comp.name, {}).setdefault('metadata', {})
-                fullname = "MD_" + md
-                try:
-                    self._persistent_data[comp.name]['metadata'][md] = md_values[getattr(model, fullname)]
-                except KeyError:
-                    logging.warning("Persistent metadata %s not found on component %s" % (md, comp.name))
-        self._write_persistent_data()
+        with self._inst_lock:
+            for comp in list(self._instantiator.components):
+                _, md_names = self._instantiator.get_persistent(comp.name)
+                md_values = comp.getMetadata()
+                for md in md_names:
+                    self._persistent_data.setdefault(comp.name, {}).setdefault('metadata', {})
+                    fullname = "MD_" + md
+                    try:
+                        self._persistent_data[comp.name]['metadata'][md] = md_values[getattr(model, fullname)]
+                    except KeyError:
+                        logging.warning("Persistent metadata %s not found on component %s" % (md, comp.name))
+            self._write_persistent_data()
 
     def _write_persistent_data(self):
         """
@@ -143,9 +153,10 @@ class BackendContainer(model.Container):
         if not self._settings or self._dry_run:
             return
 
-        self._settings.truncate(0)  # delete previous file contents
-        self._settings.seek(0)  # go back to position 0
-        yaml.safe_dump(self._persistent_data, self._settings)
+        with self._inst_lock:
+            self._settings.truncate(0)  # delete previous file contents
+            self._settings.seek(0)  # go back to position 0
+            yaml.safe_dump(self._persistent_data, self._settings)
 
     def run(self):
         # Create the root
@@ -197,57 +208,66 @@ class BackendContainer(model.Container):
 
             mic = self._instantiator.microscope
             failed = set() # set of str: name of components that failed recently
-            while not self._must_stop.is_set():
-                # Try to start simultaneously all the components that are
-                # independent from each other
-                nexts = set()
-                while not nexts:
-                    instantiated = set(c.name for c in mic.alive.value) | {mic.name}
+            running = {}  # Future -> str: name of the components being instantiated
+            reported = False  # whether the startup timeline has been logged
+            executor = futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_INSTANTIATIONS)
+            try:
+                while not self._must_stop.is_set():
+                    # Start simultaneously all the components that are
+                    # independent from each other, and as soon as a component
+                    # is alive, start the ones which were depending on it.
+                    with self._inst_lock:
+                        instantiated = set(c.name for c in mic.alive.value) | {mic.name}
                     nexts = self._instantiator.get_instantiables(instantiated)
-                    # If still some non-failed component, immediately try again,
-                    # otherwise give some time for things to get fixed or broken
-                    nexts -= failed
-                    if not nexts:
+                    nexts -= failed | set(running.values())
+                    if nexts:
+                        logging.debug("Trying to instantiate comp: %s", ", ".join(nexts))
+
+                    for n in nexts:
+                        with self._inst_lock:
+                            ghosts = mic.ghosts.value.copy()
+                            if n not in ghosts:
+                                logging.warning("going to instantiate %s but not a ghost", n)
+                            ghosts[n] = ST_STARTING
+                            mic.ghosts.value = ghosts
+                        f = executor.submit(self._start_component, n)
+                        running[f] = n
+
+                    if not running:
+                        # Nothing more can be started for now
+                        if not reported:
+                            self._log_startup_times()
+                            reported = True
                         if self._dry_run:
                             return # everything instantiated, good enough
 
+                        # Give some time for things to get fixed or broken
                         if self._must_stop.wait(10):
                             return
                         failed = set() # not recent anymore
-
-                logging.debug("Trying to instantiate comp: %s", ", ".join(nexts))
-
-                for n in nexts:
-                    ghosts = mic.ghosts.value.copy()
-                    if n not in ghosts:
-                        logging.warning("going to instantiate %s but not a ghost", n)
-                    # TODO: run each of them in a future, so that they start
-                    # in parallel, and (bonus) when the future is done, check
-                    # immediately which component can be started. The only
-                    # difficulty is to ensure non-concurrent access to .ghosts
-                    # and .alive .
-                    try:
-                        ghosts[n] = ST_STARTING
-                        mic.ghosts.value = ghosts
-                        newcmps = self._instantiate_component(n)
-                        if self._must_stop.is_set():
-                            # in case the termination was too late to stop these new component
-                            for c in newcmps:
-                                try:
-                                    c.terminate()
-                                except Exception:
-                                    logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
-                            break
-                    except ValueError:
-                        if self._dry_run:
-                            raise
-                        # We now need to stop, but cannot call terminate()
-                        # directly, as it would deadlock, waiting for us
-                        logging.debug("Stopping instantiation due to unrecoverable error")
-                        threading.Thread(target=self.terminate).start()
-                        return
-                    if not newcmps:
-                        failed.add(n)
+                        continue
+
+                    # Regularly check whether we should stop
+                    done, _ = futures.wait(running.keys(), timeout=1,
+                                           return_when=futures.FIRST_COMPLETED)
+                    for f in done:
+                        n = running.pop(f)
+                        try:
+                            newcmps = f.result()
+                        except ValueError:
+                            if self._dry_run:
+                                raise
+                            # We now need to stop, but cannot call terminate()
+                            # directly, as it would deadlock, waiting for us
+                            logging.debug("Stopping instantiation due to unrecoverable error")
+                            threading.Thread(target=self.terminate).start()
+                            return
+                        if not newcmps:
+                            failed.add(n)
+            finally:
+                # The components still starting will be terminated by
+                # _start_component(), as _must_stop is set.
+                executor.shutdown(wait=True)
 
         except Exception:
             logging.exception("Instantiator thread failed")
@@ -255,6 +275,37 @@ class BackendContainer(model.Container):
         finally:
             logging.debug("Instantiator thread finished")
 
+    def _start_component(self, name):
+        """
+        Instantiate a component, and terminate it immediately if the backend
+          is stopping. To be run in a separate thread.
+        return (set of HwComponent): see _instantiate_component()
+        raise ValueError: see _instantiate_component()
+        """
+        newcmps = self._instantiate_component(name)
+        if self._must_stop.is_set():
+            # in case the termination was too late to stop these new component
+            for c in newcmps:
+                try:
+                    c.terminate()
+                except Exception:
+                    logging.warning("Failed to terminate component '%s'", c.name, exc_info=True)
+        return newcmps
+
+    def _log_startup_times(self):
+        """
+        Log the timeline of the instantiation of all the components
+        """
+        times = self._instantiator.microscope.startupTimes.value
+        if not times:
+            return
+        t0 = min(s for s, e in times.values())
+        tend = max(e for s, e in times.values())
+        lines = ["%-32s %8.3f %8.3f" % (n, s - t0, e - s)
+                 for n, (s, e) in sorted(times.items(), key=lambda i: i[1])]
+        logging.info("Components started in %.3f s (name, start (s), duration (s)):\n%s",
+                     tend - t0, "\n".join(lines))
+
     def _instantiate_component(self, name):
         """
         Instantiate a component and handle the outcome
@@ -266,15 +317,17 @@ class BackendContainer(model.Container):
         # TODO: use the AST from the microscope (instead of the original one
         # in _instantiator) to allow modifying it online?
         mic = self._instantiator.microscope
-        ghosts = mic.ghosts.value.copy()
+        tstart = time.time()
         try:
             comp = self._instantiator.instantiate_component(name)
         except model.HwError as exp:
             # HwError means: hardware problem, try again later
             logging.warning("Failed to start component %s due to device error: %s",
                             name, exp)
-            ghosts[name] = exp
-            mic.ghosts.value = ghosts
+            with self._inst_lock:
+                ghosts = mic.ghosts.value.copy()
+                ghosts[name] = exp
+                mic.ghosts.value = ghosts
             return set()
         except Exception as exp:
             # Anything else means: microscope file or driver is borked => give up
@@ -288,15 +341,22 @@ class BackendContainer(model.Container):
                 pass
             raise ValueError("Failed to instantiate component %s" % name)
         else:
+            tend = time.time()
+            logging.debug("Component %s started in %g s", name, tend - tstart)
             children = self._instantiator.get_children(comp)
             dchildren = self._instantiator.get_delegated_children(name)
             newcmps = set(c for c in children if c.name in dchildren)
-            mic.alive.value = mic.alive.value | newcmps
-            # update ghosts by removing all the new components
-            for n in dchildren:
-                del ghosts[n]
-
-            mic.ghosts.value = ghosts
+            with self._inst_lock:
+                mic.alive.value = mic.alive.value | newcmps
+                # update ghosts by removing all the new components
+                ghosts = mic.ghosts.value.copy()
+                for n in dchildren:
+                    del ghosts[n]
+                mic.ghosts.value = ghosts
+
+                stimes = mic.startupTimes.value.copy()
+                stimes[name] = (tstart, tend)
+                mic.startupTimes.value = stimes
 
             for c in newcmps:
                 prop_names, _ = self._instantiator.get_persistent(c.name)
@@ -31,6 +31,7 @@ import logging
 from odemis import model
 from odemis.util import mock
 import re
+import threading
 import yaml
 
 
@@ -167,6 +168,9 @@ class Instantiator(object):
         self._comp_container = {}  # comp name -> container: the container that runs the given component
         self.create_sub_containers = create_sub_containers # flag for creating sub-containers
         self.dry_run = dry_run # flag for instantiating mock version of the components
+        # Protects .components, .sub_containers and the children of the
+        # microscope, as several components can be instantiated simultaneously
+        self._lock = threading.RLock()
 
         self._preparate_microscope()
 
@@ -560,7 +564,8 @@ class Instantiator(object):
             if cont is None:
                 # new container has the same name as the component
                 cont, comp = model.createInNewContainer(name, class_comp, args)
-                self.sub_containers[name] = cont
+                with self._lock:
+                    self.sub_containers[name] = cont
             else:
                 logging.debug("Creating %s in container %s", name, cont)
                 comp = cont.instantiate(class_comp, args)
@@ -569,10 +574,12 @@ class Instantiator(object):
             logging.error("Error while instantiating component %s.", name)
             raise
 
-        self.components.add(comp)
-        # Add all the children to our list of components. Useful only if child
-        # created by delegation, but can't hurt to add them all.
-        self.components |= comp.children.value
+        children = comp.children.value
+        with self._lock:
+            self.components.add(comp)
+            # Add all the children to our list of components. Useful only if child
+            # created by delegation, but can't hurt to add them all.
+            self.components |= children
 
         return comp
 
@@ -584,9 +591,10 @@ class Instantiator(object):
         Raises:
              LookupError: if no component is found
         """
-        for comp in self.components:
-            if comp.name == name:
-                return comp
+        with self._lock:
+            for comp in self.components:
+                if comp.name == name:
+                    return comp
         raise LookupError("No component named '%s' found" % name)
 
     def get_required_components(self, name):
@@ -799,9 +807,10 @@ class Instantiator(object):
             ValueError: if the component has already been instantiated
             KeyError: if component should be created by delegation
         """
-        for c in self.components:
-            if c.name == name:
-                raise ValueError("Trying to instantiate again component %s" % name)
+        with self._lock:
+            for c in self.components:
+                if c.name == name:
+                    raise ValueError("Trying to instantiate again component %s" % name)
 
         comp = self._instantiate_comp(name)
 
@@ -814,7 +823,8 @@ class Instantiator(object):
             self._update_metadata(c.name)
             self._update_affects(c.name)
         newchildren = set(c for c in newcmps if c.name in mchildren)
-        self.microscope.children.value = self.microscope.children.value | newchildren
+        with self._lock:
+            self.microscope.children.value = self.microscope.children.value | newchildren
 
         return comp
 
@@ -830,7 +840,8 @@ class Instantiator(object):
         """
         comps = set()
         if instantiated is None:
-            instantiated = set(c.name for c in self.components)
+            with self._lock:
+                instantiated = set(c.name for c in self.components)
         for n, attrs in self.ast.items():
             if n in instantiated: # should not be already instantiated
                 continue
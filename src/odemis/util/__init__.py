@@ -474,6 +474,120 @@ class RepeatingTimer(threading.Thread):
         self._must_stop.set()
 
 
+class LRUCache(object):
+    """
+    Dictionary-like cache which only keeps the most recently used entries.
+    The cache can be bounded in number of entries and/or in total size of the
+    entries. It is thread-safe.
+    """
+    def __init__(self, max_items=None, max_size=None, sizeof=None):
+        """
+        max_items (None or 0 < int): maximum number of entries
+        max_size (None or 0 <= int): maximum sum of the size of all the entries
+        sizeof (None or callable value -> int): returns the size of an entry.
+          If None, the .nbytes attribute of the value is used (ie, works for
+          numpy arrays).
+        """
+        self._max_items = max_items
+        self._max_size = max_size
+        if sizeof is None:
+            sizeof = lambda v: v.nbytes
+        self._sizeof = sizeof
+        self._entries = collections.OrderedDict()  # key -> (value, size), oldest first
+        self._size = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, value):
+        with self._lock:
+            self._max_size = value
+            self._evict()
+
+    @property
+    def size(self):
+        """
+        (int): sum of the size of all the entries
+        """
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Return the value of the entry, and mark it as recently used
+        """
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def __getitem__(self, key):
+        v = self.get(key, self)
+        if v is self:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key, value):
+        size = self._sizeof(value) if self._max_size is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if self._max_size is not None and size > self._max_size:
+                logging.debug("Not caching entry of %d bytes, bigger than the cache", size)
+                return
+            self._entries[key] = (value, size)
+            self._size += size
+            self._evict()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._size -= self._entries.pop(key)[1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._size -= size
+            return value
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self):
+        """
+        Remove the oldest entries until the cache is within its limits.
+        Must be called with the lock taken.
+        """
+        while self._entries and (
+              (self._max_items is not None and len(self._entries) > self._max_items) or
+              (self._max_size is not None and self._size > self._max_size)):
+            k, (v, size) = self._entries.popitem(last=False)
+            self._size -= size
+
+
 def executeAsyncTask(future, fn, args=(), kwargs=None):
     """
     Execute a task in a separate thread. To follow the state of execution,
@@ -22,10 +22,11 @@ If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import math
+from scipy import sparse
 from scipy.spatial import Delaunay as DelaunayTriangulation
-from scipy.interpolate import LinearNDInterpolator
 import numpy
 from odemis import model
+from odemis.util import LRUCache
 # import matplotlib.pyplot as plt
 
 # Functions to convert/manipulate Angle resolved image to polar projection
@@ -42,6 +43,12 @@ AR_HOLE_DIAMETER = 0.6e-3  # m, diameter of the hole in the mirror
 AR_FOCUS_DISTANCE = 0.5e-3  # m, the vertical mirror cutoff, iow the min distance between the mirror and the sample
 AR_PARABOLA_F = 2.5e-3  # m, parabola_parameter=1/(4f): f: focal point of mirror (place of sample)
 
+# The projection of an image only depends on the geometry (mirror, pole
+# position, pixel size, and output size), so the interpolation matrices are
+# cached, to be reused for all the images acquired with the same settings.
+_projection_cache = LRUCache(max_items=8, max_size=512 * 2 ** 20,
+                             sizeof=lambda m: m.data.nbytes + m.indices.nbytes + m.indptr.nbytes)
+
 
 def _ExtractAngleInformation(data, hole):
     """
@@ -61,6 +68,33 @@ def _ExtractAngleInformation(data, hole):
             Mask is dilated for visualization to avoid edge effects during triangulation
             and interpolation.
     """
+    theta_data, phi_data, omega, circle_mask, circle_mask_dilated = _ExtractAngleGeometry(data, hole)
+
+    # intensity_data contains the intensity values from raw data.
+    # It already reflects the shape of the mirror
+    # and is normalized by omega (solid angle:
+    # measure for photon collection efficiency depending on theta and phi)
+    cropped_image = numpy.where(circle_mask, data, 0)
+    intensity_data = cropped_image / omega
+
+    return theta_data, phi_data, intensity_data, circle_mask_dilated
+
+
+def _ExtractAngleGeometry(data, hole):
+    """
+    Calculates the corresponding theta and phi angles for each pixel in the input data,
+    and the masks to crop the data to angles which are collectible by the system.
+    Only the shape and the metadata of the data are used.
+    :parameter data (model.DataArray): The image that was projected on the detector after being
+      reflected on the parabolic mirror.
+    :returns:
+        theta_data: array containing theta values for each px in raw data
+        phi_data: array containing phi values for each px in raw data
+        omega: array containing the solid angle collected by each px in raw data
+        circle_mask: mask of the pixels which receive light from the mirror
+        circle_mask_dilated: same mask, dilated to avoid edge effects during
+            triangulation and interpolation.
+    """
 
     assert(len(data.shape) == 2)  # => 2D with greyscale
 
@@ -74,8 +108,8 @@ def _ExtractAngleInformation(data, hole):
 
     pole_pos = (pole_x, pole_y)
 
-    # Crop the input image to half circle (set values outside of half circle zero)
-    cropped_image = _CropHalfCircle(data, pixel_size, pole_pos, hole=hole)
+    # Mask to crop the input image to half circle (values outside of half circle are discarded)
+    circle_mask = _CreateMirrorMask(data, pixel_size, pole_pos, hole=hole)
 
     # return dilated circle_mask to crop input data
     # hole=False for dilated mask to avoid edge effects during interpolation
@@ -108,13 +142,73 @@ def _ExtractAngleInformation(data, hole):
     # phi_data: array containing phi values for each px in raw data
     theta_data, phi_data, omega = _FindAngle(x_array, y_array, pixel_size, parabola_f)
 
-    # intensity_data contains the intensity values from raw data.
-    # It already reflects the shape of the mirror
-    # and is normalized by omega (solid angle:
-    # measure for photon collection efficiency depending on theta and phi)
-    intensity_data = cropped_image / omega
+    return theta_data, phi_data, omega, circle_mask, circle_mask_dilated
 
-    return theta_data, phi_data, intensity_data, circle_mask_dilated
+
+def _GetGeometryKey(data, hole):
+    """
+    :returns: (tuple) all the parameters of the data which define the angles
+      of each pixel
+    """
+    md = data.metadata
+    try:
+        pixel_size = tuple(md[model.MD_PIXEL_SIZE])
+        pole_pos = tuple(md[model.MD_AR_POLE])
+    except KeyError:
+        raise ValueError("Metadata required: MD_PIXEL_SIZE, MD_AR_POLE.")
+    return (data.shape, pixel_size, pole_pos,
+            md.get(model.MD_AR_PARABOLA_F, AR_PARABOLA_F),
+            md.get(model.MD_AR_XMAX, AR_XMAX),
+            md.get(model.MD_AR_HOLE_DIAMETER, AR_HOLE_DIAMETER),
+            md.get(model.MD_AR_FOCUS_DISTANCE, AR_FOCUS_DISTANCE),
+            hole)
+
+
+def _ComputeInterpolationMatrix(points, points_px, weights, npx, xi):
+    """
+    Computes the linear interpolation (on the Delaunay triangulation) of
+      scattered points onto given positions, as a matrix.
+    :parameter points: (ndarray of shape (N, 2)) position of each point
+    :parameter points_px: (ndarray of N ints) index of the (flatten) input pixel
+      corresponding to each point. Multiple points can have the same pixel.
+    :parameter weights: (ndarray of shape npx) factor applied to each input pixel
+    :parameter npx: (int) number of input pixels
+    :parameter xi: (ndarray of shape (M, 2)) positions to interpolate
+    :returns: (scipy.sparse.csr_matrix of shape (M, npx)) the matrix which
+      converts the (flatten) input into the interpolated values. The positions
+      outside of the triangulation have no value (ie, they become 0).
+    """
+    # Same as the LinearNDInterpolator, but instead of computing the values, we
+    # only keep the barycentric coordinates of each position in its triangle.
+    triang = DelaunayTriangulation(points)
+    simplex = triang.find_simplex(xi)
+    inside = numpy.flatnonzero(simplex >= 0)
+    simplex = simplex[inside]
+
+    trans = triang.transform[simplex]  # N x 3 x 2
+    bary = numpy.einsum("ijk,ik->ij", trans[:, :2, :], xi[inside] - trans[:, 2, :])
+    bary = numpy.column_stack((bary, 1 - bary.sum(axis=1)))
+
+    cols = points_px[triang.simplices[simplex]]
+    vals = bary * weights[cols]
+    rows = numpy.repeat(inside, 3)
+    # Duplicate entries (same pixel for several points of a triangle) are summed
+    matrix = sparse.csr_matrix((vals.ravel(), (rows, cols.ravel())),
+                               shape=(xi.shape[0], npx))
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def _ApplyProjection(matrix, data, shape):
+    """
+    :parameter matrix: (scipy.sparse matrix) as returned by _ComputeInterpolationMatrix()
+    :parameter data: (2D ndarray) the raw data
+    :parameter shape: (tuple of ints) shape of the output
+    :returns: (ndarray of float) the projected data
+    """
+    qz = matrix.dot(numpy.asarray(data, dtype=numpy.float64).ravel())
+    qz.shape = shape
+    return qz
 
 
 def _FindAngle(x_array, y_array, pixel_size, parabola_f):
@@ -172,20 +266,49 @@ def AngleResolved2Polar(data, output_size, hole=True):
     :parameter hole: (boolean) Crop the pole if True
     :returns: (model.DataArray) converted image in polar view
     """
+    # The angles are all the same for a given mirror shape, so the conversion
+    # is computed once, and then reused.
+    key = ("polar", output_size) + _GetGeometryKey(data, hole)
+    matrix = _projection_cache.get(key)
+    if matrix is None:
+        matrix = _ComputePolarMatrix(data, output_size, hole)
+        _projection_cache[key] = matrix
+
+    qz = _ApplyProjection(matrix, data, (output_size, output_size))
+    # polar coordinate transformation starts with 0 at horizontal axis by definition
+    qz = numpy.rot90(qz)  # rotate by 90 degrees CCW so we start 0 at top (angles will be CW orientated)
+    qz[numpy.isnan(qz)] = 0  # remove NaNs (from the input data)
+    assert numpy.all(qz > -1)  # there should be no negative values, some very small due to interpolation are possible
+    qz[qz < 0] = 0  # all negative values (due to interpolation or wrong background subtraction) set to zero
 
+    result = model.DataArray(qz, data.metadata)
+
+    return result
+
+
+def _ComputePolarMatrix(data, output_size, hole):
+    """
+    Computes the conversion of an angle resolved image to polar projection
+    :parameter data: (model.DataArray) The image, as for AngleResolved2Polar()
+    :parameter output_size: (int) The size of the output (assumed to be square)
+    :parameter hole: (boolean) Crop the pole if True
+    :returns: (scipy.sparse.csr_matrix) matrix of shape (output_size², number of
+      pixels in data), before rotation.
+    """
     # calculate the corresponding theta and phi angles based on the geometrical properties
     # of the mirror for each px on the raw data
-    # TODO the angles are all the same for a given mirror shape
     # TODO runtime could be improved by calc mirror shape with pole pos at center and always move data to center
-    # TODO implement: if not theta, phi, intensity -> calc angles
-    theta_data, phi_data, intensity_data, circle_mask_dilated = _ExtractAngleInformation(data, hole)
+    theta_data, phi_data, omega, circle_mask, circle_mask_dilated = _ExtractAngleGeometry(data, hole)
+    # intensity (after cropping to the mirror) normalized by omega (solid angle:
+    # measure for photon collection efficiency depending on theta and phi)
+    weights = numpy.where(circle_mask, 1 / omega, 0).ravel()
 
     # Crop the raw input data based on the mirror mask (circle_mask) to save memory and improve runtime.
     # We use a dilated mask for cropping to avoid edge effects during triangulation and interpolation.
-    # The additional data points (due to dilation) will be set to zero during the interpolation step by intensity_data.
+    # The additional data points (due to dilation) will be set to zero during the interpolation step by the weights.
     theta_data_masked = theta_data[circle_mask_dilated]  # list of values for theta within mask
     phi_data_masked = phi_data[circle_mask_dilated]  # list of values for phi within mask
-    intensity_data_masked = intensity_data[circle_mask_dilated]  # list of values for intensity within mask
+    px_masked = numpy.flatnonzero(circle_mask_dilated)  # index of the corresponding pixels
 
     # Convert the spherical coordinates theta and phi into polar coordinates for display in GUI
     # theta equals radial distance r to center of whole (0 - 90 degree)
@@ -200,47 +323,21 @@ def AngleResolved2Polar(data, output_size, hole=True):
     # Therefore, not all px in the output image are populated.
     # Moreover, the data is masked with the mirror shape (mask_circle).
     # Therefore, we perform a delaunay triangulation of the given data points.
-    # The delaunay object is passed to the interpolator with the corresponding intensity values (intensity_data).
-    # The interpolator also receives a meshgrid (set of coordinates) of the size specified for the output image.
-    # The input data points (theta and phi) are mapped on the meshgrid. As the meshgrid contains much more positions
-    # compared to the input data points, the interpolator fills up the empty grid positions with intensity values.
-    # These intensity values are interpolated from the intensity values of the positions spanning the triangle they
-    # are contained in (triangle from delaunay triangulation).
-    # Grid positions located outside of any delaunay triangle are set to NaN.
+    # Each position of the meshgrid (set of coordinates) of the size specified for the output image
+    # is interpolated from the intensity values of the positions spanning the triangle it is
+    # contained in (triangle from delaunay triangulation).
+    # Grid positions located outside of any delaunay triangle are set to 0.
 
     # Note: delaunay triangulation input points: ndarray of floats, shape (npoints, ndim) -> transpose data for input
     data_transposed = numpy.array([x_data_polar, y_data_polar]).T  # transpose moves angle orientation from CCW to CW
-    triang = DelaunayTriangulation(data_transposed)
-    # create interpolation object
-    interp = LinearNDInterpolator(triang, intensity_data_masked.flat)
     # create grid of positions for interpolation: neg to pos as x/y data polar
     # contain now values from -output_size/2 to +output_size/2
     xi, yi = numpy.meshgrid(numpy.linspace(-output_size/2, output_size/2, output_size),
                             numpy.linspace(-output_size/2, output_size/2, output_size))
+    grid = numpy.column_stack((xi.ravel(), yi.ravel()))
 
-    # interpolate
-    qz = interp(xi, yi)
-    # polar coordinate transformation starts with 0 at horizontal axis by definition
-    qz = numpy.rot90(qz)  # rotate by 90 degrees CCW so we start 0 at top (angles will be CW orientated)
-    qz[numpy.isnan(qz)] = 0  # remove NaNs created during interpolation
-    assert numpy.all(qz > -1)  # there should be no negative values, some very small due to interpolation are possible
-    qz[qz < 0] = 0  # all negative values (due to interpolation or wrong background subtraction) set to zero
-
-    # plot the data
-    # plt.figure()
-    # plt.plot(theta_data_polar, phi_data_polar)
-    #
-    # plt.figure()
-    # plt.plot(triang.points[:, 0], triang.points[:, 1])
-    #
-    # plt.figure()
-    # plt.plot(triang.points[:, 0], triang.points[:, 1], 'o')
-    # plt.triplot(triang.points[:, 0], triang.points[:, 1], triang.simplices.copy())
-    # plt.title("delaunay tesselation (triangulation)")
-
-    result = model.DataArray(qz, data.metadata)
-
-    return result
+    return _ComputeInterpolationMatrix(data_transposed, px_masked, weights,
+                                       circle_mask.size, grid)
 
 
 def AngleResolved2Rectangular(data, output_size, hole=True):
@@ -259,10 +356,35 @@ def AngleResolved2Rectangular(data, output_size, hole=True):
     :parameter hole: (boolean) Crop the pole if True
     :returns: (model.DataArray) converted image in equirectangular view
     """
+    output_size = tuple(output_size)
+    key = ("rectangular", output_size) + _GetGeometryKey(data, hole)
+    matrix = _projection_cache.get(key)
+    if matrix is None:
+        matrix = _ComputeRectangularMatrix(data, output_size, hole)
+        _projection_cache[key] = matrix
+
+    qz = _ApplyProjection(matrix, data, output_size)
+    qz[numpy.isnan(qz)] = 0  # remove NaNs (from the input data) but keep negative values
+
+    result = model.DataArray(qz, data.metadata)
+
+    return result
 
+
+def _ComputeRectangularMatrix(data, output_size, hole):
+    """
+    Computes the conversion of an angle resolved image to equirectangular projection
+    :parameter data: (model.DataArray) The image, as for AngleResolved2Rectangular()
+    :parameter output_size: (int, int) The size of the output (theta, phi)
+    :parameter hole: (boolean) Crop the pole if True
+    :returns: (scipy.sparse.csr_matrix) matrix of shape (theta * phi, number of
+      pixels in data)
+    """
     # calculate the corresponding theta and phi angles based on the geometrical properties
     # of the mirror for each px on the raw data
-    theta_data, phi_data, intensity_data, circle_mask_dilated = _ExtractAngleInformation(data, hole)
+    theta_data, phi_data, omega, circle_mask, circle_mask_dilated = _ExtractAngleGeometry(data, hole)
+    weights = numpy.where(circle_mask, 1 / omega, 0).ravel()
+    px_index = numpy.arange(circle_mask.size).reshape(circle_mask.shape)
 
     # extend the data range to take care of edge effects during interpolation step
     # extend the range of phi from 0 - 2pi to -2pi to 2pi to take care of periodicity of phi
@@ -278,7 +400,7 @@ def AngleResolved2Rectangular(data, output_size, hole=True):
     # circle_mask_dilated_2 = numpy.append(numpy.append(circle_mask_dilated[:, -num:], circle_mask_dilated, axis=1),
     #                                      circle_mask_dilated[:, :num], axis=1)
 
-    # So triple the data for theta, intensity and mask, and extend phi to cover the range from -2pi to +2pi
+    # So triple the data for theta, pixel index and mask, and extend phi to cover the range from -2pi to +2pi
     # for interpolation only use the data from -pi to +3pi, which is sufficient to take care of most edge effects
     low_border = int(phi_data.shape[1] - phi_data.shape[1]/2 + 1)
     high_border = int(phi_data.shape[1]*2 + phi_data.shape[1]/2 - 1)
@@ -287,44 +409,34 @@ def AngleResolved2Rectangular(data, output_size, hole=True):
                        numpy.append(phi_data - 2 * math.pi, phi_data, axis=1),
                        phi_data + 2 * math.pi, axis=1)[:, low_border: high_border]  # -pi to +3pi
     theta_data_doubled = numpy.tile(theta_data, (1, 3))[:, low_border: high_border]
-    intensity_data_doubled = numpy.tile(intensity_data, (1, 3))[:, low_border: high_border]
+    px_index_doubled = numpy.tile(px_index, (1, 3))[:, low_border: high_border]
     circle_mask_dilated_doubled = numpy.tile(circle_mask_dilated, (1, 3))[:, low_border: high_border]
 
     # Crop the raw input data based on the mirror mask (circle_mask) to save memory and improve runtime.
     # We use a dilated mask for cropping to avoid edge effects during triangulation.
-    # The additional data points (due to dilation) will be set to zero during the interpolation step by intensity_data.
+    # The additional data points (due to dilation) will be set to zero during the interpolation step by the weights.
     theta_data_masked = theta_data_doubled[circle_mask_dilated_doubled]  # list containing values from 0 to +pi/2
     phi_data_masked = phi_data_doubled[circle_mask_dilated_doubled]  # list containing values from -pi to + 3pi
-    intensity_data_masked = intensity_data_doubled[circle_mask_dilated_doubled]
+    px_masked = px_index_doubled[circle_mask_dilated_doubled]
 
     # Multiple theta-phi combinations will be mapped to the same px in the output image after polar-transformation.
     # Therefore, not all px in the output image are populated.
     # Moreover, the data is masked with the mirror shape (mask_circle).
     # Therefore, we perform a delaunay triangulation of the given data points.
-    # The delaunay object is passed to the interpolator with the corresponding intensity values (intensity_data).
-    # The interpolator also receives a meshgrid (set of coordinates) of the size specified for the output image.
-    # The input data points (theta and phi) are mapped on the meshgrid. As the meshgrid contains much more positions
-    # compared to the input data points, the interpolator fills up the empty grid positions with intensity values.
-    # These intensity values are interpolated from the intensity values of the positions spanning the triangle they
-    # are contained in (triangle from delaunay triangulation).
-    # Grid positions located outside of any delaunay triangle are set to NaN.
+    # Each position of the meshgrid (set of coordinates) of the size specified for the output image
+    # is interpolated from the intensity values of the positions spanning the triangle it is
+    # contained in (triangle from delaunay triangulation).
+    # Grid positions located outside of any delaunay triangle are set to 0.
 
     # Note: delaunay triangulation input points: ndarray of floats, shape (npoints, ndim) -> transpose data for input
     data_transposed = numpy.array([phi_data_masked, theta_data_masked]).T
-    triang = DelaunayTriangulation(data_transposed)
-    # create interpolation object
-    interp = LinearNDInterpolator(triang, intensity_data_masked.flat)
     # create grid of positions for interpolation
     xi, yi = numpy.meshgrid(numpy.linspace(0, 2 * numpy.pi, output_size[1]),
                             numpy.linspace(0, numpy.pi / 2, output_size[0]))
+    grid = numpy.column_stack((xi.ravel(), yi.ravel()))
 
-    # interpolate
-    qz = interp(xi, yi)
-    qz[numpy.isnan(qz)] = 0  # remove NaNs created during interpolation but keep negative values 
-
-    result = model.DataArray(qz, data.metadata)
-
-    return result
+    return _ComputeInterpolationMatrix(data_transposed, px_masked, weights,
+                                       circle_mask.size, grid)
 
 
 def ARBackgroundSubtract(data):
@@ -364,24 +476,6 @@ def ARBackgroundSubtract(data):
     return result
 
 
-def _CropHalfCircle(data, pixel_size, pole_pos, offset_radius=0, hole=True):
-    """
-    Crops the image to half circle shape based on focus_distance, xmax,
-      parabola_f, and hole_diameter
-    :parameter data: (model.DataArray) The data array with the image
-    :parameter pixel_size: (float, float) effective pixel sie = sensor_pixel_size * binning / magnification
-    :parameter pole_pos: (float, float) x/y coordinates of the pole (MD_AR_POLE)
-    :parameter offset_radius: (int) offset of the radius in px to dilate the mask (takes care of edge effects
-    during triangulation and interpolation steps)
-    :parameter hole: (boolean) Crop the area around the pole if True
-    :returns: (model.DataArray) Cropped image
-    """
-    # Create mirror mask and apply to the image
-    circle_mask = _CreateMirrorMask(data, pixel_size, pole_pos, offset_radius, hole)
-    image = numpy.where(circle_mask, data, 0)
-    return image
-
-
 def _CreateMirrorMask(data, pixel_size, pole_pos, offset_radius=0, hole=True):
     """
     Creates half circle mask (i.e. True inside half circle, False outside) based on
@@ -342,7 +342,9 @@ def get_tile_md_pos(i, tile_size, tileda, origda):
     # center of the image in pixels
     img_center = img_shape / 2
 
-    tile_shape = [tileda.shape[dims.index('X')], tileda.shape[dims.index('Y')]]
+    # The tile can have less dimensions than the original image (eg, YX vs CTZYX)
+    tile_dims = tile_md.get(model.MD_DIMS, "CTZYX"[-tileda.ndim::])
+    tile_shape = [tileda.shape[tile_dims.index('X')], tileda.shape[tile_dims.index('Y')]]
     # center of the tile in pixels
     tile_center_pixels = numpy.array([
         i[0] * tile_size[0] + tile_shape[0]/2,
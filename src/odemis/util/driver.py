@@ -23,8 +23,10 @@ from __future__ import division
 
 from Pyro4.errors import CommunicationError
 import collections
+import ctypes
 import logging
 import math
+import numpy
 from odemis import model
 import os
 import re
@@ -241,3 +243,102 @@ def get_backend_status():
         return BACKEND_DEAD
 
     return BACKEND_DEAD
+
+
+class _PooledBuffer(object):
+    """
+    Owner of the memory of the arrays pointing to a buffer of a FrameBufferPool.
+    As it's the base of all these arrays (and their views), it's deleted only
+    when the last of them is deleted, at which point the buffer is given back
+    to the pool.
+    """
+    def __init__(self, pool, cbuffer, array):
+        self._pool = pool
+        self._cbuffer = cbuffer
+        self.__array_interface__ = array.__array_interface__
+
+    def __del__(self):
+        self._pool.put(self._cbuffer)
+
+
+class FrameBufferPool(object):
+    """
+    Recycles the buffers receiving the frames of a camera. Instead of allocating
+    a new buffer for each frame, the buffers are taken back once all the arrays
+    using them are deleted, and handed out again for the next frames.
+    The pool only keeps buffers of one size: when a buffer of a different size
+    is requested (eg, the resolution changed), all the free buffers are dropped.
+    If no buffer is free, a new one is allocated.
+    """
+
+    def __init__(self, max_free=4, alignment=64):
+        """
+        max_free (0 < int): maximum number of free buffers kept. More buffers
+          can be in use, but they are not kept once they are released.
+        alignment (0 < int): alignment of the address of each buffer, in bytes
+        """
+        self._max_free = max_free
+        self._alignment = alignment
+        self._key = None  # ctype, length of the buffers in the pool
+        self._free = []
+        # Reentrant, as a buffer can be released by the GC while the lock is held
+        self._lock = threading.RLock()
+
+        # Statistics
+        self.num_reused = 0  # number of buffers handed out from the pool
+        self.num_missed = 0  # number of buffers allocated
+
+    def get(self, ctype, length):
+        """
+        Provides a buffer from the pool, or a new one if the pool is empty.
+        ctype (ctypes type): type of each element (eg, c_uint16)
+        length (int): number of elements
+        return (ctypes array of ctype * length): the buffer, with undefined content.
+          It's given back to the pool when the last array created by as_array()
+          is deleted, or by calling put().
+        """
+        key = (ctype, length)
+        with self._lock:
+            if key != self._key:
+                self._key = key
+                self._free = []
+            if self._free:
+                self.num_reused += 1
+                return self._free.pop()
+            self.num_missed += 1
+
+        # Allocate a bit more, to be able to align the start of the buffer
+        size = ctypes.sizeof(ctype) * length
+        raw = (ctypes.c_byte * (size + self._alignment))()
+        offset = -ctypes.addressof(raw) % self._alignment
+        return (ctype * length).from_buffer(raw, offset)  # raw is kept referenced
+
+    def put(self, cbuffer):
+        """
+        Gives back a buffer to the pool. It must not be used afterwards.
+        cbuffer (ctypes array): a buffer provided by get()
+        """
+        key = (cbuffer._type_, len(cbuffer))
+        with self._lock:
+            if key == self._key and len(self._free) < self._max_free:
+                self._free.append(cbuffer)
+
+    def as_array(self, cbuffer, shape, metadata=None, ctype=None):
+        """
+        Converts a buffer of the pool to a DataArray, without copy. The buffer
+        is given back to the pool when the DataArray (and all its views) are
+        deleted. The buffer must not be used directly afterwards.
+        cbuffer (ctypes array): a buffer provided by get()
+        shape (tuple of int): shape of the array (in numpy order)
+        metadata (None or dict): metadata of the DataArray
+        ctype (None or ctypes type): type of the elements of the array. If None,
+          it's the same as the buffer.
+        return (DataArray): the array pointing to the buffer
+        """
+        if ctype is None:
+            ctype = cbuffer._type_
+        p = ctypes.cast(cbuffer, ctypes.POINTER(ctype))
+        ndbuffer = numpy.ctypeslib.as_array(p, tuple(shape))
+        owner = _PooledBuffer(self, cbuffer, ndbuffer)
+        return model.DataArray(numpy.asarray(owner), metadata)
+
@@ -28,6 +28,7 @@ import logging
 import math
 import numpy
 from odemis import model
+from odemis.util import LRUCache
 import scipy.ndimage
 import cv2
 from odemis.util.conversion import get_img_transformation_matrix
@@ -231,6 +232,109 @@ def histogram(data, irange=None):
     return hist, edges
 
 
+def _subsample(data, max_samples):
+    """
+    Get a regularly strided view on the data, with not much more than the
+    given number of elements.
+    data (numpy.ndarray): any array
+    max_samples (int > 0): number of elements wanted
+    return (numpy.ndarray): a view of data (or data itself if it's small enough)
+    """
+    if data.size <= max_samples or data.ndim == 0:
+        return data
+    # Same step on each dimension
+    step = int(math.ceil((data.size / max_samples) ** (1 / data.ndim)))
+    return data[(slice(None, None, step),) * data.ndim]
+
+
+class HistogramAccumulator(object):
+    """
+    Computes the histogram of a series of images (typically, of a live stream).
+    To reduce the CPU usage, only a regular sub-sample of each image is used,
+    and the histograms of the successive images are merged with an exponential
+    decay. As the successive images are usually very similar, the result is
+    almost as good as the histogram of the whole image.
+    The histogram is kept at a reduced number of bins (compacted), which is
+    precise enough to find the optimal range (auto contrast), and quick to use.
+    In exact mode, the histogram is computed on the whole image, at full
+    resolution, as with histogram().
+    """
+
+    def __init__(self, length=1024, max_samples=2 ** 18, decay=0.5, exact=False):
+        """
+        length (0 < int): maximum number of bins of the histogram (not used in
+          exact mode)
+        max_samples (0 < int): maximum number of pixels used per image
+        decay (0 <= float < 1): weight of the previous histogram when merging
+          the histogram of a new image. 0 means no merge.
+        exact (bool): if True, all the pixels are used, the histogram is
+          not compacted, and not merged with the previous ones. IOW, it's
+          exactly the histogram of the last image (eg, for acquisitions).
+        """
+        self.length = length
+        self.max_samples = max_samples
+        self.decay = decay
+        self.exact = exact
+        self.reset()
+
+    def reset(self):
+        """
+        Forget about the previous images
+        """
+        self.hist = numpy.empty(0)
+        self.edges = None
+
+    def update(self, data, irange=None):
+        """
+        Add a new image to the histogram
+        data (numpy.ndarray of numbers): greyscale image
+        irange (None or tuple of 2 unsigned int): min/max values to be found
+          in the data. None => auto (min, max will be detected from the data)
+        return hist, edges:
+         hist (ndarray 1D of 0<=float or int): number of pixels with the given
+           value, per image. Typically "length" bins (or a little bit more if
+           the original number of bins is not a multiple of it). In exact mode,
+           it's the full histogram, as returned by histogram().
+         edges (tuple of numbers): lowest and highest bound of the histogram.
+           Same as for histogram().
+        """
+        if self.exact:
+            hist, edges = histogram(data, irange)
+            self.hist = hist
+            self.edges = edges
+            return hist, edges
+
+        data = _subsample(data, self.max_samples)
+        hist, edges = histogram(data, irange)
+
+        if hist.size > self.length:
+            # Only compact by a divisor of the size, so that edges stay identical
+            f = hist.size // self.length
+            while hist.size % f:
+                f -= 1
+            hist = compactHistogram(hist, hist.size // f)
+
+        if self.decay > 0 and self.edges == edges and self.hist.shape == hist.shape:
+            # Note: the weights are normalised, so the values stay in the same
+            # order of magnitude as one (sub-sampled) image.
+            hist = self.hist * self.decay + hist * (1 - self.decay)
+        else:
+            hist = hist.astype(numpy.float64)
+
+        self.hist = hist
+        self.edges = edges
+        return hist, edges
+
+    def findOptimalRange(self, outliers=0):
+        """
+        Find the intensity range fitting best the latest images. See
+          findOptimalRange() for more information.
+        outliers (0<float<0.5): ratio of outliers to discard (on both side).
+        return (tuple of 2 values): the range (min and max values)
+        """
+        return findOptimalRange(self.hist, self.edges, outliers)
+
+
 def guessDRange(data):
     """
     Guess the data range of the data given.
@@ -272,6 +376,85 @@ def isClipping(data, drange=None):
     return (drange[1] in data)
 
 
+# Maximum number of entries of a look-up table used to convert to RGB. Data
+# needing bigger LUTs is converted by computing each pixel value.
+LUT_MAX_LENGTH = 2 ** 16
+# The most recently used look-up tables (uint8 ndarray of shape N x 3). It
+# avoids recomputing them when the same settings are used for each new image
+# (eg, live stream). Each takes at most 192 KB.
+_lut_cache = LRUCache(max_items=16)
+
+
+def _getLUTLength(dtype, bpp, irange):
+    """
+    Find out how many entries the look-up table should have to convert data
+    dtype (numpy.dtype): integer type of the data
+    bpp (None or int): number of bits actually used in the data
+    irange (tuple of 2 int): min/max intensities mapped to black/white
+    return (None or int): number of entries, or None if no look-up table
+     should be used
+    """
+    if dtype.kind == "u":
+        # Values above irange[1] are clipped to the last entry
+        maxv = irange[1]
+        if bpp is not None and 0 < bpp < dtype.itemsize * 8:
+            # Not needed to support values above the hardware range
+            maxv = min(maxv, 2 ** bpp - 1)
+        length = int(maxv) + 1
+    elif dtype.kind == "i":
+        # Data is indexed as unsigned => need the whole range
+        length = 2 ** (dtype.itemsize * 8)
+    else:
+        return None
+
+    if length > LUT_MAX_LENGTH:
+        return None
+    return length
+
+
+def _computeLUT(dtype, length, irange, tint):
+    """
+    Compute the look-up table to convert data to RGB. It gives the same
+    results as the standard conversion (ie, values rounded down).
+    dtype (numpy.dtype): integer type of the data
+    length (int): number of entries
+    irange (tuple of 2 int): min/max intensities mapped to black/white
+    tint (tuple of 3 int): RGB colour of the white
+    return (ndarray of shape length x 3 of uint8): the RGB value for each index
+    """
+    if dtype.kind == "i":
+        # The index is the data seen as unsigned
+        udtype = numpy.dtype("u%d" % dtype.itemsize)
+        vals = numpy.arange(length, dtype=udtype).view(dtype)
+    else:
+        vals = numpy.arange(length)
+
+    b = 255.99 / (irange[1] - irange[0])
+    grey = vals.clip(irange[0], irange[1]).astype(numpy.float64)
+    grey -= irange[0]
+    grey *= b
+    grey = grey.astype(numpy.uint8)
+    lut = numpy.empty((length, 3), dtype=numpy.uint8)
+    if tint == (255, 255, 255):
+        lut[:] = grey[:, numpy.newaxis]
+    else:
+        for i, t in enumerate(tint):
+            numpy.multiply(grey, t / 255, out=lut[:, i], casting="unsafe")
+    return lut
+
+
+def _getLUT(dtype, length, irange, tint):
+    """
+    Same as _computeLUT(), but uses a cache of the recent LUTs
+    """
+    key = (dtype.str, length, irange[0], irange[1], tint)
+    lut = _lut_cache.get(key)
+    if lut is None:
+        lut = _computeLUT(dtype, length, irange, tint)
+        _lut_cache[key] = lut
+    return lut
+
+
 # TODO: try to do cumulative histogram value mapping (=histogram equalization)?
 # => might improve the greys, but might be "too" clever
 def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
@@ -290,9 +473,11 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
     """
     # TODO: handle signed values
     assert(len(data.shape) == 2) # => 2D with greyscale
+    tint = tuple(tint)
 
     # Discard the DataArray aspect and just get the raw array, to be sure we
     # don't get a DataArray as result of the numpy operations
+    md = getattr(data, "metadata", {})
     data = data.view(numpy.ndarray)
 
     # fit it to 8 bits and update brightness and contrast at the same time
@@ -328,6 +513,18 @@ def DataArray2RGB(data, irange=None, tint=(255, 255, 255)):
                 else:
                     irange = (irange[0], irange[0] + 1)
 
+            # Look-up table: all the computation is done once per possible
+            # value, and the conversion is just a gather in the table.
+            lutl = _getLUTLength(data.dtype, md.get(model.MD_BPP), irange)
+            if lutl is not None:
+                lut = _getLUT(data.dtype, lutl, (int(irange[0]), int(irange[1])), tint)
+                if data.dtype.kind == "i":
+                    data = data.view("u%d" % data.itemsize)
+                rgb = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
+                # clip => values above the last entry get the last entry
+                numpy.take(lut, data, axis=0, out=rgb, mode="clip")
+                return rgb
+
             if img_fast:
                 try:
                     # only (currently) supports uint16
@@ -29,10 +29,16 @@ Odemis. If not, see http://www.gnu.org/licenses/.
 from __future__ import division
 
 import logging
+import numpy
 from numpy.polynomial import polynomial
 from odemis import model
 
 
+# Parameters of the spike removal
+SPIKE_MARGIN = 1  # number of pixels left and right of spike that are also corrected
+SPIKE_SPACING = 3  # when spikes are considered to be two separate spikes
+
+
 def get_wavelength_per_pixel(da):
     """
     Computes the wavelength for each pixel along the C dimension
@@ -207,3 +213,270 @@ def coefficients_to_dataarray(coef):
     da.metadata[model.MD_WL_LIST] = wl_list
 
     return da
+
+
+def remove_spikes(data, threshold=8, chunk_size=None, out=None):
+    """
+    Detects and removes extreme peaks (spikes) in spectral data. Such peaks are
+    typically caused by cosmic rays hitting the CCD during acquisition.
+    The spike detection is performed by comparing the signal differential
+    with the average differential in the whole data. If the differential for a
+    given pixel exceeds the threshold, it will be marked as a spike. Subsequently,
+    the identified pixels are replaced by a linear interpolation of the
+    neighbouring pixels in the spectrum.
+    data (numpy.array of shape C...): the spectra, with the spectrum on the
+      first dimension. Each spectrum is corrected independently.
+    threshold (float > 0): sensitivity of the detection (the lower, the more
+      sensitive), compared to the root mean square of the differential.
+    chunk_size (None or 0 < int): maximum number of spectra processed at once,
+      to limit the memory usage. If None, all the spectra are processed at once.
+      Note that the mean differential is then summed chunk per chunk, which can
+      change its last bits compared to processing all the data at once.
+    out (None or numpy.array): where to store the corrected data. It can be
+      the data itself, for an in-place correction. If None, a copy is made.
+    returns:
+       corrected_data (numpy.array of same shape as data)
+       pixel_corrected (int): number of spectra corrected
+       spikes corrected (int): number of spikes corrected
+    """
+    if out is None:
+        out = data.copy()
+    else:
+        if not out.flags.c_contiguous:
+            raise ValueError("out must be a C-contiguous array")
+        if out is not data:
+            out[...] = data
+
+    nc = data.shape[0]
+    if nc < 2:
+        return out, 0, 0
+    # A 2D view, with each spectrum on a column (works as long as data is C-contiguous)
+    specdat = out.reshape(nc, -1)
+    nspec = specdat.shape[1]
+    if chunk_size is None:
+        chunk_size = nspec
+
+    # this diff calculation requires higher numerical precision than 16 bits because it is squared.
+    # 32 uint should be good enough as the max diff < 2**16. However for the summation of ms_step it is more convenient to use float32.
+    ndiff = (nc - 1) * nspec
+    if chunk_size >= nspec:
+        diffspec = numpy.diff(numpy.float32(specdat), axis=0) ** 2
+        ms_step = (diffspec / ndiff).sum()
+    else:
+        diffspec = None
+        ms_step = 0
+        for i in range(0, nspec, chunk_size):
+            d = numpy.diff(numpy.float32(specdat[:, i:i + chunk_size]), axis=0) ** 2
+            ms_step += (d / ndiff).sum(dtype=numpy.float64)
+
+    # We are now calculating the threshold based on the global average.
+    # Using a more local average could help identifying spikes
+    # more precisely although but it is more involved and possibly overkill
+    spike_threshold = ms_step * threshold ** 2
+
+    npixels = 0  # number of corrected pixels (aka single spectrum)
+    nspikes = 0  # spike counter
+    for i in range(0, nspec, chunk_size):
+        chunk = specdat[:, i:i + chunk_size]
+        if diffspec is None:
+            dchunk = numpy.diff(numpy.float32(chunk), axis=0) ** 2
+        else:
+            dchunk = diffspec
+        np, ns = _remove_spikes_chunk(chunk, dchunk > spike_threshold)
+        npixels += np
+        nspikes += ns
+
+    logging.debug("Number of corrected scan pixels %s", npixels)
+    logging.debug("Number of corrected spikes %s", nspikes)
+    return out, npixels, nspikes
+
+
+def _remove_spikes_chunk(specdat, is_spike):
+    """
+    Replaces the spikes by a linear interpolation, on all the spectra at once.
+    specdat (numpy.array of shape C, N): the N spectra, updated in place
+    is_spike (numpy.array of bool of shape C-1, N): True where the differential
+      of the spectrum is above the threshold
+    returns:
+       pixel_corrected (int): number of spectra corrected
+       spikes corrected (int): number of spikes corrected
+    """
+    # Only one step that deviates is no spike
+    corrected = numpy.flatnonzero(numpy.count_nonzero(is_spike, axis=0) > 1)
+    if not corrected.size:
+        return 0, 0
+
+    # All the spike indices, ordered by spectrum, and then by index
+    pix, idx = numpy.nonzero(is_spike[:, corrected].T)
+    pix = corrected[pix]
+
+    # A new spike starts at each new spectrum, or after a large gap in the indices
+    starts = numpy.ones(idx.shape, dtype=bool)
+    starts[1:] = (pix[1:] != pix[:-1]) | (numpy.diff(idx) > SPIKE_SPACING)
+    first = numpy.flatnonzero(starts)
+    last = numpy.append(first[1:], idx.size) - 1
+
+    # Range of each spike, including the margin, limited to the spectrum
+    nc = specdat.shape[0]
+    spike_pix = pix[first]
+    lo = numpy.maximum(idx[first] - SPIKE_MARGIN, 0)
+    hi = numpy.minimum(idx[last] + SPIKE_MARGIN, nc - 1)
+
+    # Linear interpolation between the two edges (computed as numpy.linspace() does)
+    length = hi - lo + 1  # always >= 2
+    start = specdat[lo, spike_pix].astype(numpy.float64)
+    stop = specdat[hi, spike_pix].astype(numpy.float64)
+    step = (stop - start) / (length - 1)
+
+    spike_n = numpy.repeat(numpy.arange(length.size), length)
+    offset = numpy.arange(spike_n.size) - numpy.repeat(numpy.cumsum(length) - length, length)
+    line = offset * step[spike_n] + start[spike_n]
+    ends = numpy.cumsum(length) - 1
+    line[ends] = stop  # exactly the last value
+    # The spikes never overlap (nor share an edge), so they can all be written at once
+    specdat[lo[spike_n] + offset, spike_pix[spike_n]] = line
+
+    return corrected.size, first.size
+
+
+def _get_accumulator_dtype(dtype, n):
+    """
+    Find the type which can hold the sum of n values of a given type.
+    dtype (numpy.dtype): the type of the values
+    n (0 < int): number of values summed
+    returns (numpy.dtype): a type which doesn't overflow. For floating point
+      values, it's a 32-bit float, so only partial sums can be stored without
+      losing too much precision (cf CumulativeSpectrum).
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in "biu":
+        idt = numpy.iinfo(dtype) if dtype.kind != "b" else numpy.iinfo(numpy.uint8)
+        if idt.min >= 0:
+            candidates = (numpy.uint32, numpy.uint64)
+        else:
+            candidates = (numpy.int32, numpy.int64)
+        for adt in candidates:
+            aidt = numpy.iinfo(adt)
+            if n * idt.max <= aidt.max and n * idt.min >= aidt.min:
+                return numpy.dtype(adt)
+        return numpy.dtype(candidates[-1])
+    elif dtype.kind == "c":
+        return numpy.dtype(numpy.complex64)
+    else:
+        return numpy.dtype(numpy.float32)
+
+
+# Number of spectrum indices over which the cumulative sum of floating point
+# data is computed, before restarting from 0 (cf CumulativeSpectrum)
+CUMSUM_BLOCK_LENGTH = 32
+
+
+class CumulativeSpectrum(object):
+    """
+    Cumulative sum of spectral data along the spectrum dimension. Once it's
+    computed, the average over any band of the spectrum only costs one
+    subtraction per pixel.
+    For floating point data, to keep the index small, the cumulative sums are
+    stored as 32-bit floats. As the band sums are differences of large sums,
+    that would not be precise enough, so the cumulative sum restarts from 0 at
+    every block of CUMSUM_BLOCK_LENGTH indices, and the sum of all the previous
+    blocks is stored separately, as 64-bit floats.
+    """
+
+    def __init__(self, data, chunk_length=None):
+        """
+        data (numpy.array of shape C...): the spectra, with the spectrum on the
+          first dimension. It can also be any object with a .shape, a .dtype,
+          and which returns an array when sliced along the first dimension
+          (eg, calibration.CompensatedSpectrum).
+        chunk_length (None or 0 < int): number of spectrum indices read at once
+          from the data. If None, all the data is read at once.
+        """
+        nc = data.shape[0]
+        self.shape = data.shape
+        self.dtype = _get_accumulator_dtype(data.dtype, nc)
+        if self.dtype.kind in "biu":
+            self._block = nc  # Integer sums are exact => just one block
+        else:
+            self._block = min(CUMSUM_BLOCK_LENGTH, nc)
+        nblocks = (nc + self._block - 1) // self._block
+        # For each block, the sum of all the data before it
+        odt = numpy.complex128 if self.dtype.kind == "c" else numpy.float64
+        self._offsets = numpy.zeros((nblocks,) + data.shape[1:], dtype=odt)
+        # Starts with 0, so that the sum of the band [l, h] is always
+        # cumsum[h + 1] - cumsum[l] (+ the offsets of their blocks)
+        self._cumsum = numpy.empty((nc + 1,) + data.shape[1:], dtype=self.dtype)
+        self._cumsum[0] = 0
+        if chunk_length is None:
+            chunk_length = nc
+        for c in range(0, nc, chunk_length):
+            ce = min(c + chunk_length, nc)
+            chunk = data[c:ce]
+            # Split the chunk at the boundaries of the blocks
+            i = c
+            while i < ce:
+                b = i // self._block
+                ie = min(ce, (b + 1) * self._block)
+                part = chunk[i - c:ie - c]
+                out = self._cumsum[i + 1:ie + 1]
+                numpy.cumsum(part, axis=0, dtype=self.dtype, out=out)
+                if i % self._block:
+                    out += self._cumsum[i]  # continue the block
+                if b + 1 < nblocks:
+                    self._offsets[b + 1] += numpy.sum(part, axis=0, dtype=odt)
+                    if ie % self._block == 0:  # block complete
+                        self._offsets[b + 1] += self._offsets[b]
+                i = ie
+        self._mean_spectrum = None
+
+    def _get_block(self, i):
+        """
+        i (0 <= int <= C): index in the cumulative sum
+        return (int): the index of the block of the given cumulative sum
+        """
+        return max(0, i - 1) // self._block
+
+    def sum(self, low, high):
+        """
+        Compute the sum of the values within a band
+        low (0 <= int): first index of the band
+        high (low <= int < C): last index of the band (included)
+        returns (numpy.array of shape ...): the sum for each pixel
+        """
+        if not 0 <= low <= high < self.shape[0]:
+            raise ValueError("Band %d -> %d is not within 0 -> %d" %
+                             (low, high, self.shape[0] - 1))
+        lb, hb = self._get_block(low), self._get_block(high + 1)
+        if lb == hb:
+            return self._cumsum[high + 1] - self._cumsum[low]
+        s = self._offsets[hb] + self._cumsum[high + 1]
+        s -= self._offsets[lb]
+        s -= self._cumsum[low]
+        return s
+
+    def mean(self, low, high):
+        """
+        Compute the average of the values within a band
+        low (0 <= int): first index of the band
+        high (low <= int < C): last index of the band (included)
+        returns (numpy.array of float of shape ...): the average for each pixel
+        """
+        s = self.sum(low, high)
+        if s.dtype.kind in "fc":
+            s /= (high - low + 1)  # s is a new array, so can be reused
+            return s
+        return s / (high - low + 1)
+
+    def mean_spectrum(self):
+        """
+        Compute the spectrum averaged over all the pixels
+        returns (numpy.array of float of shape C): the average for each index
+        """
+        # Only computed once, as the data doesn't change
+        if self._mean_spectrum is None:
+            nc = self.shape[0]
+            cumsum = self._cumsum.reshape(nc + 1, -1).mean(axis=1, dtype=numpy.float64)
+            offsets = self._offsets.reshape(self._offsets.shape[0], -1).mean(axis=1)
+            blocks = [self._get_block(i) for i in range(nc + 1)]
+            self._mean_spectrum = numpy.diff(cumsum + offsets[blocks])
+        return self._mean_spectrum
@@ -114,6 +114,29 @@ class TestAngleResolvedDataConversion(unittest.TestCase):
 
         numpy.testing.assert_allclose(result, desired_output[0], atol=1e-07)
 
+    def test_cache(self):
+        """
+        Tests that the projection is only computed once for a given geometry
+        """
+        angleres._projection_cache.clear()
+        data = self.white_data_512
+        result = angleres.AngleResolved2Polar(data, 201)
+        self.assertEqual(len(angleres._projection_cache), 1)
+
+        # Same geometry, different intensities => same projection
+        data2 = model.DataArray(data * 2, data.metadata.copy())
+        result2 = angleres.AngleResolved2Polar(data2, 201)
+        self.assertEqual(len(angleres._projection_cache), 1)
+        numpy.testing.assert_allclose(result2, result * 2)
+
+        # Different pole => different projection
+        data2.metadata[model.MD_AR_POLE] = (280, 260)
+        angleres.AngleResolved2Polar(data2, 201)
+        self.assertEqual(len(angleres._projection_cache), 2)
+
+        angleres.AngleResolved2Rectangular(data, (90, 360))
+        self.assertEqual(len(angleres._projection_cache), 3)
+
     def test_uint16_input(self):
         """
         Tests for input of DataArray with uint16 ndarray.
@@ -26,7 +26,10 @@ from odemis import model
 import odemis
 from odemis.util import test
 from odemis.util.driver import getSerialDriver, speedUpPyroConnect, readMemoryUsage,\
-    get_linux_version
+    get_linux_version, FrameBufferPool
+import ctypes
+import gc
+import numpy
 import os
 import time
 import unittest
@@ -82,6 +85,61 @@ class TestDriver(unittest.TestCase):
                 v = get_linux_version()
 
 
+
+class TestFrameBufferPool(unittest.TestCase):
+
+    def test_recycle(self):
+        pool = FrameBufferPool(max_free=2, alignment=64)
+        cbuf = pool.get(ctypes.c_uint16, 100 * 200)
+        self.assertEqual(ctypes.addressof(cbuf) % 64, 0)
+        self.assertEqual(ctypes.sizeof(cbuf), 100 * 200 * 2)
+        self.assertEqual((pool.num_reused, pool.num_missed), (0, 1))
+        addr = ctypes.addressof(cbuf)
+
+        da = pool.as_array(cbuf, (100, 200), {model.MD_EXP_TIME: 1})
+        del cbuf
+        self.assertEqual(da.shape, (100, 200))
+        self.assertEqual(da.dtype, numpy.uint16)
+        self.assertEqual(da.metadata[model.MD_EXP_TIME], 1)
+        da[:] = 3
+
+        # As long as a view is used, the buffer is not recycled
+        view = da[10:20, ::2]
+        del da
+        cbuf2 = pool.get(ctypes.c_uint16, 100 * 200)
+        self.assertNotEqual(ctypes.addressof(cbuf2), addr)
+        self.assertEqual((pool.num_reused, pool.num_missed), (0, 2))
+        self.assertEqual(view[0, 0], 3)
+
+        del view
+        gc.collect()
+        cbuf3 = pool.get(ctypes.c_uint16, 100 * 200)
+        self.assertEqual(ctypes.addressof(cbuf3), addr)
+        self.assertEqual((pool.num_reused, pool.num_missed), (1, 2))
+
+        # Different type for the array
+        da = pool.as_array(cbuf3, (100, 100), ctype=ctypes.c_uint32)
+        self.assertEqual(da.dtype, numpy.uint32)
+
+    def test_max_free(self):
+        pool = FrameBufferPool(max_free=2)
+        das = [pool.as_array(pool.get(ctypes.c_uint8, 1000), (10, 100)) for i in range(5)]
+        self.assertEqual(pool.num_missed, 5)
+        del das
+        gc.collect()
+
+        # Only 2 buffers kept
+        cbufs = [pool.get(ctypes.c_uint8, 1000) for i in range(5)]
+        self.assertEqual((pool.num_reused, pool.num_missed), (2, 8))
+
+        # Changing the size drops the free buffers
+        for b in cbufs:
+            pool.put(b)
+        pool.get(ctypes.c_uint8, 2000)
+        pool.get(ctypes.c_uint8, 1000)
+        self.assertEqual((pool.num_reused, pool.num_missed), (2, 10))
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -301,6 +301,63 @@ class TestHistogram(unittest.TestCase):
         numpy.testing.assert_array_equal(hist, nchist)
 
 
+class TestHistogramAccumulator(unittest.TestCase):
+
+    def test_exact(self):
+        depth = 4096
+        size = (1024, 965)
+        grey_img = numpy.zeros(size, dtype="uint16") + 1500
+        grey_img[0, 0] = 0
+        grey_img[0, 1] = depth - 1
+
+        hacc = img.HistogramAccumulator(length=1024, exact=True)
+        hist, edges = hacc.update(grey_img, (0, depth - 1))
+        # Not compacted: same as the histogram of the whole image
+        self.assertEqual(len(hist), depth)
+        self.assertEqual(hist[1500], numpy.prod(size) - 2)
+        self.assertEqual(edges, (0, depth - 1))
+        self.assertEqual(numpy.sum(hist), numpy.prod(size))
+        self.assertEqual(hist[0], 1)
+        self.assertEqual(hist[-1], 1)
+
+        # Next image is independent
+        grey_img[0, 1] = 0
+        hist, edges = hacc.update(grey_img, (0, depth - 1))
+        self.assertEqual(hist[0], 2)
+        self.assertEqual(hist[-1], 0)
+
+    def test_subsample(self):
+        depth = 4096
+        size = (2048, 2048)
+        grey_img = numpy.random.randint(1000, 3000, size).astype(numpy.uint16)
+
+        hacc = img.HistogramAccumulator(length=1024, max_samples=2 ** 16)
+        hist, edges = hacc.update(grey_img, (0, depth - 1))
+        self.assertEqual(len(hist), 1024)
+        self.assertEqual(edges, (0, depth - 1))
+        self.assertLessEqual(numpy.sum(hist), 2 ** 16)
+
+        ehist, eedges = img.histogram(grey_img, (0, depth - 1))
+        rng = hacc.findOptimalRange(0)
+        erng = img.findOptimalRange(ehist, eedges, 0)
+        # Precision is limited by the bin size (4) and the sub-sampling
+        self.assertAlmostEqual(rng[0], erng[0], delta=8)
+        self.assertAlmostEqual(rng[1], erng[1], delta=8)
+
+        # Merge with a new image: the histogram is a mix of both
+        grey_img2 = numpy.zeros(size, dtype=numpy.uint16) + 4000
+        hist2, edges = hacc.update(grey_img2, (0, depth - 1))
+        self.assertAlmostEqual(numpy.sum(hist2), numpy.sum(hist), delta=numpy.sum(hist) * 0.01)
+        self.assertGreater(hist2[4000 // 4], 0)
+        self.assertGreater(hist2[2000 // 4], 0)
+        self.assertAlmostEqual(hacc.findOptimalRange(0)[1], 4000, delta=4)
+
+        # New range => forget the previous images
+        hist3, edges = hacc.update(grey_img2, (0, 2 * depth - 1))
+        self.assertEqual(edges, (0, 2 * depth - 1))
+        self.assertEqual(numpy.count_nonzero(hist3), 1)
+
+
 class TestDataArray2RGB(unittest.TestCase):
     @staticmethod
     def CountValues(array):
@@ -468,6 +525,71 @@ class TestDataArray2RGB(unittest.TestCase):
         # ±1, to handle the value shifts by the standard converter to handle floats
         numpy.testing.assert_almost_equal(rgb, rgb_nc_back, decimal=0)
 
+    def test_fast_float(self):
+        """Test the look-up table conversion is faster than the one of floats"""
+        data = numpy.ones((251, 200), dtype="uint16")
+        data[:, :] = range(200)
+        data[2, :] = 56
+        data[200, 2] = 3
+
+        data_f = data.astype(numpy.float64) # float cannot be treated by look-up table
+
+        # convert to RGB
+        hist, edges = img.histogram(data)
+        irange = img.findOptimalRange(hist, edges, 1 / 256)
+        tstart = time.time()
+        for i in range(10):
+            rgb = img.DataArray2RGB(data, irange)
+        fast_dur = time.time() - tstart
+
+        tstart = time.time()
+        for i in range(10):
+            rgb_f = img.DataArray2RGB(data_f, irange)
+        std_dur = time.time() - tstart
+
+        print("Time fast conversion = %g s, standard = %g s" % (fast_dur, std_dur))
+        self.assertLess(fast_dur, std_dur)
+        # Same rounding
+        numpy.testing.assert_array_equal(rgb, rgb_f)
+
+    def test_lut(self):
+        """Test the look-up table conversion on all the integer types"""
+        shape = (256, 301)
+        tint = (0, 73, 255)
+        for dtype, irange in (("uint8", (25, 135)),
+                              ("int8", (-100, 12)),
+                              ("uint16", (100, 3000)),
+                              ("int16", (-1000, 5000)),
+                              ("uint32", (10, 40000)),
+                              ("int64", (-50, 60)),  # Too big for a LUT
+                              ):
+            idt = numpy.iinfo(dtype)
+            data = numpy.random.randint(max(idt.min, irange[0] - 100),
+                                        min(idt.max, irange[1] + 100),
+                                        shape).astype(dtype)
+            # The reference is computed by the standard conversion
+            data_f = data.astype(numpy.float64)
+            for t in ((255, 255, 255), tint):
+                out = img.DataArray2RGB(data, irange, tint=t)
+                out_f = img.DataArray2RGB(data_f, irange, tint=t)
+                self.assertEqual(out.shape, shape + (3,))
+                numpy.testing.assert_array_equal(out, out_f)
+
+                # Second time, the LUT is in the cache => same result
+                out2 = img.DataArray2RGB(data, irange, tint=t)
+                numpy.testing.assert_array_equal(out, out2)
+
+        # BPP limits the LUT, but it still works with data above the range
+        data = model.DataArray(numpy.zeros(shape, dtype=numpy.uint16) + 1000,
+                               {model.MD_BPP: 12})
+        data[0, 0] = 4095
+        data[0, 1] = 0
+        data[0, 2] = 5000  # Shouldn't happen, but handled as the max value
+        out = img.DataArray2RGB(data, (0, 65535))
+        numpy.testing.assert_array_equal(out[0, 1], [0, 0, 0])
+        numpy.testing.assert_array_equal(out[0, 0], [15, 15, 15])
+        numpy.testing.assert_array_equal(out[0, 2], [15, 15, 15])
+
     def test_tint(self):
         """test with tint (on the fast path)"""
         size = (1024, 1024)
@@ -87,5 +87,165 @@ class TestCoefToDA(unittest.TestCase):
         numpy.testing.assert_equal(da[:, 0, 0, 0, 0], dcalib)
         numpy.testing.assert_equal(da.metadata[model.MD_WL_LIST], wl_calib * 1e-9)
 
+
+
+def remove_spikes_loop(specdat, spikestep):
+    """
+    Reference implementation of the spike removal, spectrum per spectrum
+    specdat (numpy.array of shape CYX): the data, updated in place
+    """
+    diffspec = numpy.diff(numpy.float32(specdat), axis=0) ** 2
+    size = numpy.shape(diffspec)
+    ms_step = (diffspec / numpy.prod(size)).sum()
+    threshold = ms_step * spikestep ** 2
+    npixels = 0
+    nspikes = 0
+    for ii in range(size[1]):
+        for jj in range(size[2]):
+            spec = specdat[:, ii, jj]
+            spike_indices = numpy.argwhere(diffspec[:, ii, jj] > threshold)
+            num_spike_indices = numpy.size(spike_indices)
+            if num_spike_indices <= 1:
+                continue
+            npixels += 1
+            spike_indices = numpy.squeeze(spike_indices)
+            spike_edges = numpy.argwhere(numpy.diff(spike_indices) > spectrum.SPIKE_SPACING)
+            spike_edges = numpy.append(spike_edges, num_spike_indices - 1)
+            for pp, se in enumerate(spike_edges):
+                nspikes += 1
+                if pp == 0:
+                    spike_indices1 = spike_indices[0:(se + 1)]
+                else:
+                    spike_indices1 = spike_indices[(spike_edges[pp - 1] + 1):(se + 1)]
+                min_edge = spike_indices1.min() - spectrum.SPIKE_MARGIN
+                max_edge = spike_indices1.max() + spectrum.SPIKE_MARGIN
+                if min_edge > 0 and max_edge < size[0]:
+                    line = numpy.linspace(spec[min_edge], spec[max_edge], (max_edge - min_edge) + 1)
+                    spec[min_edge:max_edge + 1] = line
+                elif min_edge <= 0:
+                    line = numpy.linspace(spec[0], spec[max_edge], max_edge + 1)
+                    spec[0:max_edge + 1] = line
+                elif max_edge >= size[0]:
+                    line = numpy.linspace(spec[min_edge], spec[size[0]], size[0] - min_edge + 1)
+                    spec[min_edge:size[0] + 1] = line
+
+    return specdat, npixels, nspikes
+
+
+class TestRemoveSpikes(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        shape = (300, 1, 1, 20, 30)
+        data = numpy.random.poisson(200, shape).astype(numpy.uint16)
+        # Add some spikes: single pixels, wide ones, close to each other and
+        # at the borders of the spectrum
+        for c, w in ((50, 1), (100, 3), (106, 1), (0, 2), (298, 2), (150, 1), (160, 1)):
+            ys = numpy.random.randint(0, shape[3], 20)
+            xs = numpy.random.randint(0, shape[4], 20)
+            data[c:c + w, 0, 0, ys, xs] += 5000
+        self.data = model.DataArray(data)
+
+    def test_identical(self):
+        exp, exp_npixels, exp_nspikes = remove_spikes_loop(self.data[:, 0, 0].copy(), 8)
+        self.assertGreater(exp_nspikes, 0)
+
+        corrected, npixels, nspikes = spectrum.remove_spikes(self.data, 8)
+        self.assertEqual(corrected.shape, self.data.shape)
+        self.assertEqual(npixels, exp_npixels)
+        self.assertEqual(nspikes, exp_nspikes)
+        numpy.testing.assert_array_equal(corrected[:, 0, 0], exp)
+
+    def test_chunks(self):
+        corrected, npixels, nspikes = spectrum.remove_spikes(self.data, 8)
+
+        data = self.data.copy()
+        corrected_c, npixels_c, nspikes_c = spectrum.remove_spikes(data, 8, chunk_size=7, out=data)
+        self.assertIs(corrected_c, data)
+        self.assertEqual(npixels_c, npixels)
+        self.assertEqual(nspikes_c, nspikes)
+        numpy.testing.assert_array_equal(corrected_c, corrected)
+
+    def test_speed(self):
+        data = numpy.random.poisson(200, (1024, 1, 1, 64, 64)).astype(numpy.uint16)
+        data[500, 0, 0, ::3, ::5] += 5000
+        data[501, 0, 0, ::3, ::5] += 5000
+
+        startt = time.time()
+        exp = remove_spikes_loop(data[:, 0, 0].copy(), 8)
+        dur_loop = time.time() - startt
+
+        startt = time.time()
+        corrected = spectrum.remove_spikes(data, 8)
+        dur = time.time() - startt
+        logging.info("Spike removal took %g s, compared to %g s spectrum per spectrum",
+                     dur, dur_loop)
+        numpy.testing.assert_array_equal(corrected[0][:, 0, 0], exp[0])
+        self.assertLess(dur, dur_loop)
+
+class TestCumulativeSpectrum(unittest.TestCase):
+
+    def test_band_mean(self):
+        numpy.random.seed(42)
+        for dtype in (numpy.uint16, numpy.int16, numpy.float32):
+            data = (numpy.random.random((200, 20, 30)) * 1000).astype(dtype)
+            index = spectrum.CumulativeSpectrum(data)
+            self.assertEqual(index.shape, data.shape)
+            for low, high in ((0, 0), (0, 199), (12, 57), (199, 199)):
+                exp = numpy.mean(data[low:high + 1], axis=0)
+                numpy.testing.assert_allclose(index.mean(low, high), exp, rtol=1e-5)
+
+            exp = data.reshape(data.shape[0], -1).mean(axis=1)
+            numpy.testing.assert_allclose(index.mean_spectrum(), exp, rtol=1e-5)
+
+            with self.assertRaises(ValueError):
+                index.mean(10, 200)
+
+    def test_accumulator(self):
+        # uint16 doesn't overflow on 32 bits, as long as there are not too many values
+        data = numpy.full((1024, 4, 4), 2 ** 16 - 1, dtype=numpy.uint16)
+        index = spectrum.CumulativeSpectrum(data)
+        self.assertEqual(index.dtype, numpy.uint32)
+        numpy.testing.assert_array_equal(index.sum(0, 1023), 1024 * (2 ** 16 - 1))
+
+        index = spectrum.CumulativeSpectrum(data.astype(numpy.uint32))
+        self.assertEqual(index.dtype, numpy.uint64)
+
+    def test_float_precision(self):
+        """
+        Floating point data is indexed on 32 bits, without losing precision on
+        narrow bands, even far in the spectrum
+        """
+        numpy.random.seed(42)
+        data = numpy.random.random((1000, 8, 8)) * 1000 + 1e4
+        for chunk_length in (None, 7, 100):
+            index = spectrum.CumulativeSpectrum(data, chunk_length)
+            self.assertEqual(index.dtype, numpy.float32)
+            for low, high in ((0, 0), (31, 32), (32, 32), (63, 64), (995, 999),
+                              (999, 999), (0, 999), (100, 163)):
+                exp = numpy.mean(data[low:high + 1], axis=0)
+                numpy.testing.assert_allclose(index.mean(low, high), exp, rtol=1e-5)
+
+            exp = data.reshape(data.shape[0], -1).mean(axis=1)
+            numpy.testing.assert_allclose(index.mean_spectrum(), exp, rtol=1e-5)
+
+    def test_speed(self):
+        data = numpy.random.poisson(200, (1024, 64, 128)).astype(numpy.uint16)
+        index = spectrum.CumulativeSpectrum(data)
+
+        startt = time.time()
+        for low in range(0, 512, 16):
+            numpy.mean(data[low:low + 512], axis=0)
+        dur_mean = time.time() - startt
+
+        startt = time.time()
+        for low in range(0, 512, 16):
+            index.mean(low, low + 511)
+        dur = time.time() - startt
+        logging.info("Band average took %g s, compared to %g s with numpy.mean()",
+                     dur, dur_mean)
+        self.assertLess(dur, dur_mean)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+'''
+Created on 18 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+from __future__ import division
+
+import numpy
+from odemis.util.timeseries import TimeSeriesBuffer
+import unittest
+
+
+class TestTimeSeriesBuffer(unittest.TestCase):
+
+    def test_append(self):
+        buf = TimeSeriesBuffer(10)
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.snapshot().shape, (0, 2))
+
+        for i in range(5):
+            buf.append(i * 10, i)
+        self.assertEqual(len(buf), 5)
+        snap = buf.snapshot()
+        numpy.testing.assert_array_equal(snap[:, 0], [0, 10, 20, 30, 40])
+        numpy.testing.assert_array_equal(snap[:, 1], [0, 1, 2, 3, 4])
+
+    def test_capacity(self):
+        buf = TimeSeriesBuffer(10)
+        for i in range(105):
+            buf.append(i, i)
+        self.assertEqual(len(buf), 10)
+        numpy.testing.assert_array_equal(buf.snapshot()[:, 1], range(95, 105))
+
+        # Bulk append larger than the capacity
+        buf.extend(range(200, 225), range(200, 225))
+        self.assertEqual(len(buf), 10)
+        numpy.testing.assert_array_equal(buf.snapshot()[:, 0], range(215, 225))
+
+        with self.assertRaises(ValueError):
+            buf.extend([1, 2], [3])
+
+    def test_grow(self):
+        """
+        The capacity increases as needed, up to the maximum capacity
+        """
+        buf = TimeSeriesBuffer(4, 20)
+        buf.extend(range(4), range(4))
+        snap = buf.snapshot()
+        buf.extend(range(4, 10), range(4, 10))
+        self.assertEqual(len(buf), 10)
+        self.assertEqual(buf.capacity, 16)
+        numpy.testing.assert_array_equal(buf.snapshot()[:, 0], range(10))
+        numpy.testing.assert_array_equal(snap[:, 0], range(4))
+
+        # When the maximum is reached, the oldest samples are dropped
+        for i in range(10, 50):
+            buf.append(i, i)
+        self.assertEqual(buf.capacity, 20)
+        self.assertEqual(len(buf), 20)
+        numpy.testing.assert_array_equal(buf.snapshot()[:, 1], range(30, 50))
+
+        with self.assertRaises(ValueError):
+            TimeSeriesBuffer(10, 5)
+
+    def test_window(self):
+        buf = TimeSeriesBuffer(100)
+        buf.extend(numpy.arange(50), numpy.arange(50) * 0.1)
+        numpy.testing.assert_array_equal(buf.snapshot(since=4.0)[:, 0], range(40, 50))
+
+        buf.discard_older(2.0)
+        self.assertEqual(len(buf), 30)
+        self.assertEqual(buf.snapshot()[0, 0], 20)
+
+        buf.clear()
+        self.assertEqual(len(buf), 0)
+
+    def test_snapshot_unchanged(self):
+        """
+        A snapshot is not modified when new samples are added
+        """
+        buf = TimeSeriesBuffer(8)
+        buf.extend(range(8), range(8))
+        snap = buf.snapshot()
+        expected = snap.copy()
+        with self.assertRaises(ValueError):
+            snap[0, 0] = 12  # read-only
+
+        for i in range(8, 100):
+            buf.append(i, i)
+            buf.discard_older(i - 5)
+        numpy.testing.assert_array_equal(snap, expected)
+        numpy.testing.assert_array_equal(buf.snapshot()[:, 1], range(94, 100))
+
+
+if __name__ == "__main__":
+    unittest.main()
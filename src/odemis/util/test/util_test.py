@@ -117,6 +117,52 @@ class TestExectuteTask(unittest.TestCase):
         return -1
 
 
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_max_items(self):
+        cache = util.LRUCache(max_items=3)
+        for i in range(3):
+            cache[i] = str(i)
+        self.assertEqual(len(cache), 3)
+
+        # Access the oldest => the second one is now the oldest
+        self.assertEqual(cache[0], "0")
+        cache[3] = "3"
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn(1, cache)
+        self.assertIn(0, cache)
+        self.assertIsNone(cache.get(1))
+        with self.assertRaises(KeyError):
+            cache[1]
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+    def test_max_size(self):
+        cache = util.LRUCache(max_size=100, sizeof=len)
+        cache["a"] = "x" * 40
+        cache["b"] = "x" * 40
+        self.assertEqual(cache.size, 80)
+        cache["c"] = "x" * 40
+        self.assertEqual(cache.size, 80)
+        self.assertNotIn("a", cache)
+
+        # Too big for the cache => not stored
+        cache["d"] = "x" * 200
+        self.assertNotIn("d", cache)
+        self.assertEqual(cache.size, 80)
+
+        # Replace an entry
+        cache["c"] = "x" * 10
+        self.assertEqual(cache.size, 50)
+
+        cache.max_size = 20
+        self.assertEqual(cache.keys(), ["c"])
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+
 class SortedAccordingTestCase(unittest.TestCase):
 
     def test_simple(self):
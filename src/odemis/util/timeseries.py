@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 18 Oct 2026
+
+@author: Éric Piel
+
+Copyright © 2026 Éric Piel, Delmic
+
+This file is part of Odemis.
+
+Odemis is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License version 2 as published by the Free Software Foundation.
+
+Odemis is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with Odemis. If not, see http://www.gnu.org/licenses/.
+'''
+# Storage of a series of (count, date) samples, typically to show a chronogram.
+from __future__ import division, absolute_import
+
+import logging
+import numpy
+import threading
+
+
+class TimeSeriesBuffer(object):
+    """
+    Ring buffer of (count, date) samples, ordered by date.
+
+    The samples are stored in an array twice as large as the capacity. New
+    samples are always written after the last one, and when the end of the array
+    is reached, the samples still kept are moved to the beginning of a new
+    array. So adding a sample is (amortized) O(1), and the samples already
+    written are never modified. That allows snapshot() to return a view
+    (without copy), which stays valid however long the reader keeps it.
+    When the buffer is full, the capacity is doubled, up to the maximum
+    capacity. Only then, the oldest samples are dropped.
+    """
+
+    def __init__(self, capacity, max_capacity=None):
+        """
+        capacity (0 < int): initial number of samples which can be kept.
+        max_capacity (None or capacity <= int): maximum number of samples kept.
+          When more samples are added, the oldest ones are dropped. If None,
+          the capacity is fixed.
+        """
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive, got %s" % (capacity,))
+        if max_capacity is None:
+            max_capacity = capacity
+        elif max_capacity < capacity:
+            raise ValueError("Maximum capacity %s is less than the capacity %s" %
+                             (max_capacity, capacity))
+        self._capacity = capacity
+        self._max_capacity = max_capacity
+        self._buf = numpy.empty((2 * capacity, 2), dtype=numpy.float64)
+        self._start = 0  # index of the oldest sample
+        self._end = 0  # index after the newest sample
+        self._dropping = False  # True once samples were dropped, due to the capacity
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        """
+        (int): the number of samples which can currently be kept
+        """
+        return self._capacity
+
+    @property
+    def max_capacity(self):
+        return self._max_capacity
+
+    def __len__(self):
+        return self._end - self._start
+
+    def append(self, count, date):
+        """
+        Add one sample
+        count (float): the value of the sample
+        date (float): the time of the sample, it should not be older than the
+          last sample.
+        """
+        self.extend((count,), (date,))
+
+    def extend(self, counts, dates):
+        """
+        Add multiple samples at once
+        counts (iterable of floats): the values of the samples
+        dates (iterable of floats): the time of each sample, in increasing order,
+          and not older than the last sample.
+        raise ValueError: if counts and dates don't have the same length
+        """
+        counts = numpy.asarray(counts, dtype=numpy.float64).ravel()
+        dates = numpy.asarray(dates, dtype=numpy.float64).ravel()
+        if counts.shape != dates.shape:
+            raise ValueError("Got %d counts but %d dates" % (len(counts), len(dates)))
+
+        with self._lock:
+            n = len(counts)
+            if self._end - self._start + n > self._capacity:
+                self._grow(self._end - self._start + n)
+
+            if n > self._capacity:
+                # The oldest samples would be dropped immediately anyway
+                counts, dates = counts[-self._capacity:], dates[-self._capacity:]
+                n = self._capacity
+
+            if self._end + n > len(self._buf):
+                self._relocate(n)
+            self._buf[self._end:self._end + n, 0] = counts
+            self._buf[self._end:self._end + n, 1] = dates
+            self._end += n
+            if self._end - self._start > self._capacity:
+                self._start = self._end - self._capacity
+                if not self._dropping:
+                    logging.warning("Time series reached its maximum of %d samples, "
+                                    "the oldest samples are dropped", self._capacity)
+                    self._dropping = True
+
+    def _grow(self, n):
+        """
+        Increase the capacity, up to the maximum capacity, to hold the given
+        number of samples. The current array is not modified, as snapshots
+        might still use it.
+        Must be called with the lock taken.
+        n (0 < int): number of samples to hold
+        """
+        capacity = self._capacity
+        while capacity < n and capacity < self._max_capacity:
+            capacity = min(capacity * 2, self._max_capacity)
+        if capacity == self._capacity:
+            return
+
+        logging.debug("Increasing time series capacity to %d samples", capacity)
+        buf = numpy.empty((2 * capacity, 2), dtype=self._buf.dtype)
+        length = self._end - self._start
+        buf[:length] = self._buf[self._start:self._end]
+        self._buf = buf
+        self._start = 0
+        self._end = length
+        self._capacity = capacity
+
+    def _relocate(self, n):
+        """
+        Move the samples to a new array, with enough space for n new samples.
+        The current array is not modified, as snapshots might still use it.
+        Must be called with the lock taken.
+        n (0 <= int <= capacity): number of samples to be added
+        """
+        keep = min(self._end - self._start, self._capacity - n)
+        buf = numpy.empty_like(self._buf)
+        buf[:keep] = self._buf[self._end - keep:self._end]
+        self._buf = buf
+        self._start = 0
+        self._end = keep
+
+    def discard_older(self, date):
+        """
+        Drop all the samples older than the given time
+        date (float): all the samples before this time are dropped
+        """
+        with self._lock:
+            dates = self._buf[self._start:self._end, 1]
+            self._start += numpy.searchsorted(dates, date)
+
+    def clear(self):
+        """
+        Drop all the samples
+        """
+        with self._lock:
+            self._start = self._end
+
+    def snapshot(self, since=None):
+        """
+        Get the samples currently stored, without copy.
+        since (float or None): if provided, only the samples at this time or
+          later are returned.
+        return (numpy.ndarray of shape (N, 2)): read-only view on the samples,
+          with the count on the first column and the date on the second one,
+          in chronological order. It's not affected by the later changes of the
+          buffer.
+        """
+        with self._lock:
+            buf, start, end = self._buf, self._start, self._end
+
+        if since is not None:
+            start += numpy.searchsorted(buf[start:end, 1], since)
+        view = buf[start:end]
+        view.flags.writeable = False
+        return view